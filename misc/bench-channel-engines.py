@@ -0,0 +1,63 @@
+from __future__ import print_function, unicode_literals
+import os, sys, time, tempfile, shutil
+from wormhole.server.database import get_db
+from wormhole.server.rendezvous import Rendezvous, SidedMessage
+from wormhole.server.rendezvous_memory import MemoryRendezvous
+
+# Compare the two Rendezvous channel-state engines, by driving the same
+# claim/open/add/release/close sequence that a pair of 'wormhole send' and
+# 'wormhole receive' clients would provoke, directly against the
+# AppNamespace/Mailbox API (no websockets involved). Both use a real
+# on-disk database, since the cost we care about is mostly commit/fsync.
+#
+# Run this as 'python misc/bench-channel-engines.py [NUM_PAIRS]'
+
+BODY = "%0500x" % 0 # ~250 bytes of ciphertext, hex-encoded, like PAKE/version
+
+def run_pairs(rv, num_pairs):
+    app = rv.get_app("lothar.com/wormhole/text-or-file-xfer")
+    now = time.time()
+    for i in range(num_pairs):
+        a, b = "side-a-%d" % i, "side-b-%d" % i
+        nameplate = app.allocate_nameplate(a, now)
+        mailbox_id = app.claim_nameplate(nameplate, a, now)
+        mb_a = app.open_mailbox(mailbox_id, a, now)
+        mb_a.add_message(SidedMessage(a, "pake", BODY, now, "1"))
+        app.claim_nameplate(nameplate, b, now)
+        mb_b = app.open_mailbox(mailbox_id, b, now)
+        mb_b.add_listener(b, lambda sm: None, lambda: None)
+        mb_b.add_message(SidedMessage(b, "pake", BODY, now, "2"))
+        app.release_nameplate(nameplate, a, now)
+        app.release_nameplate(nameplate, b, now)
+        for phase in ["version", "0", "1"]:
+            mb_a.add_message(SidedMessage(a, phase, BODY, now, phase))
+            mb_b.add_message(SidedMessage(b, phase, BODY, now, phase))
+        mb_b.remove_listener(b)
+        mb_a.close(a, "happy", now)
+        mb_b.close(b, "happy", now)
+
+def bench(name, rendezvous_class, num_pairs, basedir):
+    dbfile = os.path.join(basedir, "%s.sqlite" % name)
+    rv = rendezvous_class(get_db(dbfile), None, None, True)
+    start = time.time()
+    run_pairs(rv, num_pairs)
+    elapsed = time.time() - start
+    flush_start = time.time()
+    if hasattr(rv, "flush"):
+        rv.flush()
+    flush_elapsed = time.time() - flush_start
+    commands = num_pairs * 19 # client commands per pair, roughly
+    print("%-8s: %d pairs in %.3fs (%.0f commands/s), plus %.3fs flush" %
+          (name, num_pairs, elapsed, commands / elapsed, flush_elapsed))
+
+def main():
+    num_pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    basedir = tempfile.mkdtemp()
+    try:
+        bench("sqlite", Rendezvous, num_pairs, basedir)
+        bench("memory", MemoryRendezvous, num_pairs, basedir)
+    finally:
+        shutil.rmtree(basedir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+from __future__ import print_function, unicode_literals
+import os, sys, time, json, itertools, tempfile, shutil, socket, signal
+import argparse, platform, subprocess, multiprocessing
+from twisted.internet import defer, task
+from twisted.internet.defer import inlineCallbacks, returnValue
+from autobahn.twisted import websocket
+import wormhole
+from wormhole import framing
+from wormhole.transit import allocate_tcp_port
+
+# Measure the capacity of a rendezvous server. This starts a RelayServer on
+# loopback in a child process (so its CPU and memory are not mixed up with
+# the clients'), then drives simulated 'wormhole send'/'wormhole receive'
+# pairs through it over real websockets:
+#
+#  A: bind, allocate, claim, open, add(pake)
+#  B: bind, list, claim, open, add(pake), release
+#  A: release
+#  A+B: add(version), add(0), add(1), close
+#
+# Message bodies are about the size that a real file-transfer produces. Each
+# command is timed from when it is sent until its response arrives ("bind"
+# and "open" have no response of their own, so they are timed to their
+# "ack"). After the pairs are done, a batch of idle clients connect and bind,
+# to estimate the server's memory cost per connection.
+#
+# The results are written as JSON (to stdout, or --output), so they can be
+# compared between releases:
+#
+#   python misc/bench-rendezvous.py --pairs 2000 --concurrency 50 -o b.json
+#
+# With --workers N, the server is started the way 'wormhole-server start
+# --workers=N' does it (a WorkerPool, sharing one listening socket between N
+# worker processes), to see how it scales with cores. The memory and
+# database figures then cover all of the workers.
+#
+# Memory figures come from /proc, so they are null on non-Linux hosts.
+
+APPID = "lothar.com/wormhole/text-or-file-xfer"
+# plaintext sizes, before encryption and hex-encoding
+PAKE_SIZE = 80 # {"pake_v1": hex(33-byte SPAKE2 message)}
+VERSION_SIZE = 90 # encrypted {"app_versions": {}}
+OFFER_SIZE = 300 # file offer, with filename and size
+ANSWER_SIZE = 100 # file_ack
+TRANSIT_SIZE = 600 # transit hints (direct and relay)
+NONCE_AND_MAC = 24 + 16
+
+def body(size):
+    return os.urandom(size + NONCE_AND_MAC)
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[int(round(q * (len(sorted_values) - 1)))]
+
+def _rss_bytes(pid):
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except EnvironmentError:
+        pass
+    return None
+
+def _children(pid):
+    children = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except EnvironmentError:
+            continue # it went away
+        if int(fields[1]) == pid: # the ppid
+            children.append(int(name))
+    return children
+
+def rss_bytes(pid):
+    # the server, and its workers (if any)
+    rss = _rss_bytes(pid)
+    if rss is None:
+        return None
+    return rss + sum([_rss_bytes(child) or 0 for child in _children(pid)])
+
+def db_bytes(dbfiles):
+    # the -wal file holds commits that haven't been checkpointed yet
+    return sum([os.path.getsize(fn)
+                for dbfile in dbfiles for fn in [dbfile, dbfile + "-wal"]
+                if os.path.exists(fn)])
+
+class Latencies(object):
+    def __init__(self):
+        self.samples = {} # command type -> list of seconds
+    def add(self, mtype, elapsed):
+        self.samples.setdefault(mtype, []).append(elapsed)
+    def summary(self):
+        out = {}
+        for (mtype, s) in sorted(self.samples.items()):
+            s = sorted(s)
+            out[mtype] = {"count": len(s),
+                          "p50": percentile(s, 0.50),
+                          "p99": percentile(s, 0.99),
+                          "max": s[-1]}
+        return out
+
+class BenchClient(websocket.WebSocketClientProtocol):
+    def __init__(self):
+        websocket.WebSocketClientProtocol.__init__(self)
+        self._ids = itertools.count(0)
+        self._waiters = [] # (predicate, Deferred)
+        self._inbox = [] # "message" events nobody is waiting for yet
+
+    def onOpen(self):
+        self.codec = framing.codec_for(self.websocket_protocol_in_use)
+        self.factory.d.callback(self)
+
+    def onMessage(self, payload, isBinary):
+        ev = self.codec.decode(payload)
+        for w in self._waiters:
+            (predicate, d) = w
+            if predicate(ev):
+                self._waiters.remove(w)
+                d.callback(ev)
+                return
+        if ev["type"] == "message":
+            self._inbox.append(ev)
+        elif ev["type"] == "error":
+            print("server error: %r" % (ev,), file=sys.stderr)
+
+    def onClose(self, wasClean, code, reason):
+        for (predicate, d) in self._waiters:
+            d.errback(RuntimeError("connection lost: %s" % (reason,)))
+        self._waiters = []
+
+    def _wait(self, predicate):
+        d = defer.Deferred()
+        self._waiters.append((predicate, d))
+        return d
+
+    def command(self, mtype, response=None, **kwargs):
+        """Send a command, and fire with its response: either the first
+        event matching the 'response' predicate, or else its ack."""
+        kwargs["type"] = mtype
+        kwargs["id"] = msg_id = "%d" % next(self._ids)
+        if response is None:
+            response = lambda ev: ev["type"] == "ack" and ev["id"] == msg_id
+        d = self._wait(response)
+        start = time.time()
+        self.sendMessage(self.codec.encode(kwargs), self.codec.binary)
+        self.factory.commands += 1
+        def _done(ev):
+            self.factory.latencies.add(mtype, time.time() - start)
+            return ev
+        d.addCallback(_done)
+        return d
+
+    def add(self, phase, data):
+        return self.command("add", lambda ev: (ev["type"] == "message" and
+                                               ev["side"] == self.side and
+                                               ev["phase"] == phase),
+                            phase=phase, body=self.codec.body_to_wire(data))
+
+    def get_message(self, phase):
+        """Fire with the peer's message for 'phase'."""
+        match = lambda ev: (ev["type"] == "message" and
+                            ev["side"] != self.side and ev["phase"] == phase)
+        for ev in self._inbox:
+            if match(ev):
+                self._inbox.remove(ev)
+                return defer.succeed(ev)
+        return self._wait(match)
+
+class BenchFactory(websocket.WebSocketClientFactory):
+    protocol = BenchClient
+
+@inlineCallbacks
+def connect(reactor, port, binary, latencies, side):
+    protocols = framing.offered_protocols() if binary else []
+    f = BenchFactory("ws://127.0.0.1:%d/v1" % port, protocols=protocols)
+    f.d = defer.Deferred()
+    f.latencies = latencies
+    f.commands = 0
+    reactor.connectTCP("127.0.0.1", port, f)
+    c = yield f.d
+    c.side = side
+    yield c.command("bind", appid=APPID, side=side)
+    returnValue(c)
+
+@inlineCallbacks
+def sender(c, nameplate_d):
+    m = yield c.command("allocate", lambda ev: ev["type"] == "allocated")
+    nameplate_d.callback(m["nameplate"])
+    m = yield c.command("claim", lambda ev: ev["type"] == "claimed",
+                        nameplate=m["nameplate"])
+    yield c.command("open", mailbox=m["mailbox"])
+    yield c.add("pake", body(PAKE_SIZE))
+    yield c.get_message("pake")
+    yield c.command("release", lambda ev: ev["type"] == "released")
+    yield c.add("version", body(VERSION_SIZE))
+    yield c.get_message("version")
+    yield c.add("0", body(OFFER_SIZE))
+    yield c.add("1", body(TRANSIT_SIZE))
+    yield c.get_message("0")
+    yield c.get_message("1")
+    yield c.command("close", lambda ev: ev["type"] == "closed", mood="happy")
+
+@inlineCallbacks
+def receiver(c, nameplate_d):
+    nameplate = yield nameplate_d
+    yield c.command("list", lambda ev: ev["type"] == "nameplates")
+    m = yield c.command("claim", lambda ev: ev["type"] == "claimed",
+                        nameplate=nameplate)
+    yield c.command("open", mailbox=m["mailbox"])
+    yield c.get_message("pake")
+    yield c.add("pake", body(PAKE_SIZE))
+    yield c.command("release", lambda ev: ev["type"] == "released")
+    yield c.get_message("version")
+    yield c.add("version", body(VERSION_SIZE))
+    yield c.get_message("0")
+    yield c.add("0", body(ANSWER_SIZE))
+    yield c.get_message("1")
+    yield c.add("1", body(TRANSIT_SIZE))
+    yield c.command("close", lambda ev: ev["type"] == "closed", mood="happy")
+
+@inlineCallbacks
+def run_pair(reactor, args, latencies, i):
+    a, b = yield defer.gatherResults([
+        connect(reactor, args.port, args.binary, latencies, "a%d" % i),
+        connect(reactor, args.port, args.binary, latencies, "b%d" % i),
+        ])
+    nameplate_d = defer.Deferred()
+    yield defer.gatherResults([sender(a, nameplate_d),
+                               receiver(b, nameplate_d)])
+    for c in [a, b]:
+        c.transport.loseConnection()
+    returnValue(a.factory.commands + b.factory.commands)
+
+@inlineCallbacks
+def run_pairs(reactor, args, latencies):
+    pair_numbers = iter(range(args.pairs))
+    totals = []
+    @inlineCallbacks
+    def _slot():
+        for i in pair_numbers:
+            commands = yield run_pair(reactor, args, latencies, i)
+            totals.append(commands)
+    yield defer.gatherResults([_slot() for _ in range(args.concurrency)])
+    returnValue(sum(totals))
+
+@inlineCallbacks
+def run_idle(reactor, args):
+    clients = []
+    for i in range(args.idle_connections):
+        c = yield connect(reactor, args.port, args.binary, Latencies(),
+                          "idle%d" % i)
+        clients.append(c)
+    returnValue(clients)
+
+def wait_for_server(port, timeout=60):
+    # With --workers, the port is open well before the workers are ready to
+    # answer it, and the clients would give up on their websocket
+    # handshakes, so we wait for a real response.
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect(("127.0.0.1", port))
+            s.sendall(b"GET / HTTP/1.0\r\n\r\n")
+            s.settimeout(max(0.1, deadline - time.time()))
+            if s.recv(1):
+                return
+        except socket.error:
+            time.sleep(0.1)
+        finally:
+            s.close()
+    raise RuntimeError("server did not start answering on port %d" % port)
+
+@inlineCallbacks
+def bench(reactor, args, server_pid, dbfiles):
+    results = {}
+    yield task.deferLater(reactor, 1.0, lambda: None) # let the DB settle
+    db_start = db_bytes(dbfiles)
+    rss_start = rss_bytes(server_pid)
+
+    print("running %d pairs, %d at a time" % (args.pairs, args.concurrency),
+          file=sys.stderr)
+    latencies = Latencies()
+    start = time.time()
+    commands = yield run_pairs(reactor, args, latencies)
+    elapsed = time.time() - start
+    # give write-behind and group-commit a chance to reach the disk
+    yield task.deferLater(reactor, 1.0 + args.commit_window, lambda: None)
+    results["pairs"] = {"count": args.pairs,
+                        "concurrency": args.concurrency,
+                        "seconds": elapsed,
+                        "pairs_per_second": args.pairs / elapsed,
+                        "commands": commands,
+                        "commands_per_second": commands / elapsed,
+                        }
+    results["latency"] = latencies.summary()
+
+    rss_before_idle = rss_bytes(server_pid)
+    clients = []
+    if args.idle_connections:
+        print("opening %d idle connections" % args.idle_connections,
+              file=sys.stderr)
+        clients = yield run_idle(reactor, args)
+        yield task.deferLater(reactor, 1.0, lambda: None)
+    rss_after_idle = rss_bytes(server_pid)
+    per_connection = None
+    if (clients and rss_before_idle is not None and
+        rss_after_idle is not None):
+        per_connection = ((rss_after_idle - rss_before_idle) /
+                          float(len(clients)))
+    results["memory"] = {"rss_start": rss_start,
+                         "rss_after_pairs": rss_before_idle,
+                         "rss_with_idle_connections": rss_after_idle,
+                         "idle_connections": len(clients),
+                         "bytes_per_connection": per_connection,
+                         }
+    for c in clients:
+        c.transport.loseConnection()
+
+    db_end = db_bytes(dbfiles)
+    results["database"] = {"bytes_start": db_start,
+                           "bytes_end": db_end,
+                           "growth_bytes": db_end - db_start,
+                           "growth_bytes_per_pair": ((db_end - db_start) /
+                                                     float(args.pairs or 1)),
+                           }
+    returnValue(results)
+
+def serve(args):
+    # the child process: just a relay server
+    from twisted.internet import reactor
+    from wormhole.server.server import RelayServer
+    from wormhole.server.workers import WorkerPool
+    port = "tcp:%d:interface=127.0.0.1" % args.port
+    kwargs = dict(db_url=args.db, channel_engine=args.channel_engine,
+                  commit_window=args.commit_window)
+    if args.workers > 1:
+        s = WorkerPool(port, args.workers,
+                       dict(kwargs, advertise_version=None))
+    else:
+        s = RelayServer(port, None, **kwargs)
+    s.startService()
+    reactor.addSystemEventTrigger("before", "shutdown", s.stopService)
+    reactor.run()
+
+def main(reactor, args):
+    from wormhole.server.workers import per_worker_path
+    basedir = tempfile.mkdtemp()
+    dbfile = os.path.join(basedir, "relay.sqlite")
+    dbfiles = [dbfile]
+    if args.workers > 1:
+        dbfiles = [per_worker_path(dbfile, index)
+                   for index in range(args.workers)]
+    args.port = allocate_tcp_port()
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              "--serve", "--port", str(args.port),
+                              "--db", dbfile,
+                              "--channel-engine", args.channel_engine,
+                              "--commit-window", str(args.commit_window),
+                              "--workers", str(args.workers)])
+    try:
+        wait_for_server(args.port)
+    except Exception:
+        child.kill()
+        shutil.rmtree(basedir)
+        raise
+    d = bench(reactor, args, child.pid, dbfiles)
+    def _stop(res):
+        child.send_signal(signal.SIGTERM)
+        child.wait()
+        if isinstance(res, dict):
+            res["database"]["bytes_after_shutdown"] = db_bytes(dbfiles)
+        shutil.rmtree(basedir)
+        return res
+    d.addBoth(_stop)
+    def _report(results):
+        results["config"] = {"wormhole_version": wormhole.__version__,
+                             "python": platform.python_version(),
+                             "platform": platform.platform(),
+                             "channel_engine": args.channel_engine,
+                             "commit_window": args.commit_window,
+                             "workers": args.workers,
+                             "cpus": multiprocessing.cpu_count(),
+                             "protocol": "binary" if args.binary else "json",
+                             "created": time.time(),
+                             }
+        data = json.dumps(results, indent=1, sort_keys=True)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(data + "\n")
+        else:
+            print(data)
+    d.addCallback(_report)
+    return d
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(
+        description="Measure the capacity of a rendezvous server.")
+    p.add_argument("--pairs", type=int, default=500,
+                   help="number of sender/receiver pairs to run")
+    p.add_argument("--concurrency", type=int, default=20,
+                   help="number of pairs to run at the same time")
+    p.add_argument("--idle-connections", type=int, default=1000,
+                   help="idle clients to open, to measure memory use")
+    p.add_argument("--channel-engine", choices=["sqlite", "memory"],
+                   default="sqlite")
+    p.add_argument("--commit-window", type=float, default=0.0)
+    p.add_argument("--workers", type=int, default=1,
+                   help="run the server as N worker processes, like"
+                   " 'wormhole-server start --workers=N'")
+    p.add_argument("--binary", action="store_true",
+                   help="speak the compact binary protocol (needs msgpack)")
+    p.add_argument("-o", "--output", help="write JSON here, not to stdout")
+    # used internally, to start the server process
+    p.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    p.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    p.add_argument("--db", help=argparse.SUPPRESS)
+    return p.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.serve:
+        serve(args)
+    else:
+        if args.binary and not framing.offered_protocols():
+            sys.exit("--binary needs msgpack installed")
+        task.react(main, [args])
@@ -0,0 +1,276 @@
+from __future__ import print_function, unicode_literals
+import os, sys, time, json, tempfile, shutil, socket, signal
+import argparse, platform, subprocess
+from twisted.internet import defer, task, protocol
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.protocols.basic import Int32StringReceiver
+from autobahn.twisted import websocket
+import wormhole
+from wormhole import framing
+from wormhole.transit import allocate_tcp_port
+
+# Compare the CPU cost of the two rendezvous transports: websockets, and the
+# length-prefixed raw-TCP framing (the --rendezvous-tcp port, and tcp://
+# relay URLs). This starts a RelayServer on loopback in a child process,
+# listening for both, then for each transport opens --connections clients
+# that each send --messages commands, keeping --window of them in flight.
+#
+# The command is a "ping" by default, which the server answers without
+# touching any channel state, so the figures are mostly framing and
+# dispatch. '--command add' sends mailbox messages instead (each echoed back
+# to its sender), which is closer to a real wormhole but includes the
+# channel engine's costs too.
+#
+# For each transport, this reports the CPU seconds (user+system) that the
+# server process and the client process spent per message, along with the
+# wall-clock rate:
+#
+#   python misc/bench-transports.py --connections 50 --messages 2000
+#
+# Server CPU times come from /proc, so they are null on non-Linux hosts.
+
+APPID = "lothar.com/wormhole/bench-transports"
+BODY_SIZE = 300 + 24 + 16 # an encrypted file offer, with nonce and MAC
+
+def process_cpu(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except EnvironmentError:
+        return None
+    # utime and stime are fields 14 and 15, counting the pid as 1
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf(
+        str("SC_CLK_TCK")))
+
+class _Commands(object):
+    # what both bench clients share: they send commands, and count responses
+
+    def setup(self, codec):
+        self.codec = codec
+        self.done = None
+        self.sent = 0
+        self.received = 0
+        self.factory.d.callback(self)
+
+    def got(self, payload):
+        ev = self.codec.decode(payload)
+        if ev["type"] not in ("pong", "message"):
+            if ev["type"] == "error":
+                print("server error: %r" % (ev,), file=sys.stderr)
+            return
+        self.received += 1
+        if self.received == self.factory.messages:
+            self.done.callback(None)
+        elif self.sent < self.factory.messages:
+            self.send_next()
+
+    def send(self, mtype, **kwargs):
+        kwargs["type"] = mtype
+        self.send_payload(self.codec.encode(kwargs))
+
+    def send_next(self):
+        self.sent += 1
+        if self.factory.command == "ping":
+            self.send("ping", ping=self.sent)
+        else:
+            self.send("add", phase="%d" % self.sent,
+                      body=self.codec.body_to_wire(self.factory.body))
+
+    def run(self):
+        self.done = defer.Deferred()
+        for i in range(min(self.factory.window, self.factory.messages)):
+            self.send_next()
+        return self.done
+
+class WSBenchClient(_Commands, websocket.WebSocketClientProtocol):
+    def onOpen(self):
+        self.setup(framing.codec_for(self.websocket_protocol_in_use))
+    def onMessage(self, payload, isBinary):
+        self.got(payload)
+    def send_payload(self, payload):
+        self.sendMessage(payload, self.codec.binary)
+
+class WSBenchFactory(websocket.WebSocketClientFactory):
+    protocol = WSBenchClient
+
+class TCPBenchClient(_Commands, Int32StringReceiver):
+    MAX_LENGTH = framing.TCP_MAX_FRAME
+    def connectionMade(self):
+        self.sendString(framing.encode_offer(self.factory.protocols))
+        self._negotiated = False
+    def stringReceived(self, data):
+        if self._negotiated:
+            self.got(data)
+            return
+        self._negotiated = True
+        selected = framing.decode_offer(data)
+        self.setup(framing.codec_for(selected[0] if selected else None))
+    def send_payload(self, payload):
+        self.sendString(payload)
+
+class TCPBenchFactory(protocol.ClientFactory):
+    protocol = TCPBenchClient
+
+@inlineCallbacks
+def connect(reactor, args, transport, i):
+    protocols = framing.offered_protocols() if args.binary else []
+    if transport == "websocket":
+        f = WSBenchFactory("ws://127.0.0.1:%d/v1" % args.port,
+                           protocols=protocols)
+        port = args.port
+    else:
+        f = TCPBenchFactory()
+        f.protocols = protocols
+        port = args.tcp_port
+    f.d = defer.Deferred()
+    f.command = args.command
+    f.messages = args.messages
+    f.window = args.window
+    f.body = os.urandom(BODY_SIZE)
+    reactor.connectTCP("127.0.0.1", port, f)
+    c = yield f.d
+    c.send("bind", appid=APPID, side="%s%d" % (transport, i))
+    if args.command == "add":
+        c.send("open", mailbox="%s-%d" % (transport, i))
+    returnValue(c)
+
+@inlineCallbacks
+def bench_transport(reactor, args, transport, server_pid):
+    clients = yield defer.gatherResults([connect(reactor, args, transport, i)
+                                         for i in range(args.connections)])
+    server_start = process_cpu(server_pid)
+    client_start = time.process_time()
+    start = time.time()
+    yield defer.gatherResults([c.run() for c in clients])
+    elapsed = time.time() - start
+    client_cpu = time.process_time() - client_start
+    server_end = process_cpu(server_pid)
+    for c in clients:
+        c.transport.loseConnection()
+    messages = args.connections * args.messages
+    server_cpu = None
+    if server_start is not None and server_end is not None:
+        server_cpu = server_end - server_start
+    returnValue({"messages": messages,
+                 "seconds": elapsed,
+                 "messages_per_second": messages / elapsed,
+                 "server_cpu_seconds": server_cpu,
+                 "server_cpu_us_per_message": (
+                     None if server_cpu is None
+                     else 1e6 * server_cpu / messages),
+                 "client_cpu_seconds": client_cpu,
+                 "client_cpu_us_per_message": 1e6 * client_cpu / messages,
+                 })
+
+@inlineCallbacks
+def bench(reactor, args, server_pid):
+    results = {}
+    for transport in args.transports:
+        print("%s: %d connections, %d %ss each"
+              % (transport, args.connections, args.messages, args.command),
+              file=sys.stderr)
+        results[transport] = yield bench_transport(reactor, args, transport,
+                                                   server_pid)
+    returnValue(results)
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect(("127.0.0.1", port))
+            return
+        except socket.error:
+            time.sleep(0.1)
+        finally:
+            s.close()
+    raise RuntimeError("server did not start listening on port %d" % port)
+
+def serve(args):
+    # the child process: just a relay server, with both transports
+    from twisted.internet import reactor
+    from wormhole.server.server import RelayServer
+    s = RelayServer("tcp:%d:interface=127.0.0.1" % args.port, None,
+                    db_url=args.db, channel_engine="memory",
+                    rendezvous_tcp_port=("tcp:%d:interface=127.0.0.1"
+                                         % args.tcp_port))
+    s.startService()
+    reactor.addSystemEventTrigger("before", "shutdown", s.stopService)
+    reactor.run()
+
+def main(reactor, args):
+    basedir = tempfile.mkdtemp()
+    dbfile = os.path.join(basedir, "relay.sqlite")
+    args.port = allocate_tcp_port()
+    args.tcp_port = allocate_tcp_port()
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              "--serve", "--port", str(args.port),
+                              "--tcp-port", str(args.tcp_port),
+                              "--db", dbfile])
+    try:
+        wait_for_port(args.port)
+        wait_for_port(args.tcp_port)
+    except Exception:
+        child.kill()
+        shutil.rmtree(basedir)
+        raise
+    d = bench(reactor, args, child.pid)
+    def _stop(res):
+        child.send_signal(signal.SIGTERM)
+        child.wait()
+        shutil.rmtree(basedir)
+        return res
+    d.addBoth(_stop)
+    def _report(results):
+        results["config"] = {"wormhole_version": wormhole.__version__,
+                             "python": platform.python_version(),
+                             "platform": platform.platform(),
+                             "command": args.command,
+                             "connections": args.connections,
+                             "window": args.window,
+                             "protocol": "binary" if args.binary else "json",
+                             "created": time.time(),
+                             }
+        data = json.dumps(results, indent=1, sort_keys=True)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(data + "\n")
+        else:
+            print(data)
+    d.addCallback(_report)
+    return d
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(
+        description="Compare the CPU cost of the rendezvous transports.")
+    p.add_argument("--connections", type=int, default=20,
+                   help="clients to run at the same time, per transport")
+    p.add_argument("--messages", type=int, default=2000,
+                   help="commands each client sends")
+    p.add_argument("--window", type=int, default=10,
+                   help="commands each client keeps in flight")
+    p.add_argument("--command", choices=["ping", "add"], default="ping")
+    p.add_argument("--transport", dest="transports", action="append",
+                   choices=["websocket", "tcp"],
+                   help="only measure this transport (may be repeated)")
+    p.add_argument("--binary", action="store_true",
+                   help="speak the compact binary protocol (needs msgpack)")
+    p.add_argument("-o", "--output", help="write JSON here, not to stdout")
+    # used internally, to start the server process
+    p.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    p.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    p.add_argument("--tcp-port", type=int, help=argparse.SUPPRESS)
+    p.add_argument("--db", help=argparse.SUPPRESS)
+    args = p.parse_args(argv)
+    if not args.transports:
+        args.transports = ["websocket", "tcp"]
+    return args
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.serve:
+        serve(args)
+    else:
+        if args.binary and not framing.offered_protocols():
+            sys.exit("--binary needs msgpack installed")
+        task.react(main, [args])
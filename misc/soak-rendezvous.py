@@ -0,0 +1,159 @@
+from __future__ import print_function, unicode_literals
+import os, sys, gc, json, time, tempfile, shutil, argparse
+from wormhole.server.database import get_db
+from wormhole.server.rendezvous import Rendezvous, SidedMessage
+from wormhole.server.rendezvous_memory import MemoryRendezvous
+from wormhole.server.server import (CHANNEL_EXPIRATION_TIME,
+                                    EXPIRATION_CHECK_PERIOD)
+
+# Check that a long-running rendezvous server's memory use stays bounded.
+# This drives days of simulated churn through a Rendezvous, directly through
+# the Session API that the websocket protocol uses (like
+# bench-channel-engines.py, no sockets involved), with a simulated clock.
+# Every simulated minute:
+#
+#  * --pairs sender/receiver pairs complete a wormhole in the main app
+#  * --abandoned senders allocate a nameplate, open its mailbox, add their
+#    PAKE message, and disconnect without closing, so their channels are
+#    left for the pruning timer
+#  * --one-off-apps pairs use an app_id that is never seen again
+#
+# and prune_all_apps() runs every EXPIRATION_CHECK_PERIOD, as in the server.
+# RSS is sampled every simulated hour, after a gc.collect(). Once the first
+# day (the warmup) is over, it should stay flat: the script reports the
+# growth from the end of the first day to the end of the run, and exits
+# with an error if it is more than --max-growth percent.
+#
+# Run this as 'python misc/soak-rendezvous.py [--days N]'. The database is
+# on disk, with synchronous=OFF, so a few simulated days take minutes. RSS
+# comes from /proc, so this only works on Linux.
+
+MINUTE = 60
+HOUR = 60*MINUTE
+DAY = 24*HOUR
+APP_ID = "lothar.com/wormhole/text-or-file-xfer"
+BODY = "%0500x" % 0 # ~250 bytes of ciphertext, hex-encoded, like PAKE/version
+
+def rss_bytes():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise EnvironmentError("no VmRSS in /proc/self/status")
+
+def run_pair(rv, app_id, name, now):
+    a = rv.open_session(app_id, "%s-a" % name)
+    b = rv.open_session(app_id, "%s-b" % name)
+    nameplate = a.allocate(now)
+    mailbox_id = a.claim(nameplate, now)
+    a.open(mailbox_id, now, lambda sm: None, lambda: None)
+    a.add(SidedMessage("%s-a" % name, "pake", BODY, now, "1"))
+    b.list_nameplates()
+    b.claim(nameplate, now)
+    b.open(mailbox_id, now, lambda sm: None, lambda: None)
+    b.add(SidedMessage("%s-b" % name, "pake", BODY, now, "2"))
+    a.release(nameplate, now)
+    b.release(nameplate, now)
+    for phase in ["version", "0", "1"]:
+        a.add(SidedMessage("%s-a" % name, phase, BODY, now, phase))
+        b.add(SidedMessage("%s-b" % name, phase, BODY, now, phase))
+    a.close(mailbox_id, "happy", now)
+    b.close(mailbox_id, "happy", now)
+    a.disconnect()
+    b.disconnect()
+
+def abandon(rv, app_id, name, now):
+    a = rv.open_session(app_id, "%s-a" % name)
+    nameplate = a.allocate(now)
+    mailbox_id = a.claim(nameplate, now)
+    a.open(mailbox_id, now, lambda sm: None, lambda: None)
+    a.add(SidedMessage("%s-a" % name, "pake", BODY, now, "1"))
+    a.disconnect()
+
+def soak(args, dbfile):
+    db = get_db(dbfile)
+    db.execute("PRAGMA synchronous=OFF")
+    if args.channel_engine == "memory":
+        rv = MemoryRendezvous(db, None, None, True)
+    else:
+        rv = Rendezvous(db, None, None, True)
+    now = start = 1500000000.0
+    next_prune = now + EXPIRATION_CHECK_PERIOD
+    samples = [] # (simulated hours, rss, apps)
+    serial = 0
+    wall_start = time.time()
+    for minute in range(int(args.days * DAY / MINUTE)):
+        now = start + minute * MINUTE
+        for i in range(args.pairs):
+            serial += 1
+            run_pair(rv, APP_ID, "pair%d" % serial, now)
+        for i in range(args.abandoned):
+            serial += 1
+            abandon(rv, APP_ID, "gone%d" % serial, now)
+        for i in range(args.one_off_apps):
+            serial += 1
+            run_pair(rv, "soak/app-%d" % serial, "once%d" % serial, now)
+        rv.flush()
+        if now >= next_prune:
+            rv.prune_all_apps(now, now - CHANNEL_EXPIRATION_TIME)
+            next_prune += EXPIRATION_CHECK_PERIOD
+        if (minute + 1) % (HOUR // MINUTE) == 0:
+            gc.collect()
+            hours = (minute + 1) // (HOUR // MINUTE)
+            samples.append((hours, rss_bytes(), len(rv._apps)))
+            if args.verbose:
+                print("%4dh: rss %.1f MB, %d apps" %
+                      (hours, samples[-1][1] / 1e6, samples[-1][2]),
+                      file=sys.stderr)
+    stats = rv.get_stats()
+    rv.flush()
+    db.close()
+
+    warm = [rss for (hours, rss, apps) in samples if hours >= 24]
+    growth = None
+    if len(warm) > 1:
+        growth = 100.0 * (warm[-1] - warm[0]) / warm[0]
+    return {"days": args.days,
+            "channel_engine": args.channel_engine,
+            "wormholes": stats["since_reboot"]["mailboxes_total"],
+            "apps_remaining": samples[-1][2] if samples else None,
+            "active": stats["active"],
+            "rss_hourly": [rss for (hours, rss, apps) in samples],
+            "rss_growth_after_warmup_percent": growth,
+            "elapsed": time.time() - wall_start,
+            }
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(
+        description="Check that rendezvous server memory stays bounded.")
+    p.add_argument("--days", type=float, default=3.0,
+                   help="simulated days to run (the first is warmup)")
+    p.add_argument("--pairs", type=int, default=4,
+                   help="completed wormholes per simulated minute")
+    p.add_argument("--abandoned", type=int, default=1,
+                   help="abandoned channels per simulated minute")
+    p.add_argument("--one-off-apps", type=int, default=1,
+                   help="wormholes in never-seen-again app_ids per minute")
+    p.add_argument("--channel-engine", choices=["sqlite", "memory"],
+                   default="sqlite")
+    p.add_argument("--max-growth", type=float, default=10.0,
+                   help="allowed RSS growth after warmup, in percent")
+    p.add_argument("-v", "--verbose", action="store_true",
+                   help="print RSS every simulated hour, to stderr")
+    return p.parse_args(argv)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    basedir = tempfile.mkdtemp()
+    try:
+        results = soak(args, os.path.join(basedir, "relay.sqlite"))
+    finally:
+        shutil.rmtree(basedir)
+    print(json.dumps(results, indent=1, sort_keys=True))
+    growth = results["rss_growth_after_warmup_percent"]
+    if growth is not None and growth > args.max_growth:
+        print("RSS grew by %.1f%% after warmup" % growth, file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -41,8 +41,10 @@ setup(name="magic-wormhole",
       ],
       extras_require={
           ':sys_platform=="win32"': ["pypiwin32"],
+          "binary": ["msgpack >= 0.6.1"], # the compact rendezvous protocol
           "dev": ["mock", "tox", "pyflakes",
-                  "magic-wormhole-transit-relay==0.1.0"],
+                  "magic-wormhole-transit-relay==0.1.0",
+                  "msgpack >= 0.6.1"],
       },
       test_suite="wormhole.test",
       cmdclass=commands,
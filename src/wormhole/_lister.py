@@ -24,6 +24,13 @@ class Lister(object):
     # request will provoke a new server request, and the result will be
     # fresh. But if a server request is already in flight when a second API
     # request arrives, both requests will be satisfied by the same response.
+    #
+    # Newer servers let us subscribe instead (the RendezvousConnector sends
+    # "subscribe-list" rather than "list" when the server offers it). The
+    # answer arrives as rx_subscribed, and from then on the server pushes
+    # every change to us, so our copy stays fresh, and later API requests
+    # are answered from it without a round-trip. The subscription ends with
+    # the connection.
 
     @m.state(initial=True)
     def S0A_idle_disconnected(self): pass # pragma: no cover
@@ -33,6 +40,8 @@ class Lister(object):
     def S0B_idle_connected(self): pass # pragma: no cover
     @m.state()
     def S1B_wanting_connected(self): pass # pragma: no cover
+    @m.state()
+    def S2_subscribed(self): pass # pragma: no cover
 
     @m.input()
     def connected(self): pass
@@ -42,6 +51,10 @@ class Lister(object):
     def refresh(self): pass
     @m.input()
     def rx_nameplates(self, all_nameplates): pass
+    @m.input()
+    def rx_subscribed(self, all_nameplates): pass
+    @m.input()
+    def rx_nameplates_changed(self, added, removed): pass
 
     @m.output()
     def RC_tx_list(self):
@@ -52,6 +65,17 @@ class Lister(object):
         # future: change RendezvousConnector._response_handle_nameplates to
         # get them
         self._I.got_nameplates(all_nameplates)
+    @m.output()
+    def record_nameplates(self, all_nameplates):
+        self._nameplates = set(all_nameplates)
+    @m.output()
+    def update_nameplates(self, added, removed):
+        self._nameplates.difference_update(removed)
+        self._nameplates.update(added)
+        self._I.got_nameplates(set(self._nameplates))
+    @m.output()
+    def I_got_current(self):
+        self._I.got_nameplates(set(self._nameplates))
 
     S0A_idle_disconnected.upon(connected, enter=S0B_idle_connected, outputs=[])
     S0B_idle_connected.upon(lost, enter=S0A_idle_disconnected, outputs=[])
@@ -71,3 +95,20 @@ class Lister(object):
                                outputs=[RC_tx_list])
     S1B_wanting_connected.upon(rx_nameplates, enter=S0B_idle_connected,
                                outputs=[I_got_nameplates])
+
+    S0B_idle_connected.upon(rx_subscribed, enter=S2_subscribed,
+                            outputs=[record_nameplates, I_got_nameplates])
+    S0B_idle_connected.upon(rx_nameplates_changed, enter=S0B_idle_connected,
+                            outputs=[])
+    S1B_wanting_connected.upon(rx_subscribed, enter=S2_subscribed,
+                               outputs=[record_nameplates, I_got_nameplates])
+    S1B_wanting_connected.upon(rx_nameplates_changed,
+                               enter=S1B_wanting_connected, outputs=[])
+    S2_subscribed.upon(refresh, enter=S2_subscribed, outputs=[I_got_current])
+    S2_subscribed.upon(rx_nameplates_changed, enter=S2_subscribed,
+                       outputs=[update_nameplates])
+    S2_subscribed.upon(rx_subscribed, enter=S2_subscribed,
+                       outputs=[record_nameplates, I_got_nameplates])
+    S2_subscribed.upon(rx_nameplates, enter=S2_subscribed,
+                       outputs=[record_nameplates, I_got_nameplates])
+    S2_subscribed.upon(lost, enter=S0A_idle_disconnected, outputs=[])
@@ -5,19 +5,20 @@ from attr import attrs, attrib
 from attr.validators import provides, instance_of, optional
 from zope.interface import implementer
 from twisted.python import log
-from twisted.internet import defer, endpoints, task
+from twisted.internet import defer, endpoints, task, protocol
 from twisted.application import internet
+from twisted.protocols.basic import Int32StringReceiver
 from autobahn.twisted import websocket
 from . import _interfaces, errors
-from .util import (bytes_to_hexstr, hexstr_to_bytes,
-                   bytes_to_dict, dict_to_bytes)
+from .util import bytes_to_hexstr
+from .framing import (JSON, offered_protocols, codec_for, TCP_MAX_FRAME,
+                      encode_offer, decode_offer)
 
 class WSClient(websocket.WebSocketClientProtocol):
     def onConnect(self, response):
-        # this fires during WebSocket negotiation, and isn't very useful
-        # unless you want to modify the protocol settings
-        #print("onConnect", response)
-        pass
+        # this fires during WebSocket negotiation, and tells us whether the
+        # server accepted our offer of the binary protocol
+        self._RC.ws_negotiated(response.protocol)
 
     def onOpen(self, *args):
         # this fires when the WebSocket is ready to go. No arguments
@@ -26,7 +27,6 @@ class WSClient(websocket.WebSocketClientProtocol):
         self._RC.ws_open(self)
 
     def onMessage(self, payload, isBinary):
-        assert not isBinary
         try:
             self._RC.ws_message(payload)
         except:
@@ -57,6 +57,40 @@ class WSFactory(websocket.WebSocketClientFactory):
         #proto.wormhole_open = False
         return proto
 
+class TCPClient(Int32StringReceiver):
+    # the raw-TCP transport, for tcp:// relay URLs (see framing.py). To the
+    # RendezvousConnector, this looks just like a WSClient.
+    MAX_LENGTH = TCP_MAX_FRAME
+
+    def connectionMade(self):
+        self._negotiated = False
+        self.sendString(encode_offer(offered_protocols()))
+
+    def stringReceived(self, data):
+        if self._negotiated:
+            self._RC.ws_message(data)
+            return
+        self._negotiated = True
+        selected = decode_offer(data)
+        self._RC.ws_negotiated(selected[0] if selected else None)
+        self._RC.ws_open(self)
+
+    def sendMessage(self, payload, isBinary=False):
+        self.sendString(payload)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self._RC.ws_close(False, None, reason.getErrorMessage())
+
+class TCPFactory(protocol.Factory):
+    protocol = TCPClient
+    def __init__(self, RC):
+        self._RC = RC
+
+    def buildProtocol(self, addr):
+        proto = protocol.Factory.buildProtocol(self, addr)
+        proto._RC = self._RC
+        return proto
+
 @attrs
 @implementer(_interfaces.IRendezvousConnector)
 class RendezvousConnector(object):
@@ -74,9 +108,16 @@ class RendezvousConnector(object):
 
         self._trace = None
         self._ws = None
-        f = WSFactory(self, self._url)
-        f.setProtocolOptions(autoPingInterval=60, autoPingTimeout=600)
+        self._codec = JSON
+        self._can_subscribe = False # set by each connection's welcome
         p = urlparse(self._url)
+        if p.scheme == "tcp":
+            if p.port is None:
+                raise ValueError("tcp:// relay URLs need a port")
+            f = TCPFactory(self)
+        else:
+            f = WSFactory(self, self._url, protocols=offered_protocols())
+            f.setProtocolOptions(autoPingInterval=60, autoPingTimeout=600)
         ep = self._make_endpoint(p.hostname, p.port or 80)
         self._connector = internet.ClientService(ep, f)
         faf = None if self._have_made_a_successful_connection else 1
@@ -121,7 +162,7 @@ class RendezvousConnector(object):
     def tx_add(self, phase, body):
         assert isinstance(phase, type("")), type(phase)
         assert isinstance(body, type(b"")), type(body)
-        self._tx("add", phase=phase, body=bytes_to_hexstr(body))
+        self._tx("add", phase=phase, body=self._codec.body_to_wire(body))
 
     def tx_release(self, nameplate):
         self._tx("release", nameplate=nameplate)
@@ -142,7 +183,14 @@ class RendezvousConnector(object):
 
     # from Lister
     def tx_list(self):
-        self._tx("list")
+        # a server that offers it will keep us up to date, so the Lister
+        # won't need to ask again (until we reconnect). The welcome arrives
+        # just after connected(), so a Lister that was already waiting asks
+        # the old way first.
+        if self._can_subscribe:
+            self._tx("subscribe-list")
+        else:
+            self._tx("list")
 
     # from Code
     def tx_allocate(self):
@@ -164,6 +212,7 @@ class RendezvousConnector(object):
         self._debug("R.connected")
         self._have_made_a_successful_connection = True
         self._ws = proto
+        self._can_subscribe = False
         try:
             self._tx("bind", appid=self._appid, side=self._side)
             self._N.connected()
@@ -175,8 +224,11 @@ class RendezvousConnector(object):
             raise
         self._debug("R.connected finished notifications")
 
+    def ws_negotiated(self, protocol):
+        self._codec = codec_for(protocol)
+
     def ws_message(self, payload):
-        msg = bytes_to_dict(payload)
+        msg = self._codec.decode(payload)
         if msg["type"] != "ack":
                 self._debug("R.rx(%s %s%s)" %
                             (msg["type"], msg.get("phase",""),
@@ -187,7 +239,8 @@ class RendezvousConnector(object):
         if self._debug_record_inbound_f:
             self._debug_record_inbound_f(msg)
         mtype = msg["type"]
-        meth = getattr(self, "_response_handle_"+mtype, None)
+        meth = getattr(self, "_response_handle_"+mtype.replace("-", "_"),
+                       None)
         if not meth:
             # make tests fail, but real application will ignore it
             log.err(errors._UnknownMessageTypeError("Unknown inbound message type %r" % (msg,)))
@@ -244,18 +297,17 @@ class RendezvousConnector(object):
         kwargs["id"] = bytes_to_hexstr(os.urandom(2))
         kwargs["type"] = mtype
         self._debug("R.tx(%s %s)" % (mtype.upper(), kwargs.get("phase", "")))
-        payload = dict_to_bytes(kwargs)
+        payload = self._codec.encode(kwargs)
         self._timing.add("ws_send", _side=self._side, **kwargs)
-        self._ws.sendMessage(payload, False)
+        self._ws.sendMessage(payload, self._codec.binary)
 
     def _response_handle_allocated(self, msg):
         nameplate = msg["nameplate"]
         assert isinstance(nameplate, type("")), type(nameplate)
         self._A.rx_allocated(nameplate)
 
-    def _response_handle_nameplates(self, msg):
+    def _nameplate_ids(self, nameplates):
         # we get list of {id: ID}, with maybe more attributes in the future
-        nameplates = msg["nameplates"]
         assert isinstance(nameplates, list), type(nameplates)
         nids = set()
         for n in nameplates:
@@ -263,8 +315,19 @@ class RendezvousConnector(object):
             nameplate_id = n["id"]
             assert isinstance(nameplate_id, type("")), type(nameplate_id)
             nids.add(nameplate_id)
+        return nids
+
+    def _response_handle_nameplates(self, msg):
         # deliver a set of nameplate ids
-        self._L.rx_nameplates(nids)
+        nids = self._nameplate_ids(msg["nameplates"])
+        if msg.get("subscribed"):
+            self._L.rx_subscribed(nids)
+        else:
+            self._L.rx_nameplates(nids)
+
+    def _response_handle_nameplates_changed(self, msg):
+        self._L.rx_nameplates_changed(self._nameplate_ids(msg["added"]),
+                                      self._nameplate_ids(msg["removed"]))
 
     def _response_handle_ack(self, msg):
         pass
@@ -279,6 +342,7 @@ class RendezvousConnector(object):
         self._B.rx_error(err, orig)
 
     def _response_handle_welcome(self, msg):
+        self._can_subscribe = "subscribe-list" in msg.get("features", [])
         self._B.rx_welcome(msg["welcome"])
 
     def _response_handle_claimed(self, msg):
@@ -290,7 +354,7 @@ class RendezvousConnector(object):
         side = msg["side"]
         phase = msg["phase"]
         assert isinstance(phase, type("")), type(phase)
-        body = hexstr_to_bytes(msg["body"]) # bytes
+        body = self._codec.body_from_wire(msg["body"]) # bytes
         self._M.rx_message(side, phase, body)
 
     def _response_handle_released(self, msg):
@@ -156,6 +156,15 @@ CommonArgs = _compose(
     click.option("--listen/--no-listen", default=True,
                  help="(debug) don't open a listening socket for Transit",
                  ),
+    click.option("--transit-streams", default=1, metavar="N",
+                 type=click.IntRange(min=1),
+                 help="stripe file transfers across up to N connections",
+                 ),
+    click.option("--transit-threads", default=0, metavar="N",
+                 type=click.IntRange(min=0),
+                 help="encrypt and decrypt file transfers in N threads, so"
+                 " they can use other cores (default: in the main thread)",
+                 ),
 )
 
 TorArgs = _compose(
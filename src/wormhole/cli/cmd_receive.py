@@ -6,7 +6,7 @@ from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.python import log
 from wormhole import create, input_with_completion, __version__
-from ..transit import TransitReceiver
+from ..transit import TransitReceiver, EncryptionPool
 from ..errors import TransferError
 from ..util import (dict_to_bytes, bytes_to_dict, bytes_to_hexstr,
                     estimate_free_space)
@@ -224,11 +224,13 @@ class Receiver:
                              no_listen=(not self.args.listen),
                              tor=self._tor,
                              reactor=self._reactor,
-                             timing=self.args.timing)
+                             timing=self.args.timing,
+                             streams=self.args.transit_streams)
         self._transit_receiver = tr
         transit_key = w.derive_key(APPID+u"/transit-key", tr.TRANSIT_KEY_LENGTH)
         tr.set_transit_key(transit_key)
 
+        tr.add_connection_abilities(sender_transit.get("abilities-v1", []))
         tr.add_connection_hints(sender_transit.get("hints-v1", []))
         receiver_abilities = tr.get_connection_abilities()
         receiver_hints = yield tr.get_connection_hints()
@@ -247,17 +249,11 @@ class Receiver:
         if "file" in them_d:
             f = self._handle_file(them_d)
             self._send_permission(w)
-            rp = yield self._establish_transit()
-            datahash = yield self._transfer_data(rp, f)
-            self._write_file(f)
-            yield self._close_transit(rp, datahash)
+            yield self._receive_data(f, self._write_file)
         elif "directory" in them_d:
             f = self._handle_directory(them_d)
             self._send_permission(w)
-            rp = yield self._establish_transit()
-            datahash = yield self._transfer_data(rp, f)
-            self._write_directory(f)
-            yield self._close_transit(rp, datahash)
+            yield self._receive_data(f, self._write_directory)
         else:
             self._msg(u"I don't know what they're offering\n")
             self._msg(u"Offer details: %r" % (them_d,))
@@ -353,6 +349,23 @@ class Receiver:
         self.args.timing.add("transit connected")
         returnValue(record_pipe)
 
+    @inlineCallbacks
+    def _receive_data(self, f, write):
+        rp = yield self._establish_transit()
+        pool = None
+        if self.args.transit_threads:
+            # decrypt on the other cores, and write and hash in a thread of
+            # its own, while this one reads from the network
+            pool = EncryptionPool(self.args.transit_threads)
+            rp.start_pipelining(pool)
+        try:
+            datahash = yield self._transfer_data(rp, f)
+            write(f)
+            yield self._close_transit(rp, datahash)
+        finally:
+            if pool:
+                yield pool.stop()
+
     @inlineCallbacks
     def _transfer_data(self, record_pipe, f):
         # now receive the rest of the owl
@@ -3,12 +3,11 @@ import os, sys, six, tempfile, zipfile, hashlib
 from tqdm import tqdm
 from humanize import naturalsize
 from twisted.python import log
-from twisted.protocols import basic
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 from ..errors import TransferError, UnsendableFileError
 from wormhole import create, __version__
-from ..transit import TransitSender
+from ..transit import TransitSender, BulkFileSender, EncryptionPool
 from ..util import dict_to_bytes, bytes_to_dict, bytes_to_hexstr
 from .welcome import handle_welcome
 
@@ -150,7 +149,8 @@ class Sender:
                                no_listen=(not args.listen),
                                tor=self._tor,
                                reactor=self._reactor,
-                               timing=self._timing)
+                               timing=self._timing,
+                               streams=args.transit_streams)
             self._transit_sender = ts
 
             # for now, send this before the main offer
@@ -207,6 +207,7 @@ class Sender:
 
     def _handle_transit(self, receiver_transit):
         ts = self._transit_sender
+        ts.add_connection_abilities(receiver_transit.get("abilities-v1", []))
         ts.add_connection_hints(receiver_transit.get("hints-v1", []))
 
     def _build_offer(self):
@@ -372,29 +373,42 @@ class Sender:
             hasher.update(data)
             progress.update(len(data))
             return data
-        fs = basic.FileSender()
-
-        with self._timing.add("tx file"):
-            with progress:
-                if filesize:
-                    # don't send zero-length files
-                    yield fs.beginFileTransfer(self._fd_to_send, record_pipe,
-                                               transform=_count_and_hash)
-
-        expected_hash = hasher.digest()
-        expected_hex = bytes_to_hexstr(expected_hash)
-        print(u"File sent.. waiting for confirmation", file=stderr)
-        with self._timing.add("get ack") as t:
-            ack_bytes = yield record_pipe.receive_record()
-            record_pipe.close()
-            ack = bytes_to_dict(ack_bytes)
-            ok = ack.get(u"ack", u"")
-            if ok != u"ok":
-                t.detail(ack="failed")
-                raise TransferError("Transfer failed (remote says: %r)" % ack)
-            if u"sha256" in ack:
-                if ack[u"sha256"] != expected_hex:
-                    t.detail(datahash="failed")
-                    raise TransferError("Transfer failed (bad remote hash)")
-            print(u"Confirmation received. Transfer complete.", file=stderr)
-            t.detail(ack="ok")
+        pool = None
+        if self._args.transit_threads:
+            # encrypt on the other cores, while this one reads and sends
+            pool = EncryptionPool(self._args.transit_threads)
+            record_pipe.start_pipelining(pool)
+        try:
+            fs = BulkFileSender(ts.get_record_size())
+
+            with self._timing.add("tx file"):
+                with progress:
+                    if filesize:
+                        # don't send zero-length files
+                        yield fs.beginFileTransfer(
+                            self._fd_to_send, record_pipe,
+                            transform=_count_and_hash)
+
+            expected_hash = hasher.digest()
+            expected_hex = bytes_to_hexstr(expected_hash)
+            print(u"File sent.. waiting for confirmation", file=stderr)
+            with self._timing.add("get ack") as t:
+                ack_bytes = yield record_pipe.receive_record()
+                record_pipe.close()
+                ack = bytes_to_dict(ack_bytes)
+                ok = ack.get(u"ack", u"")
+                if ok != u"ok":
+                    t.detail(ack="failed")
+                    raise TransferError("Transfer failed (remote says: %r)"
+                                        % ack)
+                if u"sha256" in ack:
+                    if ack[u"sha256"] != expected_hex:
+                        t.detail(datahash="failed")
+                        raise TransferError(
+                            "Transfer failed (bad remote hash)")
+                print(u"Confirmation received. Transfer complete.",
+                      file=stderr)
+                t.detail(ack="ok")
+        finally:
+            if pool:
+                yield pool.stop()
@@ -0,0 +1,169 @@
+from __future__ import print_function, unicode_literals
+import json
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from .util import (dict_to_bytes, bytes_to_dict, bytes_to_hexstr,
+                   hexstr_to_bytes)
+
+# The rendezvous protocol started out as JSON text frames, with every
+# message body hex-encoded. That doubles the size of the bodies (which are
+# most of the traffic), and the type/id/server_tx keys are repeated in every
+# frame. Clients which have msgpack installed offer the "wormhole-v2"
+# websocket subprotocol when they connect to the /v1 URL, and servers which
+# also have it accept, and then both sides use binary frames:
+#
+# * each frame is one msgpack map, with the same keys and values as the JSON
+#   version, except:
+# * well-known keys (and well-known values of "type") are replaced by small
+#   integers, from KEYS and TYPES below. Other keys, and values of other
+#   keys (like "welcome" or "orig"), are left alone.
+# * "body" (in "add" and "message") is the raw bytes, not hex
+#
+# Servers without msgpack don't select the subprotocol, and clients without
+# it don't offer it, and both fall back to JSON, so any combination of old
+# and new clients and servers can talk to each other. The server still
+# stores hex bodies, so JSON and binary clients can share a mailbox.
+#
+# Both tables are append-only: their indices are part of the protocol.
+
+BINARY_PROTOCOL = "wormhole-v2"
+
+KEYS = ["type", "id", "server_tx", "server_rx", "side", "phase", "body",
+        "appid", "mailbox", "nameplate", "nameplates", "mood", "welcome",
+        "error", "orig", "ping", "pong"]
+TYPES = ["welcome", "bind", "list", "nameplates", "allocate", "allocated",
+         "claim", "claimed", "release", "released", "open", "message", "add",
+         "close", "closed", "ack", "error", "ping", "pong"]
+
+_KEY_CODES = dict([(k, i) for (i, k) in enumerate(KEYS)])
+_TYPE_CODES = dict([(t, i) for (i, t) in enumerate(TYPES)])
+
+class FramingError(Exception):
+    """A binary frame could not be decoded."""
+
+class JSONCodec(object):
+    """The original protocol: JSON text frames, hex bodies."""
+    name = "json"
+    binary = False
+
+    def encode(self, d):
+        return dict_to_bytes(d)
+
+    def decode(self, payload):
+        return bytes_to_dict(payload)
+
+    def body_to_wire(self, body):
+        return bytes_to_hexstr(body)
+
+    def body_from_wire(self, value):
+        return hexstr_to_bytes(value)
+
+    def encode_partial(self, d):
+        """Encode everything but a trailing server_tx, which finish() will
+        add. This lets a server encode a message once, and send it to many
+        connections, each with its own timestamp."""
+        return dict_to_bytes(d)[:-1]
+
+    def finish(self, partial, server_tx):
+        return partial + (', "server_tx": %s}' %
+                          json.dumps(server_tx)).encode("utf-8")
+
+def _map_header(size):
+    if size < 16:
+        return bytes(bytearray([0x80 | size]))
+    return bytes(bytearray([0xde, size >> 8, size & 0xff]))
+
+class BinaryCodec(object):
+    """The "wormhole-v2" subprotocol: msgpack binary frames, raw bodies."""
+    name = "binary"
+    binary = True
+
+    def _pack(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def _pairs(self, d):
+        for (k, v) in d.items():
+            if k == "type":
+                v = _TYPE_CODES.get(v, v)
+            yield (_KEY_CODES.get(k, k), v)
+
+    def encode(self, d):
+        return self._pack(dict(self._pairs(d)))
+
+    def decode(self, payload):
+        try:
+            packed = msgpack.unpackb(payload, raw=False,
+                                     strict_map_key=False)
+        except Exception as e:
+            raise FramingError(str(e))
+        if not isinstance(packed, dict):
+            raise FramingError("frame is not a map")
+        d = {}
+        for (k, v) in packed.items():
+            if isinstance(k, int):
+                if not 0 <= k < len(KEYS):
+                    raise FramingError("unknown key %d" % k)
+                k = KEYS[k]
+            if k == "type" and isinstance(v, int):
+                if not 0 <= v < len(TYPES):
+                    raise FramingError("unknown type %d" % v)
+                v = TYPES[v]
+            d[k] = v
+        return d
+
+    def body_to_wire(self, body):
+        return body
+
+    def body_from_wire(self, value):
+        if not isinstance(value, type(b"")):
+            raise FramingError("body must be bytes")
+        return value
+
+    def encode_partial(self, d):
+        pairs = list(self._pairs(d))
+        return _map_header(len(pairs)+1) + b"".join([self._pack(k) +
+                                                     self._pack(v)
+                                                     for (k, v) in pairs])
+
+    def finish(self, partial, server_tx):
+        return (partial + self._pack(_KEY_CODES["server_tx"]) +
+                self._pack(server_tx))
+
+JSON = JSONCodec()
+BINARY = BinaryCodec()
+
+def offered_protocols():
+    """The websocket subprotocols a client should offer."""
+    if msgpack is None:
+        return []
+    return [BINARY_PROTOCOL]
+
+def choose_protocol(offered):
+    """Return the subprotocol a server should select, or None."""
+    if msgpack is not None and BINARY_PROTOCOL in offered:
+        return BINARY_PROTOCOL
+    return None
+
+def codec_for(protocol):
+    if protocol == BINARY_PROTOCOL:
+        return BINARY
+    return JSON
+
+# The raw-TCP transport (tcp://HOST:PORT relay URLs, and the server's
+# --rendezvous-tcp port) carries the same messages without the websocket
+# layer, whose framing, masking, and UTF-8 validation cost CPU on both ends.
+# Each frame is a 4-byte big-endian length and then that many bytes
+# (Twisted's Int32StringReceiver). The client's first frame is the list of
+# subprotocols it offers, separated by commas (like Sec-WebSocket-Protocol),
+# and the server answers with the one it selected (an empty frame means
+# JSON). Every later frame holds one message, encoded by the selected codec.
+
+TCP_MAX_FRAME = 16*1024*1024
+
+def encode_offer(protocols):
+    return ",".join(protocols).encode("ascii")
+
+def decode_offer(data):
+    return [p for p in data.decode("ascii").split(",") if p]
@@ -0,0 +1,94 @@
+from __future__ import print_function, unicode_literals
+
+# A single client (or a single host running many of them) can open as many
+# connections as it likes, and send "allocate", "claim", "list",
+# "subscribe-list", and "open" as fast as its socket allows. Each of those
+# touches the database, and "list" has to find every claimed nameplate in
+# the app, so one busy neighbour can slow the relay down for everybody.
+#
+# Admission sits in front of the websocket protocol, and keeps one small
+# record per client address:
+#
+# * connections: a new websocket is refused (with HTTP 429) if that address
+#   already has max_connections open
+# * a token bucket for the expensive commands, which refills at 'rate'
+#   tokens per second, up to 'burst'. Each LIMITED_COMMANDS command spends
+#   one token, and is answered with an "error" response if there are none.
+#
+# Both limits are off by default (since everyone behind a NAT shares an
+# address), and are enabled with the --max-connections-per-ip and
+# --command-rate options. Everything is O(1) per connection and command.
+# Records for addresses with no connections are kept until their bucket has
+# refilled (so reconnecting doesn't reset it), and then dropped by prune().
+
+LIMITED_COMMANDS = frozenset(["allocate", "claim", "list", "subscribe-list",
+                              "open"])
+DEFAULT_BURST = 20
+
+class _Client(object):
+    __slots__ = ["connections", "tokens", "updated"]
+    def __init__(self, tokens, now):
+        self.connections = 0
+        self.tokens = tokens
+        self.updated = now
+
+class Admission(object):
+    """I decide which connections and commands are let in."""
+    def __init__(self, reactor, max_connections=0, rate=0.0,
+                 burst=DEFAULT_BURST):
+        self._reactor = reactor
+        self._max_connections = max_connections # 0 means unlimited
+        self._rate = float(rate) # tokens per second, 0 means unlimited
+        self._burst = float(max(burst, 1))
+        self._clients = {} # address -> _Client
+        self.refused_connections = 0
+        self.throttled_commands = 0
+
+    def _get(self, address, now):
+        c = self._clients.get(address)
+        if c is None:
+            c = self._clients[address] = _Client(self._burst, now)
+        return c
+
+    def connect(self, address):
+        """Return True (and count the connection) if 'address' may open
+        another one."""
+        now = self._reactor.seconds()
+        c = self._get(address, now)
+        if self._max_connections and c.connections >= self._max_connections:
+            self.refused_connections += 1
+            return False
+        c.connections += 1
+        return True
+
+    def disconnect(self, address):
+        self._clients[address].connections -= 1
+
+    def allow_command(self, address, mtype):
+        if not self._rate or mtype not in LIMITED_COMMANDS:
+            return True
+        now = self._reactor.seconds()
+        c = self._get(address, now)
+        c.tokens = min(self._burst,
+                       c.tokens + (now - c.updated) * self._rate)
+        c.updated = now
+        if c.tokens < 1.0:
+            self.throttled_commands += 1
+            return False
+        c.tokens -= 1.0
+        return True
+
+    def prune(self):
+        """Forget addresses with no connections and a full bucket."""
+        now = self._reactor.seconds()
+        for (address, c) in list(self._clients.items()):
+            if c.connections:
+                continue
+            if (not self._rate or
+                c.tokens + (now - c.updated) * self._rate >= self._burst):
+                del self._clients[address]
+
+    def get_stats(self):
+        return {"addresses": len(self._clients),
+                "refused_connections": self.refused_connections,
+                "throttled_commands": self.throttled_commands}
@@ -0,0 +1,134 @@
+from __future__ import print_function, unicode_literals
+import random
+
+# Nameplates are allocated from numeric "tiers": first the 1-digit ids
+# (1-9), then 2-digit, then 3-digit. Within a tier, the choice is random.
+# After 999 nameplates are in use, we fall back to 1000-999999 (which is
+# treated as a single tier, to make codes harder to guess when the server
+# is busy), and then to 7 digits, 8 digits, etc.
+#
+# Each tier remembers which of its ids are claimed. Small tiers also keep
+# a dense list of their free ids (plus an index into it), so picking a
+# random free id, or moving one between free and claimed, is O(1). Large
+# tiers start out sparse, and pick by random probing, which takes fewer
+# than two probes on average while the tier is at most half full. If the
+# tier ever becomes fuller than that, we build its free list once, and use
+# that from then on.
+#
+# In a multi-worker server, each worker may only allocate the nameplates of
+# its own shard (those with id % num_shards == shard, see sharding.py), so
+# each tier only holds those ids.
+
+DENSE_TIER_SIZE = 1000
+MAX_DIGITS = 12
+
+class _Tier(object):
+    def __init__(self, low, high, shard=(0, 1)):
+        self.low = low
+        self.high = high # exclusive
+        index, num_shards = shard
+        self._step = num_shards
+        self._first = low + (index - low) % num_shards # first id we own
+        self.size = max(0, (high - self._first + num_shards - 1) // num_shards)
+        self._claimed = set()
+        self._free = None # list of free ids, when dense
+        self._free_index = None # id -> position in self._free
+        if self.size <= DENSE_TIER_SIZE:
+            self._make_dense()
+
+    def _make_dense(self):
+        self._free = [i for i in range(self._first, self.high, self._step)
+                      if i not in self._claimed]
+        self._free_index = dict((i, pos) for (pos, i) in enumerate(self._free))
+
+    def __contains__(self, i):
+        return self.low <= i < self.high
+
+    def _owns(self, i):
+        return (i - self._first) % self._step == 0
+
+    def is_full(self):
+        return len(self._claimed) >= self.size
+
+    def claim(self, i):
+        if i in self._claimed or not self._owns(i):
+            return
+        self._claimed.add(i)
+        if self._free is not None:
+            # swap-remove from the dense list
+            pos = self._free_index.pop(i)
+            last = self._free.pop()
+            if last != i:
+                self._free[pos] = last
+                self._free_index[last] = pos
+
+    def release(self, i):
+        if i not in self._claimed:
+            return
+        self._claimed.remove(i)
+        if self._free is not None:
+            self._free_index[i] = len(self._free)
+            self._free.append(i)
+
+    def choose(self):
+        if self.is_full():
+            return None
+        if self._free is None:
+            if 2*len(self._claimed) <= self.size:
+                while True:
+                    i = self._first + self._step*random.randrange(self.size)
+                    if i not in self._claimed:
+                        return i
+            self._make_dense()
+        return random.choice(self._free)
+
+def _tier_bounds():
+    yield (1, 10)
+    yield (10, 100)
+    yield (100, 1000)
+    yield (1000, 1000*1000)
+    for digits in range(7, MAX_DIGITS+1):
+        yield (10**(digits-1), 10**digits)
+
+class NameplateAllocator(object):
+    """I track which numeric nameplates are in use, for one AppNamespace.
+
+    The AppNamespace must tell me about every nameplate that is created or
+    deleted (by claim, release, or prune). Non-numeric nameplates (and
+    numbers with leading zeros, which are distinct nameplates) are ignored,
+    since I would never allocate them anyways.
+    """
+    def __init__(self, shard=(0, 1)):
+        self._tiers = [_Tier(low, high, shard)
+                       for (low, high) in _tier_bounds()]
+
+    def _find(self, name):
+        try:
+            i = int(name)
+        except ValueError:
+            return None, None
+        if "%d" % i != name:
+            return None, None
+        for tier in self._tiers:
+            if i in tier:
+                return tier, i
+        return None, None
+
+    def claim(self, name):
+        tier, i = self._find(name)
+        if tier is not None:
+            tier.claim(i)
+
+    def release(self, name):
+        tier, i = self._find(name)
+        if tier is not None:
+            tier.release(i)
+
+    def allocate(self):
+        """Return the id of a random unused nameplate, from the shortest
+        tier that has one. This does not claim it."""
+        for tier in self._tiers:
+            i = tier.choose()
+            if i is not None:
+                return "%d" % i
+        raise ValueError("unable to find a free nameplate-id")
@@ -41,6 +41,10 @@ LaunchArgs = _compose(
         "--rendezvous", default="tcp:4000", metavar="tcp:PORT",
         help="endpoint specification for the rendezvous port",
     ),
+    click.option(
+        "--rendezvous-tcp", default=None, metavar="tcp:PORT",
+        help="endpoint specification for an extra rendezvous port, without websockets (for tcp:// relay URLs)",
+    ),
     click.option(
         "--advertise-version", metavar="VERSION",
         help="version to recommend to clients",
@@ -75,6 +79,45 @@ LaunchArgs = _compose(
         callback=_validate_websocket_protocol_options,
         help="a websocket server protocol option to configure",
     ),
+    click.option(
+        "--channel-engine", default="memory",
+        type=click.Choice(["sqlite", "memory"]),
+        help="keep channel state in memory, and write it to the database"
+        " from a separate thread (the default), or in the database, with"
+        " every change committed on the main thread before answering",
+    ),
+    click.option(
+        "--commit-window", default=0.0, type=float, metavar="SECONDS",
+        help="batch database commits from all clients for up to this long",
+    ),
+    click.option(
+        "--workers", default=1, type=click.IntRange(min=1), metavar="N",
+        help="run N rendezvous worker processes, sharing the channel state",
+    ),
+    click.option(
+        "--max-connections-per-ip", default=0, type=click.IntRange(min=0),
+        metavar="N",
+        help="refuse websocket connections beyond N from one address (default: unlimited)",
+    ),
+    click.option(
+        "--command-rate", default=0.0, type=click.FloatRange(min=0.0),
+        metavar="PER_SECOND",
+        help="limit each address's allocate/claim/list/open commands to this rate (default: unlimited)",
+    ),
+    click.option(
+        "--command-burst", default=20, type=click.IntRange(min=1),
+        metavar="N",
+        help="allow bursts of up to N commands beyond --command-rate",
+    ),
+    click.option(
+        "--usage-retention", default=None, type=click.IntRange(min=1),
+        metavar="DAYS",
+        help="delete raw usage rows after DAYS, keeping hourly/daily rollups (default: keep forever)",
+    ),
+    click.option(
+        "--handoff-socket", default=None, metavar="PATH",
+        help="listen on this unix socket, so 'restart --handoff' can take over this server (default: don't)",
+    ),
 )
 
 
@@ -93,6 +136,10 @@ def start(cfg, **kwargs):
 
 @server.command()
 @LaunchArgs
+@click.option(
+    "--handoff", is_flag=True,
+    help="take over the listening socket without dropping any clients",
+)
 @click.pass_obj
 def restart(cfg, **kwargs):
     """
@@ -1,5 +1,5 @@
 from __future__ import print_function, unicode_literals
-import os, time
+import os, time, shutil, socket, tempfile
 from twisted.python import usage
 from twisted.scripts import twistd
 
@@ -13,25 +13,59 @@ class MyPlugin(object):
         # delay this import as late as possible, to allow twistd's code to
         # accept --reactor= selection
         from .server import RelayServer
-        return RelayServer(
-            str(self.args.rendezvous),
-            self.args.advertise_version,
-            self.args.relay_database_path,
-            self.args.blur_usage,
+        from .workers import WorkerPool
+        kwargs = dict(
+            advertise_version=self.args.advertise_version,
+            db_url=self.args.relay_database_path,
+            blur_usage=self.args.blur_usage,
             signal_error=self.args.signal_error,
             stats_file=self.args.stats_json_path,
             allow_list=self.args.allow_list,
+            channel_engine=self.args.channel_engine,
+            commit_window=self.args.commit_window,
+            max_connections_per_ip=self.args.max_connections_per_ip,
+            command_rate=self.args.command_rate,
+            command_burst=self.args.command_burst,
+            usage_retention=self.args.usage_retention,
         )
+        if self.args.workers > 1:
+            return WorkerPool(str(self.args.rendezvous), self.args.workers,
+                              kwargs)
+        port = str(self.args.rendezvous)
+        if self.args.rendezvous_tcp:
+            kwargs["rendezvous_tcp_port"] = str(self.args.rendezvous_tcp)
+        kwargs["handoff_socket"] = self.args.handoff_socket
+        if getattr(self.args, "handoff", False):
+            from .handoff import receive_handoff
+            backend_dir = tempfile.mkdtemp(prefix="wormhole-handoff-")
+            try:
+                target = receive_handoff(self.args.handoff_socket,
+                                         backend_dir)
+            except Exception:
+                shutil.rmtree(backend_dir, ignore_errors=True)
+                raise
+            port = target.endpoint
+            kwargs["handoff_target"] = target
+        return RelayServer(port, **kwargs)
 
 class MyTwistdConfig(twistd.ServerOptions):
     subCommands = [("XYZ", None, usage.Options, "node")]
 
 def start_server(args):
+    if args.workers > 1 and args.rendezvous_tcp:
+        print("error: --rendezvous-tcp does not work with --workers")
+        return 1
+    if args.workers > 1 and args.handoff_socket:
+        print("error: --handoff-socket does not work with --workers")
+        return 1
     c = MyTwistdConfig()
     #twistd_args = tuple(args.twistd_args) + ("XYZ",)
     base_args = []
     if args.no_daemon:
         base_args.append("--nodaemon")
+    if getattr(args, "handoff", False):
+        # the old server still owns twistd.pid: see handoff.py
+        base_args.extend(["--pidfile", ""])
     twistd_args = base_args + ["XYZ"]
     c.parseOptions(tuple(twistd_args))
     c.loadedPlugins = {"XYZ": MyPlugin(args)}
@@ -56,7 +90,35 @@ def kill_server():
 def stop_server(args):
     kill_server()
 
+def handoff_server(args):
+    from .handoff import HandoffError
+    if args.workers > 1:
+        print("error: --handoff does not work with --workers")
+        return 1
+    if not hasattr(socket, "CMSG_SPACE"):
+        # the listening sockets arrive as SCM_RIGHTS ancillary data, which
+        # needs recvmsg() and CMSG_SPACE()
+        print("error: --handoff needs python3, to receive the old server's"
+              " sockets")
+        return 1
+    if not args.handoff_socket:
+        print("error: --handoff needs --handoff-socket, where the old server"
+              " is accepting handoffs")
+        return 1
+    if not os.path.exists(args.handoff_socket):
+        print("error: no %s: is the old server accepting handoffs?"
+              % args.handoff_socket)
+        return 1
+    print("taking over from the old server")
+    try:
+        start_server(args)
+    except HandoffError as e:
+        print("error: %s" % e)
+        return 1
+
 def restart_server(args):
+    if getattr(args, "handoff", False):
+        return handoff_server(args)
     kill_server()
     time.sleep(0.1)
     timeout = 0
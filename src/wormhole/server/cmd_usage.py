@@ -1,8 +1,9 @@
 from __future__ import print_function, unicode_literals
-import os, time, json
+import os, time, json, glob
 import click
 from humanize import naturalsize
 from .database import get_db
+from .rollups import DAY
 
 def abbrev(t):
     if t is None:
@@ -32,22 +33,34 @@ def show_usage(args):
     print("closed for renovation")
     return 0
 
-def tail_usage(args):
-    if not os.path.exists("relay.sqlite"):
+def open_databases():
+    # A server started with --workers=N writes relay-worker0.sqlite, etc,
+    # instead of relay.sqlite (see workers.py). Whatever relay.sqlite
+    # counted before that still counts, so we read all of them.
+    filenames = sorted(glob.glob("relay-worker[0-9]*.sqlite"))
+    if os.path.exists("relay.sqlite"):
+        filenames.insert(0, "relay.sqlite")
+    if not filenames:
         raise click.UsageError(
             "cannot find relay.sqlite, please run from the server directory"
         )
-    db = get_db("relay.sqlite")
+    return [get_db(fn) for fn in filenames]
+
+def tail_usage(args):
+    dbs = open_databases()
     # we don't seem to have unique row IDs, so this is an inaccurate and
     # inefficient hack
     seen = set()
     try:
         while True:
             old = time.time() - 2*60*60
-            c = db.execute("SELECT * FROM `usage`"
-                           " WHERE `started` > ?"
-                           " ORDER BY `started` ASC", (old,))
-            for row in c.fetchall():
+            rows = []
+            for db in dbs:
+                rows.extend(db.execute("SELECT * FROM `usage`"
+                                       " WHERE `started` > ?", (old,)
+                                       ).fetchall())
+            rows.sort(key=lambda row: row["started"])
+            for row in rows:
                 event = (row["type"], row["started"], row["result"],
                          row["total_bytes"], row["waiting_time"],
                          row["total_time"])
@@ -58,12 +71,20 @@ def tail_usage(args):
     except KeyboardInterrupt:
         return 0
 
+def _count(dbs, query, values=()):
+    return sum([list(db.execute(query, values).fetchone().values())[0]
+                for db in dbs])
+
+def _count_apps(dbs, query, values=()):
+    # an app may have channels (or usage) in more than one database
+    app_ids = set()
+    for db in dbs:
+        app_ids.update([row["app_id"] for row in
+                        db.execute(query, values).fetchall()])
+    return len(app_ids)
+
 def count_channels(args):
-    if not os.path.exists("relay.sqlite"):
-        raise click.UsageError(
-            "cannot find relay.sqlite, please run from the server directory"
-        )
-    db = get_db("relay.sqlite")
+    dbs = open_databases()
     c_list = []
     c_dict = {}
     def add(key, value):
@@ -71,8 +92,9 @@ def count_channels(args):
         c_dict[key] = value
     OLD = time.time() - 10*60
     def q(query, values=()):
-        return list(db.execute(query, values).fetchone().values())[0]
-    add("apps", q("SELECT COUNT(DISTINCT(`app_id`)) FROM `nameplates`"))
+        return _count(dbs, query, values)
+    add("apps", _count_apps(dbs, "SELECT DISTINCT(`app_id`) AS `app_id`"
+                            " FROM `nameplates`"))
 
     add("total nameplates", q("SELECT COUNT() FROM `nameplates`"))
     add("waiting nameplates", q("SELECT COUNT() FROM `nameplates`"
@@ -89,13 +111,15 @@ def count_channels(args):
                                  " WHERE `second` is not null"))
 
     stale_mailboxes = 0
-    for mbox_row in db.execute("SELECT * FROM `mailboxes`").fetchall():
-        newest = db.execute("SELECT `server_rx` FROM `messages`"
-                            " WHERE `app_id`=? AND `mailbox_id`=?"
-                            " ORDER BY `server_rx` DESC LIMIT 1",
-                            (mbox_row["app_id"], mbox_row["id"])).fetchone()
-        if newest and newest[0] < OLD:
-            stale_mailboxes += 1
+    for db in dbs:
+        for mbox_row in db.execute("SELECT * FROM `mailboxes`").fetchall():
+            newest = db.execute("SELECT `server_rx` FROM `messages`"
+                                " WHERE `app_id`=? AND `mailbox_id`=?"
+                                " ORDER BY `server_rx` DESC LIMIT 1",
+                                (mbox_row["app_id"], mbox_row["id"])
+                                ).fetchone()
+            if newest and newest[0] < OLD:
+                stale_mailboxes += 1
     add("stale mailboxes", stale_mailboxes)
 
     add("messages", q("SELECT COUNT() FROM `messages`"))
@@ -108,54 +132,57 @@ def count_channels(args):
     return 0
 
 def count_events(args):
-    if not os.path.exists("relay.sqlite"):
-        raise click.UsageError(
-            "cannot find relay.sqlite, please run from the server directory"
-        )
-    db = get_db("relay.sqlite")
+    dbs = open_databases()
     c_list = []
     c_dict = {}
     def add(key, value):
         c_list.append((key, value))
         c_dict[key] = value
-    def q(query, values=()):
-        return list(db.execute(query, values).fetchone().values())[0]
-
-    add("apps", q("SELECT COUNT(DISTINCT(`app_id`)) FROM `nameplate_usage`"))
-
-    add("total nameplates", q("SELECT COUNT() FROM `nameplate_usage`"))
-    add("happy nameplates", q("SELECT COUNT() FROM `nameplate_usage`"
-                              " WHERE `result`='happy'"))
-    add("lonely nameplates", q("SELECT COUNT() FROM `nameplate_usage`"
-                               " WHERE `result`='lonely'"))
-    add("pruney nameplates", q("SELECT COUNT() FROM `nameplate_usage`"
-                               " WHERE `result`='pruney'"))
-    add("crowded nameplates", q("SELECT COUNT() FROM `nameplate_usage`"
-                                " WHERE `result`='crowded'"))
-
-    add("total mailboxes", q("SELECT COUNT() FROM `mailbox_usage`"))
-    add("happy mailboxes", q("SELECT COUNT() FROM `mailbox_usage`"
-                             " WHERE `result`='happy'"))
-    add("scary mailboxes", q("SELECT COUNT() FROM `mailbox_usage`"
-                             " WHERE `result`='scary'"))
-    add("lonely mailboxes", q("SELECT COUNT() FROM `mailbox_usage`"
-                              " WHERE `result`='lonely'"))
-    add("errory mailboxes", q("SELECT COUNT() FROM `mailbox_usage`"
-                              " WHERE `result`='errory'"))
-    add("pruney mailboxes", q("SELECT COUNT() FROM `mailbox_usage`"
-                              " WHERE `result`='pruney'"))
-    add("crowded mailboxes", q("SELECT COUNT() FROM `mailbox_usage`"
-                               " WHERE `result`='crowded'"))
-
-    add("total transit", q("SELECT COUNT() FROM `transit_usage`"))
-    add("happy transit", q("SELECT COUNT() FROM `transit_usage`"
-                           " WHERE `result`='happy'"))
-    add("lonely transit", q("SELECT COUNT() FROM `transit_usage`"
-                            " WHERE `result`='lonely'"))
-    add("errory transit", q("SELECT COUNT() FROM `transit_usage`"
-                            " WHERE `result`='errory'"))
-
-    add("transit bytes", q("SELECT SUM(`total_bytes`) FROM `transit_usage`"))
+
+    # the raw usage rows may have been expired, but their rollups remain
+    add("apps", _count_apps(dbs, "SELECT DISTINCT(`app_id`) AS `app_id`"
+                            " FROM `usage_rollups`"
+                            " WHERE `kind`='nameplate' AND `period`=?",
+                            (DAY,)))
+
+    # the nameplate and mailbox totals are maintained by the server
+    def counters(kind):
+        counts = {}
+        for db in dbs:
+            for row in db.execute("SELECT `result`, `count`"
+                                  " FROM `usage_counters`"
+                                  " WHERE `kind`=?", (kind,)).fetchall():
+                counts[row["result"]] = (counts.get(row["result"], 0)
+                                         + row["count"])
+        return counts
+
+    nameplates = counters("nameplate")
+    add("total nameplates", sum(nameplates.values()))
+    for result in ["happy", "lonely", "pruney", "crowded"]:
+        add("%s nameplates" % result, nameplates.get(result, 0))
+
+    mailboxes = counters("mailbox")
+    add("total mailboxes", sum(mailboxes.values()))
+    for result in ["happy", "scary", "lonely", "errory", "pruney", "crowded"]:
+        add("%s mailboxes" % result, mailboxes.get(result, 0))
+
+    # the transit relay doesn't, but one pass over its table gets them all
+    transits = {}
+    transit_bytes = None
+    for db in dbs:
+        for row in db.execute("SELECT `result`, COUNT() AS `count`,"
+                              " SUM(`total_bytes`) AS `bytes`"
+                              " FROM `transit_usage`"
+                              " GROUP BY `result`").fetchall():
+            transits[row["result"]] = (transits.get(row["result"], 0)
+                                       + row["count"])
+            if row["bytes"] is not None:
+                transit_bytes = (transit_bytes or 0) + row["bytes"]
+    add("total transit", sum(transits.values()))
+    for result in ["happy", "lonely", "errory"]:
+        add("%s transit" % result, transits.get(result, 0))
+
+    add("transit bytes", transit_bytes)
 
     if args.json:
         print(json.dumps(c_dict))
@@ -1,9 +1,12 @@
 from __future__ import unicode_literals
 import os
 import sqlite3
-import tempfile
+import tempfile, time
 from pkg_resources import resource_string
-from twisted.python import log
+from twisted.python import log, failure
+from twisted.python.threadpool import ThreadPool
+from twisted.internet import defer, threads
+from twisted.application import service
 
 class DBError(Exception):
     pass
@@ -18,7 +21,7 @@ def get_upgrader(new_version):
                                    "db-schemas/upgrade-to-v%d.sql" % new_version)
     return schema_bytes.decode("utf-8")
 
-TARGET_VERSION = 3
+TARGET_VERSION = 6
 
 def dict_factory(cursor, row):
     d = {}
@@ -124,3 +127,139 @@ def dump_db(db):
         return "".join(db.iterdump())
     finally:
         db.row_factory = orig
+
+
+class GroupCommitter(service.Service):
+    """I wrap a database connection, and coalesce commits.
+
+    The rendezvous code calls db.commit() after almost every write, often
+    several times per client command, and each one costs an fsync. When
+    wrapped by me, commit() just notes that a commit is needed, and all the
+    writes made in the same reactor turn (or in the next 'window' seconds,
+    if non-zero) are committed together. Callers that must not reveal a
+    write to clients before it is durable (e.g. sending an ack) should wait
+    for when_committed().
+
+    Everything except commit() is passed through to the real connection, so
+    reads see uncommitted writes, just like they did before.
+    """
+
+    def __init__(self, db, reactor, window=0.0):
+        self._db = db
+        self._reactor = reactor
+        self._window = window
+        self._call = None
+        self._waiters = []
+        self.commits = 0
+        self.commit_time = 0.0 # total seconds spent in commit
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def execute(self, *args):
+        return self._db.execute(*args)
+
+    def commit(self):
+        if self._call is None:
+            self._call = self._reactor.callLater(self._window, self._commit)
+
+    def pending(self):
+        return self._call is not None
+
+    def when_committed(self):
+        if self._call is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiters.append(d)
+        return d
+
+    def flush(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._commit()
+
+    def _commit(self):
+        self._call = None
+        waiters, self._waiters = self._waiters, []
+        start = time.time()
+        try:
+            self._db.commit()
+        except Exception:
+            f = failure.Failure()
+            log.err(f, "group commit failed")
+            # throw away the rest of this transaction, rather than letting
+            # the next window commit it along with everyone else's writes
+            self._db.rollback()
+            for d in waiters:
+                d.errback(f)
+            return
+        self.commits += 1
+        self.commit_time += time.time() - start
+        for d in waiters:
+            d.callback(None)
+
+    def stopService(self):
+        self.flush()
+        return service.Service.stopService(self)
+
+
+class DatabaseWorker(service.Service):
+    """I own a second connection to the database, and a thread that uses it.
+
+    Writes that clients don't have to wait for (the memory engine's
+    write-behind flush, usage retention) are handed to run(), so their
+    statements and commit (with its fsync) happen in my thread, and a slow
+    disk doesn't stall the reactor. There is only one thread, so calls run
+    one at a time, in the order they were made, and a later flush never
+    overtakes an earlier one.
+
+    The database is switched to WAL mode, so the reactor's own connection
+    can keep reading while I write. This only works for a file: an
+    in-memory database can't be shared between connections.
+    """
+
+    def __init__(self, dbfile, reactor):
+        self._dbfile = dbfile
+        self._reactor = reactor
+        self._pool = ThreadPool(minthreads=1, maxthreads=1,
+                                name="wormhole-db")
+        self._db = None
+        self.calls = 0
+        self.busy_time = 0.0 # total seconds spent running calls
+
+    def startService(self):
+        service.Service.startService(self)
+        self._pool.start()
+        d = self.run(self._connect)
+        d.addErrback(log.err, "unable to open the database worker connection")
+
+    def _connect(self, _):
+        db = sqlite3.connect(self._dbfile, check_same_thread=False)
+        _initialize_db_connection(db)
+        db.execute("PRAGMA journal_mode=WAL")
+        self._db = db
+
+    def run(self, f, *args):
+        """Call f(db, *args) in my thread. Returns a Deferred that fires
+        (in the reactor thread) with its result."""
+        return threads.deferToThreadPool(self._reactor, self._pool,
+                                         self._call, f, args)
+
+    def _call(self, f, args):
+        start = time.time()
+        try:
+            return f(self._db, *args)
+        finally:
+            self.calls += 1
+            self.busy_time += time.time() - start
+
+    def get_stats(self):
+        return {"calls": self.calls, "busy_time": self.busy_time}
+
+    def stopService(self):
+        # this waits for everything already queued (e.g. the final flush)
+        self._pool.stop()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        return service.Service.stopService(self)
@@ -0,0 +1,20 @@
+CREATE TABLE `usage_counters`
+(
+ `kind` VARCHAR, -- "nameplate", "mailbox", or "mailbox_standalone"
+ `result` VARCHAR, -- same as the `result` column of the usage table
+ `count` INTEGER
+);
+CREATE UNIQUE INDEX `usage_counters_idx` ON `usage_counters` (`kind`, `result`);
+
+INSERT INTO `usage_counters` (`kind`, `result`, `count`)
+ SELECT 'nameplate', `result`, COUNT() FROM `nameplate_usage`
+ GROUP BY `result`;
+INSERT INTO `usage_counters` (`kind`, `result`, `count`)
+ SELECT 'mailbox', `result`, COUNT() FROM `mailbox_usage`
+ GROUP BY `result`;
+INSERT INTO `usage_counters` (`kind`, `result`, `count`)
+ SELECT 'mailbox_standalone', `result`, COUNT() FROM `mailbox_usage`
+ WHERE `for_nameplate`=0 GROUP BY `result`;
+
+DELETE FROM `version`;
+INSERT INTO `version` (`version`) VALUES (4);
@@ -0,0 +1,122 @@
+-- Hourly and daily summaries of the usage tables, so the raw rows can be
+-- deleted after a while (see rollups.py). There is one row for each kind
+-- ("nameplate", "mailbox", or "mailbox_standalone", like `usage_counters`),
+-- period, bucket, app_id, and result, updated in the same transaction that
+-- adds each usage row. The `*_le_N` columns are histograms: the number of
+-- channels whose time was more than the previous bound, and at most N
+-- seconds. `*_over` counts the ones above the last bound.
+CREATE TABLE `usage_rollups`
+(
+ `kind` VARCHAR,
+ `period` INTEGER, -- bucket length in seconds: 3600 or 86400
+ `start` INTEGER, -- seconds since epoch, a multiple of `period`
+ `app_id` VARCHAR,
+ `result` VARCHAR,
+ `count` INTEGER DEFAULT 0,
+ `total_time_sum` INTEGER DEFAULT 0,
+ `waiting_count` INTEGER DEFAULT 0, -- rows where waiting_time is not None
+ `waiting_time_sum` INTEGER DEFAULT 0,
+ `total_le_1` INTEGER DEFAULT 0,
+ `total_le_10` INTEGER DEFAULT 0,
+ `total_le_60` INTEGER DEFAULT 0,
+ `total_le_600` INTEGER DEFAULT 0,
+ `total_le_3600` INTEGER DEFAULT 0,
+ `total_over` INTEGER DEFAULT 0,
+ `waiting_le_1` INTEGER DEFAULT 0,
+ `waiting_le_10` INTEGER DEFAULT 0,
+ `waiting_le_60` INTEGER DEFAULT 0,
+ `waiting_le_600` INTEGER DEFAULT 0,
+ `waiting_le_3600` INTEGER DEFAULT 0,
+ `waiting_over` INTEGER DEFAULT 0
+);
+CREATE UNIQUE INDEX `usage_rollups_idx` ON `usage_rollups`
+ (`kind`, `period`, `start`, `app_id`, `result`);
+
+-- for expiring raw usage rows by age
+CREATE INDEX `nameplate_usage_started_idx` ON `nameplate_usage` (`started`);
+CREATE INDEX `mailbox_usage_started_idx` ON `mailbox_usage` (`started`);
+
+INSERT INTO `usage_rollups`
+ (`kind`, `period`, `start`, `app_id`, `result`, `count`, `total_time_sum`,
+  `waiting_count`, `waiting_time_sum`, `total_le_1`, `total_le_10`,
+  `total_le_60`, `total_le_600`, `total_le_3600`, `total_over`,
+  `waiting_le_1`, `waiting_le_10`, `waiting_le_60`, `waiting_le_600`,
+  `waiting_le_3600`, `waiting_over`)
+ SELECT 'nameplate', 3600, (CAST(`started` AS INTEGER) / 3600) * 3600,
+  `app_id`, `result`, COUNT(), IFNULL(SUM(`total_time`), 0),
+  COUNT(`waiting_time`), IFNULL(SUM(`waiting_time`), 0),
+  IFNULL(SUM(`total_time` <= 1), 0), IFNULL(SUM(`total_time` > 1 AND
+  `total_time` <= 10), 0), IFNULL(SUM(`total_time` > 10 AND `total_time` <=
+  60), 0), IFNULL(SUM(`total_time` > 60 AND `total_time` <= 600), 0),
+  IFNULL(SUM(`total_time` > 600 AND `total_time` <= 3600), 0),
+  IFNULL(SUM(`total_time` > 3600), 0), IFNULL(SUM(`waiting_time` <= 1), 0),
+  IFNULL(SUM(`waiting_time` > 1 AND `waiting_time` <= 10), 0),
+  IFNULL(SUM(`waiting_time` > 10 AND `waiting_time` <= 60), 0),
+  IFNULL(SUM(`waiting_time` > 60 AND `waiting_time` <= 600), 0),
+  IFNULL(SUM(`waiting_time` > 600 AND `waiting_time` <= 3600), 0),
+  IFNULL(SUM(`waiting_time` > 3600), 0)
+ FROM `nameplate_usage`
+ GROUP BY 3, `app_id`, `result`;
+
+INSERT INTO `usage_rollups`
+ (`kind`, `period`, `start`, `app_id`, `result`, `count`, `total_time_sum`,
+  `waiting_count`, `waiting_time_sum`, `total_le_1`, `total_le_10`,
+  `total_le_60`, `total_le_600`, `total_le_3600`, `total_over`,
+  `waiting_le_1`, `waiting_le_10`, `waiting_le_60`, `waiting_le_600`,
+  `waiting_le_3600`, `waiting_over`)
+ SELECT 'mailbox', 3600, (CAST(`started` AS INTEGER) / 3600) * 3600, `app_id`,
+  `result`, COUNT(), IFNULL(SUM(`total_time`), 0), COUNT(`waiting_time`),
+  IFNULL(SUM(`waiting_time`), 0), IFNULL(SUM(`total_time` <= 1), 0),
+  IFNULL(SUM(`total_time` > 1 AND `total_time` <= 10), 0),
+  IFNULL(SUM(`total_time` > 10 AND `total_time` <= 60), 0),
+  IFNULL(SUM(`total_time` > 60 AND `total_time` <= 600), 0),
+  IFNULL(SUM(`total_time` > 600 AND `total_time` <= 3600), 0),
+  IFNULL(SUM(`total_time` > 3600), 0), IFNULL(SUM(`waiting_time` <= 1), 0),
+  IFNULL(SUM(`waiting_time` > 1 AND `waiting_time` <= 10), 0),
+  IFNULL(SUM(`waiting_time` > 10 AND `waiting_time` <= 60), 0),
+  IFNULL(SUM(`waiting_time` > 60 AND `waiting_time` <= 600), 0),
+  IFNULL(SUM(`waiting_time` > 600 AND `waiting_time` <= 3600), 0),
+  IFNULL(SUM(`waiting_time` > 3600), 0)
+ FROM `mailbox_usage`
+ GROUP BY 3, `app_id`, `result`;
+
+INSERT INTO `usage_rollups`
+ (`kind`, `period`, `start`, `app_id`, `result`, `count`, `total_time_sum`,
+  `waiting_count`, `waiting_time_sum`, `total_le_1`, `total_le_10`,
+  `total_le_60`, `total_le_600`, `total_le_3600`, `total_over`,
+  `waiting_le_1`, `waiting_le_10`, `waiting_le_60`, `waiting_le_600`,
+  `waiting_le_3600`, `waiting_over`)
+ SELECT 'mailbox_standalone', 3600, (CAST(`started` AS INTEGER) / 3600) *
+  3600, `app_id`, `result`, COUNT(), IFNULL(SUM(`total_time`), 0),
+  COUNT(`waiting_time`), IFNULL(SUM(`waiting_time`), 0),
+  IFNULL(SUM(`total_time` <= 1), 0), IFNULL(SUM(`total_time` > 1 AND
+  `total_time` <= 10), 0), IFNULL(SUM(`total_time` > 10 AND `total_time` <=
+  60), 0), IFNULL(SUM(`total_time` > 60 AND `total_time` <= 600), 0),
+  IFNULL(SUM(`total_time` > 600 AND `total_time` <= 3600), 0),
+  IFNULL(SUM(`total_time` > 3600), 0), IFNULL(SUM(`waiting_time` <= 1), 0),
+  IFNULL(SUM(`waiting_time` > 1 AND `waiting_time` <= 10), 0),
+  IFNULL(SUM(`waiting_time` > 10 AND `waiting_time` <= 60), 0),
+  IFNULL(SUM(`waiting_time` > 60 AND `waiting_time` <= 600), 0),
+  IFNULL(SUM(`waiting_time` > 600 AND `waiting_time` <= 3600), 0),
+  IFNULL(SUM(`waiting_time` > 3600), 0)
+ FROM `mailbox_usage` WHERE `for_nameplate`=0
+ GROUP BY 3, `app_id`, `result`;
+
+INSERT INTO `usage_rollups`
+ (`kind`, `period`, `start`, `app_id`, `result`, `count`, `total_time_sum`,
+  `waiting_count`, `waiting_time_sum`, `total_le_1`, `total_le_10`,
+  `total_le_60`, `total_le_600`, `total_le_3600`, `total_over`,
+  `waiting_le_1`, `waiting_le_10`, `waiting_le_60`, `waiting_le_600`,
+  `waiting_le_3600`, `waiting_over`)
+ SELECT `kind`, 86400, (`start` / 86400) * 86400, `app_id`, `result`,
+  SUM(`count`), SUM(`total_time_sum`), SUM(`waiting_count`),
+  SUM(`waiting_time_sum`), SUM(`total_le_1`), SUM(`total_le_10`),
+  SUM(`total_le_60`), SUM(`total_le_600`), SUM(`total_le_3600`),
+  SUM(`total_over`), SUM(`waiting_le_1`), SUM(`waiting_le_10`),
+  SUM(`waiting_le_60`), SUM(`waiting_le_600`), SUM(`waiting_le_3600`),
+  SUM(`waiting_over`)
+ FROM `usage_rollups` WHERE `period`=3600
+ GROUP BY `kind`, 3, `app_id`, `result`;
+
+DELETE FROM `version`;
+INSERT INTO `version` (`version`) VALUES (5);
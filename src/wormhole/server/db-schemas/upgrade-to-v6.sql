@@ -0,0 +1,29 @@
+-- Indexes for the columns that the channel-state queries filter on. Without
+-- these, claiming, releasing, opening, and closing all scanned the whole
+-- `nameplate_sides` or `mailbox_sides` table, and deleting a mailbox
+-- scanned `messages` (see test_database.QueryPlans).
+
+-- `nameplate_sides`.`nameplates_id` had no type, so comparing it with an
+-- integer id could never use an index. SQLite can't change a column's
+-- type, so the table is rebuilt.
+CREATE TABLE `nameplate_sides_new`
+(
+ `nameplates_id` INTEGER REFERENCES `nameplates`(`id`),
+ `claimed` BOOLEAN, -- True after claim(), False after release()
+ `side` VARCHAR,
+ `added` INTEGER -- time when this side first claimed the nameplate
+);
+INSERT INTO `nameplate_sides_new`
+ (`nameplates_id`, `claimed`, `side`, `added`)
+ SELECT `nameplates_id`, `claimed`, `side`, `added` FROM `nameplate_sides`;
+DROP TABLE `nameplate_sides`;
+ALTER TABLE `nameplate_sides_new` RENAME TO `nameplate_sides`;
+
+CREATE INDEX `nameplates_mailbox_id_idx` ON `nameplates` (`mailbox_id`);
+CREATE INDEX `nameplate_sides_idx` ON `nameplate_sides` (`nameplates_id`, `side`);
+CREATE INDEX `mailbox_sides_idx` ON `mailbox_sides` (`mailbox_id`, `side`);
+DROP INDEX `messages_idx`;
+CREATE INDEX `messages_idx` ON `messages` (`mailbox_id`, `server_rx`);
+
+DELETE FROM `version`;
+INSERT INTO `version` (`version`) VALUES (6);
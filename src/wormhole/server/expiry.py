@@ -0,0 +1,78 @@
+from __future__ import print_function, unicode_literals
+import heapq
+
+# The pruning timer used to walk every mailbox row of every app, to find
+# the few which had been idle for too long. Instead, each AppNamespace keeps
+# an ExpiryWheel: a timer wheel, keyed by the time of last activity. Each
+# mailbox lives in the slot for its "updated" time (rounded down to
+# GRANULARITY seconds), and touching a mailbox moves it to a newer slot in
+# O(1) (or O(log(slots)) when that slot was empty). Expiring everything
+# older than a cutoff pops whole slots off the old end, and only has to
+# look at individual timestamps in the one slot that straddles the cutoff.
+# So the cost of a prune is proportional to the number of expired mailboxes
+# (plus one slot), not the number of live ones.
+
+GRANULARITY = 60 # seconds
+
+class ExpiryWheel(object):
+    def __init__(self, granularity=GRANULARITY):
+        self._granularity = granularity
+        self._slots = {} # slot number -> {key: when}
+        self._heap = [] # slot numbers, may include stale (emptied) ones
+        self._where = {} # key -> slot number
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def touch(self, key, when):
+        slot = int(when // self._granularity)
+        old_slot = self._where.get(key)
+        if old_slot is not None and old_slot != slot:
+            self._remove_from(old_slot, key)
+        if slot not in self._slots:
+            self._slots[slot] = {}
+            heapq.heappush(self._heap, slot)
+        self._slots[slot][key] = when
+        self._where[key] = slot
+
+    def remove(self, key):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            self._remove_from(slot, key)
+
+    def _remove_from(self, slot, key):
+        entries = self._slots[slot]
+        del entries[key]
+        if not entries:
+            # leave the heap entry behind, pop_expired() will skip it
+            del self._slots[slot]
+
+    def pop_expired(self, old):
+        """Remove and return the keys whose last activity was at or before
+        'old'."""
+        expired = []
+        cutoff = int(old // self._granularity)
+        while self._heap and self._heap[0] <= cutoff:
+            slot = self._heap[0]
+            entries = self._slots.get(slot)
+            if entries is None:
+                heapq.heappop(self._heap) # stale
+                continue
+            if slot < cutoff:
+                # everything in this slot is old
+                heapq.heappop(self._heap)
+                del self._slots[slot]
+                for key in entries:
+                    del self._where[key]
+                expired.extend(entries)
+                continue
+            # this slot straddles the cutoff
+            for key, when in list(entries.items()):
+                if when <= old:
+                    self.remove(key)
+                    expired.append(key)
+            break
+        return expired
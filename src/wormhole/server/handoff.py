@@ -0,0 +1,372 @@
+from __future__ import print_function, unicode_literals
+import os, json, socket, shutil, array
+from zope.interface import implementer
+from twisted.python import log
+from twisted.internet import reactor, defer, endpoints, protocol, task
+from twisted.internet.interfaces import IStreamServerEndpoint
+from twisted.application import service
+from twisted.protocols.basic import LineOnlyReceiver
+from .routing import ShardRouter
+
+# 'wormhole-server restart --handoff' replaces a running server without
+# dropping its clients. The old server listens on a control socket (a
+# unix-domain socket, if it was started with --handoff-socket=PATH). The new
+# process (given the same --handoff-socket) connects to it before it does
+# anything else, and sends:
+#
+#  {backend: DIR} -> the directory where it will serve the channel state
+#
+# The old server stops accepting connections, holds its clients' commands,
+# writes everything it knows to the database, and sends back its listening
+# socket (as SCM_RIGHTS ancillary data) with:
+#
+#  {family: "inet"|"inet6"}
+#
+# The new process then loads the channel state from the database, starts
+# accepting connections on the inherited socket, serves its state to the
+# old server (as shard 0 of 1, see routing.py) in DIR, and sends:
+#
+#  {ready: true}
+#
+# From then on the old server owns no channel state: it re-opens each of
+# its clients' sessions in the new process, so their mailboxes keep
+# working, and forwards their commands there, exactly like a worker of a
+# multi-worker server. Its clients are never disconnected: they are
+# drained, finishing their wormholes at their own pace, and the old
+# process exits when the last one is gone (or DRAIN_TIMEOUT passes). If
+# the new process dies before it is ready, the old server carries on as
+# if nothing had happened.
+#
+# Both processes can't own the same twistd.pid, so the new one is started
+# without one, and writes its own when the old one has exited.
+#
+# Only the websocket port is handed over. Any other listener (the raw-TCP
+# rendezvous port) is closed just before the socket is sent, so the new
+# server can bind it: clients that connect during that gap are refused, and
+# retry.
+
+PIDFILE = "twistd.pid"
+HANDOFF_TIMEOUT = 60.0 # seconds, for the old server to send its socket
+DRAIN_TIMEOUT = 60*60.0 # seconds, before the old server drops stragglers
+CHECK_PERIOD = 1.0 # seconds, between drain and pidfile checks
+
+class HandoffError(Exception):
+    """The running server did not hand its listening socket to us."""
+
+def _is_listening(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error:
+        return False # refused: nobody is listening any more
+    finally:
+        s.close()
+    return True
+
+@implementer(IStreamServerEndpoint)
+class RecordingEndpoint(object):
+    """I wrap a server endpoint, and remember the port it listened on."""
+    def __init__(self, endpoint):
+        self._endpoint = endpoint
+        self.port = None
+
+    def listen(self, factory):
+        d = self._endpoint.listen(factory)
+        def _listening(port):
+            self.port = port
+            return port
+        d.addCallback(_listening)
+        return d
+
+def _family_name(port):
+    return "inet6" if port.addressFamily == socket.AF_INET6 else "inet"
+
+def _send_line(s, msg):
+    s.sendall(json.dumps(msg).encode("utf-8") + b"\n")
+
+def _receive_line(s):
+    # returns (msg, fds), using recvmsg() to collect any file descriptors
+    # that arrive with the line
+    data, fds = b"", []
+    fd_size = array.array("i").itemsize
+    while b"\n" not in data:
+        chunk, ancdata, _, _ = s.recvmsg(4096, socket.CMSG_SPACE(fd_size))
+        if not chunk:
+            raise HandoffError("the old server hung up")
+        data += chunk
+        for (level, kind, fd_data) in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.extend(array.array("i", fd_data[:len(fd_data) -
+                                                    len(fd_data) % fd_size]))
+    return json.loads(data.split(b"\n", 1)[0].decode("utf-8")), fds
+
+
+class HandoffControl(LineOnlyReceiver):
+    # the old server's end of the control connection
+    delimiter = b"\n"
+
+    def lineReceived(self, line):
+        try:
+            msg = json.loads(line.decode("utf-8"))
+        except ValueError:
+            self.transport.loseConnection()
+            return
+        source = self.factory.source
+        if "backend" in msg:
+            source.begin(self, msg["backend"])
+        elif msg.get("ready"):
+            source.complete(self)
+
+    def send(self, msg):
+        self.sendLine(json.dumps(msg).encode("utf-8"))
+
+    def connectionLost(self, why=None):
+        self.factory.source.control_lost(self)
+
+class HandoffControlFactory(protocol.Factory):
+    protocol = HandoffControl
+
+    def __init__(self, source):
+        self.source = source
+
+
+class HandoffSource(service.MultiService):
+    """I listen for a new server process, hand it my listening socket, and
+    then drain my connections, forwarding their commands to it.
+
+    'endpoint' is the RecordingEndpoint of my websocket port. 'after' is an
+    optional Deferred: I won't listen for a handoff until it fires (a new
+    server waits for its predecessor's control socket to go away).
+    'other_listeners' are the services of any other ports, which are
+    stopped instead of handed over.
+    """
+    def __init__(self, socket_path, endpoint, wsfactory, rendezvous,
+                 committer, after=None, drain_timeout=DRAIN_TIMEOUT,
+                 stop_f=None, other_listeners=(), reactor=reactor):
+        service.MultiService.__init__(self)
+        self._socket_path = socket_path
+        self._endpoint = endpoint
+        self._wsfactory = wsfactory
+        self._rendezvous = rendezvous
+        self._committer = committer
+        self._after = after
+        self._drain_timeout = drain_timeout
+        self._stop_f = stop_f or reactor.stop
+        self._reactor = reactor
+        self._other_listeners = list(other_listeners)
+        self._control_factory = HandoffControlFactory(self)
+        self._listener = None # Deferred firing with the control port
+        self._control = None # the connection we're handing off to
+        self._router = None
+        self._drain = None
+        self.handed_off = False
+
+    def startService(self):
+        service.MultiService.startService(self)
+        if self._after is None:
+            self._listen()
+            return
+        def _go(_):
+            if self.running:
+                self._listen()
+        self._after.addCallback(_go)
+
+    def _listen(self):
+        # a crashed server might have left its socket behind, but if a live
+        # one is still listening there, it's theirs
+        if os.path.exists(self._socket_path):
+            if _is_listening(self._socket_path):
+                log.msg("another server is accepting handoffs on %s, so"
+                        " this one will not" % (self._socket_path,))
+                return
+            os.unlink(self._socket_path)
+        ep = endpoints.UNIXServerEndpoint(self._reactor, self._socket_path,
+                                          mode=0o600)
+        self._listener = ep.listen(self._control_factory)
+        self._listener.addErrback(log.err, "unable to listen for handoffs"
+                                  " on %s" % (self._socket_path,))
+
+    def _stop_listening(self):
+        listener, self._listener = self._listener, None
+        if listener is None:
+            return defer.succeed(None)
+        def _stop(port):
+            if port is not None:
+                return port.stopListening()
+        return listener.addCallback(_stop)
+
+    def begin(self, control, backend):
+        if self._control is not None or self.handed_off:
+            control.transport.loseConnection()
+            return
+        log.msg("handing off to a new server process")
+        self._control = control
+        self._backend = backend
+        self._wsfactory.freeze()
+        port = self._endpoint.port
+        port.stopReading()
+        # the socket is about to be shared, so closing our copy must not
+        # shut it down (Twisted does the same for an adopted socket)
+        port._shouldShutdown = False
+        d = self._stop_listening() # so the new server can listen there
+        d.addCallback(lambda _: defer.DeferredList(
+            [defer.maybeDeferred(s.stopService)
+             for s in self._other_listeners]))
+        d.addCallback(lambda _: defer.maybeDeferred(self._rendezvous.flush))
+        d.addCallback(lambda _: self._committer.flush())
+        def _flushed(_):
+            if self._control is not control:
+                return # it gave up already
+            control.transport.sendFileDescriptor(port.fileno())
+            control.send({"family": _family_name(port)})
+        d.addCallback(_flushed)
+        def _failed(f):
+            log.err(f, "unable to hand off")
+            control.transport.loseConnection()
+        d.addErrback(_failed)
+
+    def control_lost(self, control):
+        if control is not self._control or self._router is not None:
+            return
+        # the new server died before it was ready, so take everything back
+        log.msg("handoff abandoned, resuming")
+        self._control = None
+        self._endpoint.port.startReading()
+        for s in self._other_listeners:
+            if not s.running:
+                s.startService()
+        self._wsfactory.thaw()
+        if self.running:
+            self._listen()
+
+    def complete(self, control):
+        if control is not self._control or self._router is not None:
+            return
+        self._router = ShardRouter(self._rendezvous, self._committer, None,
+                                   1, self._backend, self._reactor)
+        self._router.setServiceParent(self)
+        d = self._wsfactory.hand_off(self._router, self._reactor.seconds())
+        def _handed_off(_):
+            self.handed_off = True
+            control.transport.loseConnection()
+            log.msg("handoff complete, draining %d connections"
+                    % len(self._wsfactory.connections))
+            self._deadline = self._reactor.seconds() + self._drain_timeout
+            self._drain = task.LoopingCall(self._check_drained)
+            self._drain.clock = self._reactor
+            self._drain.start(CHECK_PERIOD)
+        d.addCallback(_handed_off)
+        d.addErrback(log.err, "error during handoff")
+
+    def _check_drained(self):
+        remaining = len(self._wsfactory.connections)
+        if remaining and self._reactor.seconds() < self._deadline:
+            return
+        if remaining:
+            log.msg("dropping %d connections that outlived the handoff"
+                    % remaining)
+        else:
+            log.msg("all connections drained, exiting")
+        self._drain.stop()
+        self._drain = None
+        self._stop_f()
+
+    def stopService(self):
+        if self._drain is not None:
+            self._drain.stop()
+            self._drain = None
+        ds = [self._stop_listening(),
+              defer.maybeDeferred(service.MultiService.stopService, self)]
+        return defer.DeferredList(ds)
+
+
+class HandoffTarget(service.MultiService):
+    """I'm the new server's side of a handoff: I hold the listening socket
+    that the old server sent us, tell it when we're ready for its clients,
+    and take over its pidfile when it exits. My parent gives me the
+    ShardRouter that serves our channel state to the old server."""
+
+    def __init__(self, control, fd, family, backend_dir, pidfile=PIDFILE,
+                 reactor=reactor):
+        service.MultiService.__init__(self)
+        self._control = control
+        self._backend_dir = backend_dir
+        self._pidfile = pidfile
+        self._reactor = reactor
+        family = socket.AF_INET6 if family == "inet6" else socket.AF_INET
+        self.endpoint = endpoints.AdoptedStreamServerEndpoint(reactor, fd,
+                                                              family)
+        self.backend_dir = backend_dir
+        self._old_server_gone = defer.Deferred()
+        self._check = None
+        self._owns_pidfile = False
+
+    def when_old_server_gone(self):
+        return self._old_server_gone
+
+    def startService(self):
+        service.MultiService.startService(self)
+        # our parent starts us after its own port, and our router is
+        # listening by now too
+        try:
+            _send_line(self._control, {"ready": True})
+        except socket.error as e:
+            log.msg("unable to tell the old server we're ready: %s" % e)
+        self._control.close()
+        self._check = task.LoopingCall(self._check_old_server)
+        self._check.clock = self._reactor
+        self._check.start(CHECK_PERIOD)
+
+    def _check_old_server(self):
+        if os.path.exists(self._pidfile):
+            return
+        self._check.stop()
+        self._check = None
+        with open(self._pidfile, "w") as f:
+            f.write("%d\n" % os.getpid())
+        self._owns_pidfile = True
+        log.msg("the old server has exited, took over %s" % self._pidfile)
+        self._old_server_gone.callback(None)
+
+    def stopService(self):
+        if self._check is not None:
+            self._check.stop()
+            self._check = None
+        if self._owns_pidfile and os.path.exists(self._pidfile):
+            os.unlink(self._pidfile)
+        d = defer.maybeDeferred(service.MultiService.stopService, self)
+        d.addCallback(lambda _: shutil.rmtree(self._backend_dir,
+                                              ignore_errors=True))
+        return d
+
+
+def receive_handoff(socket_path, backend_dir, pidfile=PIDFILE,
+                    timeout=HANDOFF_TIMEOUT, reactor=reactor):
+    """Ask the server listening on socket_path for its listening socket.
+
+    This blocks, and must be called before the reactor is running (and
+    before we load any channel state, which the old server writes to the
+    database just before it answers). Returns a HandoffTarget, to be
+    started by the new RelayServer. Raises HandoffError on failure.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(socket_path)
+        _send_line(s, {"backend": backend_dir})
+        msg, fds = _receive_line(s)
+    except (socket.error, ValueError) as e:
+        s.close()
+        raise HandoffError("unable to take over from %s: %s"
+                           % (socket_path, e))
+    except HandoffError:
+        s.close()
+        raise
+    if len(fds) != 1 or "family" not in msg:
+        for fd in fds:
+            os.close(fd)
+        s.close()
+        raise HandoffError("the old server sent no listening socket")
+    s.settimeout(None)
+    return HandoffTarget(s, fds[0], msg["family"], backend_dir, pidfile,
+                         reactor)
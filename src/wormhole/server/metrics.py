@@ -0,0 +1,346 @@
+from __future__ import print_function, unicode_literals
+import collections, bisect
+from twisted.python import log
+from twisted.internet import defer
+from twisted.application import service
+from twisted.web import server
+from twisted.web.resource import Resource
+
+# The --stats-file is only rewritten every EXPIRATION_CHECK_PERIOD (10
+# minutes), which is too coarse to see what a busy server is doing. The
+# /metrics resource serves the same kind of numbers (plus a few more) in the
+# Prometheus text exposition format, computed on demand. Everything comes
+# from in-process counters: rendering the page never touches the database,
+# so it is safe to scrape every few seconds.
+#
+# Per-second rates (like messages per second) are left to the scraper: we
+# export monotonic counters, and rate() does the rest.
+#
+# In a multi-worker server (see workers.py), each scrape of /metrics lands
+# on whichever worker accepts it. That worker asks all of them (over the
+# shard links, see routing.py) for their own metrics, each labelled with
+# worker="N", and returns them together, so every counter keeps counting
+# one worker's events no matter which worker answered.
+
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+# Client commands are counted by type. Anything else a client might send is
+# lumped together, so clients can't create new label values.
+COMMAND_TYPES = ["ping", "bind", "list", "subscribe-list", "allocate",
+                 "claim", "release", "open", "add", "close"]
+
+# Latencies are recorded in histograms with log-linear buckets: 1, 2, and 5
+# times each power of ten, from 10us to 50s. Recording a sample is a bisect
+# and an increment, so it's cheap enough to do for every command. The
+# quantiles we report are the upper bounds of the buckets they fall in.
+BUCKETS = [float("%de%d" % (m, e))
+           for e in range(-5, 2) for m in (1, 2, 5)]
+
+# The reactor lag probe asks to be called every LAG_PROBE_INTERVAL seconds,
+# and records how late each call was. If the reactor is busy (or blocked in
+# a slow fsync), everything else is that late too.
+LAG_PROBE_INTERVAL = 1.0 # seconds
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                if i < len(self.buckets):
+                    return self.buckets[i]
+                break
+        return float("inf")
+
+    def get_stats(self):
+        # float("inf") can't be expressed in JSON, so overflow is None
+        def q(quantile):
+            v = self.quantile(quantile)
+            return None if v == float("inf") else v
+        stats = {"count": self.count, "sum": self.sum}
+        if self.count:
+            stats["mean"] = self.sum / self.count
+            stats["p50"] = q(0.50)
+            stats["p90"] = q(0.90)
+            stats["p99"] = q(0.99)
+        return stats
+
+class Metrics(object):
+    """I hold the counters that the websocket protocol updates."""
+    def __init__(self):
+        self.commands = collections.defaultdict(int) # type -> count
+        self.connections = 0 # currently open
+        self.connections_total = 0
+        self.messages_added = 0 # "add" commands that stored a message
+        self.messages_sent = 0 # "message" responses (one per listener)
+        self.latency = {} # type -> Histogram of command processing time
+        self.lag = Histogram() # reactor lag, from ReactorLagProbe
+
+    def command(self, mtype):
+        if mtype not in COMMAND_TYPES:
+            mtype = "other"
+        self.commands[mtype] += 1
+
+    def command_done(self, mtype, elapsed):
+        if mtype not in COMMAND_TYPES:
+            mtype = "other"
+        if mtype not in self.latency:
+            self.latency[mtype] = Histogram()
+        self.latency[mtype].observe(elapsed)
+
+    def connection_opened(self):
+        self.connections += 1
+        self.connections_total += 1
+
+    def connection_closed(self):
+        self.connections -= 1
+
+    def get_stats(self):
+        """Return the latency data for the --stats-file."""
+        return {"commands": dict([(mtype, h.get_stats()) for (mtype, h)
+                                  in self.latency.items()]),
+                "reactor_lag": self.lag.get_stats()}
+
+
+class ReactorLagProbe(service.Service):
+    """I measure how late the reactor runs a timed call."""
+    def __init__(self, reactor, histogram, interval=LAG_PROBE_INTERVAL):
+        self._reactor = reactor
+        self._histogram = histogram
+        self._interval = interval
+        self._call = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self._schedule()
+
+    def _schedule(self):
+        self._expected = self._reactor.seconds() + self._interval
+        self._call = self._reactor.callLater(self._interval, self._fired)
+
+    def _fired(self):
+        self._call = None
+        lag = self._reactor.seconds() - self._expected
+        self._histogram.observe(max(0.0, lag))
+        self._schedule()
+
+    def stopService(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        return service.Service.stopService(self)
+
+
+def _escape(value):
+    return (value.replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+class _Writer(object):
+    def __init__(self, labels=()):
+        self._labels = list(labels) # added to every sample
+        self._lines = []
+
+    def metric(self, name, mtype, helptext, samples):
+        """samples is a list of (suffix, labels, value), where labels is a
+        list of (name, value) pairs."""
+        self._lines.append("# HELP %s %s" % (name, helptext))
+        self._lines.append("# TYPE %s %s" % (name, mtype))
+        for (suffix, labels, value) in samples:
+            labels = self._labels + labels
+            if labels:
+                label_text = "{%s}" % ",".join(['%s="%s"' % (k, _escape(v))
+                                                for (k, v) in labels])
+            else:
+                label_text = ""
+            self._lines.append("%s%s%s %s" % (name, suffix, label_text,
+                                              _format_value(value)))
+
+    def simple(self, name, mtype, helptext, value):
+        self.metric(name, mtype, helptext, [("", [], value)])
+
+    def histograms(self, name, helptext, label, histograms):
+        samples = []
+        for key in sorted(histograms):
+            labels = [(label, key)] if label else []
+            h = histograms[key]
+            cumulative = 0
+            for (bound, count) in zip(h.buckets + ["+Inf"], h.counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else _format_value(bound)
+                samples.append(("_bucket", labels + [("le", le)],
+                                cumulative))
+            samples.append(("_sum", labels, h.sum))
+            samples.append(("_count", labels, h.count))
+        self.metric(name, "histogram", helptext, samples)
+
+    def labelled(self, name, mtype, helptext, label, values):
+        self.metric(name, mtype, helptext,
+                    [("", [(label, key)], values[key])
+                     for key in sorted(values)])
+
+    def text(self):
+        return "\n".join(self._lines) + "\n"
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return "%d" % value
+
+def render_metrics(rendezvous, metrics, committer=None, outbound=None,
+                   admission=None, labels=()):
+    """Return the Prometheus text for the current state, as unicode."""
+    w = _Writer(labels)
+    p = "wormhole_rendezvous_"
+
+    w.simple(p+"connections", "gauge",
+             "Websocket connections currently open.", metrics.connections)
+    w.simple(p+"connections_total", "counter",
+             "Websocket connections accepted.", metrics.connections_total)
+    commands = dict([(mtype, 0) for mtype in COMMAND_TYPES])
+    commands.update(metrics.commands)
+    w.labelled(p+"commands_total", "counter",
+               "Client commands received, by type.", "type", commands)
+    w.simple(p+"messages_added_total", "counter",
+             "Messages added to mailboxes.", metrics.messages_added)
+    w.simple(p+"messages_sent_total", "counter",
+             "Messages delivered to listening clients.",
+             metrics.messages_sent)
+
+    w.histograms(p+"command_seconds",
+                 "Time spent processing client commands, by type.",
+                 "type", metrics.latency)
+    w.histograms(p+"reactor_lag_seconds",
+                 "How late the reactor ran a timed call.",
+                 None, {None: metrics.lag})
+
+    active = rendezvous.get_active_counts()
+    w.simple(p+"apps", "gauge", "AppIDs with live channels.",
+             len(rendezvous.get_all_apps()))
+    w.simple(p+"nameplates", "gauge", "Nameplates currently claimed.",
+             active["nameplates_total"])
+    w.simple(p+"mailboxes", "gauge", "Mailboxes currently open.",
+             active["mailboxes_total"])
+    w.simple(p+"messages", "gauge", "Messages stored in open mailboxes.",
+             active["messages_total"])
+
+    w.labelled(p+"nameplate_results_total", "counter",
+               "Nameplates deallocated, by result (all-time).", "result",
+               rendezvous.get_usage_counts("nameplate"))
+    w.labelled(p+"mailbox_results_total", "counter",
+               "Mailboxes deleted, by result (all-time).", "result",
+               rendezvous.get_usage_counts("mailbox"))
+
+    if outbound is not None:
+        w.simple(p+"outbound_buffered_bytes", "gauge",
+                 "Responses queued for clients that are reading slowly.",
+                 outbound.buffered)
+        w.simple(p+"outbound_paused_connections", "gauge",
+                 "Connections whose commands we have stopped reading.",
+                 outbound.paused)
+        w.simple(p+"outbound_pauses_total", "counter",
+                 "Times we have stopped reading from a slow connection.",
+                 outbound.pauses)
+        w.labelled(p+"outbound_disconnects_total", "counter",
+                   "Connections dropped for buffering too much, by reason.",
+                   "reason", outbound.disconnects)
+
+    if admission is not None:
+        w.simple(p+"refused_connections_total", "counter",
+                 "Connections refused by the per-address limit.",
+                 admission.refused_connections)
+        w.simple(p+"throttled_commands_total", "counter",
+                 "Commands refused by the per-address rate limit.",
+                 admission.throttled_commands)
+
+    if committer is not None:
+        w.metric(p+"db_commit_seconds", "summary",
+                 "Time spent in database commits.",
+                 [("_sum", [], committer.commit_time),
+                  ("_count", [], committer.commits)])
+
+    return w.text()
+
+def merge_metrics(texts):
+    """Combine the render_metrics() output of several workers (with
+    different labels), keeping each metric's samples together."""
+    families = collections.OrderedDict() # name -> [HELP, TYPE, samples..]
+    for text in texts:
+        lines = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                name = line.split(" ", 3)[2]
+                if name not in families:
+                    families[name] = [line]
+                    lines = families[name]
+                else:
+                    lines = None # we already have its header
+            elif line.startswith("# TYPE "):
+                if lines is not None:
+                    lines.append(line)
+            else:
+                families[name].append(line)
+    return "".join(["\n".join(lines) + "\n"
+                    for lines in families.values()])
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, rendezvous, metrics, committer=None, outbound=None,
+                 admission=None, labels=()):
+        Resource.__init__(self)
+        self._rendezvous = rendezvous
+        self._metrics = metrics
+        self._committer = committer
+        self._outbound = outbound
+        self._admission = admission
+        self._labels = labels
+
+    def render_text(self):
+        return render_metrics(self._rendezvous, self._metrics,
+                              self._committer, self._outbound,
+                              self._admission, self._labels)
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", CONTENT_TYPE)
+        return self.render_text().encode("utf-8")
+
+class ShardedMetricsResource(Resource):
+    """I serve the metrics of every worker of a multi-worker server."""
+    isLeaf = True
+
+    def __init__(self, router):
+        Resource.__init__(self)
+        self._router = router
+
+    def render_GET(self, request):
+        ds = []
+        for shard in range(self._router.num_shards):
+            d = self._router.call(shard, {"op": "metrics"})
+            # a worker that is restarting is just missing for now
+            d.addErrback(lambda f, shard=shard:
+                         log.msg("no metrics from shard %d: %s"
+                                 % (shard, f.value)))
+            ds.append(d)
+        d = defer.gatherResults(ds)
+        def _done(texts):
+            request.setHeader(b"content-type", CONTENT_TYPE)
+            request.write(merge_metrics([t for t in texts if t is not None]
+                                        ).encode("utf-8"))
+            request.finish()
+        d.addCallback(_done)
+        d.addErrback(log.err, "unable to render metrics")
+        return server.NOT_DONE_YET
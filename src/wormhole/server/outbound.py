@@ -0,0 +1,166 @@
+from __future__ import print_function, unicode_literals
+from collections import deque
+from zope.interface import implementer
+from twisted.python import log
+from twisted.internet.interfaces import IPushProducer
+
+# A client that stops reading (or reads very slowly) would otherwise make us
+# buffer everything we send it, without limit: every message added to its
+# mailbox, and the whole mailbox again each time it reconnects and re-opens.
+# Enough of those (or one determined attacker) and the relay runs out of
+# memory.
+#
+# So each websocket connection has an Outbox, registered as a streaming
+# producer on its transport. Responses are written straight through until
+# the transport's own buffer fills up and it pauses us. After that they wait
+# in the Outbox, and are counted (per connection, and in total) until the
+# transport drains and resumes us:
+#
+# * above HIGH_WATER bytes, we stop reading commands from that client (so it
+#   can't ask for more), until it drains to LOW_WATER
+# * if it stays above HIGH_WATER for STALL_TIMEOUT seconds, or ever reaches
+#   MAX_BUFFERED, we disconnect it
+# * if all connections together reach GLOBAL_LIMIT, we disconnect whichever
+#   one has the most queued, until we're back under the limit
+#
+# Nothing is lost by disconnecting a client: mailbox messages are stored
+# until the mailbox is closed, and a client that reconnects and re-opens
+# gets all of them again.
+
+HIGH_WATER = 1024*1024
+LOW_WATER = 256*1024
+MAX_BUFFERED = 16*1024*1024
+STALL_TIMEOUT = 60.0 # seconds
+GLOBAL_LIMIT = 256*1024*1024
+
+class OutboundLimits(object):
+    """I hold the thresholds, and account for the bytes queued in all
+    Outboxes."""
+    def __init__(self, high_water=HIGH_WATER, low_water=LOW_WATER,
+                 max_buffered=MAX_BUFFERED, stall_timeout=STALL_TIMEOUT,
+                 global_limit=GLOBAL_LIMIT):
+        assert low_water <= high_water <= max_buffered
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_buffered = max_buffered
+        self.stall_timeout = stall_timeout
+        self.global_limit = global_limit
+        self.buffered = 0 # bytes queued, across all connections
+        self.paused = 0 # connections we've stopped reading from
+        self.pauses = 0 # times we've done that
+        self.disconnects = {"slow": 0, "overload": 0}
+        self._outboxes = set() # the ones with anything queued
+
+    def queued(self, outbox, size):
+        self.buffered += size
+        self._outboxes.add(outbox)
+        while self.buffered > self.global_limit and self._outboxes:
+            biggest = max(self._outboxes, key=lambda o: o.buffered)
+            biggest.disconnect("overload")
+
+    def drained(self, outbox, size):
+        self.buffered -= size
+        if not outbox.buffered:
+            self._outboxes.discard(outbox)
+
+    def get_stats(self):
+        return {"buffered_bytes": self.buffered,
+                "paused_connections": self.paused,
+                "pauses": self.pauses,
+                "disconnects": dict(self.disconnects)}
+
+@implementer(IPushProducer)
+class Outbox(object):
+    """I hold the responses for one websocket connection that its transport
+    isn't ready for yet."""
+    def __init__(self, protocol, limits, reactor):
+        self._protocol = protocol
+        self._limits = limits
+        self._reactor = reactor
+        self._queue = deque() # (payload, isBinary)
+        self.buffered = 0
+        self._writable = True
+        self._reading = True
+        self._stall_timer = None
+        self._closed = False
+        # when twisted.web hands a connection over to the websocket (see
+        # autobahn's WebSocketResource), its HTTPChannel is still registered
+        protocol.transport.unregisterProducer()
+        protocol.registerProducer(self, True)
+
+    def write(self, payload, isBinary):
+        if self._closed:
+            return
+        if self._writable and not self._queue:
+            self._protocol.sendMessage(payload, isBinary)
+            return
+        self._queue.append((payload, isBinary))
+        self.buffered += len(payload)
+        self._limits.queued(self, len(payload))
+        self._check()
+
+    def _check(self):
+        limits = self._limits
+        if self._closed:
+            return
+        if self.buffered >= limits.max_buffered:
+            self.disconnect("slow")
+        elif self._reading and self.buffered > limits.high_water:
+            self._reading = False
+            limits.paused += 1
+            limits.pauses += 1
+            self._protocol.transport.pauseProducing()
+            self._stall_timer = self._reactor.callLater(limits.stall_timeout,
+                                                        self.disconnect,
+                                                        "slow")
+        elif not self._reading and self.buffered <= limits.low_water:
+            self._resume_reading()
+            self._protocol.transport.resumeProducing()
+
+    def _resume_reading(self):
+        self._reading = True
+        self._limits.paused -= 1
+        if self._stall_timer:
+            if self._stall_timer.active():
+                self._stall_timer.cancel()
+            self._stall_timer = None
+
+    # IPushProducer, called by our transport
+
+    def pauseProducing(self):
+        self._writable = False
+
+    def resumeProducing(self):
+        self._writable = True
+        sent = 0
+        while self._queue and self._writable:
+            payload, isBinary = self._queue.popleft()
+            sent += len(payload)
+            self.buffered -= len(payload)
+            # this may pause us again
+            self._protocol.sendMessage(payload, isBinary)
+        if sent:
+            self._limits.drained(self, sent)
+            self._check()
+
+    def stopProducing(self):
+        self._release()
+
+    def _release(self):
+        if self._closed:
+            return
+        self._closed = True
+        if not self._reading:
+            self._resume_reading()
+        self._queue.clear()
+        buffered, self.buffered = self.buffered, 0
+        self._limits.drained(self, buffered)
+
+    def disconnect(self, reason):
+        if self._closed:
+            return
+        log.msg("dropping %s client, with %d bytes queued"
+                % (reason, self.buffered))
+        self._limits.disconnects[reason] += 1
+        self._release()
+        self._protocol.dropConnection(abort=True)
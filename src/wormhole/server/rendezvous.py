@@ -1,8 +1,12 @@
 from __future__ import print_function, unicode_literals
-import os, random, base64, collections
+import os, base64, collections
 from collections import namedtuple
 from twisted.python import log
 from twisted.application import service
+from .allocator import NameplateAllocator
+from .expiry import ExpiryWheel
+from .rollups import UsageRollups
+from .sharding import shard_of_mailbox
 
 def generate_mailbox_id():
     return base64.b32encode(os.urandom(8)).lower().strip(b"=").decode("ascii")
@@ -17,8 +21,68 @@ TransitUsage = namedtuple("TransitUsage",
                           ["started", "waiting_time", "total_time",
                            "total_bytes", "result"])
 
-SidedMessage = namedtuple("SidedMessage", ["side", "phase", "body",
-                                           "server_rx", "msg_id"])
+class SidedMessage(namedtuple("SidedMessage", ["side", "phase", "body",
+                                               "server_rx", "msg_id"])):
+    # The websocket layer caches the encoded "message" responses here (one
+    # per wire format), so a message is serialized once, no matter how many
+    # listeners it goes to (see rendezvous_websocket.encode_message).
+    encoded = None
+
+class UsageCounters(object):
+    """I hold running totals of the usage tables, by kind and result.
+
+    They live in the `usage_counters` table, and are incremented in the same
+    transaction that adds each usage row, so the stats never have to count
+    the (ever-growing) usage tables.
+    """
+    def __init__(self, db):
+        self._counts = {} # (kind, result) -> count
+        for row in db.execute("SELECT * FROM `usage_counters`").fetchall():
+            self._counts[(row["kind"], row["result"])] = row["count"]
+        self._rollups = UsageRollups()
+
+    def record(self, db, kind, app_id, usage):
+        """Count a new usage row, and add it to the rollups."""
+        self.increment(db, kind, usage.result)
+        self._rollups.add(db, kind, app_id, usage)
+
+    def increment(self, db, kind, result):
+        # 'db' is whatever the caller writes through (the connection, or a
+        # write-behind log), which may not be the one we loaded from
+        key = (kind, result)
+        if key in self._counts:
+            self._counts[key] += 1
+            db.execute("UPDATE `usage_counters` SET `count`=`count`+1"
+                       " WHERE `kind`=? AND `result`=?", key)
+        else:
+            self._counts[key] = 1
+            db.execute("INSERT INTO `usage_counters`"
+                       " (`kind`, `result`, `count`) VALUES (?,?,?)",
+                       (kind, result, 1))
+
+    def get(self, kind):
+        return dict([(result, count)
+                     for ((k, result), count) in self._counts.items()
+                     if k == kind])
+
+def all_time_stats(get_usage_counts):
+    """Return the "all_time" section of the --stats-file, given a function
+    like UsageCounters.get()."""
+    u = {}
+    nameplate_counts = get_usage_counts("nameplate")
+    un = u["nameplate_moods"] = {}
+    for result in ["happy", "lonely", "pruney", "crowded"]:
+        un[result] = nameplate_counts.get(result, 0)
+    u["nameplates_total"] = sum(nameplate_counts.values())
+    mailbox_counts = get_usage_counts("mailbox")
+    um = u["mailbox_moods"] = {}
+    for result in ["happy", "scary", "lonely", "quiet", "errory",
+                   "pruney", "crowded"]:
+        um[result] = mailbox_counts.get(result, 0)
+    u["mailboxes_total"] = sum(mailbox_counts.values())
+    u["mailboxes_standalone"] = sum(
+        get_usage_counts("mailbox_standalone").values())
+    return u
 
 class Mailbox:
     def __init__(self, app, db, app_id, mailbox_id):
@@ -29,6 +93,10 @@ class Mailbox:
         self._listeners = {} # handle -> (send_f, stop_f)
         # "handle" is a hashable object, for deregistration
         # send_f() takes a JSONable object, stop_f() has no args
+        # SidedMessages, in server_rx order, once get_messages() has read
+        # them: replaying the same objects to each client that (re-)opens
+        # the mailbox lets it reuse their cached encodings
+        self._messages = None
 
     def open(self, side, when):
         # requires caller to db.commit()
@@ -63,8 +131,14 @@ class Mailbox:
     def _touch(self, when):
         self._db.execute("UPDATE `mailboxes` SET `updated`=? WHERE `id`=?",
                          (when, self._mailbox_id))
+        self._app._mailbox_touched(self._mailbox_id, when)
 
     def get_messages(self):
+        if self._messages is None:
+            self._messages = self._load_messages()
+        return list(self._messages)
+
+    def _load_messages(self):
         messages = []
         db = self._db
         for row in db.execute("SELECT * FROM `messages`"
@@ -96,12 +170,16 @@ class Mailbox:
             send_f(sm)
 
     def _add_message(self, sm):
+        if self._messages is None:
+            self._messages = self._load_messages()
+        self._messages.append(sm)
         self._db.execute("INSERT INTO `messages`"
                          " (`app_id`, `mailbox_id`, `side`, `phase`,  `body`,"
                          "  `server_rx`, `msg_id`)"
                          " VALUES (?,?,?,?,?, ?,?)",
                          (self._app_id, self._mailbox_id, sm.side,
                           sm.phase, sm.body, sm.server_rx, sm.msg_id))
+        self._app._message_added()
         self._touch(sm.server_rx)
         self._db.commit()
 
@@ -138,11 +216,13 @@ class Mailbox:
             return
 
         # nope. delete and summarize
-        db.execute("DELETE FROM `messages` WHERE `mailbox_id`=?",
-                   (self._mailbox_id,))
+        c = db.execute("DELETE FROM `messages` WHERE `mailbox_id`=?",
+                       (self._mailbox_id,))
+        self._app._messages_deleted(c.rowcount)
         db.execute("DELETE FROM `mailbox_sides` WHERE `mailbox_id`=?",
                    (self._mailbox_id,))
         db.execute("DELETE FROM `mailboxes` WHERE `id`=?", (self._mailbox_id,))
+        self._app._mailbox_deleted(self._mailbox_id)
         self._app._summarize_mailbox_and_store(for_nameplate, side_rows,
                                                when, pruned=False)
         db.commit()
@@ -162,7 +242,8 @@ class Mailbox:
 
 class AppNamespace(object):
 
-    def __init__(self, db, blur_usage, log_requests, app_id, allow_list):
+    def __init__(self, db, blur_usage, log_requests, app_id, allow_list,
+                 counters=None, shard=None):
         self._db = db
         self._blur_usage = blur_usage
         self._log_requests = log_requests
@@ -171,11 +252,28 @@ class AppNamespace(object):
         self._nameplate_counts = collections.defaultdict(int)
         self._mailbox_counts = collections.defaultdict(int)
         self._allow_list = allow_list
+        self._allocator = None # built on first allocate
+        self._expiry = ExpiryWheel() # mailbox_id, by last activity
+        self._counters = counters
+        self._shard = shard # (index, num_shards), or None
+        # live nameplates and messages (len(self._expiry) counts mailboxes)
+        self._active_nameplates = 0
+        self._active_messages = 0
+        # the ids of all our nameplates, read once (on first use) and then
+        # kept up to date as nameplates come and go
+        self._nameplate_ids = None
+        self._list_listeners = {} # handle -> changed_f(added, removed)
+        self._sessions = 0 # Sessions that might still use us
 
     def get_nameplate_ids(self):
         if not self._allow_list:
             return []
-        return self._get_nameplate_ids()
+        return set(self._known_nameplate_ids())
+
+    def _known_nameplate_ids(self):
+        if self._nameplate_ids is None:
+            self._nameplate_ids = set(self._get_nameplate_ids())
+        return self._nameplate_ids
 
     def _get_nameplate_ids(self):
         db = self._db
@@ -185,22 +283,55 @@ class AppNamespace(object):
         return set([row["name"] for row in c.fetchall()])
 
     def _find_available_nameplate_id(self):
-        claimed = self._get_nameplate_ids()
-        for size in range(1,4): # stick to 1-999 for now
-            available = set()
-            for id_int in range(10**(size-1), 10**size):
-                id = "%d" % id_int
-                if id not in claimed:
-                    available.add(id)
-            if available:
-                return random.choice(list(available))
-        # ouch, 999 currently claimed. Try random ones for a while.
-        for tries in range(1000):
-            id_int = random.randrange(1000, 1000*1000)
-            id = "%d" % id_int
-            if id not in claimed:
-                return id
-        raise ValueError("unable to find a free nameplate-id")
+        if self._allocator is None:
+            # this is the only time we need to look at all nameplates
+            self._allocator = NameplateAllocator(self._shard or (0, 1))
+            for name in self._known_nameplate_ids():
+                self._allocator.claim(name)
+        return self._allocator.allocate()
+
+    def _generate_mailbox_id(self):
+        # a nameplate's mailbox must live in the same shard as the nameplate
+        while True:
+            mailbox_id = generate_mailbox_id()
+            if self._shard is None:
+                return mailbox_id
+            index, num_shards = self._shard
+            if shard_of_mailbox(self._app_id, mailbox_id,
+                                num_shards) == index:
+                return mailbox_id
+
+    def _nameplate_created(self, name):
+        self._active_nameplates += 1
+        if self._allocator is not None:
+            self._allocator.claim(name)
+        if self._nameplate_ids is not None:
+            self._nameplate_ids.add(name)
+        self._nameplates_changed([name], [])
+
+    def _nameplate_deleted(self, name):
+        self._active_nameplates -= 1
+        if self._allocator is not None:
+            self._allocator.release(name)
+        if self._nameplate_ids is not None:
+            self._nameplate_ids.discard(name)
+        self._nameplates_changed([], [name])
+
+    def add_list_listener(self, handle, changed_f):
+        """Call changed_f(added, removed) whenever a nameplate is created
+        or deleted, until remove_list_listener(handle). Returns the current
+        nameplate ids."""
+        self._list_listeners[handle] = changed_f
+        return self.get_nameplate_ids()
+
+    def remove_list_listener(self, handle):
+        self._list_listeners.pop(handle, None)
+
+    def _nameplates_changed(self, added, removed):
+        if not self._allow_list:
+            return
+        for changed_f in list(self._list_listeners.values()):
+            changed_f(added, removed)
 
     def allocate_nameplate(self, side, when):
         nameplate_id = self._find_available_nameplate_id()
@@ -224,13 +355,14 @@ class AppNamespace(object):
             if self._log_requests:
                 log.msg("creating nameplate#%s for app_id %s" %
                         (name, self._app_id))
-            mailbox_id = generate_mailbox_id()
+            mailbox_id = self._generate_mailbox_id()
             self._add_mailbox(mailbox_id, True, side, when) # ensure row exists
             sql = ("INSERT INTO `nameplates`"
                    " (`app_id`, `name`, `mailbox_id`)"
                    " VALUES(?,?,?)")
             npid = db.execute(sql, (self._app_id, name, mailbox_id)
                               ).lastrowid
+            self._nameplate_created(name)
         else:
             npid = row["id"]
             mailbox_id = row["mailbox_id"]
@@ -295,6 +427,7 @@ class AppNamespace(object):
         db.execute("DELETE FROM `nameplate_sides` WHERE `nameplates_id`=?",
                    (npid,))
         db.execute("DELETE FROM `nameplates` WHERE `id`=?", (npid,))
+        self._nameplate_deleted(name)
         self._summarize_nameplate_and_store(side_rows, when, pruned=False)
         db.commit()
 
@@ -308,6 +441,8 @@ class AppNamespace(object):
                          (self._app_id,
                           u.started, u.total_time, u.waiting_time, u.result))
         self._nameplate_counts[u.result] += 1
+        if self._counters:
+            self._counters.record(self._db, "nameplate", self._app_id, u)
 
     def _summarize_nameplate_usage(self, side_rows, delete_time, pruned):
         times = sorted([row["added"] for row in side_rows])
@@ -339,6 +474,7 @@ class AppNamespace(object):
                              " (`app_id`, `id`, `for_nameplate`, `updated`)"
                              " VALUES(?,?,?,?)",
                              (self._app_id, mailbox_id, for_nameplate, when))
+            self._mailbox_touched(mailbox_id, when)
             # we don't need a commit here, because mailbox.open() only
             # does SELECT FROM `mailbox_sides`, not from `mailboxes`
 
@@ -365,6 +501,33 @@ class AppNamespace(object):
             raise CrowdedError("too many sides have opened this mailbox")
         return mailbox
 
+    def _mailbox_touched(self, mailbox_id, when):
+        self._expiry.touch(mailbox_id, when)
+
+    def _mailbox_deleted(self, mailbox_id):
+        self._expiry.remove(mailbox_id)
+
+    def _message_added(self):
+        self._active_messages += 1
+
+    def _messages_deleted(self, count):
+        self._active_messages -= count
+
+    def has_state(self):
+        return bool(self._active_nameplates or len(self._expiry)
+                    or self._active_messages)
+
+    def is_idle(self):
+        """Return True if I can be forgotten: I have no channel state, and
+        no Session or Mailbox refers to me. A new AppNamespace for the same
+        app_id would be indistinguishable (except for get_counts)."""
+        return not (self.has_state() or self._mailboxes or self._sessions
+                    or self._list_listeners)
+
+    def get_active_counts(self):
+        return (self._active_nameplates, len(self._expiry),
+                self._active_messages)
+
     def free_mailbox(self, mailbox_id):
         # called from Mailbox.delete_and_summarize(), which deletes any
         # messages
@@ -386,6 +549,11 @@ class AppNamespace(object):
                    (self._app_id, for_nameplate,
                     u.started, u.total_time, u.waiting_time, u.result))
         self._mailbox_counts[u.result] += 1
+        if self._counters:
+            self._counters.record(db, "mailbox", self._app_id, u)
+            if not for_nameplate:
+                self._counters.record(db, "mailbox_standalone",
+                                      self._app_id, u)
 
     def _summarize_mailbox(self, side_rows, delete_time, pruned):
         times = sorted([row["added"] for row in side_rows])
@@ -428,83 +596,70 @@ class AppNamespace(object):
         # channel (nameplate, mailbox, and messages).
 
         # Each time a client does something, the mailbox.updated field is
-        # updated with the current timestamp. If a client is subscribed to
-        # the mailbox when pruning check runs, the "updated" field is also
-        # updated. After that check, if the "updated" field is "old", the
-        # channel is deleted.
-
-        # For now, pruning is logged even if log_requests is False, to debug
-        # the pruning process, and since pruning is triggered by a timer
-        # instead of by user action. It does reveal which mailboxes were
-        # present when the pruning process began, though, so in the log run
-        # it should do less logging.
-        log.msg(" prune begins (%s)" % self._app_id)
+        # updated with the current timestamp, and the mailbox is moved to
+        # the corresponding slot of our ExpiryWheel. Pruning pops the
+        # mailboxes that have been idle since "old" off the wheel. If a
+        # client is still subscribed to one of those, it is touched (and
+        # survives), otherwise the channel is deleted.
+
+        # Only the totals are logged, since this doesn't require a client
+        # action to happen, and so logging the individual mailboxes would
+        # reveal which ones were present.
         db = self._db
-        modified = False
-
-        for mailbox in self._mailboxes.values():
-            if mailbox.has_listeners():
-                log.msg("touch %s because listeners" % mailbox._mailbox_id)
-                mailbox._touch(now)
-        db.commit() # make sure the updates are visible below
-
-        new_mailboxes = set()
         old_mailboxes = set()
-        for row in db.execute("SELECT * FROM `mailboxes` WHERE `app_id`=?",
-                              (self._app_id,)).fetchall():
-            mailbox_id = row["id"]
-            log.msg("  1: age=%s, old=%s, %s" %
-                    (now - row["updated"], now - old, mailbox_id))
-            if row["updated"] > old:
-                new_mailboxes.add(mailbox_id)
+        touched = False
+        for mailbox_id in self._expiry.pop_expired(old):
+            mailbox = self._mailboxes.get(mailbox_id)
+            if mailbox and mailbox.has_listeners():
+                mailbox._touch(now)
+                touched = True
             else:
                 old_mailboxes.add(mailbox_id)
-        log.msg(" 2: mailboxes:", new_mailboxes, old_mailboxes)
-
-        old_nameplates = set()
-        for row in db.execute("SELECT * FROM `nameplates` WHERE `app_id`=?",
-                              (self._app_id,)).fetchall():
-            npid = row["id"]
-            mailbox_id = row["mailbox_id"]
-            if mailbox_id in old_mailboxes:
-                old_nameplates.add(npid)
-        log.msg(" 3: old_nameplates dbids", old_nameplates)
-
-        for npid in old_nameplates:
-            log.msg("  deleting nameplate with dbid", npid)
-            side_rows = db.execute("SELECT * FROM `nameplate_sides`"
-                                   " WHERE `nameplates_id`=?",
-                                   (npid,)).fetchall()
-            db.execute("DELETE FROM `nameplate_sides` WHERE `nameplates_id`=?",
-                       (npid,))
-            db.execute("DELETE FROM `nameplates` WHERE `id`=?", (npid,))
-            self._summarize_nameplate_and_store(side_rows, now, pruned=True)
-            modified = True
-
-        # delete all messages for old mailboxes
-        # delete all old mailboxes
+        if not old_mailboxes:
+            if touched:
+                db.commit()
+            return
 
+        pruned_nameplates = 0
         for mailbox_id in old_mailboxes:
-            log.msg("  deleting mailbox", mailbox_id)
+            # delete the nameplate (if any) that points at this mailbox
+            for row in db.execute("SELECT * FROM `nameplates`"
+                                  " WHERE `app_id`=? AND `mailbox_id`=?",
+                                  (self._app_id, mailbox_id)).fetchall():
+                npid = row["id"]
+                side_rows = db.execute("SELECT * FROM `nameplate_sides`"
+                                       " WHERE `nameplates_id`=?",
+                                       (npid,)).fetchall()
+                db.execute("DELETE FROM `nameplate_sides`"
+                           " WHERE `nameplates_id`=?", (npid,))
+                db.execute("DELETE FROM `nameplates` WHERE `id`=?", (npid,))
+                self._nameplate_deleted(row["name"])
+                self._summarize_nameplate_and_store(side_rows, now,
+                                                    pruned=True)
+                pruned_nameplates += 1
+
+            # and then the mailbox and its messages
             row = db.execute("SELECT * FROM `mailboxes`"
                              " WHERE `id`=?", (mailbox_id,)).fetchone()
             for_nameplate = row["for_nameplate"]
             side_rows = db.execute("SELECT * FROM `mailbox_sides`"
                                    " WHERE `mailbox_id`=?",
                                    (mailbox_id,)).fetchall()
-            db.execute("DELETE FROM `messages` WHERE `mailbox_id`=?",
-                       (mailbox_id,))
+            c = db.execute("DELETE FROM `messages` WHERE `mailbox_id`=?",
+                           (mailbox_id,))
+            self._messages_deleted(c.rowcount)
             db.execute("DELETE FROM `mailbox_sides` WHERE `mailbox_id`=?",
                        (mailbox_id,))
             db.execute("DELETE FROM `mailboxes` WHERE `id`=?",
                        (mailbox_id,))
             self._summarize_mailbox_and_store(for_nameplate, side_rows,
                                               now, pruned=True)
-            modified = True
+            # the client that opened it went away without closing it
+            self.free_mailbox(mailbox_id)
 
-        if modified:
-            db.commit()
-        log.msg("  prune complete, modified:", modified)
+        db.commit()
+        log.msg(" pruned %d nameplates and %d mailboxes (%s)" %
+                (pruned_nameplates, len(old_mailboxes), self._app_id))
 
     def get_counts(self):
         return (self._nameplate_counts, self._mailbox_counts)
@@ -514,9 +669,76 @@ class AppNamespace(object):
             channel._shutdown()
 
 
+class Session(object):
+    """I hold the channel state of one client connection: the nameplate and
+    mailbox it is using, within one AppNamespace.
+
+    The websocket protocol validates each command and then calls me. In a
+    multi-worker server, the worker that owns the nameplate or mailbox runs
+    one of these on behalf of the connection (see routing.py).
+    """
+    def __init__(self, app, side):
+        self._app = app
+        self._side = side
+        self._connected = True
+        app._sessions += 1
+        self._mailbox = None
+        self._listening = False
+        self._list_subscribed = False
+
+    def list_nameplates(self):
+        return sorted(self._app.get_nameplate_ids())
+
+    def subscribe_list(self, changed_f):
+        """Like list_nameplates(), but also call changed_f(added, removed)
+        with each later change, until disconnect()."""
+        self._list_subscribed = True
+        return sorted(self._app.add_list_listener(self, changed_f))
+
+    def allocate(self, when):
+        return self._app.allocate_nameplate(self._side, when)
+
+    def claim(self, nameplate_id, when):
+        return self._app.claim_nameplate(nameplate_id, self._side, when)
+
+    def release(self, nameplate_id, when):
+        self._app.release_nameplate(nameplate_id, self._side, when)
+
+    def open(self, mailbox_id, when, send_f, stop_f):
+        """Open the mailbox, and subscribe to new messages. Returns the
+        messages that were already there."""
+        self._mailbox = self._app.open_mailbox(mailbox_id, self._side, when)
+        self._listening = True
+        return self._mailbox.add_listener(self, send_f, stop_f)
+
+    def add(self, sm):
+        self._mailbox.add_message(sm)
+
+    def close(self, mailbox_id, mood, when):
+        if not self._mailbox:
+            self._mailbox = self._app.open_mailbox(mailbox_id, self._side,
+                                                   when)
+        if self._listening:
+            self._mailbox.remove_listener(self)
+            self._listening = False
+        self._mailbox.close(self._side, mood, when)
+        self._mailbox = None
+
+    def disconnect(self):
+        if self._mailbox and self._listening:
+            self._mailbox.remove_listener(self)
+            self._listening = False
+        if self._list_subscribed:
+            self._app.remove_list_listener(self)
+            self._list_subscribed = False
+        if self._connected:
+            self._connected = False
+            self._app._sessions -= 1
+
+
 class Rendezvous(service.MultiService):
 
-    def __init__(self, db, welcome, blur_usage, allow_list):
+    def __init__(self, db, welcome, blur_usage, allow_list, shard=None):
         service.MultiService.__init__(self)
         self._db = db
         self._welcome = welcome
@@ -525,6 +747,13 @@ class Rendezvous(service.MultiService):
         self._log_requests = log_requests
         self._allow_list = allow_list
         self._apps = {}
+        self._shard = shard
+        self._counters = UsageCounters(db)
+        # the since-reboot counts of the apps we've evicted (see
+        # prune_all_apps)
+        self._evicted_nameplate_counts = collections.defaultdict(int)
+        self._evicted_mailbox_counts = collections.defaultdict(int)
+        self._load()
 
     def get_welcome(self):
         return self._welcome
@@ -536,59 +765,113 @@ class Rendezvous(service.MultiService):
         if not app_id in self._apps:
             if self._log_requests:
                 log.msg("spawning app_id %s" % (app_id,))
-            self._apps[app_id] = AppNamespace(
-                self._db,
-                self._blur_usage,
-                self._log_requests,
-                app_id,
-                self._allow_list,
-            )
+            self._apps[app_id] = self._make_app(app_id)
         return self._apps[app_id]
 
-    def get_all_apps(self):
-        apps = set()
-        for row in self._db.execute("SELECT DISTINCT `app_id`"
-                                    " FROM `nameplates`").fetchall():
-            apps.add(row["app_id"])
-        for row in self._db.execute("SELECT DISTINCT `app_id`"
+    def _make_app(self, app_id):
+        return AppNamespace(
+            self._db,
+            self._blur_usage,
+            self._log_requests,
+            app_id,
+            self._allow_list,
+            self._counters,
+            self._shard,
+        )
+
+    def open_session(self, app_id, side):
+        return Session(self.get_app(app_id), side)
+
+    def _load(self):
+        # Channels that were open when the previous server process stopped
+        # are still in the database. Register their mailboxes with the
+        # pruning timer, and count what is still live.
+        for row in self._db.execute("SELECT `app_id`, `id`, `updated`"
                                     " FROM `mailboxes`").fetchall():
-            apps.add(row["app_id"])
-        for row in self._db.execute("SELECT DISTINCT `app_id`"
-                                    " FROM `messages`").fetchall():
-            apps.add(row["app_id"])
-        return apps
+            app = self.get_app(row["app_id"])
+            app._mailbox_touched(row["id"], row["updated"])
+        for row in self._db.execute("SELECT `app_id`, COUNT() AS `count`"
+                                    " FROM `nameplates`"
+                                    " GROUP BY `app_id`").fetchall():
+            self.get_app(row["app_id"])._active_nameplates = row["count"]
+        for row in self._db.execute("SELECT `app_id`, COUNT() AS `count`"
+                                    " FROM `messages`"
+                                    " GROUP BY `app_id`").fetchall():
+            self.get_app(row["app_id"])._active_messages = row["count"]
+
+    def get_all_apps(self):
+        return set([app_id for (app_id, app) in self._apps.items()
+                    if app.has_state()])
 
     def prune_all_apps(self, now, old):
-        # As with AppNamespace.prune_old_mailboxes, we log for now.
+        # every app with live mailboxes was created by _load(), or by the
+        # client that opened them, so we don't need to look in the database
         log.msg("beginning app prune")
-        for app_id in sorted(self.get_all_apps()):
-            log.msg(" app prune checking %r" % (app_id,))
-            app = self.get_app(app_id)
+        evicted = 0
+        for app_id in sorted(self._apps):
+            app = self._apps[app_id]
             app.prune(now, old)
-        log.msg("app prune ends, %d apps" % len(self._apps))
+            if app.is_idle():
+                self._evict_app(app_id)
+                evicted += 1
+        log.msg("app prune ends, %d apps (%d evicted)" % (len(self._apps),
+                                                         evicted))
+
+    def _evict_app(self, app_id):
+        # Without this, we'd keep an AppNamespace for every app_id we've
+        # ever seen. Its all-time usage is already in the database
+        # (usage_counters and usage_rollups), so only the since-reboot
+        # counts need to be kept, and those are folded into our own.
+        app = self._apps.pop(app_id)
+        nc, mc = app.get_counts()
+        for result, count in nc.items():
+            self._evicted_nameplate_counts[result] += count
+        for result, count in mc.items():
+            self._evicted_mailbox_counts[result] += count
+
+    def flush(self):
+        # everything is written through the (group-committed) database as
+        # it happens. The memory engine has its own write-behind log.
+        pass
+
+    def get_active_counts(self):
+        c = {}
+        c["nameplates_total"] = 0
+        # TODO: nameplates with only one side (most of them)
+        # TODO: nameplates with two sides (very fleeting)
+        # TODO: nameplates with three or more sides (crowded, unlikely)
+        c["mailboxes_total"] = 0
+        # TODO: mailboxes with only one side (most of them)
+        # TODO: mailboxes with two sides (somewhat fleeting, in-transit)
+        # TODO: mailboxes with three or more sides (unlikely)
+        c["messages_total"] = 0
+        for app in self._apps.values():
+            nameplates, mailboxes, messages = app.get_active_counts()
+            c["nameplates_total"] += nameplates
+            c["mailboxes_total"] += mailboxes
+            c["messages_total"] += messages
+        return c
+
+    def get_usage_counts(self, kind):
+        """Return the all-time usage counts for 'kind' ("nameplate",
+        "mailbox", or "mailbox_standalone"), as a dict of result->count."""
+        return self._counters.get(kind)
 
     def get_stats(self):
+        # Everything here comes from counters that are updated as the
+        # channels come and go, so this doesn't touch the database.
         stats = {}
 
         # current status: expected to be zero most of the time
         c = stats["active"] = {}
         c["apps"] = len(self.get_all_apps())
-        def q(query, values=()):
-            row = self._db.execute(query, values).fetchone()
-            return list(row.values())[0]
-        c["nameplates_total"] = q("SELECT COUNT() FROM `nameplates`")
-        # TODO: nameplates with only one side (most of them)
-        # TODO: nameplates with two sides (very fleeting)
-        # TODO: nameplates with three or more sides (crowded, unlikely)
-        c["mailboxes_total"] = q("SELECT COUNT() FROM `mailboxes`")
-        # TODO: mailboxes with only one side (most of them)
-        # TODO: mailboxes with two sides (somewhat fleeting, in-transit)
-        # TODO: mailboxes with three or more sides (unlikely)
-        c["messages_total"] = q("SELECT COUNT() FROM `messages`")
+        c.update(self.get_active_counts())
 
         # usage since last reboot
         nameplate_counts = collections.defaultdict(int)
+        nameplate_counts.update(self._evicted_nameplate_counts)
         mailbox_counts = collections.defaultdict(int)
+        mailbox_counts.update(self._evicted_mailbox_counts)
         for app in self._apps.values():
             nc, mc = app.get_counts()
             for result, count in nc.items():
@@ -606,36 +889,7 @@ class Rendezvous(service.MultiService):
         urb["mailboxes_total"] = sum(mailbox_counts.values())
 
         # historical usage (all-time)
-        u = stats["all_time"] = {}
-        un = u["nameplate_moods"] = {}
-        # TODO: there's probably a single SQL query for all this
-        un["happy"] = q("SELECT COUNT() FROM `nameplate_usage`"
-                        " WHERE `result`='happy'")
-        un["lonely"] = q("SELECT COUNT() FROM `nameplate_usage`"
-                         " WHERE `result`='lonely'")
-        un["pruney"] = q("SELECT COUNT() FROM `nameplate_usage`"
-                         " WHERE `result`='pruney'")
-        un["crowded"] = q("SELECT COUNT() FROM `nameplate_usage`"
-                          " WHERE `result`='crowded'")
-        u["nameplates_total"] = q("SELECT COUNT() FROM `nameplate_usage`")
-        um = u["mailbox_moods"] = {}
-        um["happy"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                        " WHERE `result`='happy'")
-        um["scary"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                        " WHERE `result`='scary'")
-        um["lonely"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                         " WHERE `result`='lonely'")
-        um["quiet"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                        " WHERE `result`='quiet'")
-        um["errory"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                         " WHERE `result`='errory'")
-        um["pruney"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                         " WHERE `result`='pruney'")
-        um["crowded"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                          " WHERE `result`='crowded'")
-        u["mailboxes_total"] = q("SELECT COUNT() FROM `mailbox_usage`")
-        u["mailboxes_standalone"] = q("SELECT COUNT() FROM `mailbox_usage`"
-                                      " WHERE `for_nameplate`=0")
+        stats["all_time"] = all_time_stats(self.get_usage_counts)
 
         # recent timings (last 100 operations)
         # TODO: median/etc of nameplate.total_time
@@ -0,0 +1,369 @@
+from __future__ import print_function, unicode_literals
+from twisted.python import log
+from twisted.internet import defer
+from twisted.application import internet
+from .rendezvous import (Mailbox, AppNamespace, Rendezvous, SidedMessage,
+                         CrowdedError, ReclaimedError)
+
+# This is an alternative channel-state engine for the Rendezvous server. The
+# SQLite engine in rendezvous.py executes several SELECT/INSERT/UPDATE
+# statements (and usually a commit) for every client command. This engine
+# keeps the live nameplates, mailbox sides, and message queues in plain
+# dicts, and answers every command from memory. The same rows are written to
+# the database later (write-behind), by replaying a log of SQL operations in
+# a single transaction every FLUSH_PERIOD seconds. The database therefore
+# has the same contents as the SQLite engine would produce (just a little
+# bit later), so a server can be restarted with either engine, and the
+# 'wormhole-server count-*' commands keep working. With a database file,
+# the flush runs in its own thread (see database.DatabaseWorker), so the
+# reactor never waits for the disk.
+
+# If the server crashes, anything that happened in the last FLUSH_PERIOD is
+# lost. Clients will reconnect and re-send their claim/open/add commands,
+# which are idempotent (clients filter duplicate messages), so most channels
+# will survive anyways.
+
+FLUSH_PERIOD = 1.0 # seconds
+
+def _apply(db, ops, touched):
+    for (sql, values) in ops:
+        db.execute(sql, values)
+    for (mailbox_id, when) in touched.items():
+        db.execute("UPDATE `mailboxes` SET `updated`=? WHERE `id`=?",
+                   (when, mailbox_id))
+    db.commit()
+
+class WriteBehindLog(object):
+    """I accumulate database writes and apply them in one transaction.
+
+    Mailbox 'updated' timestamps change on every message, so they are
+    coalesced: only the latest value for each mailbox is written.
+
+    If I'm given a DatabaseWorker, the transaction is run in its thread, and
+    flush() returns a Deferred that fires when it has been committed.
+    """
+    def __init__(self, db, worker=None):
+        self._db = db
+        self._worker = worker
+        self._ops = []
+        self._touched = {}
+
+    def execute(self, sql, values=()):
+        self._ops.append((sql, values))
+
+    def touch_mailbox(self, mailbox_id, when):
+        self._touched[mailbox_id] = when
+
+    def pending(self):
+        return len(self._ops) + len(self._touched)
+
+    def flush(self):
+        if not self._ops and not self._touched:
+            return defer.succeed(None)
+        ops, self._ops = self._ops, []
+        touched, self._touched = self._touched, {}
+        if self._worker is None:
+            _apply(self._db, ops, touched)
+            return defer.succeed(None)
+        d = self._worker.run(_apply, ops, touched)
+        d.addErrback(log.err, "write-behind flush failed")
+        return d
+
+
+class MemoryMailbox(Mailbox):
+    def __init__(self, app, store, app_id, mailbox_id, for_nameplate, updated):
+        Mailbox.__init__(self, app, store, app_id, mailbox_id)
+        self._for_nameplate = for_nameplate
+        self._updated = updated
+        self._sides = {} # side -> dict(side=, opened=, added=, mood=)
+        self._messages = [] # SidedMessage, in server_rx order
+
+    def open(self, side, when):
+        assert isinstance(side, type("")), type(side)
+        if side not in self._sides:
+            self._sides[side] = {"side": side, "opened": True,
+                                 "added": when, "mood": None}
+            self._db.execute("INSERT INTO `mailbox_sides`"
+                             " (`mailbox_id`, `opened`, `side`, `added`)"
+                             " VALUES(?,?,?,?)",
+                             (self._mailbox_id, True, side, when))
+        # see Mailbox.open() for why re-opening a closed side is allowed
+        self._touch(when)
+
+    def _touch(self, when):
+        self._updated = when
+        self._db.touch_mailbox(self._mailbox_id, when)
+        self._app._mailbox_touched(self._mailbox_id, when)
+
+    def _add_message(self, sm):
+        self._messages.append(sm)
+        self._db.execute("INSERT INTO `messages`"
+                         " (`app_id`, `mailbox_id`, `side`, `phase`,  `body`,"
+                         "  `server_rx`, `msg_id`)"
+                         " VALUES (?,?,?,?,?, ?,?)",
+                         (self._app_id, self._mailbox_id, sm.side,
+                          sm.phase, sm.body, sm.server_rx, sm.msg_id))
+        self._app._message_added()
+        self._touch(sm.server_rx)
+
+    def close(self, side, mood, when):
+        assert isinstance(side, type("")), type(side)
+        if self._app._mailboxes.get(self._mailbox_id) is not self:
+            return # already deleted
+        row = self._sides.get(side)
+        if not row:
+            return
+        row["opened"] = False
+        row["mood"] = mood
+        self._db.execute("UPDATE `mailbox_sides` SET `opened`=?, `mood`=?"
+                         " WHERE `mailbox_id`=? AND `side`=?",
+                         (False, mood, self._mailbox_id, side))
+
+        # are any sides still open?
+        side_rows = list(self._sides.values())
+        if any([sr["opened"] for sr in side_rows]):
+            return
+
+        # nope. delete and summarize
+        self._app._delete_mailbox(self)
+        self._app._summarize_mailbox_and_store(self._for_nameplate, side_rows,
+                                               when, pruned=False)
+        # Shut down any listeners, just in case they're still lingering
+        # around.
+        for (send_f, stop_f) in self._listeners.values():
+            stop_f()
+        self._listeners = {}
+
+
+class MemoryAppNamespace(AppNamespace):
+    def __init__(self, store, blur_usage, log_requests, app_id, allow_list,
+                 counters=None, shard=None):
+        AppNamespace.__init__(self, store, blur_usage, log_requests, app_id,
+                              allow_list, counters, shard)
+        # unlike AppNamespace, self._mailboxes holds every mailbox, not just
+        # the ones with Mailbox objects, because the objects are the state
+        self._nameplates = {} # name -> dict(mailbox_id=, sides={side: row})
+        self._mailbox_nameplates = {} # mailbox_id -> name
+
+    def _get_nameplate_ids(self):
+        return set(self._nameplates)
+
+    def claim_nameplate(self, name, side, when):
+        assert isinstance(name, type("")), type(name)
+        assert isinstance(side, type("")), type(side)
+        np = self._nameplates.get(name)
+        if np is None:
+            if self._log_requests:
+                log.msg("creating nameplate#%s for app_id %s" %
+                        (name, self._app_id))
+            mailbox_id = self._generate_mailbox_id()
+            self._add_mailbox(mailbox_id, True, side, when) # ensure it exists
+            np = self._nameplates[name] = {"mailbox_id": mailbox_id,
+                                           "sides": {}}
+            self._mailbox_nameplates[mailbox_id] = name
+            self._nameplate_created(name)
+            self._db.execute("INSERT INTO `nameplates`"
+                             " (`app_id`, `name`, `mailbox_id`)"
+                             " VALUES(?,?,?)",
+                             (self._app_id, name, mailbox_id))
+        mailbox_id = np["mailbox_id"]
+
+        row = np["sides"].get(side)
+        if not row:
+            np["sides"][side] = {"side": side, "claimed": True, "added": when}
+            self._db.execute("INSERT INTO `nameplate_sides`"
+                             " (`nameplates_id`, `claimed`, `side`, `added`)"
+                             " VALUES((SELECT `id` FROM `nameplates`"
+                             "         WHERE `app_id`=? AND `name`=?),?,?,?)",
+                             (self._app_id, name, True, side, when))
+        else:
+            if not row["claimed"]:
+                raise ReclaimedError("you cannot re-claim a nameplate that your side previously released")
+            # since that might cause a new mailbox to be allocated
+
+        self.open_mailbox(mailbox_id, side, when) # may raise CrowdedError
+        if len(np["sides"]) > 2:
+            # this line will probably never get hit: any crowding is noticed
+            # on mailbox_sides first, inside open_mailbox()
+            raise CrowdedError("too many sides have claimed this nameplate")
+        return mailbox_id
+
+    def release_nameplate(self, name, side, when):
+        assert isinstance(name, type("")), type(name)
+        assert isinstance(side, type("")), type(side)
+        np = self._nameplates.get(name)
+        if np is None:
+            return
+        row = np["sides"].get(side)
+        if not row:
+            return
+        row["claimed"] = False
+        self._db.execute("UPDATE `nameplate_sides` SET `claimed`=?"
+                         " WHERE `nameplates_id`=(SELECT `id` FROM `nameplates`"
+                         "                        WHERE `app_id`=? AND `name`=?)"
+                         " AND `side`=?",
+                         (False, self._app_id, name, side))
+
+        # now, are there any remaining claims?
+        side_rows = list(np["sides"].values())
+        if any([sr["claimed"] for sr in side_rows]):
+            return
+        # delete and summarize
+        self._delete_nameplate(name)
+        self._summarize_nameplate_and_store(side_rows, when, pruned=False)
+
+    def _delete_nameplate(self, name):
+        np = self._nameplates.pop(name)
+        self._mailbox_nameplates.pop(np["mailbox_id"], None)
+        self._nameplate_deleted(name)
+        self._db.execute("DELETE FROM `nameplate_sides` WHERE `nameplates_id`="
+                         "(SELECT `id` FROM `nameplates`"
+                         " WHERE `app_id`=? AND `name`=?)",
+                         (self._app_id, name))
+        self._db.execute("DELETE FROM `nameplates`"
+                         " WHERE `app_id`=? AND `name`=?",
+                         (self._app_id, name))
+
+    def _add_mailbox(self, mailbox_id, for_nameplate, side, when):
+        assert isinstance(mailbox_id, type("")), type(mailbox_id)
+        if mailbox_id in self._mailboxes:
+            return
+        if self._log_requests:
+            log.msg("spawning #%s for app_id %s" % (mailbox_id,
+                                                    self._app_id))
+        self._mailboxes[mailbox_id] = MemoryMailbox(self, self._db,
+                                                    self._app_id, mailbox_id,
+                                                    for_nameplate, when)
+        self._mailbox_touched(mailbox_id, when)
+        self._db.execute("INSERT INTO `mailboxes`"
+                         " (`app_id`, `id`, `for_nameplate`, `updated`)"
+                         " VALUES(?,?,?,?)",
+                         (self._app_id, mailbox_id, for_nameplate, when))
+
+    def open_mailbox(self, mailbox_id, side, when):
+        assert isinstance(mailbox_id, type("")), type(mailbox_id)
+        self._add_mailbox(mailbox_id, False, side, when) # ensure it exists
+        mailbox = self._mailboxes[mailbox_id]
+        mailbox.open(side, when)
+        if len(mailbox._sides) > 2:
+            raise CrowdedError("too many sides have opened this mailbox")
+        return mailbox
+
+    def _delete_mailbox(self, mailbox):
+        mailbox_id = mailbox._mailbox_id
+        self._db.execute("DELETE FROM `messages` WHERE `mailbox_id`=?",
+                         (mailbox_id,))
+        self._db.execute("DELETE FROM `mailbox_sides` WHERE `mailbox_id`=?",
+                         (mailbox_id,))
+        self._db.execute("DELETE FROM `mailboxes` WHERE `id`=?", (mailbox_id,))
+        self._messages_deleted(len(mailbox._messages))
+        self._mailbox_deleted(mailbox_id)
+        self.free_mailbox(mailbox_id)
+
+    def prune(self, now, old):
+        # same policy as AppNamespace.prune()
+        old_mailboxes = []
+        for mailbox_id in self._expiry.pop_expired(old):
+            mailbox = self._mailboxes[mailbox_id]
+            if mailbox.has_listeners():
+                mailbox._touch(now)
+            else:
+                old_mailboxes.append(mailbox)
+        if not old_mailboxes:
+            return
+
+        pruned_nameplates = 0
+        for mailbox in old_mailboxes:
+            name = self._mailbox_nameplates.get(mailbox._mailbox_id)
+            if name is not None:
+                side_rows = list(self._nameplates[name]["sides"].values())
+                self._delete_nameplate(name)
+                self._summarize_nameplate_and_store(side_rows, now,
+                                                    pruned=True)
+                pruned_nameplates += 1
+            side_rows = list(mailbox._sides.values())
+            self._delete_mailbox(mailbox)
+            self._summarize_mailbox_and_store(mailbox._for_nameplate,
+                                              side_rows, now, pruned=True)
+        log.msg(" pruned %d nameplates and %d mailboxes (%s)" %
+                (pruned_nameplates, len(old_mailboxes), self._app_id))
+
+
+class MemoryRendezvous(Rendezvous):
+    """A Rendezvous whose channel state lives in memory.
+
+    The database is only written by the write-behind log, and read once at
+    startup to recover any channels that were open when the previous server
+    process was shut down.
+    """
+
+    def __init__(self, db, welcome, blur_usage, allow_list,
+                 flush_period=FLUSH_PERIOD, shard=None, worker=None):
+        self._store = WriteBehindLog(db, worker) # used by _load()
+        Rendezvous.__init__(self, db, welcome, blur_usage, allow_list, shard)
+        t = internet.TimerService(flush_period, self.flush)
+        t.setServiceParent(self)
+
+    def _make_app(self, app_id):
+        return MemoryAppNamespace(
+            self._store,
+            self._blur_usage,
+            self._log_requests,
+            app_id,
+            self._allow_list,
+            self._counters,
+            self._shard,
+        )
+
+    def _load(self):
+        db = self._db
+        mailboxes = {}
+        for row in db.execute("SELECT * FROM `mailboxes`").fetchall():
+            app = self.get_app(row["app_id"])
+            mailbox = MemoryMailbox(app, self._store, row["app_id"],
+                                    row["id"], row["for_nameplate"],
+                                    row["updated"])
+            app._mailboxes[row["id"]] = mailbox
+            app._mailbox_touched(row["id"], row["updated"])
+            mailboxes[row["id"]] = mailbox
+        for row in db.execute("SELECT * FROM `mailbox_sides`").fetchall():
+            mailbox = mailboxes[row["mailbox_id"]]
+            mailbox._sides[row["side"]] = {"side": row["side"],
+                                           "opened": row["opened"],
+                                           "added": row["added"],
+                                           "mood": row["mood"]}
+        for row in db.execute("SELECT * FROM `messages`"
+                              " ORDER BY `server_rx` ASC").fetchall():
+            mailbox = mailboxes.get(row["mailbox_id"])
+            if mailbox is None:
+                continue
+            sm = SidedMessage(side=row["side"], phase=row["phase"],
+                              body=row["body"], server_rx=row["server_rx"],
+                              msg_id=row["msg_id"])
+            mailbox._messages.append(sm)
+            mailbox._app._message_added()
+
+        nameplates = {}
+        for row in db.execute("SELECT * FROM `nameplates`").fetchall():
+            app = self.get_app(row["app_id"])
+            np = app._nameplates[row["name"]] = {
+                "mailbox_id": row["mailbox_id"], "sides": {}}
+            app._mailbox_nameplates[row["mailbox_id"]] = row["name"]
+            app._active_nameplates += 1
+            nameplates[row["id"]] = np
+        for row in db.execute("SELECT * FROM `nameplate_sides`").fetchall():
+            np = nameplates[row["nameplates_id"]]
+            np["sides"][row["side"]] = {"side": row["side"],
+                                        "claimed": row["claimed"],
+                                        "added": row["added"]}
+        if self._apps:
+            log.msg("loaded %d nameplates and %d mailboxes from the database"
+                    % (len(nameplates), len(mailboxes)))
+
+    def flush(self):
+        return self._store.flush()
+
+    def stopService(self):
+        d = Rendezvous.stopService(self)
+        self.flush()
+        return d
@@ -0,0 +1,75 @@
+from __future__ import unicode_literals
+from twisted.python import log
+from twisted.internet import protocol
+from twisted.protocols.basic import Int32StringReceiver
+from .rendezvous_websocket import RendezvousCommands
+from ..framing import (TCP_MAX_FRAME, choose_protocol, encode_offer,
+                       decode_offer)
+
+# Clients that don't need to get through browsers or HTTP proxies can use a
+# plain TCP connection instead of a websocket (see framing.py for the
+# framing and the negotiation). The commands and responses are exactly the
+# same, and so is everything behind them: these connections are handled by
+# the same RendezvousCommands code, share the WebSocketRendezvousFactory's
+# limits, metrics, and set of open connections, and are drained like the
+# websocket ones during a handoff.
+
+class TCPRendezvous(RendezvousCommands, Int32StringReceiver):
+    MAX_LENGTH = TCP_MAX_FRAME
+
+    def __init__(self):
+        RendezvousCommands.__init__(self)
+        self._negotiated = False
+
+    def connectionMade(self):
+        if self.factory.rendezvous.get_log_requests():
+            log.msg("tcp client connecting: %s" % (self.transport.getPeer(),))
+        # instead of websocket pings, to notice clients that vanished
+        if hasattr(self.transport, "setTcpKeepAlive"):
+            self.transport.setTcpKeepAlive(True)
+
+    def stringReceived(self, data):
+        if self._negotiated:
+            self.onMessage(data, self._codec.binary)
+            return
+        self._negotiated = True
+        protocol = choose_protocol(decode_offer(data))
+        if not self._admit(protocol):
+            self.transport.loseConnection()
+            return
+        self.sendString(encode_offer([protocol] if protocol else []))
+        self.onOpen()
+
+    def lengthLimitExceeded(self, length):
+        self.dropConnection(abort=True)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.onClose(False, None, reason.getErrorMessage())
+
+    # the parts of an Autobahn protocol that RendezvousCommands uses
+
+    def sendMessage(self, payload, isBinary=False):
+        self.sendString(payload)
+
+    def dropConnection(self, abort=False):
+        if abort:
+            self.transport.abortConnection()
+        else:
+            self.transport.loseConnection()
+
+    def registerProducer(self, producer, streaming):
+        self.transport.registerProducer(producer, streaming)
+
+
+class TCPRendezvousFactory(protocol.Factory):
+    """I make TCPRendezvous protocols for a WebSocketRendezvousFactory,
+    which they use as their own factory."""
+    protocol = TCPRendezvous
+
+    def __init__(self, wsfactory):
+        self.wsfactory = wsfactory
+
+    def buildProtocol(self, addr):
+        p = self.protocol()
+        p.factory = self.wsfactory
+        return p
@@ -1,10 +1,15 @@
 from __future__ import unicode_literals
 import time
-from twisted.internet import reactor
-from twisted.python import log
+from twisted.internet import reactor, defer
+from twisted.python import log, failure
 from autobahn.twisted import websocket
+from autobahn.websocket.types import ConnectionDeny
 from .rendezvous import CrowdedError, ReclaimedError, SidedMessage
-from ..util import dict_to_bytes, bytes_to_dict
+from .metrics import Metrics
+from .outbound import OutboundLimits, Outbox
+from .admission import Admission
+from ..util import bytes_to_hexstr, hexstr_to_bytes
+from ..framing import JSON, FramingError, choose_protocol, codec_for
 
 # The WebSocket allows the client to send "commands" to the server, and the
 # server to send "responses" to the client. Note that commands and responses
@@ -64,10 +69,18 @@ from ..util import dict_to_bytes, bytes_to_dict
 #        current_cli_version: out-of-date clients display a warning
 #        motd: all clients display message, then continue normally
 #        error: all clients display mesage, then terminate with error
+#     .features lists the optional commands this server accepts
 # -> {type: "bind", appid:, side:}
 #
 # -> {type: "list"} -> nameplates
 #  <- {type: "nameplates", nameplates: [{id: str,..},..]}
+# -> {type: "subscribe-list"} -> nameplates, nameplates-changed
+#     like "list", but the connection then hears about every nameplate that
+#     is created or deleted, so clients can keep their completions fresh
+#     without asking again. Only offered when the welcome message has
+#     "subscribe-list" in its .features (a multi-worker server doesn't)
+#  <- {type: "nameplates", nameplates: [{id: str,..},..], subscribed: true}
+#  <- {type: "nameplates-changed", added: [{id:},..], removed: [{id:},..]}
 # -> {type: "allocate"} -> nameplate, mailbox
 #  <- {type: "allocated", nameplate: str}
 # -> {type: "claim", nameplate: str} -> mailbox
@@ -91,70 +104,170 @@ from ..util import dict_to_bytes, bytes_to_dict
 # -> {type: "ping", ping: int} -> pong (does not require bind/claim)
 #  <- {type: "pong", pong: int}
 
+def encode_message(sm, codec=JSON):
+    """Return the "message" response for a SidedMessage, encoded by 'codec'
+    but without the trailing server_tx, so that each connection can add its
+    own (with codec.finish). This is cached on the SidedMessage, so a message
+    is only encoded once (per codec), however many listeners it has, and
+    however many times it is replayed (by the memory engine, which keeps the
+    same objects around)."""
+    if sm.encoded is None:
+        sm.encoded = {}
+    if codec.name not in sm.encoded:
+        body = sm.body
+        if codec.binary:
+            body = _raw_body(body)
+        d = {"type": "message", "side": sm.side, "phase": sm.phase,
+             "body": body, "server_rx": sm.server_rx, "id": sm.msg_id}
+        sm.encoded[codec.name] = codec.encode_partial(d)
+    return sm.encoded[codec.name]
+
+def _raw_body(body):
+    # we store bodies as hex, since that's what JSON clients send us, but we
+    # never checked that they were valid, so pass anything else unchanged
+    try:
+        return hexstr_to_bytes(body)
+    except (TypeError, ValueError):
+        return body
+
+def _peer_address(peer):
+    # IPv4Address and IPv6Address have a .host, but UNIXAddress does not
+    return getattr(peer, "host", None) or str(peer)
+
 class Error(Exception):
     def __init__(self, explain):
         self._explain = explain
 
-class WebSocketRendezvous(websocket.WebSocketServerProtocol):
+class RendezvousCommands(object):
+    """I handle the commands of one client connection, and send its
+    responses, whatever carries them. A subclass provides the transport, in
+    the shape of an Autobahn protocol: it calls _admit() when the client
+    connects, then onOpen(), onMessage() for each command, and onClose(),
+    and provides sendMessage(), dropConnection(), and registerProducer().
+    Its factory is (or looks like) a WebSocketRendezvousFactory."""
     def __init__(self):
-        websocket.WebSocketServerProtocol.__init__(self)
-        self._app = None
+        self._session = None # set by "bind"
+        self._app_id = None
         self._side = None
         self._did_allocate = False # only one allocate() per websocket
-        self._listening = False
         self._did_claim = False
         self._nameplate_id = None
         self._did_release = False
-        self._did_open = False
-        self._mailbox = None
+        self._mailbox_open = False
         self._mailbox_id = None
+        self._delivered = 0 # messages sent from the open mailbox
         self._did_close = False
-
-    def onConnect(self, request):
-        rv = self.factory.rendezvous
-        if rv.get_log_requests():
-            log.msg("ws client connecting: %s" % (request.peer,))
+        self._held = None # outbound messages waiting for a DB commit
+        self._codec = JSON # or framing.BINARY, if the client asks for it
+        self._outbox = None # created when the websocket is open
+        self._address = None # the client's, once admitted
+        self._opened = False
+        # Commands are handled one at a time, in order. They normally finish
+        # immediately, but in a multi-worker server the nameplate or mailbox
+        # might live in another process.
+        self._queue = []
+        self._waiting = False # for the current command to finish
+
+    def _admit(self, protocol):
+        """Decide whether to accept this client, which asked for 'protocol'
+        (see framing.py). Returns False if it has too many connections."""
         self._reactor = self.factory.reactor
+        address = _peer_address(self.transport.getPeer())
+        if not self.factory.admission.connect(address):
+            return False
+        self._address = address
+        self._codec = codec_for(protocol)
+        return True
 
     def onOpen(self):
         rv = self.factory.rendezvous
-        self.send("welcome", welcome=rv.get_welcome())
+        self._opened = True
+        self.factory.connections.add(self)
+        self.factory.metrics.connection_opened()
+        self._outbox = Outbox(self, self.factory.outbound,
+                              self.factory.reactor)
+        features = []
+        if not self.factory.router:
+            features.append("subscribe-list")
+        self.send("welcome", welcome=rv.get_welcome(), features=features)
 
     def onMessage(self, payload, isBinary):
         server_rx = time.time()
-        msg = bytes_to_dict(payload)
-        try:
-            if "type" not in msg:
-                raise Error("missing 'type'")
-            self.send("ack", id=msg.get("id"))
-
-            mtype = msg["type"]
-            if mtype == "ping":
-                return self.handle_ping(msg)
-            if mtype == "bind":
-                return self.handle_bind(msg)
-
-            if not self._app:
-                raise Error("must bind first")
-            if mtype == "list":
-                return self.handle_list()
-            if mtype == "allocate":
-                return self.handle_allocate(server_rx)
-            if mtype == "claim":
-                return self.handle_claim(msg, server_rx)
-            if mtype == "release":
-                return self.handle_release(msg, server_rx)
-
-            if mtype == "open":
-                return self.handle_open(msg, server_rx)
-            if mtype == "add":
-                return self.handle_add(msg, server_rx)
-            if mtype == "close":
-                return self.handle_close(msg, server_rx)
-
-            raise Error("unknown type")
-        except Error as e:
-            self.send("error", error=e._explain, orig=msg)
+        msg = self._codec.decode(payload)
+        self.factory.metrics.command(msg.get("type"))
+        self._queue.append((msg, server_rx))
+        if len(self._queue) == 1:
+            self._process_queue()
+
+    def _process_queue(self):
+        # while the server is handing off (see handoff.py), commands wait
+        while self._queue and not self._waiting and not self.factory.frozen:
+            msg, server_rx = self._queue[0]
+            done = []
+            d = defer.maybeDeferred(self._dispatch, msg, server_rx)
+            d.addErrback(self._command_failed, msg)
+            d.addBoth(self._command_done, msg, server_rx)
+            d.addBoth(done.append)
+            if not done:
+                # wait for the other worker, then carry on
+                self._waiting = True
+                d.addCallback(self._resume_queue)
+                return
+
+    def _resume_queue(self, _):
+        self._waiting = False
+        self._process_queue()
+
+    def _command_failed(self, f, msg):
+        if f.check(Error):
+            self.send("error", error=f.value._explain, orig=msg)
+            return
+        return f
+
+    def _command_done(self, res, msg, server_rx):
+        self._queue.pop(0)
+        # this includes decoding the command and encoding any responses
+        # that weren't held for a commit, but not the commit itself
+        self.factory.metrics.command_done(msg.get("type"),
+                                          time.time() - server_rx)
+        if isinstance(res, failure.Failure):
+            log.err(res, "error while handling %r" % (msg.get("type"),))
+
+    def _dispatch(self, msg, server_rx):
+        if "type" not in msg:
+            raise Error("missing 'type'")
+        self.send("ack", id=msg.get("id"))
+
+        mtype = msg["type"]
+        if (self._address is not None and
+            not self.factory.admission.allow_command(self._address, mtype)):
+            raise Error("too many requests, slow down")
+        if mtype == "ping":
+            return self.handle_ping(msg)
+        if mtype == "bind":
+            return self.handle_bind(msg)
+
+        if not self._session:
+            raise Error("must bind first")
+        if mtype == "list":
+            return self.handle_list()
+        if mtype == "subscribe-list":
+            return self.handle_subscribe_list()
+        if mtype == "allocate":
+            return self.handle_allocate(server_rx)
+        if mtype == "claim":
+            return self.handle_claim(msg, server_rx)
+        if mtype == "release":
+            return self.handle_release(msg, server_rx)
+
+        if mtype == "open":
+            return self.handle_open(msg, server_rx)
+        if mtype == "add":
+            return self.handle_add(msg, server_rx)
+        if mtype == "close":
+            return self.handle_close(msg, server_rx)
+
+        raise Error("unknown type")
 
     def handle_ping(self, msg):
         if "ping" not in msg:
@@ -162,30 +275,88 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
         self.send("pong", pong=msg["ping"])
 
     def handle_bind(self, msg):
-        if self._app or self._side:
+        if self._session or self._side:
             raise Error("already bound")
         if "appid" not in msg:
             raise Error("bind requires 'appid'")
         if "side" not in msg:
             raise Error("bind requires 'side'")
-        self._app = self.factory.rendezvous.get_app(msg["appid"])
+        router = self.factory.router
+        if router:
+            self._session = router.open_session(msg["appid"], msg["side"],
+                                                self._shard_lost)
+        else:
+            rv = self.factory.rendezvous
+            self._session = rv.open_session(msg["appid"], msg["side"])
+        self._app_id = msg["appid"]
         self._side = msg["side"]
 
+    def hand_off(self, router, when):
+        """Move my session to 'router', which leads to the server process
+        that now owns the channel state. Returns a Deferred."""
+        old = self._session
+        if old is None:
+            return defer.succeed(None)
+        self._session = router.open_session(self._app_id, self._side,
+                                            self._shard_lost)
+        old.disconnect()
+        if not self._mailbox_open:
+            return defer.succeed(None)
+        # re-subscribe, and send only the messages that arrived since the
+        # old server wrote its state, which the client hasn't seen yet
+        d = self._session.open(self._mailbox_id, when, self._send_message,
+                               lambda: None)
+        def _opened(messages):
+            for sm in messages[self._delivered:]:
+                self._send_message(sm)
+        def _failed(f):
+            log.err(f, "unable to hand off a session")
+            self._shard_lost()
+        d.addCallbacks(_opened, _failed)
+        return d
+
+    def _shard_lost(self):
+        # another worker has lost our channel state, so make the client
+        # reconnect and rebuild it, like it would if the server restarted
+        log.msg("lost connection to a shard, dropping client")
+        self.dropConnection(abort=True)
 
     def handle_list(self):
-        nameplate_ids = sorted(self._app.get_nameplate_ids())
-        # provide room to add nameplate attributes later (like which wordlist
-        # is used for each, maybe how many words)
-        nameplates = [{"id": nid} for nid in nameplate_ids]
-        self.send("nameplates", nameplates=nameplates)
+        d = defer.maybeDeferred(self._session.list_nameplates)
+        def _listed(nameplate_ids):
+            # provide room to add nameplate attributes later (like which
+            # wordlist is used for each, maybe how many words)
+            nameplates = [{"id": nid} for nid in nameplate_ids]
+            self.send("nameplates", nameplates=nameplates)
+        d.addCallback(_listed)
+        return d
+
+    def handle_subscribe_list(self):
+        subscribe_list = getattr(self._session, "subscribe_list", None)
+        if subscribe_list is None:
+            # a worker's nameplates are spread over every shard, so it
+            # can't push changes (and didn't offer to)
+            return self.handle_list()
+        nameplate_ids = subscribe_list(self._nameplates_changed)
+        self.send("nameplates", nameplates=[{"id": nid}
+                                            for nid in nameplate_ids],
+                  subscribed=True)
+
+    def _nameplates_changed(self, added, removed):
+        self.send("nameplates-changed",
+                  added=[{"id": nid} for nid in added],
+                  removed=[{"id": nid} for nid in removed])
 
     def handle_allocate(self, server_rx):
         if self._did_allocate:
             raise Error("you already allocated one, don't be greedy")
-        nameplate_id = self._app.allocate_nameplate(self._side, server_rx)
-        assert isinstance(nameplate_id, type(""))
-        self._did_allocate = True
-        self.send("allocated", nameplate=nameplate_id)
+        d = defer.maybeDeferred(self._session.allocate, server_rx)
+        def _allocated(nameplate_id):
+            assert isinstance(nameplate_id, type(""))
+            self._did_allocate = True
+            self.send("allocated", nameplate=nameplate_id)
+        d.addCallback(_allocated)
+        return d
 
     def handle_claim(self, msg, server_rx):
         if "nameplate" not in msg:
@@ -196,14 +367,16 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
         nameplate_id = msg["nameplate"]
         assert isinstance(nameplate_id, type("")), type(nameplate_id)
         self._nameplate_id = nameplate_id
-        try:
-            mailbox_id = self._app.claim_nameplate(nameplate_id, self._side,
-                                                   server_rx)
-        except CrowdedError:
-            raise Error("crowded")
-        except ReclaimedError:
+        d = defer.maybeDeferred(self._session.claim, nameplate_id, server_rx)
+        def _claimed(mailbox_id):
+            self.send("claimed", mailbox=mailbox_id)
+        def _failed(f):
+            f.trap(CrowdedError, ReclaimedError)
+            if f.check(CrowdedError):
+                raise Error("crowded")
             raise Error("reclaimed")
-        self.send("claimed", mailbox=mailbox_id)
+        d.addCallbacks(_claimed, _failed)
+        return d
 
     def handle_release(self, msg, server_rx):
         if self._did_release:
@@ -219,44 +392,62 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
             nameplate_id = self._nameplate_id
         assert nameplate_id is not None
         self._did_release = True
-        self._app.release_nameplate(nameplate_id, self._side, server_rx)
-        self.send("released")
-
+        d = defer.maybeDeferred(self._session.release, nameplate_id,
+                                server_rx)
+        d.addCallback(lambda _: self.send("released"))
+        return d
 
     def handle_open(self, msg, server_rx):
-        if self._mailbox:
+        if self._mailbox_open:
             raise Error("only one open per connection")
         if "mailbox" not in msg:
             raise Error("open requires 'mailbox'")
         mailbox_id = msg["mailbox"]
         assert isinstance(mailbox_id, type(""))
         self._mailbox_id = mailbox_id
-        try:
-            self._mailbox = self._app.open_mailbox(mailbox_id, self._side,
-                                                   server_rx)
-        except CrowdedError:
-            raise Error("crowded")
-        def _send(sm):
-            self.send("message", side=sm.side, phase=sm.phase,
-                      body=sm.body, server_rx=sm.server_rx, id=sm.msg_id)
         def _stop():
             pass
-        self._listening = True
-        for old_sm in self._mailbox.add_listener(self, _send, _stop):
-            _send(old_sm)
+        d = defer.maybeDeferred(self._session.open, mailbox_id, server_rx,
+                                self._send_message, _stop)
+        def _opened(old_messages):
+            self._mailbox_open = True
+            for old_sm in old_messages:
+                self._send_message(old_sm)
+        d.addCallbacks(_opened, self._crowded)
+        return d
+
+    def _send_message(self, sm):
+        self._delivered += 1
+        self.factory.metrics.messages_sent += 1
+        self._send_or_hold(encode_message(sm, self._codec))
+
+    def _crowded(self, f):
+        f.trap(CrowdedError)
+        raise Error("crowded")
 
     def handle_add(self, msg, server_rx):
-        if not self._mailbox:
+        if not self._mailbox_open:
             raise Error("must open mailbox before adding")
         if "phase" not in msg:
             raise Error("missing 'phase'")
         if "body" not in msg:
             raise Error("missing 'body'")
         msg_id = msg.get("id") # optional
+        body = msg["body"]
+        if self._codec.binary:
+            # raw bytes on the wire, but we store hex, like JSON clients send
+            try:
+                body = bytes_to_hexstr(self._codec.body_from_wire(body))
+            except FramingError as e:
+                raise Error(str(e))
         sm = SidedMessage(side=self._side, phase=msg["phase"],
-                          body=msg["body"], server_rx=server_rx,
+                          body=body, server_rx=server_rx,
                           msg_id=msg_id)
-        self._mailbox.add_message(sm)
+        d = defer.maybeDeferred(self._session.add, sm)
+        def _added(_):
+            self.factory.metrics.messages_added += 1
+        d.addCallback(_added)
+        return d
 
     def handle_close(self, msg, server_rx):
         if self._did_close:
@@ -270,37 +461,128 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
             if self._mailbox_id is None:
                 raise Error("close without mailbox must follow open")
             mailbox_id = self._mailbox_id
-        if not self._mailbox:
-            try:
-                self._mailbox = self._app.open_mailbox(mailbox_id, self._side,
-                                                       server_rx)
-            except CrowdedError:
-                raise Error("crowded")
-        if self._listening:
-            self._mailbox.remove_listener(self)
-            self._listening = False
-        self._did_close = True
-        self._mailbox.close(self._side, msg.get("mood"), server_rx)
-        self._mailbox = None
-        self.send("closed")
+        d = defer.maybeDeferred(self._session.close, mailbox_id,
+                                msg.get("mood"), server_rx)
+        def _closed(_):
+            self._did_close = True
+            self._mailbox_open = False
+            self.send("closed")
+        d.addCallbacks(_closed, self._crowded)
+        return d
 
     def send(self, mtype, **kwargs):
         kwargs["type"] = mtype
-        kwargs["server_tx"] = time.time()
-        payload = dict_to_bytes(kwargs)
-        self.sendMessage(payload, False)
+        self._send_or_hold(kwargs)
+
+    def _send_or_hold(self, response):
+        # 'response' is a dict, or a pre-encoded one from encode_message().
+        # If the database has uncommitted writes, they might be the result
+        # of this message (or of an earlier one), so we hold everything
+        # until the group commit is complete. Responses are thus never sent
+        # before the state they describe is durable, and stay in order.
+        committer = self.factory.committer
+        if self._held is None and committer and committer.pending():
+            self._held = []
+            d = committer.when_committed()
+            d.addCallbacks(self._release_held, self._commit_failed)
+        if self._held is not None:
+            self._held.append(response)
+            return
+        self._write(response)
+
+    def _release_held(self, _):
+        held, self._held = self._held, None
+        for response in held:
+            self._write(response)
+
+    def _commit_failed(self, f):
+        # the relay's state is suspect, so don't pretend otherwise
+        self._held = None
+        self.dropConnection(abort=True)
+
+    def _write(self, response):
+        server_tx = time.time()
+        codec = self._codec
+        if isinstance(response, dict):
+            response["server_tx"] = server_tx
+            payload = codec.encode(response)
+        else:
+            payload = codec.finish(response, server_tx)
+        if self._outbox:
+            self._outbox.write(payload, codec.binary)
+        else:
+            self.sendMessage(payload, codec.binary)
 
     def onClose(self, wasClean, code, reason):
-        #log.msg("onClose", self, self._mailbox, self._listening)
-        if self._mailbox and self._listening:
-            self._mailbox.remove_listener(self)
+        #log.msg("onClose", self, self._mailbox_id)
+        if self._opened:
+            self._opened = False
+            self.factory.connections.discard(self)
+            self.factory.metrics.connection_closed()
+        if self._outbox:
+            self._outbox.stopProducing()
+        if self._address is not None:
+            self.factory.admission.disconnect(self._address)
+            self._address = None
+        if self._session:
+            self._session.disconnect()
+
+
+class WebSocketRendezvous(RendezvousCommands,
+                          websocket.WebSocketServerProtocol):
+    def __init__(self):
+        websocket.WebSocketServerProtocol.__init__(self)
+        RendezvousCommands.__init__(self)
+
+    def onConnect(self, request):
+        rv = self.factory.rendezvous
+        if rv.get_log_requests():
+            log.msg("ws client connecting: %s" % (request.peer,))
+        protocol = choose_protocol(request.protocols)
+        if not self._admit(protocol):
+            raise ConnectionDeny(429, "too many connections")
+        return protocol
 
 
 class WebSocketRendezvousFactory(websocket.WebSocketServerFactory):
     protocol = WebSocketRendezvous
 
-    def __init__(self, url, rendezvous):
+    def __init__(self, url, rendezvous, committer=None, metrics=None,
+                 router=None, outbound=None, admission=None):
         websocket.WebSocketServerFactory.__init__(self, url)
         self.setProtocolOptions(autoPingInterval=60, autoPingTimeout=600)
         self.rendezvous = rendezvous
+        self.committer = committer
+        self.router = router # for multi-worker servers, see routing.py
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        if outbound is None:
+            outbound = OutboundLimits()
+        self.outbound = outbound # see outbound.py
         self.reactor = reactor # for tests to control
+        if admission is None:
+            admission = Admission(self.reactor)
+        self.admission = admission # see admission.py
+        self.connections = set() # open ones
+        self.frozen = False
+
+    def freeze(self):
+        """Hold every connection's commands until thaw()."""
+        self.frozen = True
+
+    def thaw(self):
+        self.frozen = False
+        for p in list(self.connections):
+            p._process_queue()
+
+    def hand_off(self, router, when):
+        """Move every connection's session to 'router' (see handoff.py),
+        which is then used for new sessions too, and thaw."""
+        ds = [p.hand_off(router, when) for p in list(self.connections)]
+        d = defer.DeferredList(ds)
+        def _done(_):
+            self.router = router
+            self.thaw()
+        d.addCallback(_done)
+        return d
@@ -0,0 +1,123 @@
+from __future__ import unicode_literals
+from twisted.python import log
+
+# Every closed nameplate and mailbox adds a row to `nameplate_usage` or
+# `mailbox_usage`, and those rows are never deleted, so a busy relay's
+# database grows forever. We also summarize each row into hourly and daily
+# buckets in `usage_rollups`, per app_id and result, with the sums and
+# histograms of its waiting and total times. The buckets are updated in the
+# same transaction that adds the raw row (like `usage_counters`), so they
+# are always complete, and the raw rows can be deleted once they are older
+# than the --usage-retention window without losing anything but detail.
+
+HOUR = 60*60
+DAY = 24*HOUR
+PERIODS = [HOUR, DAY]
+# upper bounds (in seconds) of the histogram buckets, plus an overflow
+# bucket. These match the `*_le_N` columns of `usage_rollups`.
+HISTOGRAM_BOUNDS = [1, 10, 60, 600, 3600]
+MAX_KNOWN_BUCKETS = 10000
+RETENTION_BATCH = 10000 # raw rows deleted per transaction
+
+def histogram_column(prefix, seconds):
+    for bound in HISTOGRAM_BOUNDS:
+        if seconds <= bound:
+            return "%s_le_%d" % (prefix, bound)
+    return "%s_over" % prefix
+
+class UsageRollups(object):
+    """I add each usage row to its hourly and daily `usage_rollups` rows."""
+    def __init__(self):
+        # the bucket rows we've already created. This only saves an INSERT
+        # OR IGNORE per usage row, so it is simply emptied when it gets big.
+        self._known = set()
+
+    def add(self, db, kind, app_id, usage):
+        # like UsageCounters.increment, 'db' might be a write-behind log, so
+        # we can't look at the results of our statements
+        assignments = ["`count`=`count`+1",
+                       "`total_time_sum`=`total_time_sum`+?",
+                       "`{0}`=`{0}`+1".format(
+                           histogram_column("total", usage.total_time))]
+        values = [usage.total_time]
+        if usage.waiting_time is not None:
+            assignments.extend(["`waiting_count`=`waiting_count`+1",
+                                "`waiting_time_sum`=`waiting_time_sum`+?",
+                                "`{0}`=`{0}`+1".format(
+                                    histogram_column("waiting",
+                                                     usage.waiting_time))])
+            values.append(usage.waiting_time)
+        update = ("UPDATE `usage_rollups` SET " + ", ".join(assignments) +
+                  " WHERE `kind`=? AND `period`=? AND `start`=?"
+                  " AND `app_id`=? AND `result`=?")
+        if len(self._known) > MAX_KNOWN_BUCKETS:
+            self._known.clear()
+        for period in PERIODS:
+            key = (kind, period, period * (int(usage.started) // period),
+                   app_id, usage.result)
+            if key not in self._known:
+                db.execute("INSERT OR IGNORE INTO `usage_rollups`"
+                           " (`kind`, `period`, `start`, `app_id`, `result`)"
+                           " VALUES (?,?,?,?,?)", key)
+                self._known.add(key)
+            db.execute(update, tuple(values) + key)
+
+def _delete_expired(db, table, cutoff, batch):
+    c = db.execute("DELETE FROM `{0}` WHERE `rowid` IN"
+                   " (SELECT `rowid` FROM `{0}` WHERE `started` < ?"
+                   "  LIMIT ?)".format(table), (cutoff, batch))
+    db.commit()
+    return c.rowcount
+
+class UsageRetention(object):
+    """I delete raw usage rows that are older than 'retention' seconds.
+
+    A large backlog (e.g. the first time retention is enabled on an old
+    relay) is deleted RETENTION_BATCH rows at a time, with a reactor turn
+    between the batches, so clients are not stalled while it happens. If
+    I'm given a DatabaseWorker, the batches run in its thread instead.
+    """
+    TABLES = ["nameplate_usage", "mailbox_usage"]
+
+    def __init__(self, db, reactor, retention, batch=RETENTION_BATCH,
+                 worker=None):
+        self._db = db
+        self._worker = worker
+        self._reactor = reactor
+        self._retention = retention
+        self._batch = batch
+        self._running = False
+        self._pass_deleted = 0
+        self.deleted = 0
+
+    def prune(self, now):
+        if self._running:
+            return # still working through the previous backlog
+        self._running = True
+        self._pass_deleted = 0
+        self._prune_batch(now - self._retention, list(self.TABLES))
+
+    def _prune_batch(self, cutoff, tables):
+        args = (tables[0], cutoff, self._batch)
+        if self._worker is None:
+            self._deleted(_delete_expired(self._db, *args), cutoff, tables)
+            return
+        d = self._worker.run(_delete_expired, *args)
+        d.addCallback(self._deleted, cutoff, tables)
+        d.addErrback(self._failed)
+
+    def _failed(self, f):
+        self._running = False
+        log.err(f, "unable to delete expired usage rows")
+
+    def _deleted(self, count, cutoff, tables):
+        self.deleted += count
+        self._pass_deleted += count
+        if count < self._batch:
+            tables.pop(0)
+        if tables:
+            self._reactor.callLater(0, self._prune_batch, cutoff, tables)
+        else:
+            self._running = False
+            if self._pass_deleted:
+                log.msg("deleted %d expired usage rows" % self._pass_deleted)
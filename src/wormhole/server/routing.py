@@ -0,0 +1,377 @@
+from __future__ import print_function, unicode_literals
+import os
+from twisted.python import log, failure
+from twisted.internet import reactor, defer, endpoints, protocol
+from twisted.application import service, internet
+from twisted.protocols.basic import Int32StringReceiver
+from .rendezvous import CrowdedError, ReclaimedError, SidedMessage
+from .sharding import shard_of_nameplate, shard_of_mailbox
+from ..util import dict_to_bytes, bytes_to_dict
+
+# In a multi-worker server (wormhole-server start --workers=N), every worker
+# accepts websocket connections from the same listening socket, so the two
+# sides of a wormhole usually land on different workers. Each worker owns
+# one shard of the channel state (see sharding.py), and runs a ShardRouter,
+# which sends each connection's nameplate and mailbox operations to the
+# worker that owns them.
+#
+# Workers talk to each other over unix-domain sockets in a shared directory
+# (SOCKET_NAME, one per worker). Each frame is a length-prefixed JSON
+# object, one of:
+#
+#  {id:, op:, session:, app_id:, side:, ...} -> a request for the owner
+#  {response_to:, result:} or {response_to:, error:} -> its answer
+#  {deliver:, message: {side:, phase:, body:, server_rx:, msg_id:}}
+#
+# Requests with op "list" or "metrics" don't belong to any session: they ask
+# for the owner's nameplates, or its /metrics text.
+#
+# The owner runs a rendezvous.Session for each (link, session) pair, exactly
+# like a single-process server runs one for each websocket connection. When
+# a message is added to a mailbox, the owner's listener sends a "deliver"
+# frame back over the link that opened it, and the front worker writes it
+# to the websocket. Requests on one link are answered in order, and an
+# answer is sent only after the owner's database commit, just like
+# responses on a websocket.
+
+SOCKET_NAME = "shard-%d.sock"
+
+class ShardError(Exception):
+    """The worker that owns a nameplate or mailbox could not be reached."""
+
+_ERRORS = {"crowded": CrowdedError, "reclaimed": ReclaimedError}
+
+def _sm_to_dict(sm):
+    return {"side": sm.side, "phase": sm.phase, "body": sm.body,
+            "server_rx": sm.server_rx, "msg_id": sm.msg_id}
+
+def _dict_to_sm(d):
+    return SidedMessage(side=d["side"], phase=d["phase"], body=d["body"],
+                        server_rx=d["server_rx"], msg_id=d["msg_id"])
+
+class ShardLink(Int32StringReceiver):
+    MAX_LENGTH = 16*1024*1024
+
+    def connectionMade(self):
+        self._next_id = 0
+        self._pending = {} # id -> Deferred
+        self._lost = defer.Deferred()
+        self.factory.router.link_made(self)
+
+    def call(self, request):
+        self._next_id += 1
+        request["id"] = self._next_id
+        d = self._pending[self._next_id] = defer.Deferred()
+        self.sendString(dict_to_bytes(request))
+        return d
+
+    def deliver(self, session_id, sm):
+        self.sendString(dict_to_bytes({"deliver": session_id,
+                                       "message": _sm_to_dict(sm)}))
+
+    def stringReceived(self, data):
+        msg = bytes_to_dict(data)
+        router = self.factory.router
+        if "response_to" in msg:
+            d = self._pending.pop(msg["response_to"])
+            if "error" in msg:
+                error_class = _ERRORS.get(msg["error"], ShardError)
+                d.errback(error_class(msg["error"]))
+            else:
+                d.callback(msg.get("result"))
+        elif "deliver" in msg:
+            router.deliver(msg["deliver"], _dict_to_sm(msg["message"]))
+        else:
+            d = defer.maybeDeferred(router.execute, self, msg)
+            d.addBoth(self._respond, msg["id"])
+
+    def _respond(self, res, request_id):
+        response = {"response_to": request_id}
+        if isinstance(res, failure.Failure):
+            if res.check(CrowdedError):
+                response["error"] = "crowded"
+            elif res.check(ReclaimedError):
+                response["error"] = "reclaimed"
+            else:
+                log.err(res, "error in shard request")
+                response["error"] = "internal error"
+        else:
+            response["result"] = res
+        if self.transport.connected:
+            self.sendString(dict_to_bytes(response))
+
+    def connectionLost(self, why=None):
+        pending, self._pending = self._pending, {}
+        for d in pending.values():
+            d.errback(ShardError("lost connection to shard"))
+        self.factory.router.link_lost(self)
+        self._lost.callback(None)
+
+class ShardLinkFactory(protocol.Factory):
+    protocol = ShardLink
+
+    def __init__(self, router):
+        self.router = router
+
+
+class RoutingSession(object):
+    """I stand in for a rendezvous.Session, in a multi-worker server, and
+    send each operation to the worker that owns the nameplate or mailbox.
+
+    Every method returns a Deferred.
+    """
+    def __init__(self, router, session_id, app_id, side, lost_f):
+        self._router = router
+        self._session_id = session_id
+        self._app_id = app_id
+        self._side = side
+        self._lost_f = lost_f
+        self._send_f = None
+        self._mailbox_id = None
+        self.shards = set() # the ones holding state for us
+
+    def _call(self, shard, op, **kwargs):
+        request = {"op": op, "session": self._session_id,
+                   "app_id": self._app_id, "side": self._side}
+        request.update(kwargs)
+        self.shards.add(shard)
+        return self._router.call(shard, request)
+
+    def list_nameplates(self):
+        router = self._router
+        ds = [router.call(shard, {"op": "list", "app_id": self._app_id})
+              for shard in range(router.num_shards)]
+        d = defer.gatherResults(ds, consumeErrors=True)
+        d.addErrback(lambda f: f.value.subFailure)
+        d.addCallback(lambda results: sorted(set().union(*results)))
+        return d
+
+    def allocate(self, when):
+        # we only allocate nameplates from our own shard
+        return self._call(self._router.allocation_shard(), "allocate",
+                          when=when)
+
+    def claim(self, nameplate_id, when):
+        shard = shard_of_nameplate(self._app_id, nameplate_id,
+                                   self._router.num_shards)
+        return self._call(shard, "claim", nameplate=nameplate_id, when=when)
+
+    def release(self, nameplate_id, when):
+        shard = shard_of_nameplate(self._app_id, nameplate_id,
+                                   self._router.num_shards)
+        return self._call(shard, "release", nameplate=nameplate_id,
+                          when=when)
+
+    def _mailbox_shard(self, mailbox_id):
+        return shard_of_mailbox(self._app_id, mailbox_id,
+                                self._router.num_shards)
+
+    def open(self, mailbox_id, when, send_f, stop_f):
+        self._mailbox_id = mailbox_id
+        self._send_f = send_f
+        d = self._call(self._mailbox_shard(mailbox_id), "open",
+                       mailbox=mailbox_id, when=when)
+        d.addCallback(lambda messages: [_dict_to_sm(m) for m in messages])
+        return d
+
+    def add(self, sm):
+        return self._call(self._mailbox_shard(self._mailbox_id), "add",
+                          mailbox=self._mailbox_id, message=_sm_to_dict(sm))
+
+    def close(self, mailbox_id, mood, when):
+        return self._call(self._mailbox_shard(mailbox_id), "close",
+                          mailbox=mailbox_id, mood=mood, when=when)
+
+    def deliver(self, sm):
+        if self._send_f:
+            self._send_f(sm)
+
+    def lost(self):
+        self._lost_f()
+
+    def disconnect(self):
+        self._router.session_closed(self)
+
+
+class ShardRouter(service.MultiService):
+    """I connect one worker's websocket connections to the shards that hold
+    their channel state, and serve this worker's shard to the others.
+
+    With index=None I'm only a front end, and own no shard: an old server
+    that has handed its state to a new one uses me (see handoff.py).
+    """
+
+    def __init__(self, rendezvous, committer, index, num_shards, socket_dir,
+                 reactor=reactor):
+        service.MultiService.__init__(self)
+        self._rendezvous = rendezvous
+        self._committer = committer
+        self.index = index
+        self.num_shards = num_shards
+        self._socket_dir = socket_dir
+        self._reactor = reactor
+        self._factory = ShardLinkFactory(self)
+        self._links = {} # shard -> ShardLink, or list of waiting Deferreds
+        self._all_links = set() # both directions
+        self._next_session_id = 0
+        self._routing = {} # session_id -> RoutingSession (our clients)
+        self._sessions = {} # (link, session_id) -> Session (our shard)
+        # set by our RelayServer: returns our own /metrics text
+        self.metrics_text = None
+        if index is not None:
+            ep = endpoints.UNIXServerEndpoint(reactor,
+                                              self._socket_path(index))
+            internet.StreamServerEndpointService(ep, self._factory
+                                                 ).setServiceParent(self)
+
+    def _socket_path(self, index):
+        return os.path.join(self._socket_dir, SOCKET_NAME % index)
+
+    # the front end: used by our websocket connections
+
+    def allocation_shard(self):
+        # our own, or (if we have none) the first
+        return 0 if self.index is None else self.index
+
+    def open_session(self, app_id, side, lost_f):
+        self._next_session_id += 1
+        rs = RoutingSession(self, self._next_session_id, app_id, side,
+                            lost_f)
+        self._routing[rs._session_id] = rs
+        return rs
+
+    def session_closed(self, rs):
+        self._routing.pop(rs._session_id, None)
+        for shard in rs.shards:
+            d = self.call(shard, {"op": "disconnect",
+                                  "session": rs._session_id})
+            d.addErrback(lambda f: None) # its state is gone anyways
+
+    def call(self, shard, request):
+        if shard == self.index:
+            # our own shard: no need for a link, or to wait for a commit
+            # (our websocket will hold its responses until then anyways)
+            return defer.maybeDeferred(self.execute, None, request)
+        d = self._get_link(shard)
+        d.addCallback(lambda link: link.call(request))
+        return d
+
+    def _get_link(self, shard):
+        link = self._links.get(shard)
+        if isinstance(link, ShardLink):
+            return defer.succeed(link)
+        d = defer.Deferred()
+        if link is None:
+            self._links[shard] = [d]
+            self._connect(shard)
+        else:
+            link.append(d)
+        return d
+
+    def _connect(self, shard):
+        ep = endpoints.UNIXClientEndpoint(self._reactor,
+                                          self._socket_path(shard))
+        d = endpoints.connectProtocol(ep, self._factory.buildProtocol(None))
+        def _connected(link):
+            waiting, self._links[shard] = self._links[shard], link
+            for w in waiting:
+                w.callback(link)
+        def _failed(f):
+            log.msg("unable to reach shard %d: %s" % (shard, f.value))
+            waiting = self._links.pop(shard)
+            for w in waiting:
+                w.errback(ShardError("unable to reach shard %d" % shard))
+        d.addCallbacks(_connected, _failed)
+
+    def deliver(self, session_id, sm):
+        rs = self._routing.get(session_id)
+        if rs:
+            rs.deliver(sm)
+
+    # the back end: serving our shard to everyone's connections
+
+    def execute(self, link, request):
+        op = request["op"]
+        if op == "list":
+            app = self._rendezvous.get_app(request["app_id"])
+            return sorted(app.get_nameplate_ids())
+        if op == "metrics":
+            return self.metrics_text()
+        key = (link, request["session"])
+        if op == "disconnect":
+            session = self._sessions.pop(key, None)
+            if session:
+                session.disconnect()
+            return None
+        session = self._sessions.get(key)
+        if session is None:
+            session = self._rendezvous.open_session(request["app_id"],
+                                                    request["side"])
+            self._sessions[key] = session
+        when = request.get("when")
+        if op == "allocate":
+            result = session.allocate(when)
+        elif op == "claim":
+            result = session.claim(request["nameplate"], when)
+        elif op == "release":
+            result = session.release(request["nameplate"], when)
+        elif op == "open":
+            session_id = request["session"]
+            def send_f(sm):
+                self._send_message(link, session_id, sm)
+            old = session.open(request["mailbox"], when, send_f, lambda: None)
+            result = [_sm_to_dict(sm) for sm in old]
+        elif op == "add":
+            result = session.add(_dict_to_sm(request["message"]))
+        elif op == "close":
+            result = session.close(request["mailbox"], request.get("mood"),
+                                   when)
+        else:
+            raise ValueError("unknown shard op %r" % (op,))
+        if link is None:
+            return result
+        # like websocket responses, don't reveal anything before it's durable
+        d = self._when_committed()
+        d.addCallback(lambda _: result)
+        return d
+
+    def _when_committed(self):
+        if self._committer is None:
+            return defer.succeed(None)
+        return self._committer.when_committed()
+
+    def _send_message(self, link, session_id, sm):
+        if link is None:
+            self.deliver(session_id, sm)
+            return
+        d = self._when_committed()
+        def _send(_):
+            if link.transport.connected:
+                link.deliver(session_id, sm)
+        d.addCallback(_send)
+
+    def link_made(self, link):
+        self._all_links.add(link)
+
+    def link_lost(self, link):
+        self._all_links.discard(link)
+        # if it was one of ours, forget it, and tell the connections that
+        # were using that shard
+        for (shard, our_link) in list(self._links.items()):
+            if our_link is link:
+                del self._links[shard]
+                for rs in list(self._routing.values()):
+                    if shard in rs.shards:
+                        rs.lost()
+        # if it was one of theirs, drop the state it held here
+        for key in [key for key in self._sessions if key[0] is link]:
+            self._sessions.pop(key).disconnect()
+
+    def stopService(self):
+        d = defer.maybeDeferred(service.MultiService.stopService, self)
+        links = list(self._all_links)
+        for link in links:
+            link.transport.loseConnection()
+        d.addCallback(lambda _: defer.DeferredList([link._lost
+                                                    for link in links]))
+        return d
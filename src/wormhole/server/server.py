@@ -9,13 +9,23 @@ except ImportError: # pragma: nocover
     getrlimit, setrlimit, RLIMIT_NOFILE = None, None, None # pragma: nocover
 from twisted.python import log
 from twisted.internet import reactor, endpoints
+from twisted.internet.interfaces import IStreamServerEndpoint
 from twisted.application import service, internet
 from twisted.web import server, static
 from twisted.web.resource import Resource
 from autobahn.twisted.resource import WebSocketResource
-from .database import get_db
+from .database import get_db, GroupCommitter, DatabaseWorker
 from .rendezvous import Rendezvous
+from .rendezvous_memory import MemoryRendezvous
 from .rendezvous_websocket import WebSocketRendezvousFactory
+from .rendezvous_tcp import TCPRendezvousFactory
+from .metrics import (Metrics, MetricsResource, ShardedMetricsResource,
+                      ReactorLagProbe)
+from .routing import ShardRouter
+from .outbound import OutboundLimits
+from .admission import Admission, DEFAULT_BURST
+from .rollups import UsageRetention, DAY
+from .handoff import RecordingEndpoint, HandoffSource
 
 SECONDS = 1.0
 MINUTE = 60*SECONDS
@@ -40,13 +50,21 @@ class RelayServer(service.MultiService):
     def __init__(self, rendezvous_web_port,
                  advertise_version, db_url=":memory:", blur_usage=None,
                  signal_error=None, stats_file=None, allow_list=True,
-                 websocket_protocol_options=()):
+                 websocket_protocol_options=(), channel_engine="sqlite",
+                 commit_window=0.0, max_connections_per_ip=0,
+                 command_rate=0.0, command_burst=DEFAULT_BURST,
+                 usage_retention=None, handoff_socket=None,
+                 handoff_target=None, shard=None, shard_dir=None,
+                 rendezvous_tcp_port=None):
         service.MultiService.__init__(self)
         self._blur_usage = blur_usage
         self._allow_list = allow_list
         self._db_url = db_url
 
         db = get_db(db_url)
+        # coalesce the commits of all commands in one reactor turn (or
+        # commit_window seconds) into a single transaction
+        committer = GroupCommitter(db, reactor, commit_window)
         welcome = {
             # adding .motd will cause all clients to display the message,
             # then keep running normally
@@ -65,21 +83,115 @@ class RelayServer(service.MultiService):
         if signal_error:
             welcome["error"] = signal_error
 
-        self._rendezvous = Rendezvous(db, welcome, blur_usage, self._allow_list)
+        if channel_engine not in ("sqlite", "memory"):
+            raise ValueError("unknown channel engine %r" % (channel_engine,))
+        self._channel_engine = channel_engine
+        self._admission_limits = (max_connections_per_ip, command_rate)
+        # services are stopped in reverse order, so adding the committer
+        # (and the worker) first means they get to commit anything the
+        # Rendezvous writes during its own shutdown
+        committer.setServiceParent(self)
+        # The memory engine's writes don't have to be finished before we
+        # answer the client, so they can happen in another thread. The
+        # sqlite engine reads its state back from the database, so it has
+        # to stay on the reactor's connection.
+        worker = None
+        if channel_engine == "memory":
+            if db_url != ":memory:":
+                worker = DatabaseWorker(db_url, reactor)
+                worker.setServiceParent(self)
+            self._rendezvous = MemoryRendezvous(committer, welcome,
+                                                blur_usage, self._allow_list,
+                                                shard=shard, worker=worker)
+        else:
+            self._rendezvous = Rendezvous(committer, welcome, blur_usage,
+                                          self._allow_list, shard=shard)
         self._rendezvous.setServiceParent(self) # for the pruning timer
+        self._worker = worker
+        # raw usage rows older than this many days are deleted, leaving
+        # only their hourly/daily rollups
+        self._usage_retention = usage_retention
+        self._retention = None
+        if usage_retention is not None:
+            self._retention = UsageRetention(committer, reactor,
+                                             usage_retention * DAY,
+                                             worker=worker)
+
+        # in a multi-worker server (see workers.py), we are one shard
+        router = None
+        if shard is not None:
+            index, num_shards = shard
+            router = ShardRouter(self._rendezvous, committer, index,
+                                 num_shards, shard_dir)
+            router.setServiceParent(self)
+        self._shard = shard
+        # we're taking over from an old server (see handoff.py): serve it
+        # our channel state, for the clients it is still draining
+        if handoff_target:
+            ShardRouter(self._rendezvous, committer, 0, 1,
+                        handoff_target.backend_dir
+                        ).setServiceParent(handoff_target)
+        self._handoff_target = handoff_target
 
         root = Root()
-        wsrf = WebSocketRendezvousFactory(None, self._rendezvous)
+        metrics = Metrics()
+        outbound = OutboundLimits()
+        admission = Admission(reactor, max_connections_per_ip, command_rate,
+                              command_burst)
+        wsrf = WebSocketRendezvousFactory(None, self._rendezvous, committer,
+                                          metrics, router, outbound,
+                                          admission)
         _set_options(websocket_protocol_options, wsrf)
         root.putChild(b"v1", WebSocketResource(wsrf))
+        labels = []
+        if shard is not None:
+            labels.append(("worker", "%d" % shard[0]))
+        metrics_resource = MetricsResource(self._rendezvous, metrics,
+                                           committer, outbound, admission,
+                                           labels)
+        if router:
+            # any worker might get the scrape, so each serves all of them
+            router.metrics_text = metrics_resource.render_text
+            metrics_resource = ShardedMetricsResource(router)
+        root.putChild(b"metrics", metrics_resource)
+        ReactorLagProbe(reactor, metrics.lag).setServiceParent(self)
 
         site = PrivacyEnhancedSite(root)
         if blur_usage:
             site.logRequests = False
 
-        r = endpoints.serverFromString(reactor, rendezvous_web_port)
+        if IStreamServerEndpoint.providedBy(rendezvous_web_port):
+            r = rendezvous_web_port # e.g. a socket inherited from workers.py
+        else:
+            r = endpoints.serverFromString(reactor, rendezvous_web_port)
+        r = RecordingEndpoint(r)
         rendezvous_web_service = internet.StreamServerEndpointService(r, site)
         rendezvous_web_service.setServiceParent(self)
+        # the same protocol without websockets, for clients with tcp://
+        # relay URLs (see rendezvous_tcp.py)
+        other_listeners = []
+        self._rendezvous_tcp_service = None
+        if rendezvous_tcp_port:
+            ep = endpoints.serverFromString(reactor, rendezvous_tcp_port)
+            tcp_service = internet.StreamServerEndpointService(
+                ep, TCPRendezvousFactory(wsrf))
+            tcp_service.setServiceParent(self)
+            other_listeners.append(tcp_service)
+            self._rendezvous_tcp_service = tcp_service
+        if handoff_target:
+            # this tells the old server we're ready, so it comes after our
+            # port
+            handoff_target.setServiceParent(self)
+        self._handoff = None
+        if handoff_socket:
+            after = None
+            if handoff_target:
+                after = handoff_target.when_old_server_gone()
+            self._handoff = HandoffSource(handoff_socket, r, wsrf,
+                                          self._rendezvous, committer,
+                                          after=after,
+                                          other_listeners=other_listeners)
+            self._handoff.setServiceParent(self)
 
         self._stats_file = stats_file
         if self._stats_file and os.path.exists(self._stats_file):
@@ -91,10 +203,13 @@ class RelayServer(service.MultiService):
         t.setServiceParent(self)
 
         # make some things accessible for tests
-        self._db = db
+        self._db = committer
         self._root = root
         self._rendezvous_web_service = rendezvous_web_service
         self._rendezvous_websocket = wsrf
+        self._metrics = metrics
+        self._outbound = outbound
+        self._admission = admission
 
     def increase_rlimits(self):
         if getrlimit is None:
@@ -129,6 +244,8 @@ class RelayServer(service.MultiService):
         service.MultiService.startService(self)
         self.increase_rlimits()
         log.msg("websocket listening on /wormhole-relay/ws")
+        if self._rendezvous_tcp_service:
+            log.msg("raw-TCP rendezvous listening too")
         log.msg("Wormhole relay server (Rendezvous) running")
         if self._blur_usage:
             log.msg("blurring access times to %d seconds" % self._blur_usage)
@@ -137,11 +254,33 @@ class RelayServer(service.MultiService):
             log.msg("not blurring access times")
         if not self._allow_list:
             log.msg("listing of allocated nameplates disallowed")
+        if self._channel_engine == "memory":
+            log.msg("keeping channel state in memory (write-behind)")
+        if self._worker:
+            log.msg("writing to the database from a separate thread")
+        if self._shard:
+            log.msg("running as shard %d of %d" % self._shard)
+        if self._handoff_target:
+            log.msg("took over the listening socket of the old server")
+        if self._usage_retention is not None:
+            log.msg("keeping raw usage rows for %d days"
+                    % self._usage_retention)
+        if self._admission_limits[0]:
+            log.msg("allowing %d connections per client address"
+                    % self._admission_limits[0])
+        if self._admission_limits[1]:
+            log.msg("limiting expensive commands to %g/s per client address"
+                    % self._admission_limits[1])
 
     def timer(self):
+        if self._handoff and self._handoff.handed_off:
+            return # the new server owns the channel state (and stats)
         now = time.time()
         old = now - CHANNEL_EXPIRATION_TIME
         self._rendezvous.prune_all_apps(now, old)
+        self._admission.prune()
+        if self._retention:
+            self._retention.prune(now)
         self.dump_stats(now, validity=EXPIRATION_CHECK_PERIOD+60)
 
     def dump_stats(self, now, validity):
@@ -156,6 +295,11 @@ class RelayServer(service.MultiService):
         start = time.time()
         data["rendezvous"] = self._rendezvous.get_stats()
         log.msg("get_stats took:", time.time() - start)
+        data["latency"] = self._metrics.get_stats()
+        data["outbound"] = self._outbound.get_stats()
+        data["admission"] = self._admission.get_stats()
+        if self._worker:
+            data["db_worker"] = self._worker.get_stats()
 
         with open(tmpfn, "wb") as f:
             # json.dump(f) has str-vs-unicode issues on py2-vs-py3
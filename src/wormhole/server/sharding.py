@@ -0,0 +1,32 @@
+from __future__ import print_function, unicode_literals
+import hashlib
+
+# When the server runs several worker processes (--workers), each one owns a
+# "shard" of the channel state, and every nameplate and mailbox has exactly
+# one owner. The owner is a pure function of the names, so every worker can
+# work it out for itself:
+#
+# * numeric nameplates belong to shard (int(name) % num_shards), so each
+#   worker can allocate short nameplates from its own residue class without
+#   asking anyone else
+# * other nameplates, and all mailboxes, are hashed (along with the app_id)
+#
+# The mailbox that a nameplate points to is always created in the same
+# shard as the nameplate (see AppNamespace._generate_mailbox_id), so
+# claiming a nameplate (which also opens its mailbox) never crosses shards.
+
+def _hash(app_id, name):
+    data = ("%s\x00%s" % (app_id, name)).encode("utf-8")
+    return int(hashlib.sha256(data).hexdigest()[:8], 16)
+
+def shard_of_nameplate(app_id, name, num_shards):
+    try:
+        i = int(name)
+    except ValueError:
+        i = None
+    if i is not None and "%d" % i == name:
+        return i % num_shards
+    return _hash(app_id, name) % num_shards
+
+def shard_of_mailbox(app_id, mailbox_id, num_shards):
+    return _hash(app_id, mailbox_id) % num_shards
@@ -0,0 +1,240 @@
+from __future__ import print_function, unicode_literals
+import os, sys, json, socket, shutil, tempfile, numbers
+from twisted.python import log
+from twisted.internet import reactor, defer, endpoints, protocol, task
+from twisted.application import service
+
+# 'wormhole-server start --workers=N' runs N rendezvous worker processes,
+# so a busy relay can use more than one core. This parent process (the one
+# managed by twistd) opens the listening socket, and then just supervises:
+# each worker inherits the socket and accepts connections from it directly
+# (the kernel hands each new connection to one of them). Each worker owns
+# one shard of the channel state, with its own database file, and they
+# forward commands to each other as necessary (see routing.py).
+#
+# Each worker writes its own database (relay.sqlite becomes
+# relay-worker0.sqlite, etc). 'wormhole-server count-channels' (and the
+# other usage commands) add up all of them, along with relay.sqlite itself,
+# which keeps the usage from before the switch to workers. Each worker also
+# writes its own stats file, in the same private directory as the shard
+# sockets, and this parent merges them into the usual --stats-json-path,
+# adding in the all-time counts from relay.sqlite, so the munin plugins see
+# one relay. Changing the number of workers re-shards everything, so
+# channels that were open at the time will not survive the restart.
+
+RESTART_DELAY = 1.0 # seconds, before restarting a worker that died
+CHILD_LISTEN_FD = 3
+STATS_NAME = "stats-%d.json"
+STATS_POLL_INTERVAL = 10.0 # seconds, between looks at the workers' stats
+
+def per_worker_path(path, index):
+    if not path or path == ":memory:":
+        return path
+    root, ext = os.path.splitext(path)
+    return "%s-worker%d%s" % (root, index, ext)
+
+def merge_stats(stats):
+    """Add up the --stats-file data of several workers. Counts are added.
+    Latency summaries (see metrics.Histogram.get_stats) are combined: their
+    quantiles become the largest of the workers', an upper bound."""
+    stats = [s for s in stats if s is not None]
+    if not stats:
+        return None
+    if all([isinstance(s, dict) for s in stats]):
+        if all(["count" in s and "sum" in s for s in stats]):
+            return _merge_summaries(stats)
+        keys = set()
+        for s in stats:
+            keys.update(s)
+        return dict([(key, merge_stats([s.get(key) for s in stats]))
+                     for key in keys])
+    if all([isinstance(s, numbers.Number) and not isinstance(s, bool)
+            for s in stats]):
+        return sum(stats)
+    return stats[0]
+
+def _merge_summaries(summaries):
+    merged = {"count": sum([s["count"] for s in summaries]),
+              "sum": sum([s["sum"] for s in summaries])}
+    summaries = [s for s in summaries if s["count"]]
+    if summaries:
+        merged["mean"] = merged["sum"] / merged["count"]
+        for q in ["p50", "p90", "p99"]:
+            values = [s.get(q) for s in summaries]
+            # None means it overflowed the buckets
+            merged[q] = None if None in values else max(values)
+    return merged
+
+def _legacy_all_time(db_url):
+    # the all-time usage counted before we had workers
+    from .database import get_db
+    from .rendezvous import UsageCounters, all_time_stats
+    if not db_url or db_url == ":memory:" or not os.path.exists(db_url):
+        return None
+    db = get_db(db_url)
+    try:
+        return all_time_stats(UsageCounters(db).get)
+    finally:
+        db.close()
+
+class _Unused(protocol.Factory):
+    # the parent never accepts connections on the shared socket
+    def buildProtocol(self, addr):
+        return None
+
+class WorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, pool, index):
+        self._pool = pool
+        self._index = index
+        self._buffer = b""
+        self.ended = defer.Deferred()
+
+    def outReceived(self, data):
+        self._buffer += data
+        while b"\n" in self._buffer:
+            line, self._buffer = self._buffer.split(b"\n", 1)
+            log.msg("[worker %d] %s" % (self._index,
+                                        line.decode("utf-8", "replace")))
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+        self._pool.worker_ended(self._index, reason)
+
+class WorkerPool(service.Service):
+    def __init__(self, rendezvous_web_port, num_workers, relay_kwargs,
+                 reactor=reactor):
+        self._port_spec = rendezvous_web_port
+        self._num_workers = num_workers
+        self._relay_kwargs = relay_kwargs
+        self._reactor = reactor
+        self._workers = {} # index -> WorkerProcess
+        self._stopping = False
+        self._stats_file = relay_kwargs.get("stats_file")
+        self._stats_poller = None
+        self._stats_seen = None # the workers' file mtimes, when we merged
+
+    def startService(self):
+        service.Service.startService(self)
+        self._socket_dir = tempfile.mkdtemp(prefix="wormhole-server-")
+        if self._stats_file:
+            if os.path.exists(self._stats_file):
+                os.unlink(self._stats_file) # like RelayServer does
+            self._legacy_all_time = _legacy_all_time(
+                self._relay_kwargs.get("db_url"))
+            self._stats_poller = task.LoopingCall(self._merge_stats)
+            self._stats_poller.clock = self._reactor
+            self._stats_poller.start(STATS_POLL_INTERVAL, now=False)
+        ep = endpoints.serverFromString(self._reactor, self._port_spec)
+        d = ep.listen(_Unused())
+        def _listening(port):
+            port.stopReading() # let the workers have all the connections
+            self._port = port
+            for index in range(self._num_workers):
+                self._spawn(index)
+        d.addCallback(_listening)
+        d.addErrback(log.err, "unable to listen on %s" % (self._port_spec,))
+
+    def _worker_config(self, index):
+        kwargs = dict(self._relay_kwargs)
+        kwargs["db_url"] = per_worker_path(kwargs.get("db_url"), index)
+        if kwargs.get("stats_file"):
+            kwargs["stats_file"] = self._worker_stats_path(index)
+        family = "inet6" if self._port.addressFamily == socket.AF_INET6 \
+                 else "inet"
+        return {"index": index, "num_workers": self._num_workers,
+                "fd": CHILD_LISTEN_FD, "family": family,
+                "shard_dir": self._socket_dir, "relay": kwargs}
+
+    def _worker_stats_path(self, index):
+        return os.path.join(self._socket_dir, STATS_NAME % index)
+
+    def _merge_stats(self):
+        # The workers rewrite theirs every EXPIRATION_CHECK_PERIOD (and when
+        # they start). We only write ours once all of them have one, and it
+        # is only valid as long as the oldest of them.
+        paths = [self._worker_stats_path(index)
+                 for index in range(self._num_workers)]
+        try:
+            seen = [os.stat(path).st_mtime for path in paths]
+            if seen == self._stats_seen:
+                return
+            stats = []
+            for path in paths:
+                with open(path, "rb") as f:
+                    stats.append(json.loads(f.read().decode("utf-8")))
+        except (EnvironmentError, ValueError):
+            return # some worker is (re)starting, or halfway through a write
+        self._stats_seen = seen
+        data = merge_stats([dict(s, created=None, valid_until=None)
+                            for s in stats])
+        data["created"] = max([s["created"] for s in stats])
+        data["valid_until"] = min([s["valid_until"] for s in stats])
+        data["workers"] = self._num_workers
+        if self._legacy_all_time:
+            rendezvous = data["rendezvous"]
+            rendezvous["all_time"] = merge_stats([rendezvous["all_time"],
+                                                  self._legacy_all_time])
+        tmpfn = self._stats_file + ".tmp"
+        with open(tmpfn, "wb") as f:
+            f.write(json.dumps(data, indent=1).encode("utf-8"))
+            f.write(b"\n")
+        os.rename(tmpfn, self._stats_file)
+
+    def _spawn(self, index):
+        config = json.dumps(self._worker_config(index))
+        p = WorkerProcess(self, index)
+        self._workers[index] = p
+        args = [sys.executable, "-m", "wormhole.server.workers", config]
+        self._reactor.spawnProcess(p, sys.executable, args, env=os.environ,
+                                   childFDs={0: "w", 1: "r", 2: "r",
+                                             CHILD_LISTEN_FD:
+                                             self._port.fileno()})
+        log.msg("started worker %d" % index)
+
+    def worker_ended(self, index, reason):
+        del self._workers[index]
+        if self._stopping:
+            return
+        log.msg("worker %d died (%s), restarting" % (index, reason.value))
+        self._reactor.callLater(RESTART_DELAY, self._respawn, index)
+
+    def _respawn(self, index):
+        if not self._stopping:
+            self._spawn(index)
+
+    def stopService(self):
+        self._stopping = True
+        if self._stats_poller is not None:
+            self._stats_poller.stop()
+            self._stats_poller = None
+        ended = []
+        for p in self._workers.values():
+            ended.append(p.ended)
+            p.transport.signalProcess("TERM")
+        d = defer.DeferredList(ended)
+        def _cleanup(_):
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+            return service.Service.stopService(self)
+        d.addCallback(_cleanup)
+        return d
+
+
+def run_worker(config):
+    # this runs in the child process, without twistd
+    from .server import RelayServer
+    log.startLogging(sys.stdout, setStdout=False)
+    family = socket.AF_INET6 if config["family"] == "inet6" \
+             else socket.AF_INET
+    ep = endpoints.AdoptedStreamServerEndpoint(reactor, config["fd"], family)
+    relay_kwargs = config["relay"]
+    advertise_version = relay_kwargs.pop("advertise_version")
+    s = RelayServer(ep, advertise_version,
+                    shard=(config["index"], config["num_workers"]),
+                    shard_dir=config["shard_dir"], **relay_kwargs)
+    s.startService()
+    reactor.addSystemEventTrigger("before", "shutdown", s.stopService)
+    reactor.run()
+
+if __name__ == "__main__":
+    run_worker(json.loads(sys.argv[1]))
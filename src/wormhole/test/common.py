@@ -17,15 +17,19 @@ class ServerBase:
         self.sp = service.MultiService()
         self.sp.startService()
         self.relayport = allocate_tcp_port()
+        self.relaytcpport = allocate_tcp_port()
         # need to talk to twisted team about only using unicode in
         # endpoints.serverFromString
         s = RelayServer("tcp:%d:interface=127.0.0.1" % self.relayport,
                         advertise_version=advertise_version,
-                        signal_error=error)
+                        signal_error=error,
+                        rendezvous_tcp_port=("tcp:%d:interface=127.0.0.1"
+                                             % self.relaytcpport))
         s.setServiceParent(self.sp)
         self._relay_server = s
         self._rendezvous = s._rendezvous
         self.relayurl = u"ws://127.0.0.1:%d/v1" % self.relayport
+        self.relayurl_tcp = u"tcp://127.0.0.1:%d" % self.relaytcpport
         self.rdv_ws_port = self.relayport
         # ws://127.0.0.1:%d/wormhole-relay/ws
 
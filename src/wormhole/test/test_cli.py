@@ -381,7 +381,8 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
     @inlineCallbacks
     def _do_test(self, as_subprocess=False,
                  mode="text", addslash=False, override_filename=False,
-                 fake_tor=False, overwrite=False, mock_accept=False):
+                 fake_tor=False, overwrite=False, mock_accept=False,
+                 transit_threads=0):
         assert mode in ("text", "file", "empty-file", "directory",
                         "slow-text", "slow-sender-text")
         if fake_tor:
@@ -396,6 +397,7 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
             cfg.transit_helper = ""
             cfg.listen = True
             cfg.code = u"1-abc"
+            cfg.transit_threads = transit_threads
             cfg.stdout = io.StringIO()
             cfg.stderr = io.StringIO()
 
@@ -678,6 +680,8 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
         return self._do_test(mode="file", overwrite=True, mock_accept=True)
     def test_file_tor(self):
         return self._do_test(mode="file", fake_tor=True)
+    def test_file_threads(self):
+        return self._do_test(mode="file", transit_threads=2)
     def test_empty_file(self):
         return self._do_test(mode="empty-file")
 
@@ -685,6 +689,8 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
         return self._do_test(mode="directory")
     def test_directory_addslash(self):
         return self._do_test(mode="directory", addslash=True)
+    def test_directory_threads(self):
+        return self._do_test(mode="directory", transit_threads=2)
     def test_directory_override(self):
         return self._do_test(mode="directory", override_filename=True)
     def test_directory_overwrite(self):
@@ -1252,6 +1258,18 @@ class Help(unittest.TestCase):
         self._check_top_level_help(result.output)
         self.assertEqual(result.exit_code, 0)
 
+    def test_transit_streams(self):
+        result = CliRunner().invoke(cli.wormhole, ["send", "--text", "hi",
+                                                   "--transit-streams=0"])
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn("--transit-streams", result.output)
+
+    def test_transit_threads(self):
+        # records are only encrypted in other threads when asked
+        self.assertEqual(config("send").transit_threads, 0)
+        self.assertEqual(config("send", "--transit-threads=2").transit_threads,
+                         2)
+
 class FakeConfig(object):
     no_daemon = True
     blur_usage = True
@@ -1262,6 +1280,15 @@ class FakeConfig(object):
     allow_list = False
     relay_database_path = "relay.sqlite"
     stats_json_path = "stats.json"
+    channel_engine = "memory"
+    commit_window = 0.0
+    workers = 1
+    max_connections_per_ip = 0
+    command_rate = 0.0
+    command_burst = 20
+    usage_retention = None
+    handoff_socket = None
+    rendezvous_tcp = None
 
 
 class Server(unittest.TestCase):
@@ -1294,6 +1321,92 @@ class Server(unittest.TestCase):
         cfg = fake_start_reserver.mock_calls[0][1][0]
         MyPlugin(cfg).makeService(None)
 
+    @mock.patch("wormhole.server.cmd_server.start_server")
+    def test_channel_engine(self, fake_start_server):
+        # the memory engine (whose database writes happen in a thread of
+        # their own) is the default
+        result = self.runner.invoke(server, ['start'])
+        self.assertEqual(0, result.exit_code)
+        cfg = fake_start_server.mock_calls[0][1][0]
+        self.assertEqual(cfg.channel_engine, "memory")
+        relay = MyPlugin(cfg).makeService(None)
+        self.assertEqual(relay._channel_engine, "memory")
+        self.assertNotEqual(relay._worker, None)
+
+        fake_start_server.reset_mock()
+        result = self.runner.invoke(server, ['start',
+                                             '--channel-engine=sqlite'])
+        self.assertEqual(0, result.exit_code)
+        cfg = fake_start_server.mock_calls[0][1][0]
+        relay = MyPlugin(cfg).makeService(None)
+        self.assertEqual(relay._channel_engine, "sqlite")
+        self.assertEqual(relay._worker, None)
+
+    @mock.patch("wormhole.server.cmd_server.start_server")
+    def test_workers(self, fake_start_server):
+        result = self.runner.invoke(server, ['start', '--workers=3'])
+        self.assertEqual(0, result.exit_code)
+        cfg = fake_start_server.mock_calls[0][1][0]
+        self.assertEqual(cfg.workers, 3)
+        pool = MyPlugin(cfg).makeService(None)
+        self.assertEqual(pool._num_workers, 3)
+        self.assertEqual(pool._relay_kwargs["db_url"], "relay.sqlite")
+
+        result = self.runner.invoke(server, ['start', '--workers=0'])
+        self.assertNotEqual(0, result.exit_code)
+
+    @mock.patch("wormhole.server.cmd_server.start_server")
+    def test_admission(self, fake_start_server):
+        result = self.runner.invoke(server, ['start',
+                                             '--max-connections-per-ip=10',
+                                             '--command-rate=2.5',
+                                             '--command-burst=5'])
+        self.assertEqual(0, result.exit_code)
+        cfg = fake_start_server.mock_calls[0][1][0]
+        relay = MyPlugin(cfg).makeService(None)
+        a = relay._admission
+        self.assertEqual((a._max_connections, a._rate, a._burst),
+                         (10, 2.5, 5.0))
+
+    @mock.patch("wormhole.server.cmd_server.start_server")
+    def test_handoff_without_old_server(self, fake_start_server):
+        result = self.runner.invoke(server, ['restart', '--handoff',
+                                             '--handoff-socket=missing.sock'])
+        self.assertEqual(0, result.exit_code)
+        self.assertIn("is the old server accepting handoffs?", result.output)
+        self.assertEqual(fake_start_server.mock_calls, [])
+
+    @mock.patch("wormhole.server.cmd_server.socket", object())
+    @mock.patch("wormhole.server.cmd_server.start_server")
+    def test_handoff_without_recvmsg(self, fake_start_server):
+        # python2's sockets can't receive file descriptors
+        result = self.runner.invoke(server, ['restart', '--handoff',
+                                             '--handoff-socket=h.sock'])
+        self.assertEqual(0, result.exit_code)
+        self.assertIn("--handoff needs python3", result.output)
+        self.assertEqual(fake_start_server.mock_calls, [])
+
+    @mock.patch("wormhole.server.cmd_server.start_server")
+    def test_handoff_needs_socket(self, fake_start_server):
+        # servers only accept handoffs when asked to
+        result = self.runner.invoke(server, ['start'])
+        cfg = fake_start_server.mock_calls[0][1][0]
+        self.assertEqual(cfg.handoff_socket, None)
+        fake_start_server.reset_mock()
+        result = self.runner.invoke(server, ['restart', '--handoff'])
+        self.assertEqual(0, result.exit_code)
+        self.assertIn("--handoff needs --handoff-socket", result.output)
+        self.assertEqual(fake_start_server.mock_calls, [])
+
+    @mock.patch('wormhole.server.cmd_server.twistd')
+    def test_handoff_socket_with_workers(self, fake_twistd):
+        # worker pools can't be handed off, so don't pretend to listen
+        result = self.runner.invoke(server, ['start', '--workers=2',
+                                             '--handoff-socket=h.sock'])
+        self.assertIn("--handoff-socket does not work with --workers",
+                      result.output)
+        self.assertEqual(fake_twistd.mock_calls, [])
+
     def test_state_locations(self):
         cfg = FakeConfig()
         plugin = MyPlugin(cfg)
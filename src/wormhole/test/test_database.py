@@ -2,8 +2,13 @@ from __future__ import print_function, unicode_literals
 import os
 from twisted.python import filepath
 from twisted.trial import unittest
+from twisted.internet import task, reactor
+from twisted.internet.defer import inlineCallbacks
 from ..server import database
-from ..server.database import get_db, TARGET_VERSION, dump_db
+from ..server.database import (get_db, TARGET_VERSION, dump_db,
+                               GroupCommitter, DatabaseWorker)
+from ..server.rendezvous import Rendezvous, SidedMessage
+from ..server.rendezvous_memory import MemoryRendezvous
 
 class DB(unittest.TestCase):
     def test_create_default(self):
@@ -59,3 +64,260 @@ class DB(unittest.TestCase):
             with open("new.sql","w") as f: f.write(latest_text)
             # check with "diff -u _trial_temp/up.sql _trial_temp/new.sql"
             self.assertEqual(dbA_text, latest_text)
+
+    def test_upgrade_counters(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "upgrade.db")
+        db = get_db(fn, 3)
+        for result in ["happy", "happy", "lonely"]:
+            db.execute("INSERT INTO `nameplate_usage`"
+                       " (`app_id`, `started`, `total_time`, `waiting_time`,"
+                       "  `result`) VALUES (?,?,?,?,?)",
+                       ("appid", 1, 2, 3, result))
+        for (for_nameplate, result) in [(True, "happy"), (False, "happy"),
+                                        (False, "scary")]:
+            db.execute("INSERT INTO `mailbox_usage`"
+                       " (`app_id`, `for_nameplate`, `started`, `total_time`,"
+                       "  `waiting_time`, `result`) VALUES (?,?,?,?,?,?)",
+                       ("appid", for_nameplate, 1, 2, 3, result))
+        db.commit()
+        del db
+
+        db = get_db(fn, 4)
+        rows = db.execute("SELECT * FROM `usage_counters`").fetchall()
+        counts = dict([((r["kind"], r["result"]), r["count"]) for r in rows])
+        self.assertEqual(counts, {("nameplate", "happy"): 2,
+                                  ("nameplate", "lonely"): 1,
+                                  ("mailbox", "happy"): 2,
+                                  ("mailbox", "scary"): 1,
+                                  ("mailbox_standalone", "happy"): 1,
+                                  ("mailbox_standalone", "scary"): 1,
+                                  })
+
+    def test_upgrade_rollups(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "upgrade.db")
+        db = get_db(fn, 4)
+        for (started, waiting_time, total_time) in [(3600, 2, 30),
+                                                    (7000, None, 5000),
+                                                    (90000, 20, 100)]:
+            db.execute("INSERT INTO `nameplate_usage`"
+                       " (`app_id`, `started`, `total_time`, `waiting_time`,"
+                       "  `result`) VALUES (?,?,?,?,?)",
+                       ("appid", started, total_time, waiting_time, "happy"))
+        db.commit()
+        del db
+
+        db = get_db(fn, 5)
+        rows = db.execute("SELECT * FROM `usage_rollups`"
+                          " ORDER BY `period`, `start`").fetchall()
+        self.assertEqual([(r["kind"], r["period"], r["start"], r["count"],
+                           r["total_time_sum"], r["waiting_count"],
+                           r["waiting_time_sum"]) for r in rows],
+                         [("nameplate", 3600, 3600, 2, 5030, 1, 2),
+                          ("nameplate", 3600, 90000, 1, 100, 1, 20),
+                          ("nameplate", 86400, 0, 2, 5030, 1, 2),
+                          ("nameplate", 86400, 86400, 1, 100, 1, 20),
+                          ])
+        self.assertEqual([(r["total_le_60"], r["total_le_600"],
+                           r["total_over"], r["waiting_le_10"],
+                           r["waiting_le_60"]) for r in rows],
+                         [(1, 0, 1, 1, 0), (0, 1, 0, 0, 1),
+                          (1, 0, 1, 1, 0), (0, 1, 0, 0, 1)])
+
+
+    def test_upgrade_indexes(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "upgrade.db")
+        db = get_db(fn, 5)
+        npid = db.execute("INSERT INTO `nameplates` (`app_id`, `name`)"
+                          " VALUES (?,?)", ("appid", "1")).lastrowid
+        db.execute("INSERT INTO `nameplate_sides`"
+                   " (`nameplates_id`, `claimed`, `side`, `added`)"
+                   " VALUES (?,?,?,?)", (npid, True, "side", 1))
+        db.commit()
+        del db
+
+        db = get_db(fn, 6)
+        # the table was rebuilt, with the same rows
+        rows = db.execute("SELECT * FROM `nameplate_sides`").fetchall()
+        self.assertEqual(rows, [{"nameplates_id": npid, "claimed": 1,
+                                 "side": "side", "added": 1}])
+        indexes = set([row["name"] for row in
+                       db.execute("SELECT `name` FROM `sqlite_master`"
+                                  " WHERE `type`='index'").fetchall()])
+        for name in ["nameplate_sides_idx", "mailbox_sides_idx",
+                     "nameplates_mailbox_id_idx", "messages_idx"]:
+            self.assertIn(name, indexes)
+        row = db.execute("SELECT `sql` FROM `sqlite_master`"
+                         " WHERE `name`='messages_idx'").fetchone()
+        self.assertIn("`server_rx`", row["sql"])
+
+
+class _Recorder(object):
+    # a database wrapper that remembers every statement
+    def __init__(self, db):
+        self._db = db
+        self.statements = []
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def execute(self, sql, values=()):
+        self.statements.append((sql, tuple(values)))
+        return self._db.execute(sql, values)
+
+def _ignore(*args):
+    pass
+
+class QueryPlans(unittest.TestCase):
+    # Every statement that a client command (or the pruning timer) runs
+    # should find its rows through an index, not by scanning a table, and
+    # messages should come out of the index already sorted.
+
+    def _exercise(self, rv):
+        s1 = rv.open_session("appid", "side1")
+        nameplate = s1.allocate(1)
+        mailbox_id = s1.claim(nameplate, 1)
+        s1.open(mailbox_id, 1, _ignore, _ignore)
+        s1.add(SidedMessage("side1", "pake", "body1", 2, "id1"))
+        s2 = rv.open_session("appid", "side2")
+        s2.list_nameplates()
+        s2.claim(nameplate, 3)
+        s2.open(mailbox_id, 3, _ignore, _ignore)
+        s2.add(SidedMessage("side2", "pake", "body2", 4, "id2"))
+        s1.release(nameplate, 5)
+        s2.release(nameplate, 5)
+        s1.close(mailbox_id, "happy", 6)
+        s2.close(mailbox_id, "happy", 6)
+        # and a lonely one, which is pruned
+        s3 = rv.open_session("appid", "side3")
+        lonely = s3.allocate(7)
+        s3.open(s3.claim(lonely, 7), 7, _ignore, _ignore)
+        s3.disconnect()
+        rv.prune_all_apps(10000, 9000)
+
+    def _check(self, db, statements):
+        self.assertNotEqual(statements, [])
+        for (sql, values) in sorted(set(statements)):
+            plan = db.execute("EXPLAIN QUERY PLAN " + sql,
+                              values).fetchall()
+            for row in plan:
+                detail = row["detail"]
+                self.assertFalse(detail.startswith("SCAN")
+                                 and detail != "SCAN CONSTANT ROW",
+                                 "%s: %s" % (detail, sql))
+                self.assertNotIn("TEMP B-TREE", detail, sql)
+
+    def test_sqlite_engine(self):
+        db = _Recorder(get_db(":memory:"))
+        rv = Rendezvous(db, None, None, True)
+        del db.statements[:] # loading at startup may scan
+        self._exercise(rv)
+        self._check(db, db.statements)
+
+    def test_memory_engine(self):
+        db = _Recorder(get_db(":memory:"))
+        rv = MemoryRendezvous(db, None, None, True)
+        del db.statements[:]
+        self._exercise(rv)
+        rv.flush() # the write-behind log's statements
+        self._check(db, db.statements)
+
+
+class FakeDB(object):
+    def __init__(self):
+        self.commits = 0
+        self.rollbacks = 0
+        self.executed = []
+    def execute(self, *args):
+        self.executed.append(args)
+    def commit(self):
+        self.commits += 1
+    def rollback(self):
+        self.rollbacks += 1
+
+class GroupCommit(unittest.TestCase):
+    def test_coalesce(self):
+        clock = task.Clock()
+        db = FakeDB()
+        gc = GroupCommitter(db, clock, 0.5)
+        self.assertFalse(gc.pending())
+        d0 = gc.when_committed()
+        self.assertEqual(self.successResultOf(d0), None)
+
+        gc.execute("INSERT 1")
+        gc.commit()
+        gc.execute("INSERT 2")
+        gc.commit()
+        self.assertEqual(db.executed, [("INSERT 1",), ("INSERT 2",)])
+        self.assertTrue(gc.pending())
+        d1 = gc.when_committed()
+        d2 = gc.when_committed()
+        clock.advance(0.4)
+        self.assertEqual(db.commits, 0)
+        self.assertNoResult(d1)
+        clock.advance(0.1)
+        self.assertEqual(db.commits, 1)
+        self.assertFalse(gc.pending())
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+        self.assertEqual(gc.commits, 1)
+
+        gc.commit()
+        gc.stopService() # commits right away
+        self.assertEqual(db.commits, 2)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_failure(self):
+        clock = task.Clock()
+        db = FakeDB()
+        def broken():
+            raise ValueError("disk full")
+        db.commit = broken
+        gc = GroupCommitter(db, clock)
+        gc.commit()
+        d = gc.when_committed()
+        clock.advance(0)
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(db.rollbacks, 1)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+class Worker(unittest.TestCase):
+    @inlineCallbacks
+    def test_run(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "relay.sqlite")
+        db = get_db(fn)
+        worker = DatabaseWorker(fn, reactor)
+        worker.startService()
+        def add(wdb, name):
+            wdb.execute("INSERT INTO `nameplates` (`app_id`, `name`)"
+                        " VALUES (?,?)", ("appid", name))
+            wdb.commit()
+            return name
+        # calls run in order, one at a time
+        ds = [worker.run(add, "%d" % i) for i in range(10)]
+        results = yield ds[-1]
+        self.assertEqual(results, "9")
+        rows = db.execute("SELECT `name` FROM `nameplates`"
+                          " ORDER BY `id`").fetchall()
+        self.assertEqual([r["name"] for r in rows],
+                         ["%d" % i for i in range(10)])
+
+        def broken(wdb):
+            raise ValueError("disk full")
+        d = worker.run(broken)
+        yield self.assertFailure(d, ValueError)
+
+        # stopping waits for whatever is still queued
+        worker.run(add, "last")
+        worker.stopService()
+        row = db.execute("SELECT COUNT() AS `count` FROM `nameplates`"
+                         " WHERE `name`='last'").fetchone()
+        self.assertEqual(row["count"], 1)
+        self.assertEqual(worker.get_stats()["calls"], 13)
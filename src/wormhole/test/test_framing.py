@@ -0,0 +1,80 @@
+from __future__ import print_function, unicode_literals
+import json
+from twisted.trial import unittest
+from .. import framing
+
+class JSONCodec(unittest.TestCase):
+    def test_roundtrip(self):
+        c = framing.JSON
+        self.assertFalse(c.binary)
+        d = {"type": "add", "phase": "pake", "body": "0001"}
+        self.assertEqual(json.loads(c.encode(d).decode("utf-8")), d)
+        self.assertEqual(c.decode(c.encode(d)), d)
+        self.assertEqual(c.body_to_wire(b"\x00\x01"), "0001")
+        self.assertEqual(c.body_from_wire("0001"), b"\x00\x01")
+
+    def test_finish(self):
+        c = framing.JSON
+        partial = c.encode_partial({"type": "message", "body": "00"})
+        self.assertEqual(c.decode(c.finish(partial, 1.5)),
+                         {"type": "message", "body": "00", "server_tx": 1.5})
+
+class BinaryCodec(unittest.TestCase):
+    if framing.msgpack is None:
+        skip = "msgpack is not installed"
+
+    def test_roundtrip(self):
+        c = framing.BINARY
+        self.assertTrue(c.binary)
+        d = {"type": "add", "phase": "pake", "body": b"\x00\x01",
+             "id": "abcd", "new-key": [1, 2]}
+        encoded = c.encode(d)
+        self.assertEqual(c.decode(encoded), d)
+        # well-known keys and types are sent as small integers
+        packed = framing.msgpack.unpackb(encoded, raw=False,
+                                         strict_map_key=False)
+        self.assertEqual(packed[0], framing.TYPES.index("add"))
+        self.assertEqual(packed[6], b"\x00\x01")
+        self.assertEqual(packed["new-key"], [1, 2])
+        self.assertLess(len(encoded), len(framing.JSON.encode(
+            {"type": "add", "phase": "pake", "body": "0001", "id": "abcd",
+             "new-key": [1, 2]})))
+        # unknown types are passed as strings
+        self.assertEqual(c.decode(c.encode({"type": "new"})), {"type": "new"})
+
+    def test_bodies(self):
+        c = framing.BINARY
+        self.assertEqual(c.body_to_wire(b"\x00\x01"), b"\x00\x01")
+        self.assertEqual(c.body_from_wire(b"\x00\x01"), b"\x00\x01")
+        self.assertRaises(framing.FramingError, c.body_from_wire, "0001")
+
+    def test_finish(self):
+        c = framing.BINARY
+        for size in [1, 20]: # fixmap, and map16
+            d = dict([("k%d" % i, i) for i in range(size)])
+            d["type"] = "message"
+            partial = c.encode_partial(d)
+            expected = dict(d)
+            expected["server_tx"] = 1.5
+            self.assertEqual(c.decode(c.finish(partial, 1.5)), expected)
+
+    def test_bad_frames(self):
+        c = framing.BINARY
+        pack = framing.msgpack.packb
+        self.assertRaises(framing.FramingError, c.decode, b"\xc1")
+        self.assertRaises(framing.FramingError, c.decode, pack([1, 2]))
+        self.assertRaises(framing.FramingError, c.decode, pack({99: 1}))
+        self.assertRaises(framing.FramingError, c.decode, pack({0: 99}))
+
+class Negotiation(unittest.TestCase):
+    def test_negotiate(self):
+        if framing.msgpack is None:
+            self.assertEqual(framing.offered_protocols(), [])
+            self.assertEqual(framing.choose_protocol(["wormhole-v2"]), None)
+        else:
+            self.assertEqual(framing.offered_protocols(), ["wormhole-v2"])
+            self.assertEqual(framing.choose_protocol(["x", "wormhole-v2"]),
+                             "wormhole-v2")
+        self.assertEqual(framing.choose_protocol([]), None)
+        self.assertIs(framing.codec_for(None), framing.JSON)
+        self.assertIs(framing.codec_for("wormhole-v2"), framing.BINARY)
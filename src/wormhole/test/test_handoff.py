@@ -0,0 +1,160 @@
+from __future__ import print_function, unicode_literals
+import os, socket, shutil, tempfile
+from twisted.trial import unittest
+from twisted.application import service
+from twisted.internet import reactor, defer, threads
+from twisted.internet.defer import inlineCallbacks
+from ..server import handoff
+from ..server.server import RelayServer
+from ..transit import allocate_tcp_port
+from .common import poll_until
+from .test_server import WSFactory
+
+def _abandon(socket_path, backend_dir):
+    # a new server that dies after it gets the socket, before it's ready
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(socket_path)
+    handoff._send_line(s, {"backend": backend_dir})
+    msg, fds = handoff._receive_line(s)
+    for fd in fds:
+        os.close(fd)
+    s.close()
+    return msg, len(fds)
+
+class Handoff(unittest.TestCase):
+    if not hasattr(socket, "CMSG_SPACE"):
+        skip = "handoff needs socket.recvmsg() (python3)"
+
+    def setUp(self):
+        # unix socket paths are limited to about 100 bytes, which rules
+        # out self.mktemp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.dbfile = os.path.join(self.dir, "relay.sqlite")
+        self.control = os.path.join(self.dir, "handoff.sock")
+        self.pidfile = os.path.join(self.dir, "twistd.pid")
+        with open(self.pidfile, "w") as f:
+            f.write("1\n") # the old server's
+        self.port = allocate_tcp_port()
+        self.stopped = []
+        self.old = self.start_relay("tcp:%d:interface=127.0.0.1" % self.port)
+        self.old._handoff._stop_f = lambda: self.stopped.append(True)
+
+    def start_relay(self, port, target=None, control=None):
+        sp = service.MultiService()
+        s = RelayServer(port, None, db_url=self.dbfile,
+                        channel_engine="memory",
+                        handoff_socket=control or self.control,
+                        handoff_target=target)
+        s.setServiceParent(sp)
+        sp.startService()
+        self.addCleanup(sp.stopService)
+        return s
+
+    @inlineCallbacks
+    def make_client(self):
+        f = WSFactory("ws://127.0.0.1:%d/v1" % self.port)
+        f.d = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", self.port, f)
+        c = yield f.d
+        self.addCleanup(c.transport.loseConnection)
+        yield c.next_non_ack() # welcome
+        defer.returnValue(c)
+
+    @inlineCallbacks
+    def test_handoff(self):
+        c0 = yield self.make_client()
+        c0.send("bind", appid="appid", side="side0")
+        c0.send("allocate")
+        nameplate = (yield c0.next_non_ack())["nameplate"]
+        c0.send("claim", nameplate=nameplate)
+        mailbox_id = (yield c0.next_non_ack())["mailbox"]
+        c0.send("open", mailbox=mailbox_id)
+        c0.send("add", phase="pake", body="aa")
+        m = yield c0.next_non_ack()
+        self.assertEqual(m["body"], "aa")
+
+        backend_dir = tempfile.mkdtemp(dir=self.dir)
+        target = yield threads.deferToThread(handoff.receive_handoff,
+                                             self.control, backend_dir,
+                                             pidfile=self.pidfile)
+        # the old server wrote its state before it answered, and the new
+        # one loads it from there
+        new = self.start_relay(target.endpoint, target)
+        app = new._rendezvous.get_app("appid")
+        self.assertEqual(app.get_nameplate_ids(), set([nameplate]))
+        yield poll_until(lambda: self.old._handoff.handed_off)
+
+        # new clients land on the new server, and meet the old ones there
+        c1 = yield self.make_client()
+        c1.send("bind", appid="appid", side="side1")
+        c1.send("claim", nameplate=nameplate)
+        self.assertEqual((yield c1.next_non_ack())["mailbox"], mailbox_id)
+        c1.send("open", mailbox=mailbox_id)
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["body"]), ("message", "aa"))
+        c1.send("add", phase="pake", body="bb")
+        self.assertEqual((yield c1.next_non_ack())["body"], "bb")
+        # the old connection hears about it (but isn't sent "aa" again)
+        m = yield c0.next_non_ack()
+        self.assertEqual((m["side"], m["body"]), ("side1", "bb"))
+        c0.send("add", phase="version", body="cc")
+        self.assertEqual((yield c0.next_non_ack())["body"], "cc")
+        self.assertEqual((yield c1.next_non_ack())["body"], "cc")
+        self.assertEqual(len(new._rendezvous_websocket.connections), 1)
+
+        # once its last connection is gone, the old server stops
+        c0.send("close", mood="happy")
+        self.assertEqual((yield c0.next_non_ack())["type"], "closed")
+        yield c0.close()
+        yield poll_until(lambda: self.stopped)
+        self.assertEqual(self.old._rendezvous_websocket.connections, set())
+
+        # and when it has exited, the new server takes its pidfile, and
+        # waits for the next handoff
+        os.unlink(self.pidfile)
+        yield poll_until(lambda: os.path.exists(self.control))
+        with open(self.pidfile) as f:
+            self.assertEqual(int(f.read()), os.getpid())
+
+    @inlineCallbacks
+    def test_abandoned(self):
+        c0 = yield self.make_client()
+        msg, fds = yield threads.deferToThread(_abandon, self.control,
+                                               self.dir)
+        self.assertEqual((msg, fds), ({"family": "inet"}, 1))
+        # the old server carries on: its clients and listening socket work
+        yield poll_until(lambda: os.path.exists(self.control))
+        self.assertFalse(self.old._handoff.handed_off)
+        c0.send("bind", appid="appid", side="side0")
+        c0.send("allocate")
+        self.assertEqual((yield c0.next_non_ack())["type"], "allocated")
+        yield self.make_client()
+
+    def test_no_server(self):
+        with self.assertRaises(handoff.HandoffError):
+            handoff.receive_handoff(os.path.join(self.dir, "missing.sock"),
+                                    self.dir)
+
+    @inlineCallbacks
+    def test_socket_in_use(self):
+        # a second server in the same directory doesn't steal the control
+        # socket from the first
+        other = self.start_relay("tcp:%d:interface=127.0.0.1"
+                                 % allocate_tcp_port())
+        self.assertEqual(other._handoff._listener, None)
+        msg, fds = yield threads.deferToThread(_abandon, self.control,
+                                               self.dir)
+        self.assertEqual((msg, fds), ({"family": "inet"}, 1))
+        yield poll_until(lambda: os.path.exists(self.control))
+
+    def test_stale_socket(self):
+        # but it does replace one that nobody is listening on
+        control = os.path.join(self.dir, "stale.sock")
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(control)
+        s.close()
+        other = self.start_relay("tcp:%d:interface=127.0.0.1"
+                                 % allocate_tcp_port(), control=control)
+        self.assertNotEqual(other._handoff._listener, None)
+        self.assertTrue(handoff._is_listening(control))
@@ -1,11 +1,14 @@
 from __future__ import print_function, unicode_literals
-import json
+import json, struct
 import mock
 from zope.interface import directlyProvides, implementer
 from twisted.trial import unittest
+from twisted.python import failure
+from twisted.internet import error
+from twisted.test import proto_helpers
 from .. import (errors, timing, _order, _receive, _key, _code, _lister, _boss,
                 _input, _allocator, _send, _terminator, _nameplate, _mailbox,
-                _rendezvous)
+                _rendezvous, framing)
 from .._interfaces import (IKey, IReceive, IBoss, ISend, IMailbox, IOrder,
                            IRendezvousConnector, ILister, IInput, IAllocator,
                            INameplate, ICode, IWordlist, ITerminator)
@@ -550,6 +553,34 @@ class Lister(unittest.TestCase):
         self.assertEqual(events, [("i.got_nameplates", {"1", "2", "3"}),
                                   ])
 
+    def test_subscribed(self):
+        l, rc, i, events = self.build()
+        l.connected()
+        l.refresh()
+        # changes that arrive before the subscription are ignored
+        l.rx_nameplates_changed({"9"}, set())
+        l.rx_subscribed({"1", "2"})
+        self.assertEqual(events, [("rc.tx_list",),
+                                  ("i.got_nameplates", {"1", "2"}),
+                                  ])
+        events[:] = []
+        # the server keeps us up to date
+        l.rx_nameplates_changed({"3"}, {"1"})
+        self.assertEqual(events, [("i.got_nameplates", {"2", "3"}),
+                                  ])
+        events[:] = []
+        # so refreshing doesn't need to ask
+        l.refresh()
+        self.assertEqual(events, [("i.got_nameplates", {"2", "3"}),
+                                  ])
+        events[:] = []
+        # until we lose the connection, and the subscription with it
+        l.lost()
+        l.refresh()
+        l.connected()
+        self.assertEqual(events, [("rc.tx_list",),
+                                  ])
+
 class Allocator(unittest.TestCase):
     def build(self):
         events = []
@@ -1444,12 +1475,12 @@ class Boss(unittest.TestCase):
 
 
 class Rendezvous(unittest.TestCase):
-    def build(self):
+    def build(self, url="ws://host:4000/v1"):
         events = []
         reactor = object()
         journal = ImmediateJournal()
         tor_manager = None
-        rc = _rendezvous.RendezvousConnector("ws://host:4000/v1", "appid",
+        rc = _rendezvous.RendezvousConnector(url, "appid",
                                              "side", reactor,
                                              journal, tor_manager,
                                              timing.DebugTiming())
@@ -1466,6 +1497,34 @@ class Rendezvous(unittest.TestCase):
         rc, events = self.build()
         del rc, events
 
+    def test_tcp(self):
+        rc, events = self.build("tcp://host:4001")
+        with self.assertRaises(ValueError):
+            self.build("tcp://host")
+        p = _rendezvous.TCPFactory(rc).buildProtocol(None)
+        t = proto_helpers.StringTransport()
+        p.makeConnection(t)
+        offer = framing.encode_offer(framing.offered_protocols())
+        self.assertEqual(t.value(), struct.pack("!I", len(offer)) + offer)
+        t.clear()
+        # the server selected no protocol, so this connection speaks JSON
+        p.dataReceived(struct.pack("!I", 0))
+        self.assertEqual(events, [("n.connected", ),
+                                  ("m.connected", ),
+                                  ("l.connected", ),
+                                  ("a.connected", ),
+                                  ])
+        bind = t.value()
+        self.assertEqual(struct.unpack("!I", bind[:4])[0], len(bind) - 4)
+        self.assertEqual(bytes_to_dict(bind[4:])["type"], "bind")
+        events[:] = []
+        p.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual(events, [("n.lost", ),
+                                  ("m.lost", ),
+                                  ("l.lost", ),
+                                  ("a.lost", ),
+                                  ])
+
     def test_websocket_failure(self):
         # if the TCP connection succeeds, but the subsequent WebSocket
         # negotiation fails, then we'll see an onClose without first seeing
@@ -1512,6 +1571,82 @@ class Rendezvous(unittest.TestCase):
                                   ("a.lost", ),
                                   ])
 
+    def test_binary(self):
+        if framing.msgpack is None:
+            raise unittest.SkipTest("msgpack is not installed")
+        rc, events = self.build()
+        m = Dummy("m", events, IMailbox, "connected", "lost", "rx_message")
+        rc._M = m
+        ws = mock.Mock()
+        rc.ws_negotiated(framing.BINARY_PROTOCOL)
+        rc.ws_open(ws)
+        rc.tx_open("mb1")
+        rc.tx_add("phase", b"\x00\xff")
+        sent = [(framing.BINARY.decode(c[1][0]), c[1][1])
+                for c in ws.mock_calls]
+        self.assertEqual([(m["type"], binary) for (m, binary) in sent],
+                         [("bind", True), ("open", True), ("add", True)])
+        self.assertEqual(sent[2][0]["body"], b"\x00\xff")
+
+        events[:] = []
+        rc.ws_message(framing.BINARY.encode({"type": "message",
+                                             "side": "side2",
+                                             "phase": "phase",
+                                             "body": b"\x01"}))
+        self.assertEqual(events, [("m.rx_message", "side2", "phase", b"\x01")])
+
+        # the next connection might be to an older server
+        rc.ws_close(True, None, None)
+        ws = mock.Mock()
+        rc.ws_negotiated(None)
+        rc.ws_open(ws)
+        rc.tx_add("phase", b"\x00\xff")
+        self.assertEqual(bytes_to_dict(ws.mock_calls[-1][1][0])["body"], "00ff")
+        self.assertEqual(ws.mock_calls[-1][1][1], False)
+
+    def test_subscribe_list(self):
+        rc, events = self.build()
+        l = Dummy("l", events, ILister, "connected", "lost", "rx_nameplates",
+                  "rx_subscribed", "rx_nameplates_changed")
+        b = Dummy("b", events, IBoss, "rx_welcome")
+        rc._L = l
+        rc._B = b
+        def sent_type(ws):
+            return bytes_to_dict(ws.mock_calls[-1][1][0])["type"]
+        # older servers don't offer subscriptions
+        ws = mock.Mock()
+        rc.ws_open(ws)
+        rc.ws_message(dict_to_bytes({"type": "welcome", "welcome": {}}))
+        rc.tx_list()
+        self.assertEqual(sent_type(ws), "list")
+        rc.ws_close(True, None, None)
+
+        ws = mock.Mock()
+        rc.ws_open(ws)
+        rc.ws_message(dict_to_bytes({"type": "welcome", "welcome": {},
+                                     "features": ["subscribe-list"]}))
+        rc.tx_list()
+        self.assertEqual(sent_type(ws), "subscribe-list")
+        events[:] = []
+        rc.ws_message(dict_to_bytes({"type": "nameplates",
+                                     "nameplates": [{"id": "1"}],
+                                     "subscribed": True}))
+        rc.ws_message(dict_to_bytes({"type": "nameplates-changed",
+                                     "added": [{"id": "2"}],
+                                     "removed": [{"id": "1"}]}))
+        rc.ws_message(dict_to_bytes({"type": "nameplates",
+                                     "nameplates": []}))
+        self.assertEqual(events, [("l.rx_subscribed", {"1"}),
+                                  ("l.rx_nameplates_changed", {"2"}, {"1"}),
+                                  ("l.rx_nameplates", set()),
+                                  ])
+        # the next server might not offer it
+        rc.ws_close(True, None, None)
+        ws = mock.Mock()
+        rc.ws_open(ws)
+        rc.tx_list()
+        self.assertEqual(sent_type(ws), "list")
+
 
 
 # TODO
@@ -0,0 +1,217 @@
+from __future__ import print_function, unicode_literals
+import os
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from ..server import rendezvous
+from ..server.rendezvous import SidedMessage
+from ..server.rendezvous_memory import MemoryRendezvous
+from ..server.database import get_db, DatabaseWorker
+
+def make_rendezvous(db=None, blur_usage=None):
+    if db is None:
+        db = get_db(":memory:")
+    return MemoryRendezvous(db, None, blur_usage, True)
+
+class Nameplates(unittest.TestCase):
+    def test_allocate(self):
+        rv = make_rendezvous()
+        app = rv.get_app("appid")
+        nids = set()
+        for i in range(9):
+            nids.add(int(app.allocate_nameplate("side%d" % i, 0)))
+        self.assertEqual(set(range(1,10)), nids)
+        self.assertEqual(app.get_nameplate_ids(),
+                         set(["%d" % nid for nid in nids]))
+
+    def test_claim_release(self):
+        rv = make_rendezvous()
+        db = rv._db
+        app = rv.get_app("appid")
+        mailbox_id = app.claim_nameplate("123", "side1", 1)
+        self.assertEqual(app.claim_nameplate("123", "side1", 2), mailbox_id)
+        self.assertEqual(app.claim_nameplate("123", "side2", 3), mailbox_id)
+        self.assertRaises(rendezvous.CrowdedError,
+                          app.claim_nameplate, "123", "side3", 4)
+
+        # nothing is written until the flush
+        self.assertEqual(db.execute("SELECT * FROM `nameplates`").fetchall(),
+                         [])
+        rv.flush()
+        np_rows = db.execute("SELECT * FROM `nameplates`").fetchall()
+        self.assertEqual(len(np_rows), 1)
+        self.assertEqual(np_rows[0]["mailbox_id"], mailbox_id)
+        side_rows = db.execute("SELECT * FROM `nameplate_sides`"
+                               " WHERE `nameplates_id`=?",
+                               (np_rows[0]["id"],)).fetchall()
+        self.assertEqual(sorted([(r["side"], r["added"]) for r in side_rows]),
+                         [("side1", 1), ("side2", 3), ("side3", 4)])
+
+        app.release_nameplate("123", "side1", 5)
+        self.assertRaises(rendezvous.ReclaimedError,
+                          app.claim_nameplate, "123", "side1", 6)
+        app.release_nameplate("123", "side2", 6)
+        app.release_nameplate("123", "side3", 7)
+        self.assertEqual(app.get_nameplate_ids(), set())
+        rv.flush()
+        self.assertEqual(db.execute("SELECT * FROM `nameplates`").fetchall(),
+                         [])
+        self.assertEqual(db.execute("SELECT * FROM `nameplate_sides`")
+                         .fetchall(), [])
+        usage = db.execute("SELECT * FROM `nameplate_usage`").fetchone()
+        self.assertEqual(usage["started"], 1)
+        self.assertEqual(usage["waiting_time"], 2)
+        self.assertEqual(usage["total_time"], 6)
+        self.assertEqual(usage["result"], "crowded")
+
+class Mailboxes(unittest.TestCase):
+    def test_messages(self):
+        rv = make_rendezvous()
+        db = rv._db
+        app = rv.get_app("appid")
+        m1 = app.open_mailbox("mid", "side1", 0)
+        self.assertIdentical(m1, app.open_mailbox("mid", "side2", 1))
+        m1.add_message(SidedMessage("side1", "phase", "body", 2, "msgid"))
+        l1 = []
+        old = m1.add_listener("handle1", l1.append, lambda: None)
+        self.assertEqual([sm.body for sm in old], ["body"])
+        m1.add_message(SidedMessage("side2", "phase", "body2", 3, "msgid"))
+        self.assertEqual([sm.body for sm in l1], ["body2"])
+
+        rv.flush()
+        rows = db.execute("SELECT * FROM `messages`"
+                          " ORDER BY `server_rx`").fetchall()
+        self.assertEqual([r["body"] for r in rows], ["body", "body2"])
+        mb_row = db.execute("SELECT * FROM `mailboxes`").fetchone()
+        self.assertEqual(mb_row["updated"], 3)
+
+        stopped = []
+        m1.add_listener("handle2", l1.append, lambda: stopped.append(True))
+        m1.close("side1", "happy", 4)
+        m1.close("side2", "happy", 5)
+        self.assertEqual(stopped, [True])
+        self.assertEqual(app._mailboxes, {})
+        # closing again is ignored
+        m1.close("side2", "happy", 6)
+        rv.flush()
+        self.assertEqual(db.execute("SELECT * FROM `mailboxes`").fetchall(),
+                         [])
+        self.assertEqual(db.execute("SELECT * FROM `messages`").fetchall(),
+                         [])
+        usage = db.execute("SELECT * FROM `mailbox_usage`").fetchone()
+        self.assertEqual(usage["result"], "happy")
+        self.assertEqual(usage["total_time"], 5)
+
+    def test_prune(self):
+        rv = make_rendezvous(blur_usage=3600)
+        db = rv._db
+        app = rv.get_app("appid")
+        app.claim_nameplate("np-1", "side1", 1)
+        app.claim_nameplate("np-2", "side1", 60)
+        app.open_mailbox("mb-1", "side1", 1)
+        mb = app.open_mailbox("mb-2", "side1", 1)
+        mb.add_listener("handle", None, None)
+        rv.prune_all_apps(now=123, old=50)
+        self.assertEqual(app.get_nameplate_ids(), set(["np-2"]))
+        self.assertEqual(len(app._mailboxes), 2)
+        self.assertIn("mb-2", app._mailboxes)
+        self.assertEqual(app._mailboxes["mb-2"]._updated, 123)
+
+        rv.flush()
+        names = [r["name"] for r in
+                 db.execute("SELECT * FROM `nameplates`").fetchall()]
+        self.assertEqual(names, ["np-2"])
+        results = [r["result"] for r in
+                   db.execute("SELECT * FROM `mailbox_usage`").fetchall()]
+        self.assertEqual(results, ["pruney", "pruney"])
+
+    def test_evict(self):
+        rv = make_rendezvous()
+        app = rv.get_app("appid")
+        app.claim_nameplate("np-1", "side1", 1)
+        rv.get_app("other").open_mailbox("mb-2", "side1", 60)
+        rv.prune_all_apps(now=123, old=50)
+        # once its channels are pruned, the app is forgotten
+        self.assertEqual(app._mailboxes, {})
+        self.assertEqual(sorted(rv._apps), ["other"])
+        stats = rv.get_stats()
+        self.assertEqual(stats["since_reboot"]["nameplate_moods"],
+                         {"pruney": 1})
+        self.assertEqual(stats["since_reboot"]["mailboxes_total"], 1)
+        # and a new one takes its place if a client comes back
+        self.assertEqual(rv.get_app("appid").get_nameplate_ids(), set())
+
+class Persistence(unittest.TestCase):
+    def test_reload(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "relay.sqlite")
+        rv = make_rendezvous(get_db(fn))
+        app = rv.get_app("appid")
+        mailbox_id = app.claim_nameplate("4", "side1", 1)
+        mb = app.open_mailbox(mailbox_id, "side1", 1)
+        mb.add_message(SidedMessage("side1", "pake", "body1", 2, "id1"))
+        mb.add_message(SidedMessage("side1", "version", "body2", 3, "id2"))
+        app.claim_nameplate("5", "side1", 4)
+        app.release_nameplate("5", "side1", 5)
+        rv.startService()
+        rv.stopService() # flushes
+
+        rv2 = make_rendezvous(get_db(fn))
+        self.assertEqual(rv2.get_all_apps(), set(["appid"]))
+        app2 = rv2.get_app("appid")
+        self.assertEqual(app2.get_nameplate_ids(), set(["4"]))
+        self.assertEqual(app2.claim_nameplate("4", "side1", 6), mailbox_id)
+        self.assertEqual(app2.claim_nameplate("4", "side2", 7), mailbox_id)
+        mb2 = app2.open_mailbox(mailbox_id, "side2", 8)
+        self.assertEqual([sm.body for sm in mb2.get_messages()],
+                         ["body1", "body2"])
+        stats = rv2.get_stats()
+        self.assertEqual(stats["active"]["nameplates_total"], 1)
+        # nameplate "5" was released, but its mailbox is still open
+        self.assertEqual(stats["active"]["mailboxes_total"], 2)
+        self.assertEqual(stats["active"]["messages_total"], 2)
+        self.assertEqual(stats["all_time"]["nameplates_total"], 1)
+
+    @inlineCallbacks
+    def test_worker(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "relay.sqlite")
+        db = get_db(fn)
+        worker = DatabaseWorker(fn, reactor)
+        worker.startService()
+        self.addCleanup(worker.stopService)
+        rv = MemoryRendezvous(db, None, None, True, worker=worker)
+        app = rv.get_app("appid")
+        mailbox_id = app.claim_nameplate("4", "side1", 1)
+        mb = app.open_mailbox(mailbox_id, "side1", 1)
+        mb.add_message(SidedMessage("side1", "pake", "body1", 2, "id1"))
+        d1 = rv.flush()
+        app.release_nameplate("4", "side1", 3)
+        d2 = rv.flush() # queued behind the first
+        yield d1
+        yield d2
+        self.assertEqual(worker.calls, 3) # connect, and two flushes
+        self.assertEqual(db.execute("SELECT * FROM `nameplates`").fetchall(),
+                         [])
+        rows = db.execute("SELECT * FROM `messages`").fetchall()
+        self.assertEqual([r["body"] for r in rows], ["body1"])
+        usage = db.execute("SELECT * FROM `nameplate_usage`").fetchone()
+        self.assertEqual(usage["result"], "lonely")
+        self.assertEqual(db.execute("PRAGMA journal_mode").fetchone(),
+                         {"journal_mode": "wal"})
+
+    def test_sqlite_engine_compatible(self):
+        # the write-behind log produces rows the SQLite engine can use
+        db = get_db(":memory:")
+        rv = make_rendezvous(db)
+        app = rv.get_app("appid")
+        mailbox_id = app.claim_nameplate("4", "side1", 1)
+        rv.flush()
+        sql_app = rendezvous.Rendezvous(db, None, None, True).get_app("appid")
+        self.assertEqual(sql_app.claim_nameplate("4", "side2", 2), mailbox_id)
+        sql_app.release_nameplate("4", "side1", 3)
+        sql_app.release_nameplate("4", "side2", 4)
+        usage = db.execute("SELECT * FROM `nameplate_usage`").fetchone()
+        self.assertEqual(usage["result"], "happy")
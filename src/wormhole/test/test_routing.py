@@ -0,0 +1,356 @@
+from __future__ import print_function, unicode_literals
+import os, io, json, shutil, tempfile
+import mock
+from twisted.trial import unittest
+from twisted.application import service
+from twisted.internet import reactor, defer
+from twisted.internet.defer import inlineCallbacks
+from twisted.web import client
+from ..server import sharding, allocator, workers, cmd_usage, metrics
+from ..server.server import RelayServer
+from ..server.rendezvous import Rendezvous, CrowdedError
+from ..server.database import get_db
+from ..server.routing import ShardRouter
+from ..transit import allocate_tcp_port
+from .test_server import WSFactory
+
+def _nothing():
+    pass
+
+class Sharding(unittest.TestCase):
+    def test_nameplates(self):
+        self.assertEqual(sharding.shard_of_nameplate("appid", "7", 3), 1)
+        self.assertEqual(sharding.shard_of_nameplate("appid", "12", 3), 0)
+        # non-canonical numbers are hashed, like any other name
+        h = sharding.shard_of_nameplate("appid", "012", 1000)
+        self.assertEqual(h, sharding._hash("appid", "012") % 1000)
+        self.assertEqual(sharding.shard_of_nameplate("appid", "abc", 5),
+                         sharding._hash("appid", "abc") % 5)
+
+    def test_mailboxes(self):
+        shards = set([sharding.shard_of_mailbox("appid", "mb%d" % i, 4)
+                      for i in range(100)])
+        self.assertEqual(shards, set(range(4)))
+
+    def test_allocator(self):
+        a = allocator.NameplateAllocator((1, 3))
+        ids = set([a.allocate() for i in range(50)])
+        self.assertEqual(ids, set(["1", "4", "7"]))
+        for name in ["1", "4", "7", "2"]:
+            a.claim(name) # "2" isn't ours, and is ignored
+        ids = set([int(a.allocate()) for i in range(50)])
+        self.assertEqual([i for i in ids if i % 3 != 1], [])
+        self.assertTrue(ids.issubset(set(range(10, 100))))
+
+    def test_allocator_empty_tier(self):
+        # with more shards than 1-digit ids, some shards start at 2 digits
+        a = allocator.NameplateAllocator((11, 12))
+        for i in range(20):
+            self.assertIn(a.allocate(), ["11", "23", "35", "47", "59", "71",
+                                         "83", "95"])
+
+    def test_app(self):
+        rv = Rendezvous(get_db(":memory:"), None, None, True, shard=(2, 3))
+        app = rv.get_app("appid")
+        for i in range(3):
+            nameplate = app.allocate_nameplate("side%d" % i, 1)
+            self.assertEqual(sharding.shard_of_nameplate("appid", nameplate,
+                                                         3), 2)
+            mailbox_id = app.claim_nameplate(nameplate, "side%d" % i, 1)
+            self.assertEqual(sharding.shard_of_mailbox("appid", mailbox_id,
+                                                       3), 2)
+
+    def test_per_worker_path(self):
+        self.assertEqual(workers.per_worker_path("relay.sqlite", 2),
+                         "relay-worker2.sqlite")
+        self.assertEqual(workers.per_worker_path(":memory:", 2), ":memory:")
+        self.assertEqual(workers.per_worker_path(None, 2), None)
+
+
+def _add_counts(dbfile, kind, counts):
+    db = get_db(dbfile)
+    for (result, count) in counts.items():
+        db.execute("INSERT INTO `usage_counters` (`kind`, `result`, `count`)"
+                   " VALUES (?,?,?)", (kind, result, count))
+    db.commit()
+    db.close()
+
+class WorkerStats(unittest.TestCase):
+    def test_merge(self):
+        w0 = {"rendezvous": {"active": {"apps": 1, "nameplates_total": 2}},
+              "latency": {"reactor_lag": {"count": 0, "sum": 0.0},
+                          "commands": {"add": {"count": 1, "sum": 0.5,
+                                               "mean": 0.5, "p50": 0.5,
+                                               "p90": 0.5, "p99": 0.5}}},
+              "outbound": {"disconnects": {}}}
+        w1 = {"rendezvous": {"active": {"apps": 2, "nameplates_total": 0}},
+              "latency": {"reactor_lag": {"count": 0, "sum": 0.0},
+                          "commands": {"add": {"count": 3, "sum": 0.1,
+                                               "mean": 0.033, "p50": 0.02,
+                                               "p90": 0.05, "p99": None}}},
+              "outbound": {"disconnects": {"buffered": 1}}}
+        merged = workers.merge_stats([w0, w1])
+        self.assertEqual(merged["rendezvous"]["active"],
+                         {"apps": 3, "nameplates_total": 2})
+        self.assertEqual(merged["latency"]["reactor_lag"],
+                         {"count": 0, "sum": 0.0})
+        self.assertEqual(merged["latency"]["commands"]["add"],
+                         {"count": 4, "sum": 0.6, "mean": 0.6 / 4,
+                          "p50": 0.5, "p90": 0.5, "p99": None})
+        self.assertEqual(merged["outbound"], {"disconnects": {"buffered": 1}})
+
+    def test_pool(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        stats_file = os.path.join(basedir, "stats.json")
+        dbfile = os.path.join(basedir, "relay.sqlite")
+        _add_counts(dbfile, "mailbox", {"happy": 5, "lonely": 1})
+        pool = workers.WorkerPool("tcp:0", 2, {"stats_file": stats_file,
+                                               "db_url": dbfile})
+        pool._socket_dir = basedir
+        pool._legacy_all_time = workers._legacy_all_time(dbfile)
+        pool._merge_stats()
+        self.assertFalse(os.path.exists(stats_file)) # not until both are
+        rs = RelayServer("tcp:0", None, stats_file=pool._worker_stats_path(0))
+        rs._rendezvous.get_app("appid").open_mailbox("mb", "side", 1)
+        rs.dump_stats(1000, 600)
+        with open(pool._worker_stats_path(1), "wb") as f:
+            f.write(json.dumps({"created": 1010, "valid_until": 1500,
+                                "rendezvous": {"active": {"apps": 2}}}
+                               ).encode("utf-8"))
+        pool._merge_stats()
+        with open(stats_file, "rb") as f:
+            data = json.loads(f.read().decode("utf-8"))
+        self.assertEqual(data["created"], 1010)
+        self.assertEqual(data["valid_until"], 1500)
+        self.assertEqual(data["workers"], 2)
+        self.assertEqual(data["rendezvous"]["active"]["apps"], 3)
+        all_time = data["rendezvous"]["all_time"]
+        self.assertEqual(all_time["mailbox_moods"]["happy"], 5)
+        self.assertEqual(all_time["mailboxes_total"], 6)
+
+    def test_count_events(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(basedir)
+        # usage from before, and after, the switch to --workers
+        _add_counts("relay.sqlite", "mailbox", {"happy": 5, "lonely": 1})
+        _add_counts(workers.per_worker_path("relay.sqlite", 0), "mailbox",
+                    {"happy": 2})
+        _add_counts(workers.per_worker_path("relay.sqlite", 1), "mailbox",
+                    {"happy": 1, "scary": 1})
+        self.assertEqual(len(cmd_usage.open_databases()), 3)
+        args = mock.Mock(json=True)
+        with mock.patch("sys.stdout", io.StringIO()) as stdout:
+            cmd_usage.count_events(args)
+        counts = json.loads(stdout.getvalue())
+        self.assertEqual(counts["total mailboxes"], 10)
+        self.assertEqual(counts["happy mailboxes"], 8)
+        self.assertEqual(counts["scary mailboxes"], 1)
+
+
+class Routers(unittest.TestCase):
+    # two shards in one process, talking over real unix sockets
+    def setUp(self):
+        # unix socket paths are limited to about 100 bytes, which rules
+        # out self.mktemp()
+        self.socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.socket_dir)
+        self.sp = service.MultiService()
+        self.sp.startService()
+        self.addCleanup(self.sp.stopService)
+        self.rendezvous = []
+        self.routers = []
+        for index in range(2):
+            rv = Rendezvous(get_db(":memory:"), None, None, True,
+                            shard=(index, 2))
+            r = ShardRouter(rv, None, index, 2, self.socket_dir)
+            r.setServiceParent(self.sp)
+            self.rendezvous.append(rv)
+            self.routers.append(r)
+
+    def _remote_nameplate(self, shard):
+        # a nameplate owned by 'shard'
+        return "%d" % (10 + shard)
+
+    @inlineCallbacks
+    def test_channel(self):
+        r0, r1 = self.routers
+        name = self._remote_nameplate(1)
+        got0, got1 = [], []
+        s0 = r0.open_session("appid", "side0", _nothing)
+        mailbox_id = yield s0.claim(name, 1)
+        self.assertEqual(self.rendezvous[0]._apps.get("appid"), None)
+        app1 = self.rendezvous[1].get_app("appid")
+        self.assertEqual(app1.get_nameplate_ids(), set([name]))
+        old = yield s0.open(mailbox_id, 2, got0.append, None)
+        self.assertEqual(old, [])
+
+        s1 = r1.open_session("appid", "side1", _nothing)
+        self.assertEqual((yield s1.claim(name, 3)), mailbox_id)
+        yield s1.open(mailbox_id, 3, got1.append, None)
+        self.assertEqual((yield s1.list_nameplates()), [name])
+        from ..server.rendezvous import SidedMessage
+        yield s0.add(SidedMessage("side0", "pake", "body0", 4, "id0"))
+        yield s1.add(SidedMessage("side1", "pake", "body1", 5, "id1"))
+        # s0's copy of the message came back over the link, which is done
+        # by the time it answers the next request
+        yield s0.list_nameplates()
+        self.assertEqual([sm.body for sm in got0], ["body0", "body1"])
+        self.assertEqual([sm.body for sm in got1], ["body0", "body1"])
+
+        yield s0.release(name, 6)
+        yield s1.release(name, 6)
+        self.assertEqual((yield s0.list_nameplates()), [])
+        yield s0.close(mailbox_id, "happy", 7)
+        yield s1.close(mailbox_id, "happy", 8)
+        self.assertEqual(app1.get_active_counts(), (0, 0, 0))
+        s0.disconnect()
+        s1.disconnect()
+
+    @inlineCallbacks
+    def test_errors(self):
+        r0, r1 = self.routers
+        name = self._remote_nameplate(1)
+        for side in ["a", "b"]:
+            yield r0.open_session("appid", side, _nothing).claim(name, 1)
+        s = r0.open_session("appid", "c", _nothing)
+        yield self.assertFailure(s.claim(name, 2), CrowdedError)
+
+    @inlineCallbacks
+    def test_lost_link(self):
+        r0, r1 = self.routers
+        lost = []
+        s0 = r0.open_session("appid", "side0", lambda: lost.append(True))
+        mailbox_id = yield s0.claim(self._remote_nameplate(1), 1)
+        yield s0.open(mailbox_id, 2, None, None)
+        app1 = self.rendezvous[1].get_app("appid")
+        self.assertTrue(app1._mailboxes[mailbox_id].has_listeners())
+        link = r0._links[1]
+        link.transport.loseConnection()
+        yield link._lost
+        self.assertEqual(lost, [True])
+        # the other side of the link noticed too, and stopped listening
+        yield self._wait_for(lambda: not app1._mailboxes[mailbox_id]
+                         .has_listeners())
+
+    def _wait_for(self, check):
+        d = defer.Deferred()
+        def _poll():
+            if check():
+                d.callback(None)
+            else:
+                reactor.callLater(0.01, _poll)
+        _poll()
+        return d
+
+
+class Workers(unittest.TestCase):
+    # two RelayServer shards, with separate ports, so we can choose which
+    # one each client connects to
+    def setUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.socket_dir)
+        self.sp = service.MultiService()
+        self.sp.startService()
+        self.addCleanup(self.sp.stopService)
+        self.ports = []
+        for index in range(2):
+            port = allocate_tcp_port()
+            s = RelayServer("tcp:%d:interface=127.0.0.1" % port, None,
+                            shard=(index, 2), shard_dir=self.socket_dir)
+            s.setServiceParent(self.sp)
+            self.ports.append(port)
+
+    @inlineCallbacks
+    def make_client(self, index):
+        f = WSFactory("ws://127.0.0.1:%d/v1" % self.ports[index])
+        f.d = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", self.ports[index], f)
+        c = yield f.d
+        self.addCleanup(c.transport.loseConnection)
+        yield c.next_non_ack() # welcome
+        defer.returnValue(c)
+
+    @inlineCallbacks
+    def test_wormhole(self):
+        c0 = yield self.make_client(0)
+        c1 = yield self.make_client(1)
+        c0.send("bind", appid="appid", side="side0")
+        c0.send("allocate")
+        m = yield c0.next_non_ack()
+        self.assertEqual(m["type"], "allocated")
+        nameplate = m["nameplate"]
+        self.assertEqual(sharding.shard_of_nameplate("appid", nameplate, 2),
+                         0)
+        c0.send("claim", nameplate=nameplate)
+        mailbox_id = (yield c0.next_non_ack())["mailbox"]
+        c0.send("open", mailbox=mailbox_id)
+        c0.send("add", phase="pake", body="aa")
+        m = yield c0.next_non_ack()
+        self.assertEqual(m["body"], "aa")
+
+        # the other side lands on the other worker
+        c1.send("bind", appid="appid", side="side1")
+        # workers can't push nameplate changes, so this is a plain "list"
+        c1.send("subscribe-list")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["nameplates"], [{"id": nameplate}])
+        self.assertNotIn("subscribed", m)
+        c1.send("claim", nameplate=nameplate)
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["mailbox"], mailbox_id)
+        c1.send("open", mailbox=mailbox_id)
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["body"]), ("message", "aa"))
+        c1.send("add", phase="pake", body="bb")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["body"], "bb")
+        m = yield c0.next_non_ack()
+        self.assertEqual((m["side"], m["body"]), ("side1", "bb"))
+
+        c1.send("claim", nameplate="nope") # second claim is rejected
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["error"], "only one claim per connection")
+        c1.send("close", mood="happy")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "closed")
+
+    @inlineCallbacks
+    def test_metrics(self):
+        c1 = yield self.make_client(1)
+        c1.send("bind", appid="appid", side="side1")
+        c1.send("list")
+        yield c1.next_non_ack()
+        # either worker serves the counters of both, each labelled
+        url = "http://127.0.0.1:%d/metrics" % self.ports[0]
+        resp = yield client.Agent(reactor).request(b"GET",
+                                                   url.encode("ascii"))
+        self.assertEqual(resp.headers.getRawHeaders(b"content-type"),
+                         [metrics.CONTENT_TYPE])
+        lines = (yield client.readBody(resp)).decode("utf-8").splitlines()
+        p = "wormhole_rendezvous_"
+        self.assertIn(p+'connections{worker="0"} 0', lines)
+        self.assertIn(p+'connections{worker="1"} 1', lines)
+        self.assertIn(p+'commands_total{worker="1",type="list"} 1', lines)
+        self.assertIn(p+'commands_total{worker="0",type="list"} 0', lines)
+        self.assertEqual(lines.count("# TYPE %sconnections gauge" % p), 1)
+        # and each metric's samples stay together
+        names = [line.split("{")[0].split(" ")[0] for line in lines
+                 if not line.startswith("#")]
+        self.assertEqual(names.index(p+"connections"), 0)
+        self.assertEqual(names[1], p+"connections")
+
+    def test_merge_metrics(self):
+        w0 = metrics._Writer([("worker", "0")])
+        w0.simple("a", "counter", "A.", 1)
+        w0.simple("b", "gauge", "B.", 2)
+        w1 = metrics._Writer([("worker", "1")])
+        w1.simple("a", "counter", "A.", 3)
+        w1.simple("b", "gauge", "B.", 4)
+        self.assertEqual(metrics.merge_metrics([w0.text(), w1.text()]),
+                         "# HELP a A.\n# TYPE a counter\n"
+                         'a{worker="0"} 1\na{worker="1"} 3\n'
+                         "# HELP b B.\n# TYPE b gauge\n"
+                         'b{worker="0"} 2\nb{worker="1"} 4\n')
@@ -1,15 +1,20 @@
 from __future__ import print_function, unicode_literals
-import os, json, itertools, time
+import os, json, itertools, time, struct
 import mock
 from twisted.trial import unittest
 from twisted.python import log
-from twisted.internet import reactor, defer, endpoints
+from twisted.internet import reactor, defer, endpoints, task, protocol
+from twisted.protocols.basic import Int32StringReceiver
 from twisted.internet.defer import inlineCallbacks, returnValue
 from autobahn.twisted import websocket
-from .common import ServerBase
-from ..server import server, rendezvous
+from .common import ServerBase, poll_until
+from twisted.web import client
+from .. import framing
+from ..server import (server, rendezvous, allocator, expiry, metrics,
+                      outbound, admission, rollups)
 from ..server.rendezvous import Usage, SidedMessage
-from ..server.database import get_db
+from ..server.database import get_db, GroupCommitter, DatabaseWorker
+from ..server.rendezvous_websocket import WebSocketRendezvous, encode_message
 
 def easy_relay(
         rendezvous_web_port=str("tcp:0"),
@@ -360,6 +365,277 @@ class Server(_Util, ServerBase, unittest.TestCase):
         self.assertEqual(len(msgs), 5)
         self.assertEqual(msgs[-1]["body"], "body")
 
+    def test_replayed_messages(self):
+        # each client that opens the mailbox is sent the same SidedMessage
+        # objects (and so their cached encodings), not copies from the db
+        app = self._rendezvous.get_app("appid")
+        m1 = app.open_mailbox("mid", "side1", 0)
+        sm1 = SidedMessage("side1", "pake", "body1", 1, "id1")
+        m1.add_message(sm1)
+        old = m1.add_listener("handle1", lambda sm: None, lambda: None)
+        self.assertEqual(len(old), 1)
+        self.assertIs(old[0], sm1)
+        self.assertEqual(old[0].body, "body1")
+        sm2 = SidedMessage("side1", "version", "body2", 2, "id2")
+        m1.add_message(sm2)
+        m2 = app.open_mailbox("mid", "side2", 3)
+        self.assertIs(m2, m1)
+        old = m2.add_listener("handle2", lambda sm: None, lambda: None)
+        self.assertEqual(len(old), 2)
+        self.assertIs(old[0], sm1)
+        self.assertIs(old[1], sm2)
+
+class Allocator(unittest.TestCase):
+    def test_tiers(self):
+        a = allocator.NameplateAllocator()
+        ids = set()
+        for i in range(9):
+            nid = a.allocate()
+            a.claim(nid)
+            ids.add(nid)
+        self.assertEqual(ids, set(["%d" % i for i in range(1,10)]))
+        self.assertEqual(len(a.allocate()), 2)
+
+        # releasing a short one makes it the next choice
+        a.release("4")
+        self.assertEqual(a.allocate(), "4")
+        a.release("4")
+        a.release("4") # ignored
+        a.claim("4")
+        a.claim("4") # ignored
+        self.assertEqual(len(a.allocate()), 2)
+
+    def test_ignore_non_numeric(self):
+        a = allocator.NameplateAllocator()
+        for name in ["1", "01", "x", "-2", " 3", "\u0664"]:
+            a.claim(name)
+        for i in range(100):
+            self.assertIn(a.allocate(), ["%d" % i for i in range(2,10)])
+        a.release("01")
+        a.release("x")
+
+    def test_large_tier(self):
+        a = allocator.NameplateAllocator()
+        for i in range(1, 1000):
+            a.claim("%d" % i)
+        nid = int(a.allocate())
+        self.assert_(1000 <= nid < 1000000, nid)
+
+    def test_dense_after_half_full(self):
+        tier = allocator._Tier(1000, 1000+2*allocator.DENSE_TIER_SIZE)
+        self.assertEqual(tier._free, None)
+        for i in range(tier.low, tier.high-1):
+            tier.claim(i)
+        # the only free id is found, by switching to the dense list
+        self.assertEqual(tier.choose(), tier.high-1)
+        self.assertNotEqual(tier._free, None)
+        tier.claim(tier.high-1)
+        self.assertEqual(tier.choose(), None)
+        tier.release(1500)
+        self.assertEqual(tier.choose(), 1500)
+
+    def test_app_tracks_release_and_prune(self):
+        db = get_db(":memory:")
+        rv = rendezvous.Rendezvous(db, None, None, True)
+        app = rv.get_app("appid")
+        # pre-existing nameplates are loaded on the first allocate
+        app.claim_nameplate("3", "side1", 1)
+        app.claim_nameplate("8", "side1", 60)
+        for i in range(7):
+            app.allocate_nameplate("side%d" % i, 1)
+        self.assertEqual(app.get_nameplate_ids(),
+                         set(["%d" % i for i in range(1,10)]))
+        self.assertEqual(len(app._allocator.allocate()), 2)
+
+        app.release_nameplate("8", "side1", 61)
+        self.assertEqual(app._allocator.allocate(), "8")
+        rv.prune_all_apps(now=123, old=50) # prunes all but "8"
+        self.assertEqual(app.get_nameplate_ids(), set())
+        self.assertEqual(len(app._allocator.allocate()), 1)
+
+class Expiry(unittest.TestCase):
+    def test_wheel(self):
+        w = expiry.ExpiryWheel(granularity=10)
+        w.touch("a", 1)
+        w.touch("b", 5)
+        w.touch("c", 15)
+        w.touch("d", 31)
+        self.assertEqual(len(w), 4)
+        self.assertEqual(w.pop_expired(0), [])
+        # "b" and "c" straddle the cutoff of their slot
+        self.assertEqual(sorted(w.pop_expired(14)), ["a", "b"])
+        self.assertEqual(w.pop_expired(14), [])
+        w.touch("c", 40) # moves to a newer slot
+        self.assertEqual(w.pop_expired(39), ["d"])
+        self.assertNotIn("d", w)
+        w.touch("e", 2) # time can go backwards, in tests
+        w.remove("e")
+        w.remove("e")
+        self.assertEqual(w.pop_expired(100), ["c"])
+        self.assertEqual(len(w), 0)
+        self.assertEqual(w.pop_expired(1000), [])
+
+    def test_load(self):
+        # mailboxes left behind by a previous server process are pruned
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "relay.sqlite")
+        rv = rendezvous.Rendezvous(get_db(fn), None, None, True)
+        app = rv.get_app("appid")
+        app.claim_nameplate("1", "side1", 1)
+        app.open_mailbox("mb-2", "side1", 60)
+
+        rv2 = rendezvous.Rendezvous(get_db(fn), None, None, True)
+        self.assertEqual(list(rv2._apps), ["appid"])
+        rv2.prune_all_apps(now=123, old=50)
+        db = rv2._db
+        self.assertEqual(db.execute("SELECT * FROM `nameplates`").fetchall(),
+                         [])
+        mailboxes = [row["id"] for row in
+                     db.execute("SELECT * FROM `mailboxes`").fetchall()]
+        self.assertEqual(mailboxes, ["mb-2"])
+
+class Counters(unittest.TestCase):
+    def test_active(self):
+        rv = rendezvous.Rendezvous(get_db(":memory:"), None, None, True)
+        app = rv.get_app("appid")
+        mailbox_id = app.claim_nameplate("1", "side1", 1)
+        mb = app.open_mailbox(mailbox_id, "side1", 1)
+        mb.add_message(SidedMessage("side1", "pake", "body", 2, "id1"))
+        app.open_mailbox("mb-2", "side1", 3)
+        self.assertEqual(app.get_active_counts(), (1, 2, 1))
+        self.assertEqual(rv.get_all_apps(), set(["appid"]))
+        app.release_nameplate("1", "side1", 4)
+        mb.close("side1", "happy", 5)
+        self.assertEqual(app.get_active_counts(), (0, 1, 0))
+        rv.get_app("mb-2-app") # no state, so not listed
+        self.assertEqual(rv.get_all_apps(), set(["appid"]))
+
+    def test_persist(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "relay.sqlite")
+        rv = rendezvous.Rendezvous(get_db(fn), None, None, True)
+        app = rv.get_app("appid")
+        mailbox_id = app.claim_nameplate("1", "side1", 1)
+        mb = app.open_mailbox(mailbox_id, "side1", 1)
+        mb.add_message(SidedMessage("side1", "pake", "body", 2, "id1"))
+        app.release_nameplate("1", "side1", 4)
+        app.claim_nameplate("2", "side1", 5)
+        app.open_mailbox("mb-2", "side1", 6).close("side1", "happy", 7)
+
+        rv2 = rendezvous.Rendezvous(get_db(fn), None, None, True)
+        stats = rv2.get_stats()
+        self.assertEqual(stats["active"]["apps"], 1)
+        self.assertEqual(stats["active"]["nameplates_total"], 1)
+        self.assertEqual(stats["active"]["mailboxes_total"], 2)
+        self.assertEqual(stats["active"]["messages_total"], 1)
+        self.assertEqual(stats["all_time"]["nameplates_total"], 1)
+        self.assertEqual(stats["all_time"]["nameplate_moods"]["lonely"], 1)
+        self.assertEqual(stats["all_time"]["mailboxes_total"], 1)
+        self.assertEqual(stats["all_time"]["mailboxes_standalone"], 1)
+        self.assertEqual(stats["all_time"]["mailbox_moods"]["lonely"], 1)
+        self.assertEqual(stats["since_reboot"]["nameplates_total"], 0)
+
+class Rollups(unittest.TestCase):
+    def rollups(self, db, period):
+        rows = db.execute("SELECT * FROM `usage_rollups` WHERE `period`=?"
+                          " ORDER BY `kind`, `start`, `result`",
+                          (period,)).fetchall()
+        return [dict([(k, v) for (k, v) in row.items()
+                      if v and k != "period"]) for row in rows]
+
+    def test_rollup(self):
+        db = get_db(":memory:")
+        rv = rendezvous.Rendezvous(db, None, None, True)
+        app = rv.get_app("appid")
+        hour = rollups.HOUR
+        # one happy nameplate and mailbox, in the second hour
+        mailbox_id = app.claim_nameplate("1", "side1", hour+10)
+        app.claim_nameplate("1", "side2", hour+15)
+        mb = app.open_mailbox(mailbox_id, "side1", hour+10)
+        app.open_mailbox(mailbox_id, "side2", hour+15)
+        app.release_nameplate("1", "side1", hour+20)
+        app.release_nameplate("1", "side2", hour+20)
+        mb.close("side1", "happy", hour+100)
+        mb.close("side2", "happy", hour+100)
+        # and a lonely standalone mailbox, in the third
+        app.open_mailbox("mb2", "side1", 2*hour).close("side1", "lonely",
+                                                         2*hour+5000)
+
+        happy = {"app_id": "appid", "result": "happy", "start": hour,
+                 "count": 1, "waiting_count": 1, "waiting_time_sum": 5,
+                 "waiting_le_10": 1}
+        lonely = {"app_id": "appid", "result": "lonely", "start": 2*hour,
+                  "count": 1, "total_time_sum": 5000, "total_over": 1}
+        self.assertEqual(self.rollups(db, hour), [
+            dict(happy, kind="mailbox", total_time_sum=90, total_le_600=1),
+            dict(lonely, kind="mailbox"),
+            dict(lonely, kind="mailbox_standalone"),
+            dict(happy, kind="nameplate", total_time_sum=10, total_le_10=1),
+            ])
+        # everything here is on the first day
+        self.assertEqual([(r["kind"], r.get("start"), r["count"])
+                          for r in self.rollups(db, rollups.DAY)],
+                         [("mailbox", None, 1), ("mailbox", None, 1),
+                          ("mailbox_standalone", None, 1),
+                          ("nameplate", None, 1)])
+
+        # a second nameplate in the same hour updates the same rows
+        app.claim_nameplate("2", "side1", hour+200)
+        app.claim_nameplate("2", "side2", hour+210)
+        app.release_nameplate("2", "side1", hour+300)
+        app.release_nameplate("2", "side2", hour+300)
+        row = db.execute("SELECT * FROM `usage_rollups` WHERE `period`=?"
+                         " AND `kind`='nameplate'", (hour,)).fetchone()
+        self.assertEqual((row["count"], row["total_time_sum"],
+                          row["waiting_time_sum"], row["total_le_10"],
+                          row["total_le_600"]), (2, 110, 15, 1, 1))
+
+    def test_retention(self):
+        clock = task.Clock()
+        db = get_db(":memory:")
+        for started in [1, 2, 3, 100, 200]:
+            db.execute("INSERT INTO `nameplate_usage`"
+                       " (`app_id`, `started`, `total_time`, `result`)"
+                       " VALUES (?,?,?,?)", ("appid", started, 1, "lonely"))
+            db.execute("INSERT INTO `mailbox_usage`"
+                       " (`app_id`, `started`, `total_time`, `result`)"
+                       " VALUES (?,?,?,?)", ("appid", started, 1, "lonely"))
+        r = rollups.UsageRetention(db, clock, 50, batch=2)
+        r.prune(now=150)
+        r.prune(now=150) # ignored while the first is still running
+        clock.advance(0)
+        clock.advance(0)
+        clock.advance(0)
+        self.assertEqual(r.deleted, 6)
+        for table in ["nameplate_usage", "mailbox_usage"]:
+            rows = db.execute("SELECT `started` FROM `%s`" % table).fetchall()
+            self.assertEqual(sorted([row["started"] for row in rows]),
+                             [100, 200])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_retention_worker(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "relay.sqlite")
+        db = get_db(fn)
+        for started in [1, 2, 3, 100]:
+            db.execute("INSERT INTO `nameplate_usage`"
+                       " (`app_id`, `started`, `total_time`, `result`)"
+                       " VALUES (?,?,?,?)", ("appid", started, 1, "lonely"))
+        db.commit()
+        worker = DatabaseWorker(fn, reactor)
+        worker.startService()
+        self.addCleanup(worker.stopService)
+        r = rollups.UsageRetention(db, reactor, 50, batch=2, worker=worker)
+        r.prune(now=150)
+        yield poll_until(lambda: not r._running)
+        self.assertEqual(r.deleted, 3)
+        rows = db.execute("SELECT `started` FROM `nameplate_usage`").fetchall()
+        self.assertEqual([row["started"] for row in rows], [100])
+
 class Prune(unittest.TestCase):
 
     def _get_mailbox_updated(self, app, mbox_id):
@@ -391,6 +667,31 @@ class Prune(unittest.TestCase):
         rv.prune_all_apps(now=123, old=122)
         self.assertEqual(app.prune.mock_calls, [mock.call(123, 122)])
 
+    def test_evict(self):
+        rv = rendezvous.Rendezvous(get_db(":memory:"), None, None, True)
+        app = rv.get_app("appid")
+        mailbox_id = app.claim_nameplate("np-1", "side1", 1)
+        app.open_mailbox(mailbox_id, "side1", 1) # never closed
+        self.assertIn(mailbox_id, app._mailboxes)
+        session = rv.open_session("bound", "side1")
+        rv.get_app("live").open_mailbox("mb-2", "side1", 60)
+
+        rv.prune_all_apps(now=123, old=50)
+        # the abandoned channel is gone, and so is its Mailbox object, and
+        # the app, whose counts are kept
+        self.assertEqual(app._mailboxes, {})
+        self.assertEqual(sorted(rv._apps), ["bound", "live"])
+        stats = rv.get_stats()
+        self.assertEqual(stats["since_reboot"]["nameplate_moods"],
+                         {"pruney": 1})
+        self.assertEqual(stats["since_reboot"]["mailbox_moods"],
+                         {"pruney": 1})
+        # an app is kept while a connection is bound to it
+        session.disconnect()
+        session.disconnect()
+        rv.prune_all_apps(now=124, old=50)
+        self.assertEqual(sorted(rv._apps), ["live"])
+
     def test_nameplates(self):
         db = get_db(":memory:")
         rv = rendezvous.Rendezvous(db, None, 3600, True)
@@ -539,9 +840,11 @@ class WSClient(websocket.WebSocketClientProtocol):
         self.ping_counter = itertools.count(0)
     def onOpen(self):
         self.factory.d.callback(self)
+    codec = framing.JSON
+
     def onMessage(self, payload, isBinary):
-        assert not isBinary
-        event = json.loads(payload.decode("utf-8"))
+        assert isBinary == self.codec.binary
+        event = self.codec.decode(payload)
         if event["type"] == "error":
             self.errors.append(event)
         if self.d:
@@ -582,8 +885,8 @@ class WSClient(websocket.WebSocketClientProtocol):
 
     def send(self, mtype, **kwargs):
         kwargs["type"] = mtype
-        payload = json.dumps(kwargs).encode("utf-8")
-        self.sendMessage(payload, False)
+        payload = self.codec.encode(kwargs)
+        self.sendMessage(payload, self.codec.binary)
 
     def send_notype(self, **kwargs):
         payload = json.dumps(kwargs).encode("utf-8")
@@ -605,6 +908,62 @@ class WSClient(websocket.WebSocketClientProtocol):
 class WSFactory(websocket.WebSocketClientFactory):
     protocol = WSClient
 
+class BinaryWSClient(WSClient):
+    codec = framing.BINARY
+
+    def onConnect(self, response):
+        assert response.protocol == framing.BINARY_PROTOCOL
+
+class BinaryWSFactory(websocket.WebSocketClientFactory):
+    protocol = BinaryWSClient
+
+    def __init__(self, url):
+        websocket.WebSocketClientFactory.__init__(
+            self, url, protocols=[framing.BINARY_PROTOCOL])
+
+class TCPClient(Int32StringReceiver):
+    # the same interface as WSClient, over the raw-TCP transport
+    def __init__(self):
+        self.events = []
+        self.d = None
+        self.selected = None
+        self.codec = None
+
+    def connectionMade(self):
+        self.sendString(framing.encode_offer(self.factory.offer))
+
+    def stringReceived(self, data):
+        if self.codec is None:
+            offer = framing.decode_offer(data)
+            self.selected = offer[0] if offer else None
+            self.codec = framing.codec_for(self.selected)
+            self.factory.d.callback(self)
+            return
+        event = self.codec.decode(data)
+        if self.d:
+            d,self.d = self.d,None
+            d.callback(event)
+            return
+        self.events.append(event)
+
+    def connectionLost(self, reason=None):
+        if self.d:
+            self.d.callback(("closed", reason))
+
+    next_event = WSClient.__dict__["next_event"]
+    next_non_ack = WSClient.__dict__["next_non_ack"]
+
+    def send(self, mtype, **kwargs):
+        kwargs["type"] = mtype
+        self.sendString(self.codec.encode(kwargs))
+
+class TCPFactory(protocol.ClientFactory):
+    protocol = TCPClient
+
+    def __init__(self, offer=()):
+        self.offer = list(offer)
+        self.d = defer.Deferred()
+
 class WSClientSync(unittest.TestCase):
     # make sure my 'sync' method actually works
 
@@ -675,8 +1034,8 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
         return ServerBase.tearDown(self)
 
     @inlineCallbacks
-    def make_client(self):
-        f = WSFactory(self.relayurl)
+    def make_client(self, factory=WSFactory):
+        f = factory(self.relayurl)
         f.d = defer.Deferred()
         reactor.connectTCP("127.0.0.1", self.rdv_ws_port, f)
         c = yield f.d
@@ -693,6 +1052,7 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
         c1 = yield self.make_client()
         msg = yield c1.next_non_ack()
         self.check_welcome(msg)
+        self.assertEqual(msg["features"], ["subscribe-list"])
         self.assertEqual(self._rendezvous._apps, {})
 
     @inlineCallbacks
@@ -764,6 +1124,36 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
             nids.add(n["id"])
         self.assertEqual(nids, set([nameplate_id1, "np2"]))
 
+    @inlineCallbacks
+    def test_subscribe_list(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        app = self._rendezvous.get_app("appid")
+        app.claim_nameplate("np1", "side1", 0)
+
+        c1.send("bind", appid="appid", side="side")
+        c1.send("subscribe-list")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "nameplates")
+        self.assertEqual(m["nameplates"], [{"id": "np1"}])
+        self.assertEqual(m["subscribed"], True)
+
+        # other clients' nameplates are pushed to us as they come and go
+        nameplate_id = app.allocate_nameplate("side2", 0)
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "nameplates-changed")
+        self.assertEqual((m["added"], m["removed"]),
+                         ([{"id": nameplate_id}], []))
+        app.release_nameplate("np1", "side1", 0)
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "nameplates-changed")
+        self.assertEqual((m["added"], m["removed"]), ([], [{"id": "np1"}]))
+        self.assertEqual(app.get_nameplate_ids(), set([nameplate_id]))
+
+        # and the subscription ends with the connection
+        yield c1.close()
+        yield poll_until(lambda: not app._list_listeners)
+
     @inlineCallbacks
     def test_allocate(self):
         c1 = yield self.make_client()
@@ -1001,10 +1391,119 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
         m = yield c1.next_non_ack() # echoed back
         self.assertEqual(m["type"], "message")
         self.assertEqual(m["body"], "body")
+        self.assertIsInstance(m["server_tx"], float)
 
         self.assertEqual(len(l1), 1)
         self.assertEqual(l1[0].body, "body")
 
+    @inlineCallbacks
+    def test_binary(self):
+        if framing.msgpack is None:
+            raise unittest.SkipTest("msgpack is not installed")
+        c1 = yield self.make_client()
+        c2 = yield self.make_client(BinaryWSFactory)
+        for c, side in [(c1, "side1"), (c2, "side2")]:
+            welcome = yield c.next_non_ack()
+            self.check_welcome(welcome)
+            c.send("bind", appid="appid", side=side)
+            c.send("open", mailbox="mb1")
+
+        c2.send("add", phase="phase", body="ff00") # must be bytes
+        err = yield c2.next_non_ack()
+        self.assertEqual(err["error"], "body must be bytes")
+
+        c2.send("add", phase="phase", body=b"\xff\x00", id="a1")
+        m = yield c2.next_non_ack()
+        self.assertEqual((m["type"], m["body"], m["id"]),
+                         ("message", b"\xff\x00", "a1"))
+        self.assertIsInstance(m["server_tx"], float)
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["side"], m["body"]), ("side2", "ff00"))
+
+        c1.send("add", phase="phase", body="0102")
+        m = yield c2.next_non_ack()
+        self.assertEqual((m["side"], m["body"]), ("side1", b"\x01\x02"))
+
+        # and a reconnecting binary client gets the old messages too
+        c3 = yield self.make_client(BinaryWSFactory)
+        yield c3.next_non_ack()
+        c3.send("bind", appid="appid", side="side2")
+        c3.send("open", mailbox="mb1")
+        m = yield c3.next_non_ack()
+        self.assertEqual(m["body"], b"\xff\x00")
+        m = yield c3.next_non_ack()
+        self.assertEqual(m["body"], b"\x01\x02")
+
+    @inlineCallbacks
+    def make_tcp_client(self, offer=()):
+        f = TCPFactory(offer)
+        reactor.connectTCP("127.0.0.1", self.relaytcpport, f)
+        c = yield f.d
+        self._clients.append(c)
+        returnValue(c)
+
+    @inlineCallbacks
+    def test_tcp(self):
+        c1 = yield self.make_tcp_client()
+        self.assertEqual(c1.selected, None)
+        welcome = yield c1.next_non_ack()
+        self.check_welcome(welcome)
+        self.assertEqual(len(self._relay_server._rendezvous_websocket.connections), 1)
+        c1.send("bind", appid="appid", side="side1")
+        c1.send("allocate")
+        nameplate = (yield c1.next_non_ack())["nameplate"]
+        c1.send("claim", nameplate=nameplate)
+        mailbox_id = (yield c1.next_non_ack())["mailbox"]
+        c1.send("open", mailbox=mailbox_id)
+
+        # it meets websocket clients
+        c2 = yield self.make_client()
+        yield c2.next_non_ack()
+        c2.send("bind", appid="appid", side="side2")
+        c2.send("list")
+        m = yield c2.next_non_ack()
+        self.assertEqual(m["nameplates"], [{"id": nameplate}])
+        c2.send("open", mailbox=mailbox_id)
+        c2.send("add", phase="pake", body="aa")
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["side"], m["body"]),
+                         ("message", "side2", "aa"))
+        c1.send("add", phase="pake", body="bb")
+        self.assertEqual((yield c1.next_non_ack())["body"], "bb")
+        m = yield c2.next_non_ack()
+        self.assertEqual(m["body"], "aa")
+        m = yield c2.next_non_ack()
+        self.assertEqual((m["side"], m["body"]), ("side1", "bb"))
+
+        c1.send("close", mood="happy")
+        self.assertEqual((yield c1.next_non_ack())["type"], "closed")
+        c1.transport.loseConnection()
+        yield poll_until(lambda: len(self._relay_server._rendezvous_websocket.connections)
+                         == 1)
+
+    @inlineCallbacks
+    def test_tcp_binary(self):
+        if framing.msgpack is None:
+            raise unittest.SkipTest("msgpack is not installed")
+        c1 = yield self.make_tcp_client(["unknown", framing.BINARY_PROTOCOL])
+        self.assertEqual(c1.selected, framing.BINARY_PROTOCOL)
+        self.check_welcome((yield c1.next_non_ack()))
+        c1.send("bind", appid="appid", side="side1")
+        c1.send("open", mailbox="mb1")
+        c1.send("add", phase="phase", body=b"\xff\x00")
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["body"]), ("message", b"\xff\x00"))
+
+    @inlineCallbacks
+    def test_tcp_oversized(self):
+        c1 = yield self.make_tcp_client()
+        yield c1.next_non_ack()
+        d = c1.next_event()
+        # a length prefix beyond TCP_MAX_FRAME gets the connection dropped
+        c1.transport.write(struct.pack("!I", framing.TCP_MAX_FRAME + 1))
+        m = yield d
+        self.assertEqual(m[0], "closed")
+
     @inlineCallbacks
     def test_close(self):
         c1 = yield self.make_client()
@@ -1264,6 +1763,312 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
         c.close()
         yield c.d
 
+    @inlineCallbacks
+    def test_metrics(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        c1.send("claim", nameplate="np1")
+        m = yield c1.next_non_ack()
+        c1.send("open", mailbox=m["mailbox"])
+        c1.send("add", phase="1", body="")
+        yield c1.next_non_ack()
+        c1.send("___unknown")
+        yield c1.next_non_ack()
+
+        url = "http://127.0.0.1:%d/metrics" % self.relayport
+        agent = client.Agent(reactor)
+        resp = yield agent.request(b"GET", url.encode("ascii"))
+        self.assertEqual(resp.headers.getRawHeaders(b"content-type"),
+                         [metrics.CONTENT_TYPE])
+        body = yield client.readBody(resp)
+        lines = body.decode("utf-8").splitlines()
+        p = "wormhole_rendezvous_"
+        self.assertIn(p+"connections 1", lines)
+        self.assertIn(p+'commands_total{type="bind"} 1', lines)
+        self.assertIn(p+'commands_total{type="add"} 1', lines)
+        self.assertIn(p+'commands_total{type="list"} 0', lines)
+        self.assertIn(p+'commands_total{type="other"} 1', lines)
+        self.assertIn(p+"messages_added_total 1", lines)
+        self.assertIn(p+"messages_sent_total 1", lines)
+        self.assertIn(p+"nameplates 1", lines)
+        self.assertIn(p+"mailboxes 1", lines)
+        self.assertIn(p+"messages 1", lines)
+        self.assertIn("# TYPE %sdb_commit_seconds summary" % p, lines)
+        self.assertIn(p+'command_seconds_count{type="add"} 1', lines)
+        self.assertIn("# TYPE %sreactor_lag_seconds histogram" % p, lines)
+        self.assertIn(p+"outbound_buffered_bytes 0", lines)
+        self.assertIn(p+'outbound_disconnects_total{reason="slow"} 0', lines)
+
+        text = metrics.render_metrics(self._rendezvous,
+                                      self._relay_server._rendezvous_websocket
+                                      .metrics)
+        self.assertIn(p+"connections_total 1\n", text)
+        self.assertNotIn("db_commit_seconds", text)
+
+    @inlineCallbacks
+    def test_throttled(self):
+        wsrf = self._relay_server._rendezvous_websocket
+        wsrf.admission = admission.Admission(task.Clock(), rate=1.0, burst=1)
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        c1.send("list")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "nameplates")
+        c1.send("list")
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["type"], "error")
+        self.assertEqual(err["error"], "too many requests, slow down")
+        c1.send("ping", ping=1) # cheap commands are not limited
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "pong")
+        self.assertEqual(wsrf.admission.throttled_commands, 1)
+
+
+class FakeFactory(object):
+    def __init__(self, committer):
+        self.committer = committer
+        self.metrics = metrics.Metrics()
+
+class HeldResponses(unittest.TestCase):
+    def test_hold_until_commit(self):
+        clock = task.Clock()
+        db = get_db(":memory:")
+        committer = GroupCommitter(db, clock)
+        p = WebSocketRendezvous()
+        p.factory = FakeFactory(committer)
+        sent = []
+        p.sendMessage = lambda payload, isBinary: sent.append(
+            json.loads(payload.decode("utf-8"))["type"])
+
+        p.send("ack") # nothing to commit: sent right away
+        self.assertEqual(sent, ["ack"])
+
+        committer.commit()
+        p.send("ack")
+        p.send("claimed", mailbox="mb1")
+        self.assertEqual(sent, ["ack"])
+        clock.advance(0)
+        self.assertEqual(sent, ["ack", "ack", "claimed"])
+
+        # once anything is held, later messages queue behind it
+        committer.commit()
+        p.send("message")
+        committer.flush()
+        p.send("closed")
+        self.assertEqual(sent, ["ack", "ack", "claimed", "message", "closed"])
+
+class EncodedMessages(unittest.TestCase):
+    def test_encode_once(self):
+        sm = SidedMessage(side="side", phase="phase", body="body",
+                          server_rx=1.5, msg_id="id")
+        encoded = encode_message(sm)
+        self.assertIs(encode_message(sm), encoded)
+        self.assertEqual(json.loads((encoded + b"}").decode("utf-8")),
+                         {"type": "message", "side": "side", "phase": "phase",
+                          "body": "body", "server_rx": 1.5, "id": "id"})
+        if framing.msgpack is not None:
+            # bodies are stored as hex, and sent raw, but since we never
+            # checked that they were hex, anything else is passed through
+            binary = encode_message(sm, framing.BINARY)
+            self.assertIs(encode_message(sm, framing.BINARY), binary)
+            self.assertEqual(framing.BINARY.decode(
+                framing.BINARY.finish(binary, 2.0))["body"], "body")
+        # _replace() makes a new message, which must not share the cache
+        self.assertEqual(sm._replace(body="other").encoded, None)
+
+    def test_server_tx(self):
+        clock = task.Clock()
+        committer = GroupCommitter(get_db(":memory:"), clock)
+        sm = SidedMessage(side="side", phase="phase", body="body",
+                          server_rx=1.5, msg_id=None)
+        sent = []
+        def make():
+            p = WebSocketRendezvous()
+            p.factory = FakeFactory(committer)
+            p.sendMessage = lambda payload, isBinary: sent.append(
+                json.loads(payload.decode("utf-8")))
+            return p
+        p1, p2 = make(), make()
+        with mock.patch("time.time", return_value=2.25):
+            p1._send_or_hold(encode_message(sm))
+        with mock.patch("time.time", return_value=3.0):
+            p2._send_or_hold(encode_message(sm))
+            # held messages get their server_tx when they're written
+            committer.commit()
+            p2._send_or_hold(encode_message(sm))
+            self.assertEqual(len(sent), 2)
+        with mock.patch("time.time", return_value=4.0):
+            clock.advance(0)
+        self.assertEqual([m["server_tx"] for m in sent], [2.25, 3.0, 4.0])
+        for m in sent:
+            self.assertEqual((m["type"], m["body"], m["id"]),
+                             ("message", "body", None))
+
+class FakeTransport(object):
+    def __init__(self):
+        self.reading = True
+    def unregisterProducer(self):
+        pass
+    def pauseProducing(self):
+        self.reading = False
+    def resumeProducing(self):
+        self.reading = True
+
+class FakeProtocol(object):
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.sent = []
+        self.dropped = False
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+    def sendMessage(self, payload, isBinary):
+        self.sent.append(payload)
+    def dropConnection(self, abort):
+        self.dropped = True
+
+class Outbound(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.limits = outbound.OutboundLimits(high_water=100, low_water=50,
+                                              max_buffered=1000,
+                                              stall_timeout=10,
+                                              global_limit=1500)
+
+    def make(self):
+        p = FakeProtocol()
+        o = outbound.Outbox(p, self.limits, self.clock)
+        self.assertIs(p.producer, o)
+        return p, o
+
+    def test_backpressure(self):
+        p, o = self.make()
+        o.write(b"a"*60, False)
+        self.assertEqual(p.sent, [b"a"*60]) # straight through
+        o.pauseProducing() # the transport is full
+        o.write(b"b"*60, False)
+        self.assertEqual((o.buffered, self.limits.buffered), (60, 60))
+        self.assertTrue(p.transport.reading)
+        o.write(b"c"*60, False)
+        # over the high-water mark: stop reading commands
+        self.assertFalse(p.transport.reading)
+        self.assertEqual(self.limits.get_stats(),
+                         {"buffered_bytes": 120, "paused_connections": 1,
+                          "pauses": 1,
+                          "disconnects": {"slow": 0, "overload": 0}})
+        o.resumeProducing()
+        self.assertEqual(p.sent, [b"a"*60, b"b"*60, b"c"*60])
+        self.assertTrue(p.transport.reading)
+        self.assertEqual((o.buffered, self.limits.buffered,
+                          self.limits.paused), (0, 0, 0))
+        # the stall timer was cancelled
+        self.clock.advance(20)
+        self.assertFalse(p.dropped)
+
+    def test_stalled(self):
+        p, o = self.make()
+        o.pauseProducing()
+        o.write(b"a"*200, False)
+        self.assertFalse(p.transport.reading)
+        self.clock.advance(9)
+        self.assertFalse(p.dropped)
+        self.clock.advance(1)
+        self.assertTrue(p.dropped)
+        self.assertEqual(self.limits.get_stats(),
+                         {"buffered_bytes": 0, "paused_connections": 0,
+                          "pauses": 1,
+                          "disconnects": {"slow": 1, "overload": 0}})
+        o.write(b"b", False) # ignored after disconnect
+        self.assertEqual(o.buffered, 0)
+
+    def test_max_buffered(self):
+        p, o = self.make()
+        o.pauseProducing()
+        o.write(b"a"*1000, False)
+        self.assertTrue(p.dropped)
+        self.assertEqual(self.limits.disconnects["slow"], 1)
+        self.assertEqual(self.limits.buffered, 0)
+
+    def test_global_limit(self):
+        p1, o1 = self.make()
+        p2, o2 = self.make()
+        o1.pauseProducing()
+        o2.pauseProducing()
+        o1.write(b"a"*900, False)
+        o2.write(b"b"*500, False)
+        self.assertEqual(self.limits.buffered, 1400)
+        o2.write(b"b"*200, False)
+        # o1 has the most queued, so it goes first
+        self.assertTrue(p1.dropped)
+        self.assertFalse(p2.dropped)
+        self.assertEqual(self.limits.disconnects["overload"], 1)
+        self.assertEqual(self.limits.buffered, 700)
+
+    def test_connection_lost(self):
+        p, o = self.make()
+        o.pauseProducing()
+        o.write(b"a"*200, False)
+        o.stopProducing()
+        self.assertEqual(self.limits.get_stats()["buffered_bytes"], 0)
+        self.assertEqual(self.limits.paused, 0)
+        self.clock.advance(20)
+        self.assertFalse(p.dropped)
+
+class Admission(unittest.TestCase):
+    def test_connections(self):
+        clock = task.Clock()
+        a = admission.Admission(clock, max_connections=2)
+        self.assertTrue(a.connect("1.2.3.4"))
+        self.assertTrue(a.connect("1.2.3.4"))
+        self.assertFalse(a.connect("1.2.3.4"))
+        self.assertTrue(a.connect("5.6.7.8"))
+        a.disconnect("1.2.3.4")
+        self.assertTrue(a.connect("1.2.3.4"))
+        self.assertEqual(a.get_stats(),
+                         {"addresses": 2, "refused_connections": 1,
+                          "throttled_commands": 0})
+
+    def test_unlimited(self):
+        a = admission.Admission(task.Clock())
+        for i in range(100):
+            self.assertTrue(a.connect("1.2.3.4"))
+            self.assertTrue(a.allow_command("1.2.3.4", "list"))
+
+    def test_token_bucket(self):
+        clock = task.Clock()
+        a = admission.Admission(clock, rate=2.0, burst=3)
+        a.connect("1.2.3.4")
+        for i in range(3):
+            self.assertTrue(a.allow_command("1.2.3.4", "allocate"))
+        self.assertFalse(a.allow_command("1.2.3.4", "claim"))
+        self.assertTrue(a.allow_command("1.2.3.4", "add")) # not limited
+        self.assertTrue(a.allow_command("5.6.7.8", "list")) # separate bucket
+        clock.advance(0.5) # one token back
+        self.assertTrue(a.allow_command("1.2.3.4", "list"))
+        self.assertFalse(a.allow_command("1.2.3.4", "list"))
+        clock.advance(100) # refills only up to the burst
+        for i in range(3):
+            self.assertTrue(a.allow_command("1.2.3.4", "open"))
+        self.assertFalse(a.allow_command("1.2.3.4", "open"))
+        self.assertEqual(a.throttled_commands, 3)
+
+    def test_prune(self):
+        clock = task.Clock()
+        a = admission.Admission(clock, rate=1.0, burst=2)
+        a.connect("1.2.3.4")
+        a.allow_command("1.2.3.4", "list")
+        a.connect("5.6.7.8")
+        a.allow_command("5.6.7.8", "list")
+        a.disconnect("5.6.7.8")
+        a.prune() # 1.2.3.4 is connected, 5.6.7.8 is not yet refilled
+        self.assertEqual(a.get_stats()["addresses"], 2)
+        clock.advance(1)
+        a.prune()
+        self.assertEqual(a.get_stats()["addresses"], 1)
+        a.disconnect("1.2.3.4")
+        a.prune()
+        self.assertEqual(a.get_stats()["addresses"], 0)
 
 class Summary(unittest.TestCase):
     def test_mailbox(self):
@@ -1329,13 +2134,13 @@ class Summary(unittest.TestCase):
     def test_nameplate_disallowed(self):
         db = get_db(":memory:")
         a = rendezvous.AppNamespace(db, None, False, "some_app_id", False)
-        a.allocate_nameplate("side1", "123")
+        a.allocate_nameplate("side1", 123)
         self.assertEqual([], a.get_nameplate_ids())
 
     def test_nameplate_allowed(self):
         db = get_db(":memory:")
         a = rendezvous.AppNamespace(db, None, False, "some_app_id", True)
-        np = a.allocate_nameplate("side1", "321")
+        np = a.allocate_nameplate("side1", 321)
         self.assertEqual(set([np]), a.get_nameplate_ids())
 
     def test_blur(self):
@@ -1393,6 +2198,58 @@ class DumpStats(unittest.TestCase):
         self.assertEqual(data["created"], now)
         self.assertEqual(data["valid_until"], now+validity)
         self.assertEqual(data["rendezvous"]["all_time"]["mailboxes_total"], 0)
+        self.assertEqual(data["latency"]["reactor_lag"], {"count": 0,
+                                                          "sum": 0.0})
+        self.assertEqual(data["outbound"]["buffered_bytes"], 0)
+
+class Latency(unittest.TestCase):
+    def test_histogram(self):
+        h = metrics.Histogram()
+        self.assertEqual(h.quantile(0.5), None)
+        for i in range(90):
+            h.observe(0.0015) # lands in the 0.002 bucket
+        for i in range(9):
+            h.observe(0.3)
+        h.observe(100.0) # overflow
+        self.assertEqual(h.count, 100)
+        self.assertEqual(h.quantile(0.5), 0.002)
+        self.assertEqual(h.quantile(0.9), 0.002)
+        self.assertEqual(h.quantile(0.95), 0.5)
+        self.assertEqual(h.quantile(1.0), float("inf"))
+        stats = h.get_stats()
+        self.assertEqual(stats["p50"], 0.002)
+        self.assertEqual(stats["p99"], 0.5)
+        self.assertAlmostEqual(stats["mean"], (90*0.0015+9*0.3+100.0)/100)
+        text = metrics._Writer()
+        text.histograms("h", "help", None, {None: h})
+        lines = text.text().splitlines()
+        self.assertIn('h_bucket{le="0.001"} 0', lines)
+        self.assertIn('h_bucket{le="0.002"} 90', lines)
+        self.assertIn('h_bucket{le="50.0"} 99', lines)
+        self.assertIn('h_bucket{le="+Inf"} 100', lines)
+        self.assertIn("h_count 100", lines)
+
+    def test_lag_probe(self):
+        clock = task.Clock()
+        h = metrics.Histogram()
+        p = metrics.ReactorLagProbe(clock, h, interval=1.0)
+        p.startService()
+        clock.advance(1.0)
+        clock.advance(1.5) # half a second late
+        self.assertEqual(h.count, 2)
+        self.assertEqual(h.sum, 0.5)
+        p.stopService()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_commands(self):
+        m = metrics.Metrics()
+        m.command_done("add", 0.001)
+        m.command_done("add", 0.003)
+        m.command_done("___unknown", 0.001)
+        stats = m.get_stats()
+        self.assertEqual(sorted(stats["commands"]), ["add", "other"])
+        self.assertEqual(stats["commands"]["add"]["count"], 2)
+        self.assertEqual(stats["commands"]["add"]["p50"], 0.001)
 
 
 class Startup(unittest.TestCase):
@@ -1,12 +1,17 @@
 from __future__ import print_function, unicode_literals
 import six
 import io
+import os
 import gc
+import hashlib
+import threading
 import mock
 from binascii import hexlify, unhexlify
 from collections import namedtuple
 from twisted.trial import unittest
-from twisted.internet import defer, task, endpoints, protocol, address, error
+from zope.interface import implementer, directlyProvides
+from twisted.internet import (defer, task, endpoints, protocol, address, error,
+                              interfaces)
 from twisted.internet.defer import gatherResults, inlineCallbacks
 from twisted.python import log
 from twisted.test import proto_helpers
@@ -315,8 +320,43 @@ class Basic(unittest.TestCase):
         abilities = c.get_connection_abilities()
         self.assertEqual(abilities, [{"type": "direct-tcp-v1"},
                                      {"type": "relay-v1"},
+                                     {"type": "records-v1",
+                                      "max-size": transit.MAX_RECORD_SIZE},
                                      ])
 
+    def test_striped_abilities(self):
+        c = transit.Common(None, no_listen=True, streams=4)
+        self.assertIn({"type": "striped-v1", "max-streams": 4},
+                      c.get_connection_abilities())
+        # peers that don't say get one stream
+        self.assertEqual(c.get_stream_count(), 1)
+        c.add_connection_abilities([{"type": "striped-v1"},
+                                    {"type": "striped-v1",
+                                     "max-streams": True}])
+        self.assertEqual(c.get_stream_count(), 1)
+        c.add_connection_abilities([{"type": "striped-v1",
+                                     "max-streams": 2}])
+        self.assertEqual(c.get_stream_count(), 2)
+        c.add_connection_abilities([{"type": "striped-v1",
+                                     "max-streams": 8}])
+        self.assertEqual(c.get_stream_count(), 4)
+
+    def test_record_size(self):
+        c = transit.Common(None, no_listen=True)
+        # older peers don't say, so they get what they used to
+        c.add_connection_abilities([{"type": "direct-tcp-v1"}])
+        self.assertEqual(c.get_record_size(), transit.DEFAULT_RECORD_SIZE)
+        c.add_connection_abilities([{"type": "records-v1"},
+                                    {"type": "records-v1", "max-size": "big"},
+                                    {"type": "records-v1", "max-size": 0}])
+        self.assertEqual(c.get_record_size(), transit.DEFAULT_RECORD_SIZE)
+        c.add_connection_abilities([{"type": "records-v1",
+                                     "max-size": 2**15}])
+        self.assertEqual(c.get_record_size(), 2**15)
+        c.add_connection_abilities(c.get_connection_abilities())
+        self.assertEqual(c.get_record_size(), transit.RECORD_SIZE)
+        self.assertEqual(c.get_record_size(), 256*1024)
+
     def test_transit_key_wait(self):
         KEY = b"123"
         c = transit.Common("")
@@ -364,6 +404,26 @@ class Basic(unittest.TestCase):
         self.assertEqual(r.connection_ready("p1"), "wait-for-decision")
         self.assertEqual(r.connection_ready("p2"), "wait-for-decision")
 
+    def test_connection_ready_stripe(self):
+        # the sender accepts the extra streams it opened, once it has a
+        # winner
+        s = transit.TransitSender("")
+        self.assertEqual(s.connection_ready("p1"), "go")
+        stripe = mock.Mock(stripe=1)
+        self.assertEqual(s.connection_ready(stripe), "go")
+        self.assertEqual(s._winner, "p1")
+        self.assertEqual(s.connection_ready(mock.Mock(stripe=0)),
+                         "nevermind")
+
+    def test_stripe_relay_handshake(self):
+        # each stripe is paired up by the relay separately
+        side = u"abcdef0123456789"
+        handshakes = set(transit.build_sided_relay_handshake(b"k", side, i)
+                         for i in range(3))
+        self.assertEqual(len(handshakes), 3)
+        self.assertIn(transit.build_sided_relay_handshake(b"k", side),
+                      handshakes)
+
 
 class Listener(unittest.TestCase):
     def test_listener(self):
@@ -429,8 +489,17 @@ class FakeTransport:
         self._peeraddr = peeraddr
         self._buf = b""
         self._connected = True
+        self.paused = False
     def write(self, data):
         self._buf += data
+    def pauseProducing(self):
+        self.paused = True
+    def resumeProducing(self):
+        self.paused = False
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+    def unregisterProducer(self):
+        self.producer = None
     def loseConnection(self):
         self._connected = False
         if self.signalConnectionLost:
@@ -443,6 +512,27 @@ class FakeTransport:
         self._buf = b""
         return b
 
+class FakeEncryptionPool:
+    def __init__(self, threads):
+        self.threads = threads
+        self.calls = []
+    def encrypt(self, box, record, nonce):
+        return self._call(box.encrypt, record, nonce)
+    def decrypt(self, box, ciphertext, nonce):
+        return self._call(box.decrypt, ciphertext, nonce)
+    def _call(self, f, *args):
+        d = defer.Deferred()
+        self.calls.append((d, f, args))
+        return d
+    def finish(self, i):
+        d, f, args = self.calls[i]
+        try:
+            result = f(*args)
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+
 class RandomError(Exception):
     pass
 
@@ -1039,6 +1129,66 @@ class Connection(unittest.TestCase):
         c.dataReceived(r5+r6)
         self.assertEqual(inbound_records, [RECORD5, RECORD6])
 
+    def encrypt_records(self, owner, records, first_nonce=0):
+        send_box = SecretBox(owner._receiver_record_key())
+        out = []
+        for (i, record) in enumerate(records):
+            nonce_buf = unhexlify("%048x" % (first_nonce + i))
+            encrypted = send_box.encrypt(record, nonce_buf)
+            out.append(unhexlify("%08x" % len(encrypted)) + encrypted)
+        return b"".join(out)
+
+    def test_records_chunked(self):
+        # records that straddle arbitrary chunk boundaries are all
+        # delivered, and the consumed part of the buffer is discarded
+        t, c, owner = self.make_connection()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        records = [str(i).encode("ascii") * (i * 37) for i in range(50)]
+        data = self.encrypt_records(owner, records)
+        largest = 0
+        for i in range(0, len(data), 1000):
+            c.dataReceived(data[i:i+1000])
+            largest = max(largest, len(c._records_buf))
+        self.assertEqual(inbound_records, records)
+        self.assertLess(largest, 2 * (1000 + 4 + 24 + 49*37*2 + 16))
+        # and it keeps working once everything was consumed
+        c.dataReceived(self.encrypt_records(owner, [b"more"], 50))
+        self.assertEqual(inbound_records[-1], b"more")
+
+    def test_records_with_handshake(self):
+        # records that arrive along with the end of the handshake are not
+        # lost
+        owner = MockOwner()
+        c = transit.Connection(owner, None, None, "description")
+        c.transport = FakeTransport(c, address.HostnameAddress("example.com",
+                                                               1234))
+        c.factory = MockFactory()
+        c.connectionMade()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        owner._state = "go"
+        d = c.startNegotiation()
+        c.dataReceived(b"expect_this" +
+                       self.encrypt_records(owner, [b"r0", b"r1"]))
+        self.assertEqual(self.successResultOf(d), c)
+        self.assertEqual(inbound_records, [b"r0", b"r1"])
+
+    def test_records_reentrant(self):
+        # a consumer's flow control can deliver more data while we're still
+        # delivering the records from an earlier chunk
+        t, c, owner = self.make_connection()
+        data = self.encrypt_records(owner, [b"r0", b"r1", b"r2", b"r3"])
+        half = len(data) // 2
+        inbound_records = []
+        def _received(record):
+            inbound_records.append(record)
+            if record == b"r0":
+                c.dataReceived(data[half:])
+        c.recordReceived = _received
+        c.dataReceived(data[:half])
+        self.assertEqual(inbound_records, [b"r0", b"r1", b"r2", b"r3"])
+
     def corrupt(self, orig):
         last_byte = orig[-1:]
         num = int(hexlify(last_byte).decode("ascii"), 16)
@@ -1093,6 +1243,319 @@ class Connection(unittest.TestCase):
         # happens? We currently get a type-check assertion from HKDF because
         # the key is None.
 
+    def test_oversized_record(self):
+        # we don't wait for (and buffer) more than we said we'd accept
+        t, c, owner = self.make_connection()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        largest = (transit.MAX_RECORD_SIZE + SecretBox.NONCE_SIZE
+                   + SecretBox.MACBYTES)
+        c.dataReceived(unhexlify("%08x" % largest))
+        self.assertEqual(t._connected, True)
+
+        t, c, owner = self.make_connection()
+        c.recordReceived = inbound_records.append
+        self.assertRaises(transit.TransitError, c.dataReceived,
+                          unhexlify("%08x" % (largest + 1)))
+        self.assertEqual(inbound_records, [])
+        self.assertEqual(t._connected, False)
+
+    def decrypt_sent(self, owner, buf):
+        # returns [(nonce, record)] for the records in buf
+        receive_box = SecretBox(owner._sender_record_key())
+        out = []
+        while buf:
+            length = int(hexlify(buf[:4]), 16)
+            encrypted, buf = buf[4:4+length], buf[4+length:]
+            out.append((int(hexlify(encrypted[:24]), 16),
+                        receive_box.decrypt(encrypted)))
+        return out
+
+    def test_pipelined(self):
+        t, c, owner = self.make_connection()
+        pool = FakeEncryptionPool(threads=2)
+        c.start_pipelining(pool)
+        c.send_record(b"r0")
+        c.send_record(b"r1")
+        c.send_record(b"r2")
+        self.assertEqual(len(pool.calls), 3)
+        # they're written in nonce order, whatever order they finish in
+        pool.finish(1)
+        self.assertEqual(t.read_buf(), b"")
+        pool.finish(0)
+        self.assertEqual(self.decrypt_sent(owner, t.read_buf()),
+                         [(0, b"r0"), (1, b"r1")])
+        pool.finish(2)
+        self.assertEqual(self.decrypt_sent(owner, t.read_buf()),
+                         [(2, b"r2")])
+
+    def test_pipelined_close(self):
+        t, c, owner = self.make_connection()
+        pool = FakeEncryptionPool(threads=1)
+        c.start_pipelining(pool)
+        c.send_record(b"r0")
+        c.close()
+        self.assertEqual(t._connected, True)
+        pool.finish(0)
+        self.assertEqual(self.decrypt_sent(owner, t.read_buf()),
+                         [(0, b"r0")])
+        self.assertEqual(t._connected, False)
+
+    def test_pipelined_producer(self):
+        t, c, owner = self.make_connection()
+        t.registerProducer = mock.Mock()
+        directlyProvides(t, interfaces.IConsumer)
+        pool = FakeEncryptionPool(threads=1)
+        c.start_pipelining(pool, depth=2)
+        producer = mock.Mock()
+        c.registerProducer(producer, True)
+        wrapper = t.registerProducer.mock_calls[0][1][0]
+        c.write(b"r0")
+        self.assertEqual(producer.mock_calls, [])
+        c.write(b"r1") # the pipeline is full
+        self.assertEqual(producer.mock_calls, [mock.call.pauseProducing()])
+        producer.reset_mock()
+        wrapper.resumeProducing() # the transport is ready, but we're not
+        self.assertEqual(producer.mock_calls, [])
+        pool.finish(0)
+        self.assertEqual(producer.mock_calls, [mock.call.resumeProducing()])
+        producer.reset_mock()
+        wrapper.pauseProducing() # now the transport is full
+        self.assertEqual(producer.mock_calls, [mock.call.pauseProducing()])
+        producer.reset_mock()
+        pool.finish(1)
+        self.assertEqual(producer.mock_calls, [])
+        wrapper.resumeProducing()
+        self.assertEqual(producer.mock_calls, [mock.call.resumeProducing()])
+        self.assertEqual([r for (n, r) in self.decrypt_sent(owner,
+                                                             t.read_buf())],
+                         [b"r0", b"r1"])
+
+    def test_pipelined_pull_producer(self):
+        t, c, owner = self.make_connection()
+        t.registerProducer = mock.Mock()
+        directlyProvides(t, interfaces.IConsumer)
+        pool = FakeEncryptionPool(threads=1)
+        c.start_pipelining(pool, depth=1)
+        producer = mock.Mock()
+        producer.resumeProducing.side_effect = lambda: c.write(b"r")
+        c.registerProducer(producer, False)
+        wrapper = t.registerProducer.mock_calls[0][1][0]
+        wrapper.resumeProducing()
+        self.assertEqual(len(pool.calls), 1)
+        wrapper.resumeProducing() # full, so it waits
+        self.assertEqual(len(pool.calls), 1)
+        pool.finish(0)
+        self.assertEqual(len(pool.calls), 2)
+
+    def test_pipelined_receive(self):
+        t, c, owner = self.make_connection()
+        pool = FakeEncryptionPool(threads=2)
+        c.start_pipelining(pool)
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        c.dataReceived(self.encrypt_records(owner, [b"r0", b"r1", b"r2"]))
+        self.assertEqual(len(pool.calls), 3)
+        # they're delivered in nonce order, whatever order they finish in
+        pool.finish(1)
+        self.assertEqual(inbound_records, [])
+        pool.finish(0)
+        self.assertEqual(inbound_records, [b"r0", b"r1"])
+        pool.finish(2)
+        self.assertEqual(inbound_records, [b"r0", b"r1", b"r2"])
+
+    def test_pipelined_receive_full(self):
+        t, c, owner = self.make_connection()
+        pool = FakeEncryptionPool(threads=1)
+        c.start_pipelining(pool, depth=2)
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        records = [str(i).encode("ascii") for i in range(5)]
+        c.dataReceived(self.encrypt_records(owner, records))
+        # the rest wait in the buffer, and the transport is paused
+        self.assertEqual(len(pool.calls), 2)
+        self.assertEqual(t.paused, True)
+        pool.finish(0)
+        self.assertEqual(inbound_records, records[:1])
+        self.assertEqual(len(pool.calls), 3)
+        self.assertEqual(t.paused, True)
+        for i in range(1, 5):
+            pool.finish(i)
+        self.assertEqual(inbound_records, records)
+        self.assertEqual(t.paused, False)
+
+    def test_pipelined_receive_consumer_paused(self):
+        # the transport stays paused until both the consumer and the
+        # pipeline are ready for more
+        t, c, owner = self.make_connection()
+        pool = FakeEncryptionPool(threads=1)
+        c.start_pipelining(pool, depth=1)
+        c.recordReceived = lambda record: None
+        c.dataReceived(self.encrypt_records(owner, [b"r0"]))
+        self.assertEqual(t.paused, True)
+        c.pauseProducing()
+        pool.finish(0)
+        self.assertEqual(t.paused, True)
+        c.resumeProducing()
+        self.assertEqual(t.paused, False)
+
+    def test_pipelined_receive_lost(self):
+        # records that arrived before the connection was lost are written
+        # before the consumer hears about it
+        t, c, owner = self.make_connection()
+        pool = FakeEncryptionPool(threads=1)
+        c.start_pipelining(pool)
+        consumer = proto_helpers.StringTransport()
+        d = c.connectConsumer(consumer, expected=10)
+        c.dataReceived(self.encrypt_records(owner, [b"r0", b"r1"]))
+        c.connectionLost()
+        self.assertNoResult(d)
+        pool.finish(0)
+        pool.finish(1)
+        self.assertEqual(consumer.value(), b"r0r1")
+        self.failureResultOf(d, error.ConnectionClosed)
+
+    def test_pipelined_receive_bad(self):
+        t, c, owner = self.make_connection()
+        pool = FakeEncryptionPool(threads=2)
+        c.start_pipelining(pool)
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        data = bytearray(self.encrypt_records(owner, [b"r0", b"r1"]))
+        data[-1] ^= 0x01 # corrupt the second record
+        c.dataReceived(bytes(data))
+        pool.finish(1)
+        self.assertEqual(len(self.flushLoggedErrors(CryptoError)), 1)
+        self.assertEqual(t._connected, False)
+        pool.finish(0)
+        self.assertEqual(inbound_records, [])
+
+    @inlineCallbacks
+    def test_pipelined_writeToFile(self):
+        t, c, owner = self.make_connection()
+        pool = FakeEncryptionPool(threads=1)
+        c.start_pipelining(pool)
+        f = io.BytesIO()
+        hashed = []
+        d = c.writeToFile(f, 4, hasher=hashed.append)
+        c.dataReceived(self.encrypt_records(owner, [b"r0", b"r1"]))
+        pool.finish(0)
+        pool.finish(1)
+        # the Deferred waits for the writer thread
+        self.assertEqual((yield d), 4)
+        self.assertEqual(f.getvalue(), b"r0r1")
+        self.assertEqual(hashed, [b"r0", b"r1"])
+
+    def make_stripes(self, count=2):
+        connections = [self.make_connection() for i in range(count)]
+        stripes = transit._Stripes(connections[0][1])
+        for (t, c, owner) in connections[1:]:
+            stripes.add(c)
+        inbound_records = []
+        connections[0][1].recordReceived = inbound_records.append
+        return stripes, connections, inbound_records
+
+    def encrypt_record(self, owner, record, nonce):
+        return self.encrypt_records(owner, [record], nonce)
+
+    def test_striped_receive(self):
+        stripes, connections, inbound_records = self.make_stripes()
+        (t0, c0, owner), (t1, c1, _) = connections
+        # records arrive on either stream, and are delivered in order
+        c1.dataReceived(self.encrypt_record(owner, b"r1", 1))
+        c1.dataReceived(self.encrypt_record(owner, b"r3", 3))
+        self.assertEqual(inbound_records, [])
+        c0.dataReceived(self.encrypt_record(owner, b"r0", 0))
+        self.assertEqual(inbound_records, [b"r0", b"r1"])
+        c0.dataReceived(self.encrypt_record(owner, b"r2", 2))
+        self.assertEqual(inbound_records, [b"r0", b"r1", b"r2", b"r3"])
+
+    def test_striped_replay(self):
+        # each nonce is only accepted once, on whichever stream
+        stripes, connections, inbound_records = self.make_stripes()
+        (t0, c0, owner), (t1, c1, _) = connections
+        c0.dataReceived(self.encrypt_record(owner, b"r1", 1))
+        self.assertRaises(transit.BadNonce, c1.dataReceived,
+                          self.encrypt_record(owner, b"r1", 1))
+        self.assertEqual(inbound_records, [])
+        # and losing one stream closes the others
+        self.assertEqual(t1._connected, False)
+        self.assertEqual(t0._connected, False)
+
+    def test_striped_nonces_increase(self):
+        stripes, connections, inbound_records = self.make_stripes()
+        (t0, c0, owner), (t1, c1, _) = connections
+        c1.dataReceived(self.encrypt_record(owner, b"r2", 2))
+        self.assertRaises(transit.BadNonce, c1.dataReceived,
+                          self.encrypt_record(owner, b"r1", 1))
+
+    def test_striped_window(self):
+        stripes, connections, inbound_records = self.make_stripes()
+        (t0, c0, owner), (t1, c1, _) = connections
+        stripes.WINDOW = 2
+        c1.dataReceived(self.encrypt_records(owner, [b"r2", b"r3"], 2))
+        # that stream is too far ahead: it waits, unparsed
+        self.assertEqual(t1.paused, True)
+        self.assertEqual(stripes._claimed, set())
+        c0.dataReceived(self.encrypt_record(owner, b"r0", 0))
+        self.assertEqual(inbound_records, [b"r0"])
+        self.assertEqual(t1.paused, True)
+        c0.dataReceived(self.encrypt_record(owner, b"r1", 1))
+        self.assertEqual(inbound_records, [b"r0", b"r1", b"r2", b"r3"])
+        self.assertEqual(t1.paused, False)
+
+    def test_striped_pipelined_receive(self):
+        stripes, connections, inbound_records = self.make_stripes()
+        (t0, c0, owner), (t1, c1, _) = connections
+        pool = FakeEncryptionPool(threads=2)
+        c0.start_pipelining(pool)
+        c1.dataReceived(self.encrypt_record(owner, b"r1", 1))
+        c0.dataReceived(self.encrypt_record(owner, b"r0", 0))
+        pool.finish(0)
+        self.assertEqual(inbound_records, [])
+        pool.finish(1)
+        self.assertEqual(inbound_records, [b"r0", b"r1"])
+
+    def test_striped_send(self):
+        stripes, connections, inbound_records = self.make_stripes(3)
+        (t0, c0, owner) = connections[0]
+        for i in range(6):
+            c0.send_record(b"r%d" % i)
+        # each stream gets every third record, and they're numbered across
+        # all of them
+        sent = [self.decrypt_sent(owner, t.read_buf())
+                for (t, c, _) in connections]
+        self.assertEqual(sorted(sum(sent, [])),
+                         [(i, b"r%d" % i) for i in range(6)])
+        self.assertEqual([len(records) for records in sent], [2, 2, 2])
+
+    def test_striped_producer(self):
+        stripes, connections, inbound_records = self.make_stripes()
+        (t0, c0, owner), (t1, c1, _) = connections
+        directlyProvides(t0, interfaces.IConsumer)
+        producer = mock.Mock()
+        c0.registerProducer(producer, True)
+        # the producer is only paused once every stream is full
+        t0.producer.pauseProducing()
+        self.assertEqual(producer.mock_calls, [])
+        c0.send_record(b"r0") # so this goes to the other one
+        self.assertEqual(t0.read_buf(), b"")
+        self.assertEqual(len(self.decrypt_sent(owner, t1.read_buf())), 1)
+        t1.producer.pauseProducing()
+        self.assertEqual(producer.mock_calls, [mock.call.pauseProducing()])
+        producer.reset_mock()
+        t0.producer.resumeProducing()
+        self.assertEqual(producer.mock_calls, [mock.call.resumeProducing()])
+        c0.unregisterProducer()
+        self.assertEqual((t0.producer, t1.producer), (None, None))
+
+    def test_striped_close(self):
+        stripes, connections, inbound_records = self.make_stripes()
+        (t0, c0, owner), (t1, c1, _) = connections
+        c0.close()
+        self.assertEqual(t0._connected, False)
+        self.assertEqual(t1._connected, False)
+
     def test_receive_queue(self):
         c = transit.Connection(None, None, None, "description")
         c.transport = FakeTransport(c, None)
@@ -1304,6 +1767,210 @@ class FileConsumer(unittest.TestCase):
         self.assertEqual(f.getvalue(), b"."*99+b"!")
         self.assertEqual(hashee, [b"."*99, b"!"])
 
+@implementer(interfaces.IConsumer)
+class RecordingConsumer:
+    # pauses its producer once 'limit' bytes are waiting
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.producer = None
+        self.streaming = None
+        self.writes = []
+        self.waiting = 0
+    def registerProducer(self, producer, streaming):
+        self.producer, self.streaming = producer, streaming
+    def unregisterProducer(self):
+        self.producer = None
+    def write(self, data):
+        self.writes.append(data)
+        self.waiting += len(data)
+        if self.limit is not None and self.waiting >= self.limit:
+            self.producer.pauseProducing()
+    def drain(self):
+        self.waiting = 0
+        self.producer.resumeProducing()
+
+class BlockingFile(io.BytesIO):
+    # write() waits (in the writer thread) until the test lets it go
+    def __init__(self):
+        io.BytesIO.__init__(self)
+        self.proceed = threading.Event()
+    def write(self, data):
+        self.proceed.wait()
+        return io.BytesIO.write(self, data)
+
+class FailingFile(io.BytesIO):
+    def write(self, data):
+        raise IOError("disk full")
+
+class ThreadedFileConsumer(unittest.TestCase):
+    @inlineCallbacks
+    def test_basic(self):
+        f = io.BytesIO()
+        progress = []
+        hashed = []
+        fc = transit.ThreadedFileConsumer(f, progress.append, hashed.append)
+        producer = mock.Mock()
+        fc.registerProducer(producer, True)
+        fc.write(b"a" * 10)
+        fc.write(b"b" * 5)
+        writers = list(fc._pool.threads)
+        yield fc.flush()
+        self.assertFalse(any(t.is_alive() for t in writers))
+        self.assertEqual(f.getvalue(), b"a" * 10 + b"b" * 5)
+        self.assertEqual(progress, [10, 5])
+        self.assertEqual(hashed, [b"a" * 10, b"b" * 5])
+        fc.unregisterProducer()
+        self.assertEqual(producer.mock_calls, [])
+
+    @inlineCallbacks
+    def test_full(self):
+        f = BlockingFile()
+        fc = transit.ThreadedFileConsumer(f)
+        fc.MAX_QUEUED = 10
+        producer = mock.Mock()
+        fc.registerProducer(producer, True)
+        fc.write(b"a" * 6)
+        self.assertEqual(producer.mock_calls, [])
+        fc.write(b"b" * 6)
+        self.assertEqual(producer.mock_calls, [mock.call.pauseProducing()])
+        producer.reset_mock()
+        f.proceed.set()
+        yield fc.flush()
+        self.assertEqual(producer.mock_calls, [mock.call.resumeProducing()])
+        self.assertEqual(f.getvalue(), b"a" * 6 + b"b" * 6)
+
+    @inlineCallbacks
+    def test_failure(self):
+        fc = transit.ThreadedFileConsumer(FailingFile())
+        producer = mock.Mock()
+        fc.registerProducer(producer, True)
+        fc.write(b"data")
+        yield self.assertFailure(fc.flush(), IOError)
+        self.assertEqual(producer.mock_calls, [mock.call.stopProducing()])
+        # later writes are dropped
+        fc.write(b"more")
+        yield self.assertFailure(fc.flush(), IOError)
+
+class EncryptionPool(unittest.TestCase):
+    @inlineCallbacks
+    def test_encrypt(self):
+        pool = transit.EncryptionPool(threads=2)
+        self.addCleanup(pool.stop)
+        box = SecretBox(b"\x01" * SecretBox.KEY_SIZE)
+        nonces = [transit._encode_nonce(i) for i in range(10)]
+        results = yield gatherResults([pool.encrypt(box, b"record", n)
+                                       for n in nonces])
+        self.assertEqual(results, [box.encrypt(b"record", n)
+                                   for n in nonces])
+
+    @inlineCallbacks
+    def test_decrypt(self):
+        pool = transit.EncryptionPool(threads=2)
+        self.addCleanup(pool.stop)
+        box = SecretBox(b"\x01" * SecretBox.KEY_SIZE)
+        nonce = transit._encode_nonce(0)
+        encrypted = box.encrypt(b"record", nonce)
+        ciphertext = encrypted[SecretBox.NONCE_SIZE:]
+        self.assertEqual((yield pool.decrypt(box, ciphertext, nonce)),
+                         b"record")
+        yield self.assertFailure(pool.decrypt(box, ciphertext[:-1], nonce),
+                                 CryptoError)
+
+    @inlineCallbacks
+    def test_stop(self):
+        pool = transit.EncryptionPool(threads=2)
+        yield pool.stop() # never started
+        box = SecretBox(b"\x01" * SecretBox.KEY_SIZE)
+        yield pool.encrypt(box, b"record", transit._encode_nonce(0))
+        workers = list(pool._pool.threads)
+        self.assertEqual(len(workers), 2)
+        yield pool.stop()
+        self.assertFalse(any(t.is_alive() for t in workers))
+
+class BulkFileSender(unittest.TestCase):
+    def test_send(self):
+        clock = task.Clock()
+        data = os.urandom(1000)
+        consumer = RecordingConsumer()
+        hashed = []
+        def _transform(chunk):
+            hashed.append(chunk)
+            return chunk
+        fs = transit.BulkFileSender(300, clock)
+        d = fs.beginFileTransfer(io.BytesIO(data), consumer, _transform)
+        self.assertEqual(consumer.streaming, True)
+        self.assertEqual(consumer.writes, [])
+        clock.advance(0)
+        self.assertEqual(self.successResultOf(d), 1000)
+        self.assertEqual([len(w) for w in consumer.writes], [300, 300, 300,
+                                                              100])
+        self.assertEqual(b"".join(consumer.writes), data)
+        self.assertEqual(hashed, consumer.writes)
+        self.assertEqual(consumer.producer, None)
+
+    def test_pause(self):
+        clock = task.Clock()
+        data = os.urandom(1000)
+        consumer = RecordingConsumer(limit=500)
+        fs = transit.BulkFileSender(300, clock)
+        d = fs.beginFileTransfer(io.BytesIO(data), consumer)
+        clock.advance(0)
+        self.assertEqual(len(consumer.writes), 2) # and then we were paused
+        clock.advance(0)
+        self.assertEqual(len(consumer.writes), 2)
+        self.assertNoResult(d)
+        consumer.drain()
+        clock.advance(0)
+        self.assertEqual(b"".join(consumer.writes), data)
+        self.assertEqual(self.successResultOf(d), 1000)
+
+    def test_burst(self):
+        # we give the reactor a turn after every BURST_SIZE bytes
+        calls = []
+        reactor = mock.Mock()
+        reactor.callLater = lambda delay, f: calls.append(f)
+        consumer = RecordingConsumer()
+        fs = transit.BulkFileSender(100, reactor)
+        fs.BURST_SIZE = 250
+        d = fs.beginFileTransfer(io.BytesIO(b"." * 1000), consumer)
+        calls.pop(0)()
+        self.assertEqual(len(consumer.writes), 3)
+        calls.pop(0)()
+        self.assertEqual(len(consumer.writes), 6)
+        calls.pop(0)()
+        calls.pop(0)()
+        self.assertEqual(calls, [])
+        self.assertEqual(self.successResultOf(d), 1000)
+
+    def test_stop(self):
+        clock = task.Clock()
+        consumer = RecordingConsumer(limit=1)
+        fs = transit.BulkFileSender(100, clock)
+        d = fs.beginFileTransfer(io.BytesIO(b"." * 1000), consumer)
+        clock.advance(0)
+        fs.stopProducing()
+        self.failureResultOf(d, Exception)
+        fs.resumeProducing()
+        clock.advance(0)
+        self.assertEqual(len(consumer.writes), 1)
+
+    def test_readahead(self):
+        fn = self.mktemp()
+        data = os.urandom(1000)
+        with open(fn, "wb") as f:
+            f.write(data)
+        clock = task.Clock()
+        consumer = RecordingConsumer()
+        fs = transit.BulkFileSender(300, clock)
+        with open(fn, "rb") as f:
+            f.seek(100)
+            d = fs.beginFileTransfer(f, consumer)
+            clock.advance(0)
+            self.assertEqual(self.successResultOf(d), 900)
+        self.assertEqual(b"".join(consumer.writes), data[100:])
+        # in-memory files can't have any
+        self.assertEqual(transit._readahead_fd(io.BytesIO(data)), None)
+
 
 DIRECT_HINT_JSON = {"type": "direct-tcp-v1",
                     "hostname": "direct", "port": 1234}
@@ -1584,6 +2251,77 @@ class Full(ServerBase, unittest.TestCase):
         yield x.close()
         yield y.close()
 
+    @inlineCallbacks
+    def test_pipelined_file(self):
+        KEY = b"k"*32
+        s = transit.TransitSender(None)
+        r = transit.TransitReceiver(None)
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+        s.add_connection_hints((yield r.get_connection_hints()))
+        r.add_connection_hints((yield s.get_connection_hints()))
+        (x,y) = yield self.doBoth(s.connect(), r.connect())
+
+        pool = transit.EncryptionPool(threads=3)
+        self.addCleanup(pool.stop)
+        x.start_pipelining(pool)
+        y.start_pipelining(pool)
+        data = os.urandom(1000000)
+        f = io.BytesIO()
+        hasher = hashlib.sha256()
+        received_d = y.writeToFile(f, len(data), hasher=hasher.update)
+        fs = transit.BulkFileSender(10000)
+        sent = yield fs.beginFileTransfer(io.BytesIO(data), x)
+        self.assertEqual(sent, len(data))
+        self.assertEqual((yield received_d), len(data))
+        self.assertEqual(f.getvalue(), data)
+        self.assertEqual(hasher.digest(), hashlib.sha256(data).digest())
+
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def striped_transfer(self, s, r):
+        KEY = b"k"*32
+        for t in (s, r):
+            t.set_transit_key(KEY)
+        s.add_connection_abilities(r.get_connection_abilities())
+        r.add_connection_abilities(s.get_connection_abilities())
+        s.add_connection_hints((yield r.get_connection_hints()))
+        r.add_connection_hints((yield s.get_connection_hints()))
+        (x,y) = yield self.doBoth(s.connect(), r.connect())
+
+        data = os.urandom(1000000)
+        f = io.BytesIO()
+        received_d = y.writeToFile(f, len(data))
+        fs = transit.BulkFileSender(10000)
+        sent = yield fs.beginFileTransfer(io.BytesIO(data), x)
+        self.assertEqual(sent, len(data))
+        self.assertEqual((yield received_d), len(data))
+        self.assertEqual(f.getvalue(), data)
+        # and back the other way
+        d = x.receive_record()
+        y.send_record(b"ack")
+        self.assertEqual((yield d), b"ack")
+        self.assertEqual(len(x._streams()), 3)
+        self.assertEqual(len(y._streams()), 3)
+
+        yield x.close()
+        yield y.close()
+
+    def test_striped_direct(self):
+        s = transit.TransitSender(None, streams=3)
+        r = transit.TransitReceiver(None, streams=3)
+        # so that the sender opens the connection, to the receiver
+        s._listener_d = None
+        s._build_listener = lambda: ([], None)
+        return self.striped_transfer(s, r)
+
+    def test_striped_relay(self):
+        s = transit.TransitSender(self.transit, no_listen=True, streams=3)
+        r = transit.TransitReceiver(self.transit, no_listen=True, streams=4)
+        return self.striped_transfer(s, r)
+
     @inlineCallbacks
     def test_relay(self):
         KEY = b"k"*32
@@ -184,6 +184,28 @@ class Wormholes(ServerBase, unittest.TestCase):
         c2 = yield w2.close()
         self.assertEqual(c2, "happy")
 
+    @inlineCallbacks
+    def test_tcp(self):
+        # a client using the raw-TCP transport can meet a websocket one
+        w1 = wormhole.create(APPID, self.relayurl_tcp, reactor)
+        w2 = wormhole.create(APPID, self.relayurl, reactor)
+        w1.allocate_code()
+        code = yield w1.get_code()
+        w2.set_code(code)
+        verifier1 = yield w1.get_verifier()
+        verifier2 = yield w2.get_verifier()
+        self.assertEqual(verifier1, verifier2)
+        w1.send_message(b"data1")
+        w2.send_message(b"data2")
+        dataX = yield w1.get_message()
+        dataY = yield w2.get_message()
+        self.assertEqual(dataX, b"data2")
+        self.assertEqual(dataY, b"data1")
+        c1 = yield w1.close()
+        self.assertEqual(c1, "happy")
+        c2 = yield w2.close()
+        self.assertEqual(c2, "happy")
+
     @inlineCallbacks
     def test_get_code_early(self):
         w1 = wormhole.create(APPID, self.relayurl, reactor)
@@ -2,6 +2,7 @@ from __future__ import print_function, absolute_import, unicode_literals
 import json, time
 from zope.interface import implementer
 from ._interfaces import ITiming
+from .util import bytes_to_hexstr
 
 class Event:
     def __init__(self, name, when, **details):
@@ -35,6 +36,12 @@ class Event:
         else:
             self.finish()
 
+def _json_default(o):
+    # message bodies are bytes, when we use the binary rendezvous protocol
+    if isinstance(o, type(b"")):
+        return bytes_to_hexstr(o)
+    raise TypeError(repr(o))
+
 @implementer(ITiming)
 class DebugTiming:
     def __init__(self):
@@ -52,6 +59,6 @@ class DebugTiming:
                           details=e._details,
                           )
                      for e in self._events ]
-            json.dump(data, f, indent=1)
+            json.dump(data, f, indent=1, default=_json_default)
             f.write("\n")
         print("Timing data written to %s" % fn, file=stderr)
@@ -1,14 +1,15 @@
 # no unicode_literals, revisit after twisted patch
 from __future__ import print_function, absolute_import
-import os, re, sys, time, socket
+import io, os, re, sys, time, socket, struct, multiprocessing
 from collections import namedtuple, deque
-from binascii import hexlify, unhexlify
+from binascii import hexlify
 import six
 from zope.interface import implementer
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.python.runtime import platformType
+from twisted.python.threadpool import ThreadPool
 from twisted.internet import (reactor, interfaces, defer, protocol,
-                              endpoints, task, address, error)
+                              endpoints, task, address, error, threads)
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.protocols import policies
 from nacl.secret import SecretBox
@@ -71,10 +72,14 @@ def build_sender_handshake(key):
     hexid = HKDF(key, 32, CTXinfo=b"transit_sender")
     return b"transit sender "+hexlify(hexid)+b" ready\n\n"
 
-def build_sided_relay_handshake(key, side):
+def build_sided_relay_handshake(key, side, stripe=0):
     assert isinstance(side, type(u""))
     assert len(side) == 8*2
-    token = HKDF(key, 32, CTXinfo=b"transit_relay_token")
+    # each extra stream of a striped transfer is paired up separately
+    context = b"transit_relay_token"
+    if stripe:
+        context += b"_stripe_" + str(stripe).encode("ascii")
+    token = HKDF(key, 32, CTXinfo=context)
     return b"please relay "+hexlify(token)+b" for side "+side.encode("ascii")+b"\n"
 
 
@@ -140,8 +145,44 @@ def parse_hint_argv(hint, stderr=sys.stderr):
 
 TIMEOUT = 60 # seconds
 
+# each record is a 4-byte big-endian length, then the encrypted record: a
+# 24-byte big-endian nonce, and the ciphertext (with its MAC)
+_RECORD_LENGTH = struct.Struct(">L")
+_NONCE = struct.Struct(">QQQ")
+_U64 = 2**64 - 1
+
+# Senders that haven't heard otherwise keep their records to 16KiB, the
+# size that older versions (which read files with FileSender) send. Each
+# record costs a nonce, a MAC, a length, and a trip through the reactor, so
+# on a fast network larger ones are cheaper: peers that advertise a
+# "records-v1" ability get records of up to RECORD_SIZE, or their own
+# "max-size" if that is smaller. MAX_RECORD_SIZE is what we advertise, and
+# other implementations may send that much. We send 256KiB: every record
+# goes through several buffers of its own size, and beyond glibc's 128KiB
+# mmap threshold each of those allocations costs fresh pages, so the
+# sender's CPU ceiling (misc/bench-transit-send.py) is lower than with
+# 64KiB records (about 380MB/s instead of 620MB/s on one core), but it is
+# still well above what a gigabit link carries, and a quarter as many
+# records means a quarter as many trips through the reactor on each side.
+DEFAULT_RECORD_SIZE = 2**14
+RECORD_SIZE = 2**18
+MAX_RECORD_SIZE = 2**22
+# what a peer may put in a record's length prefix: we hang up on anything
+# larger, rather than buffering it
+_MAX_RECORD_LENGTH = (MAX_RECORD_SIZE + SecretBox.NONCE_SIZE
+                      + SecretBox.MACBYTES)
+
+def _encode_nonce(n):
+    return _NONCE.pack(n >> 128, (n >> 64) & _U64, n & _U64)
+
+def _decode_nonce(nonce_buf):
+    (high, middle, low) = _NONCE.unpack(nonce_buf)
+    return (high << 128) | (middle << 64) | low
+
 @implementer(interfaces.IProducer, interfaces.IConsumer)
 class Connection(protocol.Protocol, policies.TimeoutMixin):
+    stripe = 0 # which extra stream of a striped transfer we were dialed as
+
     def __init__(self, owner, relay_handshake, start, description):
         self.state = "too-early"
         self.buf = b""
@@ -157,6 +198,25 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         self._consumer_deferred = None
         self._inbound_records = deque()
         self._waiting_reads = deque()
+        # once negotiation is done, inbound data is appended here, and
+        # records are parsed in place, starting at _records_start
+        self._records_buf = bytearray()
+        self._records_start = 0
+        # outbound records, when they're encrypted by an EncryptionPool
+        self._pipeline = None
+        self._pipeline_depth = None
+        self._pending = deque() # [encrypted or None], in nonce order
+        self._outbound_producer = None
+        self._close_when_flushed = False
+        # inbound records being decrypted by the pool, also in nonce order
+        self._decrypting = deque() # [record or None]
+        self._consumer_paused = False
+        self._reading_paused = False
+        self._lost = False
+        # the _Stripes we belong to, if our records are striped across
+        # several connections
+        self._stripes = None
+        self._ahead = False # of the other stripes
 
     def connectionMade(self):
         self.setTimeout(TIMEOUT) # does timeoutConnection() when it expires
@@ -209,6 +269,8 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         #  wait for (receive|send)_handshake
         #  sender: decide, send "go" or hang up
         #  receiver: wait for "go"
+        if self.state == "records":
+            return self.dataReceivedRECORDS(data)
         self.buf += data
 
         assert self.state != "too-early"
@@ -258,30 +320,125 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         receive_key = self.owner._receiver_record_key()
         self.receive_box = SecretBox(receive_key)
         self.next_receive_nonce = 0
+        # anything that arrived right after the handshake is a record
+        self._records_buf += self.buf
+        self.buf = b""
         d, self._negotiation_d = self._negotiation_d, None
         d.callback(self)
 
-    def dataReceivedRECORDS(self):
+    def dataReceivedRECORDS(self, data=b""):
+        # Large transfers arrive in many chunks, so we don't build a new
+        # string for each one, or for what's left after each record: data
+        # is appended to a bytearray, and only the records themselves are
+        # copied out of it. The consumed prefix is discarded once it is at
+        # least as large as what remains, so each byte is moved at most
+        # once or twice.
+        buf = self._records_buf
+        if self._records_start and self._records_start * 2 >= len(buf):
+            del buf[:self._records_start]
+            self._records_start = 0
+        buf += data
         while True:
-            if len(self.buf) < 4:
+            if self._decrypting and self._decrypting_full():
+                # leave the rest in the buffer until there's room
+                return
+            # recordReceived() can call back into us (through the
+            # consumer's flow control), so re-read our position each time
+            start = self._records_start
+            if len(buf) - start < 4:
                 return
-            length = int(hexlify(self.buf[:4]), 16)
-            if len(self.buf) < 4+length:
+            (length,) = _RECORD_LENGTH.unpack_from(buf, start)
+            if length > _MAX_RECORD_LENGTH:
+                raise TransitError("received a record of %d bytes, larger"
+                                   " than we accept" % length)
+            end = start + 4 + length
+            if len(buf) < end:
                 return
-            encrypted, self.buf = self.buf[4:4+length], self.buf[4+length:]
+            if length < SecretBox.NONCE_SIZE:
+                raise BadNonce("received a record too short to hold its nonce")
+            if self._stripes and not self._stripes.accepts(self, buf,
+                                                           start + 4):
+                # leave it in the buffer until the other stripes catch up
+                return
+            nonce_end = start + 4 + SecretBox.NONCE_SIZE
+            view = memoryview(buf)
+            nonce_buf = view[start+4:nonce_end].tobytes()
+            ciphertext = view[nonce_end:end].tobytes()
+            del view # so the bytearray can be resized again
+            self._records_start = end
+
+            if self._pipeline is None:
+                self._deliver(*self._decrypt_record(nonce_buf, ciphertext))
+                continue
+            slot = [None, self._check_nonce(nonce_buf)]
+            self._decrypting.append(slot)
+            d = self._pipeline.decrypt(self.receive_box, ciphertext, nonce_buf)
+            d.addCallbacks(self._decrypted, self._decryption_failed,
+                           callbackArgs=(slot,))
+            d.addErrback(log.err, "unable to process a transit record")
+            self._update_reading()
+
+    def _check_nonce(self, nonce_buf):
+        # returns the nonce, as an integer
+        if self._stripes is not None:
+            return self._stripes.check_nonce(self, nonce_buf)
+        if nonce_buf != _encode_nonce(self.next_receive_nonce):
+            raise BadNonce("received out-of-order record: got %d, expected %d"
+                           % (_decode_nonce(nonce_buf),
+                              self.next_receive_nonce))
+        self.next_receive_nonce += 1
+        return self.next_receive_nonce - 1
 
-            record = self._decrypt_record(encrypted)
+    def _decrypt_record(self, nonce_buf, ciphertext):
+        # returns (nonce, record)
+        nonce = self._check_nonce(nonce_buf)
+        return nonce, self.receive_box.decrypt(ciphertext, nonce_buf)
+
+    def _deliver(self, nonce, record):
+        if self._stripes is None:
             self.recordReceived(record)
+        else:
+            self._stripes.received(nonce, record)
 
-    def _decrypt_record(self, encrypted):
-        nonce_buf = encrypted[:SecretBox.NONCE_SIZE] # assume it's prepended
-        nonce = int(hexlify(nonce_buf), 16)
-        if nonce != self.next_receive_nonce:
-            raise BadNonce("received out-of-order record: got %d, expected %d"
-                           % (nonce, self.next_receive_nonce))
-        self.next_receive_nonce += 1
-        record = self.receive_box.decrypt(encrypted)
-        return record
+    def _decrypting_full(self):
+        return len(self._decrypting) >= self._pipeline_depth
+
+    def _decrypted(self, record, slot):
+        if self.state == "hung up":
+            return
+        slot[0] = record
+        while self._decrypting and self._decrypting[0][0] is not None:
+            record, nonce = self._decrypting.popleft()
+            self._deliver(nonce, record)
+        self._update_reading()
+        try:
+            # parse anything that was left waiting for room in the pipeline
+            self.dataReceived(b"")
+        finally:
+            self._maybeFinishConnectionLost()
+
+    def _decryption_failed(self, f):
+        if self.state == "hung up":
+            return
+        log.err(f, "unable to decrypt a transit record")
+        self._decrypting.clear()
+        self.state = "hung up"
+        self.transport.loseConnection()
+        self._maybeFinishConnectionLost()
+
+    def _update_reading(self):
+        # the transport is paused while our consumer asks us to pause,
+        # while the decryption pipeline is full, and while we're too far
+        # ahead of our fellow stripes
+        paused = (self._consumer_paused or self._ahead
+                  or bool(self._decrypting and self._decrypting_full()))
+        if self._lost or paused == self._reading_paused:
+            return
+        self._reading_paused = paused
+        if paused:
+            self.transport.pauseProducing()
+        else:
+            self.transport.resumeProducing()
 
     def describe(self):
         return self._description
@@ -291,12 +448,73 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         assert SecretBox.NONCE_SIZE == 24
         assert self.send_nonce < 2**(8*24)
         assert len(record) < 2**(8*4)
-        nonce = unhexlify("%048x" % self.send_nonce) # big-endian
+        nonce = _encode_nonce(self.send_nonce)
         self.send_nonce += 1
-        encrypted = self.send_box.encrypt(record, nonce)
-        length = unhexlify("%08x" % len(encrypted)) # always 4 bytes long
-        self.transport.write(length)
-        self.transport.write(encrypted)
+        if self._pipeline is None:
+            self._write_record(self.send_box.encrypt(record, nonce))
+            return
+        slot = [None]
+        self._pending.append(slot)
+        d = self._pipeline.encrypt(self.send_box, record, nonce)
+        d.addCallback(self._encrypted, slot)
+        d.addErrback(self._encryption_failed)
+        self._pipeline_changed()
+
+    def _write_record(self, encrypted):
+        transport = self.transport
+        if self._stripes is not None:
+            transport = self._stripes.next_transport()
+        transport.write(_RECORD_LENGTH.pack(len(encrypted)))
+        transport.write(encrypted)
+
+    def _streams(self):
+        if self._stripes is None:
+            return [self]
+        return self._stripes.streams
+
+    def _loseConnection(self):
+        for stream in self._streams():
+            if not stream._lost:
+                stream.transport.loseConnection()
+
+    def start_pipelining(self, pool, depth=None):
+        """Encrypt outbound records in 'pool' (an EncryptionPool), several
+        at a time. send_record() still gives each record the next nonce,
+        and they are written in that order, as each one (and everything
+        before it) is ready. At most 'depth' records (twice the pool's
+        threads, by default) are in flight: while there are that many, a
+        producer registered with us is paused.
+
+        Inbound records are decrypted in the pool too, and delivered in
+        order as they are ready, with up to 'depth' of them in flight (the
+        transport is paused while there are that many). writeToFile() will
+        then hash and write the file in a thread of its own."""
+        for stream in self._streams():
+            stream._pipeline = pool
+            stream._pipeline_depth = depth or 2 * pool.threads
+
+    def _pipeline_full(self):
+        if self._pipeline is None:
+            return False
+        return len(self._pending) >= self._pipeline_depth
+
+    def _encrypted(self, encrypted, slot):
+        slot[0] = encrypted
+        while self._pending and self._pending[0][0] is not None:
+            self._write_record(self._pending.popleft()[0])
+        self._pipeline_changed()
+
+    def _encryption_failed(self, f):
+        log.err(f, "unable to encrypt a transit record")
+        self._pending.clear()
+        self.transport.loseConnection()
+
+    def _pipeline_changed(self):
+        if self._outbound_producer:
+            self._outbound_producer.update()
+        if self._close_when_flushed and not self._pending:
+            self._close_when_flushed = False
+            self._loseConnection()
 
     def recordReceived(self, record):
         if self._consumer:
@@ -318,7 +536,11 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             d.callback(r)
 
     def close(self):
-        self.transport.loseConnection()
+        if self._pending:
+            # let the records we've been given reach the transport first
+            self._close_when_flushed = True
+        else:
+            self._loseConnection()
         while self._waiting_reads:
             d = self._waiting_reads.popleft()
             d.errback(error.ConnectionClosed())
@@ -329,6 +551,10 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
 
     def connectionLost(self, reason=None):
         self.setTimeout(None)
+        self._lost = True
+        if self._stripes is not None:
+            # a striped transfer can't go on without all of its streams
+            self._stripes.lost(self)
         d, self._negotiation_d = self._negotiation_d, None
         # the Deferred is only relevant until negotiation finishes, so skip
         # this if it's alredy been fired
@@ -345,6 +571,15 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             # timeout: BadHandshake("timeout")
 
             d.errback(self._error or BadHandshake("connection lost"))
+        self._maybeFinishConnectionLost()
+
+    def _maybeFinishConnectionLost(self):
+        # records that arrived before the connection was lost are delivered
+        # first, unless we've given up on them
+        if not self._lost:
+            return
+        if self._decrypting and self.state != "hung up":
+            return
         if self._consumer_deferred:
             self._consumer_deferred.errback(error.ConnectionClosed())
 
@@ -352,20 +587,37 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
     # the transport. The 'producer' is something like a t.p.basic.FileSender
     def registerProducer(self, producer, streaming):
         assert interfaces.IConsumer.providedBy(self.transport)
+        if self._pipeline is not None or self._stripes is not None:
+            # the producer must also wait for records in the pipeline, or
+            # for room in any of our streams
+            producer = _PipelineProducer(self, producer, streaming)
+            self._outbound_producer = producer
+        if self._stripes is not None:
+            self._stripes.registerProducer(producer, streaming)
+            return
         self.transport.registerProducer(producer, streaming)
     def unregisterProducer(self):
+        self._outbound_producer = None
+        if self._stripes is not None:
+            self._stripes.unregisterProducer()
+            return
         self.transport.unregisterProducer()
     def write(self, data):
         self.send_record(data)
 
     # IProducer methods, for inbound flow-control. We pass these through to
-    # the transport.
+    # the transport (which the decryption pipeline might be pausing too).
     def stopProducing(self):
-        self.transport.stopProducing()
+        for stream in self._streams():
+            stream.transport.stopProducing()
     def pauseProducing(self):
-        self.transport.pauseProducing()
+        for stream in self._streams():
+            stream._consumer_paused = True
+            stream._update_reading()
     def resumeProducing(self):
-        self.transport.resumeProducing()
+        for stream in self._streams():
+            stream._consumer_paused = False
+            stream._update_reading()
 
     # Helper methods
 
@@ -435,24 +687,270 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
     # optional callable which will be called on each write (with the number
     # of bytes written). Returns a Deferred that fires (with the number of
     # bytes written) when the count is reached or the RecordPipe is closed.
+    # When we're pipelined, the writes and 'hasher' happen in another
+    # thread, and the Deferred waits for them to finish.
 
     def writeToFile(self, f, expected, progress=None, hasher=None):
-        fc = FileConsumer(f, progress, hasher)
-        return self.connectConsumer(fc, expected)
+        if self._pipeline is None:
+            fc = FileConsumer(f, progress, hasher)
+            return self.connectConsumer(fc, expected)
+        fc = ThreadedFileConsumer(f, progress, hasher)
+        d = self.connectConsumer(fc, expected)
+        def _flush(res):
+            d2 = fc.flush()
+            d2.addCallback(lambda _: res)
+            return d2
+        d.addBoth(_flush)
+        return d
+
+@implementer(interfaces.IPushProducer)
+class _PipelineProducer(object):
+    """I stand between a Connection's transport and the producer that is
+    writing records to it, when the Connection is pipelined. The producer
+    gets to produce only when the transport wants more data and the
+    pipeline has room."""
+    def __init__(self, connection, producer, streaming):
+        self._connection = connection
+        self._producer = producer
+        self._streaming = streaming
+        self._transport_paused = False
+        self._paused = False # what we've told a streaming producer
+        self._pull_wanted = False # a pull producer has been asked for more
+
+    def pauseProducing(self):
+        self._transport_paused = True
+        self.update()
+
+    def resumeProducing(self):
+        self._transport_paused = False
+        if not self._streaming:
+            self._pull_wanted = True
+        self.update()
+
+    def stopProducing(self):
+        self._producer.stopProducing()
+
+    def update(self):
+        full = self._connection._pipeline_full()
+        if not self._streaming:
+            if self._pull_wanted and not full:
+                self._pull_wanted = False
+                self._producer.resumeProducing()
+            return
+        pause = self._transport_paused or full
+        if pause and not self._paused:
+            self._paused = True
+            self._producer.pauseProducing()
+        elif not pause and self._paused:
+            self._paused = False
+            self._producer.resumeProducing()
+
+class _Stripes(object):
+    """I hold the connections (streams) that a striped transfer spreads its
+    records across. The first is the Connection that Common.connect()
+    returned, which the application uses: records sent through it are
+    written to whichever stream has room, and records that arrive on any
+    stream are delivered to it in nonce order.
+
+    Each direction still uses one sequence of nonces, so every record can
+    only be accepted once, whichever stream it arrives on. The nonces on
+    each stream must increase, and at most WINDOW records may arrive ahead
+    of the next one we need: a stream that gets further ahead than that is
+    paused until the others catch up.
+    """
+    WINDOW = 256
+
+    def __init__(self, primary):
+        self.primary = primary
+        self.streams = [primary]
+        primary._stripes = self
+        self._next = primary.next_receive_nonce # next record to deliver
+        self._claimed = set() # nonces accepted, but not yet delivered
+        self._early = {} # nonce -> record, waiting for those before it
+        self._ahead = set() # streams waiting for the window to move
+        self._turn = 0
+        self._paused = set() # streams whose transports want no more
+        self._producer = None
+        self._streaming = None
+        self._closing = False
+
+    def add(self, stream):
+        stream._stripes = self
+        stream.next_receive_nonce = self._next
+        stream._pipeline = self.primary._pipeline
+        stream._pipeline_depth = self.primary._pipeline_depth
+        stream._consumer_paused = self.primary._consumer_paused
+        stream._update_reading()
+        self.streams.append(stream)
+        if self._producer is not None:
+            stream.transport.registerProducer(_StreamProducer(self, stream),
+                                              self._streaming)
+            # it has room, even if the others don't
+            self._producer.resumeProducing()
+        # anything that arrived with the end of its handshake
+        stream.dataReceived(b"")
+
+    # receiving
+
+    def accepts(self, stream, buf, offset):
+        (high, middle, low) = _NONCE.unpack_from(buf, offset)
+        nonce = (high << 128) | (middle << 64) | low
+        if nonce < self._next + self.WINDOW:
+            return True
+        stream._ahead = True
+        self._ahead.add(stream)
+        stream._update_reading()
+        return False
+
+    def check_nonce(self, stream, nonce_buf):
+        nonce = _decode_nonce(nonce_buf)
+        if (nonce < stream.next_receive_nonce or nonce < self._next
+            or nonce in self._claimed):
+            raise BadNonce("received out-of-order record %d on a stripe"
+                           % nonce)
+        stream.next_receive_nonce = nonce + 1
+        self._claimed.add(nonce)
+        return nonce
+
+    def received(self, nonce, record):
+        self._early[nonce] = record
+        if nonce != self._next:
+            return
+        while self._next in self._early:
+            record = self._early.pop(self._next)
+            self._claimed.discard(self._next)
+            self._next += 1
+            self.primary.recordReceived(record)
+        for stream in list(self._ahead):
+            self._ahead.discard(stream)
+            stream._ahead = False
+            stream._update_reading()
+            stream.dataReceived(b"")
+
+    def lost(self, stream):
+        if self._closing:
+            return
+        self._closing = True
+        for s in self.streams:
+            if s is not stream and not s._lost:
+                s.transport.loseConnection()
+
+    # sending
+
+    def next_transport(self):
+        # take turns, skipping streams that are full, unless they all are
+        for i in range(len(self.streams)):
+            self._turn = (self._turn + 1) % len(self.streams)
+            if self.streams[self._turn] not in self._paused:
+                break
+        return self.streams[self._turn].transport
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        self._streaming = streaming
+        for stream in self.streams:
+            stream.transport.registerProducer(_StreamProducer(self, stream),
+                                              streaming)
+
+    def unregisterProducer(self):
+        self._producer = None
+        self._paused.clear()
+        for stream in self.streams:
+            stream.transport.unregisterProducer()
+
+    def stream_paused(self, stream, paused):
+        if paused:
+            self._paused.add(stream)
+        else:
+            self._paused.discard(stream)
+        if self._producer is None:
+            return
+        if not paused:
+            self._producer.resumeProducing()
+        elif len(self._paused) == len(self.streams):
+            self._producer.pauseProducing()
+
+    def stop_producing(self):
+        if self._producer is not None:
+            self._producer.stopProducing()
+
+@implementer(interfaces.IPushProducer)
+class _StreamProducer(object):
+    """I'm registered with the transport of each stream of a striped
+    Connection, to tell the _Stripes when it has room for more records."""
+    def __init__(self, stripes, stream):
+        self._stripes = stripes
+        self._stream = stream
+
+    def pauseProducing(self):
+        self._stripes.stream_paused(self._stream, True)
+
+    def resumeProducing(self):
+        self._stripes.stream_paused(self._stream, False)
+
+    def stopProducing(self):
+        self._stripes.stop_producing()
+
+class EncryptionPool(object):
+    """I encrypt and decrypt transit records in a pool of threads, for
+    pipelined Connections (see Connection.start_pipelining). libsodium
+    releases the GIL while it works, so the threads can use one core each.
+    My threads are started on first use, and stop() must be called when I'm
+    no longer needed. One pool can serve any number of Connections.
+
+    Each record costs a trip to another thread and back, so this only pays
+    off with more than one core, and for more than a few records.
+    """
+    def __init__(self, threads=None, reactor=reactor):
+        self.threads = threads or multiprocessing.cpu_count()
+        self._reactor = reactor
+        self._pool = ThreadPool(minthreads=self.threads,
+                                maxthreads=self.threads,
+                                name="wormhole-transit")
+
+    def encrypt(self, box, record, nonce):
+        """Return a Deferred that fires (in the reactor thread) with
+        box.encrypt(record, nonce)."""
+        return self._run(box.encrypt, record, nonce)
+
+    def decrypt(self, box, ciphertext, nonce):
+        """Return a Deferred that fires (in the reactor thread) with
+        box.decrypt(ciphertext, nonce), or errbacks with CryptoError."""
+        return self._run(box.decrypt, ciphertext, nonce)
+
+    def _run(self, f, *args):
+        if not self._pool.started:
+            self._pool.start()
+        return threads.deferToThreadPool(self._reactor, self._pool, f, *args)
+
+    def stop(self):
+        """Stop my threads, once they've finished anything already queued.
+        They are joined from the reactor's own thread pool, rather than
+        blocking the reactor: returns a Deferred that fires when they're
+        gone."""
+        if not self._pool.started:
+            return defer.succeed(None)
+        return threads.deferToThreadPool(self._reactor,
+                                         self._reactor.getThreadPool(),
+                                         self._pool.stop)
 
 class OutboundConnectionFactory(protocol.ClientFactory):
     protocol = Connection
 
-    def __init__(self, owner, relay_handshake, description):
+    def __init__(self, owner, relay_handshake, description, endpoint=None,
+                 stripe=0):
         self.owner = owner
         self.relay_handshake = relay_handshake
         self._description = description
+        self.endpoint = endpoint # to open more streams, when striping
+        self.stripe = stripe
         self.start = time.time()
 
     def buildProtocol(self, addr):
         p = self.protocol(self.owner, self.relay_handshake, self.start,
                           self._description)
         p.factory = self
+        p.stripe = self.stripe
         return p
 
     def connectionWasMade(self, p):
@@ -468,6 +966,9 @@ class InboundConnectionFactory(protocol.ClientFactory):
         self.start = time.time()
         self._inbound_d = defer.Deferred(self._cancel)
         self._pending_connections = set()
+        # set by our owner when the other streams of a striped transfer
+        # might arrive right behind the first connection
+        self.accept_stripes = False
 
     def whenDone(self):
         return self._inbound_d
@@ -504,7 +1005,13 @@ class InboundConnectionFactory(protocol.ClientFactory):
         return res
 
     def _proto_succeeded(self, p):
-        self._shutdown()
+        if self._inbound_d.called:
+            # we're still listening for the rest of a striped transfer's
+            # streams
+            self.owner.add_stripe(p)
+            return
+        if not self.accept_stripes:
+            self._shutdown()
         self._inbound_d.callback(p)
 
     def _proto_failed(self, f):
@@ -586,10 +1093,11 @@ def there_can_be_only_one(contenders):
 
 class Common:
     RELAY_DELAY = 2.0
+    STRIPE_TIMEOUT = 10.0
     TRANSIT_KEY_LENGTH = SecretBox.KEY_SIZE
 
     def __init__(self, transit_relay, no_listen=False, tor=None,
-                 reactor=reactor, timing=None):
+                 reactor=reactor, timing=None, streams=1):
         self._side = bytes_to_hexstr(os.urandom(8)) # unicode
         if transit_relay:
             if not isinstance(transit_relay, type(u"")):
@@ -603,10 +1111,18 @@ class Common:
         self._their_direct_hints = [] # hintobjs
         self._our_relay_hints = set(self._transit_relays)
         self._tor = tor
+        self._their_max_record_size = None
+        self._streams = streams
+        self._their_max_streams = None
+        self._stripes = None
+        self._stripes_wanted = 0
+        self._stripe_timer = None
+        self._early_stripes = [] # arrived before _start_stripes
         self._transit_key = None
         self._no_listen = no_listen
         self._waiting_for_transit_key = []
         self._listener = None
+        self._listener_port = None
         self._winner = None
         self._reactor = reactor
         self._timing = timing or DebugTiming()
@@ -628,9 +1144,47 @@ class Common:
         return direct_hints, ep
 
     def get_connection_abilities(self):
-        return [{u"type": u"direct-tcp-v1"},
-                {u"type": u"relay-v1"},
-                ]
+        abilities = [{u"type": u"direct-tcp-v1"},
+                     {u"type": u"relay-v1"},
+                     {u"type": u"records-v1", u"max-size": MAX_RECORD_SIZE},
+                     ]
+        if self._streams > 1:
+            abilities.append({u"type": u"striped-v1",
+                              u"max-streams": self._streams})
+        return abilities
+
+    def add_connection_abilities(self, abilities):
+        for a in abilities:
+            if a.get(u"type") == u"records-v1":
+                max_size = self._positive_int(a, u"max-size")
+                if max_size is not None:
+                    self._their_max_record_size = max_size
+            elif a.get(u"type") == u"striped-v1":
+                max_streams = self._positive_int(a, u"max-streams")
+                if max_streams is not None:
+                    self._their_max_streams = max_streams
+
+    def _positive_int(self, ability, key):
+        value = ability.get(key)
+        if (not isinstance(value, six.integer_types)
+            or isinstance(value, bool) or value <= 0):
+            log.msg("invalid %s in ability: %r" % (key, ability))
+            return None
+        return value
+
+    def get_record_size(self):
+        """Return the largest record our peer is prepared to receive, up to
+        RECORD_SIZE."""
+        if self._their_max_record_size is None:
+            return DEFAULT_RECORD_SIZE
+        return min(RECORD_SIZE, self._their_max_record_size)
+
+    def get_stream_count(self):
+        """Return how many connections a transfer may be striped across:
+        the most that both we and our peer allow."""
+        if self._their_max_streams is None:
+            return 1
+        return min(self._streams, self._their_max_streams)
 
     @inlineCallbacks
     def get_connection_hints(self):
@@ -677,8 +1231,14 @@ class Common:
         d = self._listener.listen(f)
         def _listening(lp):
             # lp is an IListeningPort
-            #self._listener_port = lp # for tests
+            self._listener_port = lp
             def _stop_listening(res):
+                if isinstance(res, Connection) and self._accepts_stripes():
+                    # our peer will open the rest of the streams to this
+                    # port: see _start_stripes
+                    self._stripe_timer = self._reactor.callLater(
+                        self.STRIPE_TIMEOUT, self._stop_accepting_stripes)
+                    return res
                 lp.stopListening()
                 return res
             self._listener_d.addBoth(_stop_listening)
@@ -794,10 +1354,15 @@ class Common:
     def connect(self):
         with self._timing.add("transit connect"):
             yield self._get_transit_key()
+            if self._listener_d and self._accepts_stripes():
+                # the losers of the race will be told "nevermind", so any
+                # others that connect are our peer's extra streams
+                self._listener_f.accept_stripes = True
             # we want to have the transit key before starting any outbound
             # connections, so those connections will know what to say when
             # they connect
             winner = yield self._connect()
+        self._start_stripes(winner)
         returnValue(winner)
 
     def _connect(self):
@@ -871,15 +1436,17 @@ class Common:
         d.addBoth(_done)
         return d
 
-    def _build_relay_handshake(self):
-        return build_sided_relay_handshake(self._transit_key, self._side)
+    def _build_relay_handshake(self, stripe=0):
+        return build_sided_relay_handshake(self._transit_key, self._side,
+                                           stripe)
 
-    def _start_connector(self, ep, description, is_relay=False):
+    def _start_connector(self, ep, description, is_relay=False, stripe=0):
         relay_handshake = None
         if is_relay:
             assert self._transit_key
-            relay_handshake = self._build_relay_handshake()
-        f = OutboundConnectionFactory(self, relay_handshake, description)
+            relay_handshake = self._build_relay_handshake(stripe)
+        f = OutboundConnectionFactory(self, relay_handshake, description, ep,
+                                      stripe)
         d = ep.connect(f)
         # fires with protocol, or ConnectError
         d.addCallback(lambda p: p.startNegotiation())
@@ -909,12 +1476,79 @@ class Common:
             return "wait-for-decision"
 
         if self._winner:
+            if getattr(p, "stripe", 0):
+                # we opened this one to stripe the winner's records across
+                return "go"
             # we already have a winner, so this one loses
             return "nevermind"
         # this one wins!
         self._winner = p
         return "go"
 
+    # Striped transfers: once the race above has a winner, whoever opened it
+    # opens get_stream_count()-1 more connections the same way (to the same
+    # direct hint, or the same relay, using a different relay token for
+    # each), and the sender says "go" on all of them. The receiver takes
+    # every connection that it gets a "go" on as another stream. Through a
+    # relay, both sides open them. For a direct connection, only the sender
+    # does: if the receiver opened the winner, the transfer isn't striped.
+
+    def _accepts_stripes(self):
+        return not self.is_sender and self.get_stream_count() > 1
+
+    def _start_stripes(self, p):
+        streams = self.get_stream_count()
+        if streams < 2:
+            return
+        outbound = isinstance(p.factory, OutboundConnectionFactory)
+        relay = outbound and p.factory.relay_handshake is not None
+        dial = relay or (outbound and self.is_sender)
+        if not dial and not (self._accepts_stripes() and not outbound):
+            self._stop_accepting_stripes()
+            return
+        self._stripes = _Stripes(p)
+        self._stripes_wanted = streams - 1
+        if not dial:
+            # they will arrive at our listener
+            early, self._early_stripes = self._early_stripes, []
+            for stripe in early:
+                self.add_stripe(stripe)
+            return
+        for stripe in range(1, streams):
+            d = self._start_connector(p.factory.endpoint, p.describe(),
+                                      is_relay=relay, stripe=stripe)
+            d = self._not_forever(self.STRIPE_TIMEOUT, d)
+            d.addCallbacks(self.add_stripe, self._stripe_failed)
+
+    def add_stripe(self, p):
+        if self._stripes is None and self._stripe_timer is not None:
+            self._early_stripes.append(p)
+            return
+        if not self._stripes_wanted:
+            p.transport.loseConnection()
+            return
+        self._stripes_wanted -= 1
+        self._stripes.add(p)
+        if not self._stripes_wanted:
+            self._stop_accepting_stripes()
+
+    def _stripe_failed(self, f):
+        # we'll just have fewer streams
+        f.trap(BadHandshake, defer.CancelledError, error.ConnectError)
+
+    def _stop_accepting_stripes(self):
+        self._stripes_wanted = 0
+        if self._stripe_timer is None:
+            return
+        if self._stripe_timer.active():
+            self._stripe_timer.cancel()
+        self._stripe_timer = None
+        self._listener_port.stopListening()
+        self._listener_f._shutdown()
+        early, self._early_stripes = self._early_stripes, []
+        for p in early:
+            p.transport.loseConnection()
+
 class TransitSender(Common):
     is_sender = True
 
@@ -922,6 +1556,107 @@ class TransitReceiver(Common):
     is_sender = False
 
 
+@implementer(interfaces.IPushProducer)
+class BulkFileSender(object):
+    """I send a file to a consumer (usually a transit Connection) in large
+    chunks, each of which becomes a single record.
+
+    Unlike twisted.protocols.basic.FileSender, which waits to be asked for
+    each 16KiB chunk, I'm a streaming producer: I keep writing until the
+    consumer pauses me, so its transport always has the next record queued
+    behind the one it's sending. Before each read I ask the kernel to start
+    reading the chunk after it, so the disk works while we encrypt and send.
+    To let other events through, I return to the reactor after every
+    BURST_SIZE bytes.
+    """
+    BURST_SIZE = 2**22
+
+    def __init__(self, chunk_size=RECORD_SIZE, reactor=reactor):
+        self._chunk_size = chunk_size
+        self._reactor = reactor
+        self._file = None
+        self._consumer = None
+        self._transform = None
+        self._deferred = None
+        self._paused = False
+        self._call = None
+        self._sent = 0
+        self._fd = None
+        self._start = 0
+
+    def beginFileTransfer(self, f, consumer, transform=None):
+        """Start sending the contents of 'f' to 'consumer', passing each
+        chunk through 'transform' (if provided) first. Returns a Deferred
+        that fires with the number of bytes read, once they have all been
+        written to the consumer."""
+        self._file = f
+        self._consumer = consumer
+        self._transform = transform
+        self._fd = _readahead_fd(f)
+        if self._fd is not None:
+            self._start = f.tell()
+        self._deferred = defer.Deferred()
+        consumer.registerProducer(self, True)
+        self._schedule()
+        return self._deferred
+
+    def _schedule(self):
+        if self._call is None and self._file is not None:
+            self._call = self._reactor.callLater(0, self._send)
+
+    def _send(self):
+        self._call = None
+        burst = 0
+        while not self._paused and self._file is not None:
+            if burst >= self.BURST_SIZE:
+                self._schedule()
+                return
+            if self._fd is not None:
+                next_chunk = self._start + self._sent + self._chunk_size
+                os.posix_fadvise(self._fd, next_chunk, self._chunk_size,
+                                 os.POSIX_FADV_WILLNEED)
+            chunk = self._file.read(self._chunk_size)
+            if not chunk:
+                self._finish()
+                return
+            self._sent += len(chunk)
+            burst += len(chunk)
+            if self._transform:
+                chunk = self._transform(chunk)
+            self._consumer.write(chunk)
+
+    def _finish(self):
+        self._file = None
+        self._consumer.unregisterProducer()
+        d, self._deferred = self._deferred, None
+        d.callback(self._sent)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._schedule()
+
+    def stopProducing(self):
+        self._file = None
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if self._deferred:
+            d, self._deferred = self._deferred, None
+            d.errback(Exception("Consumer asked us to stop producing"))
+
+def _readahead_fd(f):
+    # only plain files get readahead: asking a SpooledTemporaryFile for its
+    # fileno() would make it move to disk
+    if not hasattr(os, "posix_fadvise"):
+        return None
+    raw = getattr(f, "raw", f)
+    if not isinstance(raw, io.FileIO):
+        return None
+    return raw.fileno()
+
 # based on twisted.protocols.ftp.FileConsumer, but don't close the filehandle
 # when done, and add a progress function that gets called with the length of
 # each write, and a hasher function that gets called with the data.
@@ -950,6 +1685,113 @@ class FileConsumer:
         assert self._producer
         self._producer = None
 
+@implementer(interfaces.IConsumer)
+class ThreadedFileConsumer(object):
+    """I'm a FileConsumer whose file writes and hasher calls happen in a
+    thread of my own (in order), so the disk and the hash can keep up with
+    a pipelined Connection while the reactor goes on receiving. 'progress'
+    is still called in the reactor thread, once each write is done.
+
+    At most MAX_QUEUED bytes wait for my thread: beyond that, I pause my
+    producer until half of them are written. Call flush() when you're done
+    writing: it stops my thread once it has caught up.
+    """
+    MAX_QUEUED = 2**23
+
+    def __init__(self, f, progress=None, hasher=None, reactor=reactor):
+        self._f = f
+        self._progress = progress
+        self._hasher = hasher
+        self._reactor = reactor
+        self._producer = None
+        self._pool = None
+        self._queued = 0
+        self._paused = False
+        self._failure = None
+        self._flushes = []
+
+    def registerProducer(self, producer, streaming):
+        assert not self._producer
+        self._producer = producer
+        assert streaming
+
+    def write(self, bytes):
+        if self._failure:
+            return
+        if self._pool is None:
+            self._pool = ThreadPool(minthreads=1, maxthreads=1,
+                                    name="wormhole-transit-writer")
+            self._pool.start()
+        self._queued += len(bytes)
+        d = threads.deferToThreadPool(self._reactor, self._pool,
+                                      self._write, bytes)
+        d.addBoth(self._written, len(bytes))
+        if self._queued >= self.MAX_QUEUED and not self._paused:
+            self._paused = True
+            if self._producer:
+                self._producer.pauseProducing()
+
+    def _write(self, bytes):
+        # in my thread
+        if self._failure:
+            return
+        self._f.write(bytes)
+        if self._hasher:
+            self._hasher(bytes)
+
+    def _written(self, res, length):
+        self._queued -= length
+        if isinstance(res, failure.Failure):
+            if not self._failure:
+                self._failure = res
+                if self._producer:
+                    self._producer.stopProducing()
+        elif self._progress:
+            self._progress(length)
+        if self._paused and self._queued <= self.MAX_QUEUED // 2:
+            self._paused = False
+            if self._producer:
+                self._producer.resumeProducing()
+        self._maybe_flushed()
+
+    def unregisterProducer(self):
+        assert self._producer
+        if self._paused:
+            # we might be unregistered before we catch up, and our producer
+            # shouldn't stay paused on our account
+            self._paused = False
+            self._producer.resumeProducing()
+        self._producer = None
+
+    def flush(self):
+        """Return a Deferred that fires when everything written so far has
+        reached the file and the hasher, or errbacks if a write failed."""
+        d = defer.Deferred()
+        self._flushes.append(d)
+        self._maybe_flushed()
+        return d
+
+    def _maybe_flushed(self):
+        if self._queued or not self._flushes:
+            return
+        flushes, self._flushes = self._flushes, []
+        pool, self._pool = self._pool, None
+        d = defer.succeed(None)
+        if pool is not None:
+            # join my thread from the reactor's pool, not the reactor
+            d = threads.deferToThreadPool(self._reactor,
+                                          self._reactor.getThreadPool(),
+                                          pool.stop)
+        d.addCallback(self._flushed, flushes)
+        d.addErrback(log.err, "unable to stop the file writer thread")
+
+    def _flushed(self, _, flushes):
+        for d in flushes:
+            if self._failure:
+                d.errback(self._failure)
+            else:
+                d.callback(None)
+
 # the TransitSender/Receiver.connect() yields a Connection, on which you can
 # do send_record(), but what should the receive API be? set a callback for
 # inbound records? get a Deferred for the next record? The producer/consumer